@@ -0,0 +1,316 @@
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+
+from flow_engine import RollingWindowEngine
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+latency_history_size = 100
+
+
+def trade_doc_columns(trade_docs):
+    """
+    Column arrays (same layout as ColumnarTradeStore.read_range()) from a list of trade documents
+    """
+
+    return {
+        'trade_id': np.fromiter((trade_doc['_id'] for trade_doc in trade_docs), dtype='i8', count=len(trade_docs)),
+        'trade_time': np.fromiter((trade_doc['trade_time'] for trade_doc in trade_docs), dtype='i8', count=len(trade_docs)),
+        'price': np.fromiter((trade_doc['price'] for trade_doc in trade_docs), dtype='f8', count=len(trade_docs)),
+        'quantity': np.fromiter((trade_doc['quantity'] for trade_doc in trade_docs), dtype='f8', count=len(trade_docs)),
+        'side': np.fromiter((1 if trade_doc['side'] == 'buy' else 0 for trade_doc in trade_docs), dtype='i1', count=len(trade_docs))
+    }
+
+
+def shard_worker(shard_index, markets, intervals, retention, store_path, connection):
+    """
+    Long-lived analysis process owning one shard of markets
+
+    Keeps its own RollingWindowEngine between ticks. With a store_path, new trades are read from
+    the ColumnarTradeStore files (memory mapped, so the page cache is shared with the writer);
+    otherwise the parent sends new trades as column arrays with each tick.
+
+    Messages in:  ('tick', now_ms, {market_key: columns}, [full resync market keys], prune_before_ms or None)
+                  ('stop',)
+    Messages out: ('result', shard_index, {market_key: {interval: analyze() return}}, timings)
+    """
+
+    trade_store = None
+
+    if store_path != None:
+        from trade_store import ColumnarTradeStore
+
+        trade_store = ColumnarTradeStore(store_path)
+
+    engine = RollingWindowEngine(retention=retention)
+
+    while True:
+        try:
+            message = connection.recv()
+
+        except (EOFError, KeyboardInterrupt):
+            break
+
+        if message[0] == 'stop':
+            break
+
+        tick_start = time.perf_counter()
+
+        now_ms, pushed_columns, resync_markets, prune_before_ms = message[1:]
+
+        synced_count = 0
+
+        try:
+            for market_key in markets:
+                if trade_store != None:
+                    synced_count += engine.sync_columnar(trade_store, market_key[0], market_key[1], full=(market_key in resync_markets))
+
+                else:
+                    if market_key in resync_markets:
+                        engine.markets.pop(market_key, None)
+
+                    if market_key in pushed_columns:
+                        columns = pushed_columns[market_key]
+
+                        engine.series(market_key[0], market_key[1]).extend(columns['trade_id'], columns['trade_time'], columns['price'],
+                                                                         columns['quantity'], columns['side'] == 1)
+
+                        synced_count += len(columns['trade_id'])
+
+            if prune_before_ms != None:
+                engine.prune(prune_before_ms)
+
+            sync_time = time.perf_counter() - tick_start
+
+            analysis_results = engine.analyze_all(intervals, now_ms=now_ms, markets=markets)
+
+        except Exception as e:
+            logger.exception(e)
+
+            sync_time = time.perf_counter() - tick_start
+
+            analysis_results = {}
+
+        timings = {
+            'sync': sync_time,
+            'analyze': time.perf_counter() - tick_start - sync_time,
+            'synced': synced_count,
+            'held': sum(len(engine.series(market_key[0], market_key[1])) for market_key in markets)
+        }
+
+        connection.send(('result', shard_index, analysis_results, timings))
+
+    connection.close()
+
+
+class ShardedAnalysisPool:
+    """
+    Spread analyze_all() across long-lived worker processes, each owning a shard of markets
+
+    Workers keep their trade arrays between ticks, so each tick only moves new trades. Every tick
+    goes to all shards at once and the merged result has the same shape as analyze_all().
+
+    markets - (exchange, market) keys
+    workers - Number of worker processes (Default: CPU count, at most one per market)
+    store_path - ColumnarTradeStore root path for workers to read trades from (None to push trades from this process)
+
+    Per-shard latency (worker sync/analyze time and round trip) is kept for sizing the pool, see get_stats().
+    """
+
+    def __init__(self, markets, intervals, workers=None, store_path=None, retention=((2 * 86400000) + 3600000)):
+        self.markets = list(markets)
+        self.intervals = list(intervals)
+
+        if workers == None:
+            workers = multiprocessing.cpu_count()
+
+        worker_count = max(min(workers, len(self.markets)), 1)
+
+        self.shards = [self.markets[x::worker_count] for x in range(worker_count)]
+
+        self.shard_lookup = {}
+        for shard_index in range(len(self.shards)):
+            for market_key in self.shards[shard_index]:
+                self.shard_lookup[market_key] = shard_index
+
+        self.store_path = store_path
+        self.retention = retention
+
+        self.processes = []
+        self.connections = []
+
+        self.pending_docs = [{} for shard in self.shards]
+        self.pending_resync = [set() for shard in self.shards]
+        self.pending_prune = None
+
+        self.latency = [{'ticks': 0, 'round_trip': [], 'sync_last': None, 'analyze_last': None, 'synced_last': None, 'held': None}
+                        for shard in self.shards]
+
+    def start(self):
+        # Spawned (not forked) so workers don't inherit the parent's threads, sockets or event loop
+        context = multiprocessing.get_context('spawn')
+
+        for shard_index in range(len(self.shards)):
+            parent_connection, child_connection = context.Pipe()
+
+            process = context.Process(target=shard_worker, args=(shard_index, self.shards[shard_index], self.intervals,
+                                                                 self.retention, self.store_path, child_connection),
+                                      daemon=True)
+            process.start()
+
+            child_connection.close()
+
+            self.processes.append(process)
+            self.connections.append(parent_connection)
+
+        logger.info('Started ' + str(len(self.processes)) + ' analysis workers for ' + str(len(self.markets)) + ' markets.')
+
+    def push(self, trade_docs):
+        """
+        Queue written trade documents for the next tick (ignored when workers read from the columnar store)
+        """
+
+        if self.store_path != None:
+            return
+
+        for trade_doc in trade_docs:
+            market_key = (trade_doc['exchange'], trade_doc['market'])
+
+            if market_key not in self.shard_lookup:
+                continue
+
+            shard_docs = self.pending_docs[self.shard_lookup[market_key]]
+
+            if market_key not in shard_docs:
+                shard_docs[market_key] = []
+
+            shard_docs[market_key].append(trade_doc)
+
+    def resync(self, exchange, market, storage=None):
+        """
+        Replace a market's trades on the next tick (ex. after backfill)
+
+        Columnar store workers reload from the store themselves. Otherwise trades for the whole
+        retention period are read once here from storage and pushed to the owning worker.
+        """
+
+        market_key = (exchange, market)
+
+        if market_key not in self.shard_lookup:
+            return
+
+        shard_index = self.shard_lookup[market_key]
+
+        self.pending_resync[shard_index].add(market_key)
+
+        if self.store_path == None and storage != None:
+            # Later push() calls append to this list before the tick sends it
+            self.pending_docs[shard_index][market_key] = list(storage.trades_since(exchange, market, start_ms=(int(time.time() * 1000) - self.retention)))
+
+    def prune(self, before_ms=None):
+        """
+        Drop trades older than before_ms (Default: retention period) on the next tick
+        """
+
+        if before_ms == None:
+            before_ms = int(time.time() * 1000) - self.retention
+
+        self.pending_prune = before_ms
+
+    def analyze(self, now_ms=None):
+        """
+        Run one tick on every shard. Returns {(exchange, market): {interval: analyze() return}}
+        """
+
+        if now_ms == None:
+            now_ms = int(time.time()) * 1000
+
+        send_times = []
+
+        for shard_index in range(len(self.shards)):
+            pushed_columns = {}
+            for market_key, trade_docs in self.pending_docs[shard_index].items():
+                pushed_columns[market_key] = trade_doc_columns(trade_docs)
+
+            send_times.append(time.perf_counter())
+
+            self.connections[shard_index].send(('tick', now_ms, pushed_columns, self.pending_resync[shard_index], self.pending_prune))
+
+            self.pending_docs[shard_index] = {}
+            self.pending_resync[shard_index] = set()
+
+        self.pending_prune = None
+
+        analysis_results = {}
+
+        for shard_index in range(len(self.shards)):
+            message = self.connections[shard_index].recv()
+
+            shard_latency = self.latency[shard_index]
+
+            shard_latency['ticks'] += 1
+            shard_latency['round_trip'] = (shard_latency['round_trip'] + [time.perf_counter() - send_times[shard_index]])[-latency_history_size:]
+            shard_latency['sync_last'] = message[3]['sync']
+            shard_latency['analyze_last'] = message[3]['analyze']
+            shard_latency['synced_last'] = message[3]['synced']
+            shard_latency['held'] = message[3]['held']
+
+            analysis_results.update(message[2])
+
+        return analysis_results
+
+    def get_stats(self):
+        """
+        Per-shard latency summary. Round trip covers sending the tick, worker sync/analysis and receiving results.
+        """
+
+        pool_stats = []
+
+        for shard_index in range(len(self.shards)):
+            shard_latency = self.latency[shard_index]
+
+            shard_stats = {
+                'shard': shard_index,
+                'markets': len(self.shards[shard_index]),
+                'ticks': shard_latency['ticks'],
+                'held': shard_latency['held'],
+                'synced_last': shard_latency['synced_last'],
+                'sync_last': shard_latency['sync_last'],
+                'analyze_last': shard_latency['analyze_last'],
+                'round_trip_last': None,
+                'round_trip_p50': None,
+                'round_trip_max': None
+            }
+
+            if len(shard_latency['round_trip']) > 0:
+                shard_stats['round_trip_last'] = shard_latency['round_trip'][-1]
+                shard_stats['round_trip_p50'] = float(np.percentile(shard_latency['round_trip'], 50))
+                shard_stats['round_trip_max'] = max(shard_latency['round_trip'])
+
+            pool_stats.append(shard_stats)
+
+        return pool_stats
+
+    def stop(self, timeout=10):
+        for connection in self.connections:
+            try:
+                connection.send(('stop',))
+            except (BrokenPipeError, OSError):
+                pass
+
+        for process in self.processes:
+            process.join(timeout)
+
+            if process.is_alive():
+                process.terminate()
+
+        for connection in self.connections:
+            connection.close()
+
+        self.processes = []
+        self.connections = []
@@ -7,7 +7,9 @@ import sys
 
 import csv
 import numpy as np
-from pymongo import MongoClient
+
+from index_manager import IndexManager
+from storage import MongoStorage, open_storage
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -107,19 +109,13 @@ if __name__ == '__main__':
         config = configparser.ConfigParser()
         config.read(config_path)
 
-        mongo_uri = config['mongodb']['uri']
-
-        if mongo_uri == 'localhost':
-            mongo_uri = None
+        storage = open_storage(config)
 
-        db = MongoClient(mongo_uri)[config['mongodb']['db']]
+        if isinstance(storage, MongoStorage):
+            ensure_indexes_result = IndexManager(storage.db, storage.collections).ensure_indexes(collection_keys=['historical', 'candles'])
 
-        collections = {
-            'data': config['mongodb']['collection_data'],
-            'analysis': config['mongodb']['collection_analysis'],
-            'historical': config['mongodb']['collection_historical'],
-            'candles': config['mongodb']['collection_candles']
-        }
+            if ensure_indexes_result['success'] == False:
+                logger.error('Error while building database indexes.')
 
         available_exchanges = ['binance']#, 'poloniex']
 
@@ -144,7 +140,7 @@ if __name__ == '__main__':
 
         logger.debug('analysis_exchange: ' + analysis_exchange)
 
-        exchange_docs = db[collections['historical']].find({'exchange': analysis_exchange})
+        exchange_docs = storage.historical_range(analysis_exchange)
 
         available_markets = []
 
@@ -185,7 +181,7 @@ if __name__ == '__main__':
             logger.error('Unrecognized selection for confirmation of market selection. Exiting.')
             sys.exit(1)
 
-        analysis_docs = db[collections['historical']].find({'exchange': analysis_exchange, 'market': analysis_market}, sort=[('time', 1)])
+        analysis_docs = storage.historical_range(analysis_exchange, analysis_market)
 
         analysis_data = {
             'x': [],
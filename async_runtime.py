@@ -0,0 +1,462 @@
+import asyncio
+import functools
+import json
+import logging
+import signal
+import time
+
+import websockets
+
+from backfill import LiveMerge, aggtrade_doc
+from binance_endpoints import binance_stream_url
+from trade_writer import observe_batch, trades_dropped, write_queue_depth
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def parse_aggtrade(message):
+    """
+    aggTrade event of a websocket message (single or combined stream), or None for other events
+    """
+
+    payload = json.loads(message)
+
+    # Combined streams wrap each event as {'stream': ..., 'data': {...}}
+    if 'data' in payload:
+        payload = payload['data']
+
+    if payload.get('e') != 'aggTrade':
+        logger.warning('Unknown event type: ' + str(payload.get('e')))
+        return None
+
+    return payload
+
+
+def queue_live_trade(flow_meter, payload, trade_queue, gap_tracker, writer_label, stats):
+    """
+    Record, dedupe and queue one live aggTrade event of flow_meter's market for the writer
+
+    Shared by AsyncRuntime and MarketDaemon shards (one FlowMeter context per market). Claimed
+    trades also go to the market's flow bars and publisher when they are running.
+
+    Returns the queued trade document (None if duplicate or dropped)
+    """
+
+    stats['received'] += 1
+
+    flow_meter.observe_message(payload)
+
+    # Reconnects and lost messages show up as a jump in aggregate ids
+    gap_tracker.observe(payload['s'], int(payload['a']))
+
+    if flow_meter.recorder != None:
+        flow_meter.recorder.record('aggTrade', payload)
+
+    trade_doc = aggtrade_doc(payload, flow_meter.user_exchange, payload['s'],
+                             flow_meter.user_trade_currency, flow_meter.user_quote_currency, doc_type='aggTrade')
+
+    if flow_meter.live_merge.claim_live(trade_doc) == False:
+        stats['duplicates'] += 1
+        return None
+
+    if flow_meter.flow_bars != None:
+        flow_meter.flow_bars.add_trades([trade_doc])
+
+    if flow_meter.publisher != None:
+        flow_meter.publisher.publish('trade', trade_doc['market'], trade_doc)
+
+    try:
+        trade_queue.put_nowait(trade_doc)
+
+    except asyncio.QueueFull:
+        stats['dropped'] += 1
+
+        trades_dropped.labels(writer_label).inc()
+
+        gap_tracker.report_docs([trade_doc], 'dropped')
+
+        logger.warning('Trade queue full. Dropped trade ' + str(trade_doc['_id']) + '.')
+
+        return None
+
+    return trade_doc
+
+
+async def stream_intake(stream_url, handle_message, stats, label):
+    """
+    Keep a websocket connected to stream_url and pass every message to handle_message()
+
+    Reconnects with a delay doubling from 1 to 60 sec (counted in stats['reconnects']).
+
+    label - Connection name for log messages
+    """
+
+    reconnect_delay = 1
+
+    while True:
+        try:
+            async with websockets.connect(stream_url) as websocket:
+                logger.info('Websocket connected for ' + label + '.')
+
+                reconnect_delay = 1
+
+                async for message in websocket:
+                    handle_message(message)
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as e:
+            logger.warning(label + ' websocket error (' + str(e) + ').')
+
+        stats['reconnects'] += 1
+
+        logger.info('Reconnecting ' + label + ' websocket in ' + str(reconnect_delay) + ' sec.')
+
+        await asyncio.sleep(reconnect_delay)
+
+        reconnect_delay = min(reconnect_delay * 2, 60)
+
+
+async def write_trades(storage, batch, writer_label, stats, failure_callback, trade_tape):
+    """
+    Write one trade batch in the default executor and update write stats/metrics, market metadata and the trade tape
+
+    failure_callback - Called with the batch if any trade failed to write (ex. FlowMeter.report_failed_docs)
+
+    Returns insert_trades() result
+    """
+
+    loop = asyncio.get_running_loop()
+
+    flush_start = time.time()
+
+    insert_result = await loop.run_in_executor(None, storage.insert_trades, batch)
+
+    write_errors = 0
+    if insert_result['success'] == False:
+        write_errors = len(batch) - insert_result['result']['inserted'] - insert_result['result']['duplicates']
+
+    observe_batch(writer_label, len(batch), time.time() - flush_start, insert_result['result']['inserted'], write_errors)
+
+    stats['flushes'] += 1
+    stats['inserted'] += insert_result['result']['inserted']
+    stats['write_duplicates'] += insert_result['result']['duplicates']
+
+    if insert_result['success'] == False:
+        stats['write_errors'] += write_errors
+
+        logger.error('Errors while writing ' + writer_label + ' trade batch.')
+
+        failure_callback(batch)
+
+    if insert_result['success'] == True or insert_result['result']['inserted'] > 0:
+        # Trades stored by a partly failed batch count too, refills would only see them as duplicates
+        await loop.run_in_executor(None, storage.record_written, batch, insert_result['result']['inserted'])
+
+        await loop.run_in_executor(None, trade_tape.add_trades, batch)
+
+    return insert_result
+
+
+async def batch_writer(trade_queue, flush, batch_size, flush_interval):
+    """
+    Collect batches of up to batch_size trades (waiting at most flush_interval after the first) and await flush(batch)
+
+    When cancelled, everything still queued (and the batch being collected) is flushed before re-raising.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    batch = []
+
+    try:
+        while True:
+            batch = [await trade_queue.get()]
+
+            flush_deadline = loop.time() + flush_interval
+
+            while len(batch) < batch_size:
+                remaining = flush_deadline - loop.time()
+
+                if remaining <= 0:
+                    break
+
+                try:
+                    batch.append(await asyncio.wait_for(trade_queue.get(), remaining))
+
+                except asyncio.TimeoutError:
+                    break
+
+            flush_batch = batch
+            batch = []
+
+            await flush(flush_batch)
+
+    except asyncio.CancelledError:
+        # Include the batch that was still being collected when cancelled
+        leftover = batch
+        while not trade_queue.empty():
+            leftover.append(trade_queue.get_nowait())
+
+        logger.info('Flushing trade queue. [' + str(len(leftover)) + ' queued]')
+
+        for x in range(0, len(leftover), batch_size):
+            await flush(leftover[x:(x + batch_size)])
+
+        raise
+
+
+class AsyncRuntime:
+    """
+    asyncio runtime for a configured FlowMeter (created with autostart=False)
+
+    Websocket intake, batched writing, backfill and periodic analysis run as tasks on one event
+    loop with explicit queues between them:
+
+        intake --trade_queue--> writer --analysis_queue--> analysis
+
+    Blocking work (storage writes, REST backfill, analysis passes) runs in the loop's default
+    executor, so no task holds up the websocket. Ctrl-C / SIGTERM cancels intake, backfill and
+    analysis, and then lets the writer flush everything still queued before exiting.
+    """
+
+    def __init__(self, flow_meter, stream_url=binance_stream_url, queue_size=None):
+        self.flow_meter = flow_meter
+        self.stream_url = stream_url
+
+        if queue_size == None:
+            queue_size = flow_meter.write_queue_size
+
+        self.queue_size = queue_size
+
+        # Created inside the running loop
+        self.trade_queue = None
+        self.analysis_queue = None
+        self.backfill_done = None
+        self.stop_event = None
+
+        self.backfill_plan = None
+
+        self.stats = {
+            'received': 0,
+            'duplicates': 0,
+            'dropped': 0,
+            'inserted': 0,
+            'write_duplicates': 0,
+            'write_errors': 0,
+            'flushes': 0,
+            'reconnects': 0,
+            'analysis_passes': 0,
+            'analysis_latency_last': None
+        }
+
+    def stream_path(self):
+        return '/ws/' + self.flow_meter.user_market.lower() + '@aggTrade'
+
+    def handle_message(self, message):
+        payload = parse_aggtrade(message)
+
+        if payload != None:
+            queue_live_trade(self.flow_meter, payload, self.trade_queue, self.flow_meter.gap_tracker, 'asyncio', self.stats)
+
+    async def intake(self):
+        await stream_intake(self.stream_url + self.stream_path(), self.handle_message, self.stats,
+                            self.flow_meter.user_exchange.capitalize() + '-' + self.flow_meter.user_market)
+
+    async def flush(self, batch):
+        await write_trades(self.flow_meter.storage, batch, 'asyncio', self.stats, self.flow_meter.report_failed_docs, self.flow_meter.trade_tape)
+
+        self.analysis_queue.put_nowait(batch)
+
+    async def writer(self):
+        await batch_writer(self.trade_queue, self.flush, self.flow_meter.write_batch_size, self.flow_meter.write_flush_interval)
+
+    async def backfill(self):
+        loop = asyncio.get_running_loop()
+
+        try:
+            if self.backfill_plan['populate_start'] == None and self.backfill_plan['trade_id_last'] == None:
+                return
+
+            logger.info('Waiting for first live trade to set backfill end point.')
+
+            wait_start = loop.time()
+            while self.flow_meter.live_merge.first_live_id == None and (loop.time() - wait_start) < self.flow_meter.live_wait:
+                await asyncio.sleep(0.1)
+
+            live_first_id = self.flow_meter.live_merge.first_live_id
+            live_first_time = self.flow_meter.live_merge.first_live_time
+
+            if live_first_id != None:
+                logger.info('Backfilling up to first live trade ' + str(live_first_id) + '.')
+            else:
+                logger.info('No live trade within ' + str(self.flow_meter.live_wait) + ' sec. Backfilling up to current time.')
+
+            await loop.run_in_executor(None, functools.partial(self.flow_meter.populate_to_live, self.backfill_plan,
+                                                               end_id=live_first_id, end_time=live_first_time))
+
+            await loop.run_in_executor(None, self.flow_meter.catch_up_flow_bars)
+
+        except asyncio.CancelledError:
+            if self.flow_meter.backfill != None:
+                # Executor thread keeps running until the backfill notices
+                self.flow_meter.backfill.stop()
+
+            raise
+
+        finally:
+            self.backfill_done.set()
+
+    def refilled_trades(self, loop, market, trade_docs):
+        # Refilled trades go to the engine through the analysis queue like written batches
+        loop.call_soon_threadsafe(self.analysis_queue.put_nowait, trade_docs)
+
+        if self.flow_meter.flow_bars != None:
+            self.flow_meter.flow_bars.add_trades(trade_docs)
+
+    def analysis_tick(self, trade_docs):
+        if self.flow_meter.analysis_engine != None:
+            for trade_doc in trade_docs:
+                self.flow_meter.analysis_engine.add_trade_doc(trade_doc)
+
+        # Engine is fed from the writer queue instead of re-reading storage
+        self.flow_meter.analysis_pass(sync_engine=False)
+
+    def drain_analysis_queue(self):
+        trade_docs = []
+
+        while not self.analysis_queue.empty():
+            trade_docs.extend(self.analysis_queue.get_nowait())
+
+        return trade_docs
+
+    async def analysis(self):
+        loop = asyncio.get_running_loop()
+
+        await loop.run_in_executor(None, self.flow_meter.prepare_analysis)
+
+        await self.backfill_done.wait()
+
+        logger.info('Database ready for analysis.')
+
+        cleanup_last = 0
+
+        while True:
+            tick_start = loop.time()
+
+            if (time.time() - cleanup_last) > self.flow_meter.cleanup_interval:
+                # Written batches queued so far are covered by the full engine reload in cleanup_pass()
+                self.drain_analysis_queue()
+
+                if await loop.run_in_executor(None, self.flow_meter.cleanup_pass) == True:
+                    cleanup_last = time.time()
+
+            await loop.run_in_executor(None, self.analysis_tick, self.drain_analysis_queue())
+
+            self.stats['analysis_passes'] += 1
+            self.stats['analysis_latency_last'] = loop.time() - tick_start
+
+            logger.debug('Runtime stats: ' + str(self.get_stats()))
+
+            await asyncio.sleep(max(self.flow_meter.loop_time - (loop.time() - tick_start), 0))
+
+    def get_stats(self):
+        runtime_stats = self.stats.copy()
+
+        runtime_stats['trade_queue_depth'] = self.trade_queue.qsize() if self.trade_queue != None else None
+        runtime_stats['analysis_queue_depth'] = self.analysis_queue.qsize() if self.analysis_queue != None else None
+
+        return runtime_stats
+
+    def request_stop(self):
+        if not self.stop_event.is_set():
+            logger.info('Exit signal received.')
+
+            self.stop_event.set()
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+
+        self.trade_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.analysis_queue = asyncio.Queue()
+        self.backfill_done = asyncio.Event()
+        self.stop_event = asyncio.Event()
+
+        write_queue_depth.labels('asyncio').set_function(self.trade_queue.qsize)
+        write_queue_depth.labels('asyncio_analysis').set_function(self.analysis_queue.qsize)
+
+        self.flow_meter.start_flow_bars()
+
+        self.flow_meter.start_gap_refill(callback=functools.partial(self.refilled_trades, loop))
+
+        for signal_number in [signal.SIGINT, signal.SIGTERM]:
+            try:
+                loop.add_signal_handler(signal_number, self.request_stop)
+            except (NotImplementedError, RuntimeError):
+                # Not available on this platform or outside the main thread, KeyboardInterrupt still applies
+                pass
+
+        intake_task = asyncio.create_task(self.intake())
+        writer_task = asyncio.create_task(self.writer())
+        backfill_task = asyncio.create_task(self.backfill())
+        analysis_task = asyncio.create_task(self.analysis())
+        stop_task = asyncio.create_task(self.stop_event.wait())
+
+        done, pending = await asyncio.wait([intake_task, writer_task, analysis_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+
+        for task in done:
+            if task is not stop_task and task.exception() != None:
+                logger.error('Runtime task failed: ' + repr(task.exception()))
+
+        ## Shut down producers first so the writer can drain everything they queued ##
+        for task in [intake_task, backfill_task, analysis_task, stop_task]:
+            task.cancel()
+
+        await asyncio.gather(intake_task, backfill_task, analysis_task, stop_task, return_exceptions=True)
+
+        writer_task.cancel()
+
+        await asyncio.gather(writer_task, return_exceptions=True)
+
+        if self.flow_meter.gap_refill != None:
+            self.flow_meter.gap_refill.stop()
+
+        if self.flow_meter.flow_bars != None:
+            self.flow_meter.flow_bars.stop()
+
+        if self.flow_meter.publisher != None:
+            self.flow_meter.publisher.stop()
+
+        logger.info('Runtime final stats: ' + str(self.get_stats()))
+
+        if self.flow_meter.recorder != None:
+            self.flow_meter.recorder.close()
+
+    def run(self):
+        """
+        Select market, plan backfill and run until stopped
+        """
+
+        self.flow_meter.select_market()
+
+        self.flow_meter.verify_indexes()
+
+        self.flow_meter.open_recorder()
+
+        self.flow_meter.open_publisher()
+
+        self.backfill_plan = self.flow_meter.plan_backfill()
+
+        # Backfill stops at the first live trade, and both sides claim ids here before writing
+        self.flow_meter.live_merge = LiveMerge()
+
+        try:
+            asyncio.run(self.main())
+
+        except KeyboardInterrupt:
+            logger.info('Exit signal received.')
+
+        logger.debug('Exiting run().')
@@ -0,0 +1,739 @@
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from binance.exceptions import BinanceAPIException
+import requests
+
+from id_ranges import IdRangeSet
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+class BackfillStopped(Exception):
+    pass
+
+
+# Binance only accepts startTime/endTime aggTrades queries spanning at most 1 hour
+max_chunk_ms = 60 * 60 * 1000
+
+
+def aggtrade_doc(trade, exchange, market, trade_currency=None, quote_currency=None, doc_type='populate'):
+    """
+    Trade document from a REST or websocket aggTrade message
+    """
+
+    trade_doc = {}
+
+    trade_doc['_id'] = int(trade['a'])      # Aggregate Trade ID
+    trade_doc['type'] = doc_type
+    trade_doc['exchange'] = exchange
+    trade_doc['market'] = market
+    trade_doc['trade_currency'] = trade_currency
+    trade_doc['quote_currency'] = quote_currency
+    trade_doc['price'] = float(trade['p'])
+    trade_doc['quantity'] = float(trade['q'])
+    trade_doc['trade_time'] = int(trade['T'])
+    if trade['m'] == True:
+        trade_doc['side'] = 'sell'
+    else:
+        trade_doc['side'] = 'buy'
+
+    return trade_doc
+
+
+def split_time_range(start_ms, end_ms, chunk_ms=max_chunk_ms):
+    """
+    List of [start, end) millisecond chunks covering [start_ms, end_ms)
+    """
+
+    chunks = []
+
+    chunk_start = start_ms
+    while chunk_start < end_ms:
+        chunk_end = min(chunk_start + chunk_ms, end_ms)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+
+    return chunks
+
+
+class WeightLimiter:
+    """
+    Sliding one minute request weight budget shared by all backfill workers
+
+    weight_per_minute should stay well under the account limit (1200/min on Binance) so the
+    live websocket session and other REST calls keep some headroom.
+    """
+
+    def __init__(self, weight_per_minute=600):
+        if weight_per_minute <= 0:
+            raise ValueError('Request weight per minute must be positive, got ' + str(weight_per_minute) + '.')
+
+        self.weight_per_minute = weight_per_minute
+
+        self.lock = threading.Lock()
+
+        # (request time, weight) for requests made in the last minute
+        self.requests = collections.deque()
+
+        self.paused_until = 0
+
+    def acquire(self, weight=1):
+        # A request heavier than the whole budget could never be admitted
+        if weight > self.weight_per_minute:
+            raise ValueError('Request weight ' + str(weight) + ' exceeds the ' + str(self.weight_per_minute) + ' per minute budget.')
+
+        while True:
+            with self.lock:
+                now = time.time()
+
+                while len(self.requests) > 0 and (now - self.requests[0][0]) >= 60:
+                    self.requests.popleft()
+
+                used = sum(request[1] for request in self.requests)
+
+                if now >= self.paused_until and (used + weight) <= self.weight_per_minute:
+                    self.requests.append((now, weight))
+                    return
+
+                if now < self.paused_until:
+                    wait_time = self.paused_until - now
+                else:
+                    wait_time = 60 - (now - self.requests[0][0])
+
+            time.sleep(max(wait_time, 0.05))
+
+    def pause(self, seconds):
+        """
+        Hold every worker (ex. after HTTP 429 with Retry-After)
+        """
+
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+
+class LiveMerge:
+    """
+    Joins backfill and live websocket ingest for one market
+
+    The first live aggregate id marks where backfill stops, and every id written during the
+    session is claimed in an IdRangeSet. A trade is written by whichever side claims it first,
+    so overlap never reaches storage as a duplicate key error.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.claimed = IdRangeSet()
+
+        self.first_live_id = None
+        self.first_live_time = None
+        self.first_live_event = threading.Event()
+
+        self.duplicates = 0
+
+    def claim(self, trade_id):
+        """
+        Returns False if trade_id was already written this session
+        """
+
+        with self.lock:
+            claimed = self.claimed.add(trade_id)
+
+            if claimed == False:
+                self.duplicates += 1
+
+        return claimed
+
+    def claim_live(self, trade_doc):
+        if self.first_live_id == None:
+            with self.lock:
+                if self.first_live_id == None:
+                    self.first_live_id = trade_doc['_id']
+                    self.first_live_time = trade_doc['trade_time']
+
+            self.first_live_event.set()
+
+        return self.claim(trade_doc['_id'])
+
+    def wait_first_live(self, timeout=None):
+        """
+        Block until the first live trade arrives. Returns its aggregate id, or None on timeout.
+        """
+
+        self.first_live_event.wait(timeout)
+
+        return self.first_live_id
+
+
+class BackfillProgress:
+    """
+    Backfill progress measured as time covered against the target range
+
+    callback - Called with snapshot() after every update (ex. GUI progress bar)
+    log_interval - Minimum time (seconds) between progress log messages
+    """
+
+    def __init__(self, start_ms, end_ms, callback=None, log_interval=5):
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+
+        self.callback = callback
+        self.log_interval = log_interval
+
+        self.lock = threading.Lock()
+
+        self.covered_ms = 0
+        self.trade_count = 0
+
+        self.time_start = time.time()
+        self.log_last = 0
+
+    def set_covered(self, trade_time, trade_count):
+        """
+        Sequential fill has reached trade_time
+        """
+
+        with self.lock:
+            self.covered_ms = max(self.covered_ms, min(trade_time, self.end_ms) - self.start_ms)
+            self.trade_count += trade_count
+
+        self.report()
+
+    def add_covered(self, span_ms, trade_count):
+        """
+        Chunk spanning span_ms finished (chunks complete out of order)
+        """
+
+        with self.lock:
+            self.covered_ms += span_ms
+            self.trade_count += trade_count
+
+        self.report()
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.time_start
+
+            total_ms = max(self.end_ms - self.start_ms, 1)
+            covered_ms = min(self.covered_ms, total_ms)
+
+            progress_snapshot = {
+                'start': self.start_ms,
+                'end': self.end_ms,
+                'covered_ms': covered_ms,
+                'fraction': covered_ms / total_ms,
+                'trades': self.trade_count,
+                'elapsed': elapsed,
+                'trades_per_sec': (self.trade_count / elapsed) if elapsed > 0 else None,
+                'eta': None
+            }
+
+        if covered_ms > 0 and elapsed > 0:
+            progress_snapshot['eta'] = (total_ms - covered_ms) / (covered_ms / elapsed)
+
+        return progress_snapshot
+
+    def report(self, force=False):
+        progress_snapshot = self.snapshot()
+
+        if self.callback != None:
+            try:
+                self.callback(progress_snapshot)
+            except Exception as e:
+                logger.exception(e)
+
+        if force == True or (time.time() - self.log_last) >= self.log_interval:
+            self.log_last = time.time()
+
+            logger_message = 'Backfill ' + "{:.2f}".format(progress_snapshot['fraction'] * 100) + '% complete. ['
+            logger_message += str(progress_snapshot['trades']) + ' trades'
+            if progress_snapshot['trades_per_sec'] != None:
+                logger_message += ' @ ' + "{:.0f}".format(progress_snapshot['trades_per_sec']) + '/sec'
+            if progress_snapshot['eta'] != None:
+                logger_message += ', ETA ' + "{:.0f}".format(progress_snapshot['eta']) + ' sec'
+            logger_message += ']'
+
+            logger.info(logger_message)
+
+        return progress_snapshot
+
+
+class ChunkedBackfill:
+    """
+    Parallel historical aggTrade backfill
+
+    The requested time range is split into chunks of at most one hour. Each chunk opens with a
+    startTime/endTime query and continues with fromId paging until the chunk end is passed, so
+    chunks never overlap. Chunks are fetched concurrently by a bounded thread pool, every request
+    passes through a shared WeightLimiter, and each page is written with one storage.insert_trades()
+    call, which skips trades already stored.
+
+    stream() covers the open-ended catch-up after a known aggregate id with a single fromId pass.
+    Every page is fetched once, progress is reported through a BackfillProgress and the range is
+    checkpointed like a chunk.
+
+    With end_id (ex. LiveMerge.first_live_id) backfill stops just before that id, and with a
+    LiveMerge every page is filtered through its claimed ids before reaching storage.
+
+    Chunk progress (range, last aggregate id stored, status) is checkpointed in storage, so a
+    restarted run() or resume() only fetches what is missing and coverage_map() shows which
+    ranges are complete.
+    """
+
+    def __init__(self, client, storage, exchange, market, trade_currency=None, quote_currency=None,
+                 workers=4, chunk_minutes=60, weight_per_minute=600, request_weight=1, page_limit=1000, max_retries=5,
+                 progress_callback=None, merge=None, checkpoints=True):
+        self.client = client
+        self.storage = storage
+
+        self.exchange = exchange
+        self.market = market
+        self.trade_currency = trade_currency
+        self.quote_currency = quote_currency
+
+        self.workers = workers
+        self.chunk_ms = min(int(chunk_minutes * 60 * 1000), max_chunk_ms)
+        self.request_weight = request_weight
+        self.page_limit = page_limit
+        self.max_retries = max_retries
+
+        self.limiter = WeightLimiter(weight_per_minute)
+
+        self.progress_callback = progress_callback
+        self.progress = None
+
+        self.merge = merge
+
+        # Persist per-chunk progress through storage.save_checkpoint()
+        self.checkpoints = checkpoints
+
+        self.stop_event = threading.Event()
+
+        # Exclusive aggregate id bound for the current run
+        self.end_id = None
+
+    def stop(self):
+        """
+        Make every worker give up before its next request (interrupted chunks stay resumable)
+        """
+
+        self.stop_event.set()
+
+    def request_trades(self, **params):
+        retry_count = 0
+
+        while True:
+            if self.stop_event.is_set():
+                raise BackfillStopped()
+
+            self.limiter.acquire(self.request_weight)
+
+            try:
+                return self.client.get_aggregate_trades(symbol=self.market, limit=self.page_limit, **params)
+
+            except BinanceAPIException as e:
+                if e.status_code not in [418, 429] or retry_count >= self.max_retries:
+                    raise
+
+                retry_after = int(e.response.headers.get('Retry-After', 2 ** (retry_count + 1)))
+
+                logger.warning('Request weight limit hit. Pausing backfill for ' + str(retry_after) + ' sec.')
+
+                self.limiter.pause(retry_after)
+
+            except requests.exceptions.RequestException as e:
+                if retry_count >= self.max_retries:
+                    raise
+
+                logger.warning('Request error while backfilling (' + str(e) + '). Retrying.')
+
+                time.sleep(2 ** retry_count)
+
+            retry_count += 1
+
+    def page_docs(self, trades, end_ms):
+        """
+        Trade documents for the part of a page before end_ms / end_id
+        """
+
+        trade_docs = []
+
+        for trade in trades:
+            if int(trade['T']) >= end_ms or (self.end_id != None and int(trade['a']) >= self.end_id):
+                break
+
+            trade_docs.append(aggtrade_doc(trade, self.exchange, self.market, self.trade_currency, self.quote_currency))
+
+        return trade_docs
+
+    def insert_page(self, trade_docs):
+        claimed_docs = trade_docs
+
+        if self.merge != None:
+            claimed_docs = [trade_doc for trade_doc in trade_docs if self.merge.claim(trade_doc['_id']) == True]
+
+        insert_result = {'success': True, 'result': {'inserted': 0, 'duplicates': 0}}
+
+        if len(claimed_docs) > 0:
+            insert_result = self.storage.insert_trades(claimed_docs)
+
+            if insert_result['success'] == False:
+                raise RuntimeError('Storage error while inserting backfill page.')
+
+            self.storage.record_written(claimed_docs, insert_result['result']['inserted'])
+
+        insert_result['result']['duplicates'] += len(trade_docs) - len(claimed_docs)
+
+        return insert_result
+
+    def checkpoint_id(self, chunk_start):
+        return self.exchange + '-' + self.market + '-' + str(chunk_start)
+
+    def save_checkpoint(self, chunk_start, chunk_end, trade_id_last, status):
+        if self.checkpoints == False:
+            return
+
+        checkpoint = {
+            '_id': self.checkpoint_id(chunk_start),
+            'exchange': self.exchange,
+            'market': self.market,
+            'chunk_start': chunk_start,
+            'chunk_end': chunk_end,
+            'trade_id_last': trade_id_last,
+            'status': status,
+            'updated': time.time()
+        }
+
+        try:
+            self.storage.save_checkpoint(checkpoint)
+        except Exception as e:
+            logger.exception(e)
+
+    def fetch_chunk(self, chunk_start, chunk_end, resume_id=None):
+        """
+        Fetch one chunk, checkpointing after each page
+
+        resume_id - Last aggregate id already stored for this chunk (continue with fromId paging)
+        """
+
+        fetch_chunk_return = {'success': True, 'result': {'chunk': (chunk_start, chunk_end), 'pages': 0, 'inserted': 0, 'duplicates': 0,
+                                                          'trade_id_first': None, 'trade_id_last': resume_id}}
+
+        try:
+            self.save_checkpoint(chunk_start, chunk_end, resume_id, 'running')
+
+            if resume_id == None:
+                # endTime is inclusive
+                trades = self.request_trades(startTime=chunk_start, endTime=(chunk_end - 1))
+            else:
+                trades = self.request_trades(fromId=(int(resume_id) + 1))
+
+            while len(trades) > 0:
+                fetch_chunk_return['result']['pages'] += 1
+
+                trade_docs = self.page_docs(trades, chunk_end)
+
+                if len(trade_docs) > 0:
+                    insert_result = self.insert_page(trade_docs)
+
+                    fetch_chunk_return['result']['inserted'] += insert_result['result']['inserted']
+                    fetch_chunk_return['result']['duplicates'] += insert_result['result']['duplicates']
+
+                    if fetch_chunk_return['result']['trade_id_first'] == None:
+                        fetch_chunk_return['result']['trade_id_first'] = trade_docs[0]['_id']
+                    fetch_chunk_return['result']['trade_id_last'] = trade_docs[-1]['_id']
+
+                # Short page or trades past the chunk end (or end_id) mean the chunk is complete
+                if len(trades) < self.page_limit or len(trade_docs) < len(trades):
+                    break
+
+                self.save_checkpoint(chunk_start, chunk_end, fetch_chunk_return['result']['trade_id_last'], 'running')
+
+                trades = self.request_trades(fromId=(int(trades[-1]['a']) + 1))
+
+        except BackfillStopped:
+            fetch_chunk_return['success'] = False
+
+        except Exception as e:
+            logger.exception(e)
+
+            fetch_chunk_return['success'] = False
+
+        finally:
+            if fetch_chunk_return['success'] == True:
+                self.save_checkpoint(chunk_start, chunk_end, fetch_chunk_return['result']['trade_id_last'], 'complete')
+            else:
+                self.save_checkpoint(chunk_start, chunk_end, fetch_chunk_return['result']['trade_id_last'], 'failed')
+
+            if self.progress != None and fetch_chunk_return['success'] == True:
+                self.progress.add_covered(chunk_end - chunk_start, fetch_chunk_return['result']['inserted'] + fetch_chunk_return['result']['duplicates'])
+
+            return fetch_chunk_return
+
+    def run_chunks(self, chunk_jobs, backfill_return):
+        """
+        Fetch (chunk_start, chunk_end, resume_id) jobs on the worker pool
+        """
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            chunk_futures = [executor.submit(self.fetch_chunk, chunk_start, chunk_end, resume_id) for chunk_start, chunk_end, resume_id in chunk_jobs]
+
+            for chunk_future in as_completed(chunk_futures):
+                chunk_result = chunk_future.result()
+
+                backfill_return['result']['inserted'] += chunk_result['result']['inserted']
+                backfill_return['result']['duplicates'] += chunk_result['result']['duplicates']
+
+                if chunk_result['success'] == False:
+                    backfill_return['result']['failed_chunks'].append(chunk_result['result']['chunk'])
+
+        if len(backfill_return['result']['failed_chunks']) > 0:
+            logger.error('Failed to backfill ' + str(len(backfill_return['result']['failed_chunks'])) + ' chunks.')
+
+            backfill_return['success'] = False
+
+    def run(self, start_ms, end_ms=None, end_id=None):
+        """
+        Backfill [start_ms, end_ms) (Default end: now), stopping before aggregate id end_id if given
+
+        Chunks are aligned to the chunk size so their checkpoints line up between runs. Chunks
+        already completed up to the requested end are skipped and partly done chunks continue
+        after their last stored aggregate id.
+        """
+
+        backfill_return = {'success': True, 'result': {'chunks': 0, 'skipped': 0, 'failed_chunks': [], 'inserted': 0, 'duplicates': 0, 'duration': None}}
+
+        backfill_start = time.time()
+
+        try:
+            if end_ms == None:
+                end_ms = int(time.time() * 1000)
+
+            self.end_id = end_id
+
+            aligned_start = int(start_ms) - (int(start_ms) % self.chunk_ms)
+
+            chunks = split_time_range(aligned_start, int(end_ms), self.chunk_ms)
+
+            backfill_return['result']['chunks'] = len(chunks)
+
+            self.progress = BackfillProgress(aligned_start, int(end_ms), callback=self.progress_callback)
+
+            checkpoints = {}
+            if self.checkpoints == True:
+                checkpoints = {checkpoint['chunk_start']: checkpoint for checkpoint in self.storage.load_checkpoints(self.exchange, self.market)}
+
+            chunk_jobs = []
+
+            for chunk_start, chunk_end in chunks:
+                resume_id = None
+
+                if chunk_start in checkpoints:
+                    checkpoint = checkpoints[chunk_start]
+
+                    if checkpoint['status'] == 'complete' and checkpoint['chunk_end'] >= chunk_end:
+                        backfill_return['result']['skipped'] += 1
+
+                        self.progress.add_covered(chunk_end - chunk_start, 0)
+
+                        continue
+
+                    resume_id = checkpoint['trade_id_last']
+
+                # Record every chunk up front so a crash before it starts still leaves it pending
+                self.save_checkpoint(chunk_start, chunk_end, resume_id, 'pending')
+
+                chunk_jobs.append((chunk_start, chunk_end, resume_id))
+
+            logger.info('Backfilling ' + self.exchange.capitalize() + '-' + self.market + ' in ' + str(len(chunk_jobs)) + ' chunks with ' +
+                        str(self.workers) + ' workers. [' + str(backfill_return['result']['skipped']) + ' chunks already complete]')
+
+            self.run_chunks(chunk_jobs, backfill_return)
+
+            self.progress.report(force=True)
+
+        except Exception as e:
+            logger.exception(e)
+
+            backfill_return['success'] = False
+
+        finally:
+            backfill_return['result']['duration'] = time.time() - backfill_start
+
+            return backfill_return
+
+    def resume(self, end_id=None):
+        """
+        Continue every checkpointed chunk that never completed (ex. after a crash), wherever it lies
+        """
+
+        resume_return = {'success': True, 'result': {'chunks': 0, 'skipped': 0, 'failed_chunks': [], 'inserted': 0, 'duplicates': 0, 'duration': None}}
+
+        resume_start = time.time()
+
+        try:
+            if self.checkpoints == False:
+                return resume_return
+
+            self.end_id = end_id
+
+            chunk_jobs = [(checkpoint['chunk_start'], checkpoint['chunk_end'], checkpoint['trade_id_last'])
+                          for checkpoint in self.storage.load_checkpoints(self.exchange, self.market) if checkpoint['status'] != 'complete']
+
+            resume_return['result']['chunks'] = len(chunk_jobs)
+
+            if len(chunk_jobs) > 0:
+                logger.info('Resuming ' + str(len(chunk_jobs)) + ' incomplete backfill chunks for ' + self.exchange.capitalize() + '-' + self.market + '.')
+
+                self.progress = BackfillProgress(0, sum(chunk_end - chunk_start for chunk_start, chunk_end, resume_id in chunk_jobs), callback=self.progress_callback)
+
+                self.run_chunks(chunk_jobs, resume_return)
+
+                self.progress.report(force=True)
+
+        except Exception as e:
+            logger.exception(e)
+
+            resume_return['success'] = False
+
+        finally:
+            resume_return['result']['duration'] = time.time() - resume_start
+
+            return resume_return
+
+    def coverage_map(self):
+        """
+        Checkpointed time ranges merged by status, as [{'start', 'end', 'status', 'chunks'}]
+        """
+
+        coverage = []
+
+        for checkpoint in self.storage.load_checkpoints(self.exchange, self.market):
+            if len(coverage) > 0 and coverage[-1]['status'] == checkpoint['status'] and coverage[-1]['end'] == checkpoint['chunk_start']:
+                coverage[-1]['end'] = checkpoint['chunk_end']
+                coverage[-1]['chunks'] += 1
+            else:
+                coverage.append({'start': checkpoint['chunk_start'], 'end': checkpoint['chunk_end'], 'status': checkpoint['status'], 'chunks': 1})
+
+        return coverage
+
+    def stream(self, trade_id_last, start_ms=None, end_ms=None, end_id=None):
+        """
+        Single pass fill of every trade after trade_id_last up to end_ms (Default: now) and before end_id
+
+        start_ms - Trade time of trade_id_last, used as the progress origin (Default: first fetched trade)
+
+        The range is checkpointed like a chunk from start_ms to end_ms, so an interrupted pass is continued
+        by resume() even after live trades have moved the stored watermark past it.
+        """
+
+        stream_return = {'success': True, 'result': {'pages': 0, 'inserted': 0, 'duplicates': 0, 'trade_id_last': trade_id_last, 'duration': None}}
+
+        stream_start = time.time()
+
+        # Checkpoint chunk start, known once start_ms is
+        chunk_start = None
+
+        try:
+            if end_ms == None:
+                end_ms = int(time.time() * 1000)
+
+            end_ms = int(end_ms)
+
+            self.end_id = end_id
+
+            if end_id != None and end_id <= int(trade_id_last) + 1:
+                logger.info('No trades missing between stored and live data.')
+
+                return stream_return
+
+            if start_ms != None:
+                chunk_start = int(start_ms)
+
+                self.save_checkpoint(chunk_start, end_ms, trade_id_last, 'running')
+
+            trades = self.request_trades(fromId=(int(trade_id_last) + 1))
+
+            if len(trades) > 0:
+                if start_ms == None:
+                    start_ms = int(trades[0]['T'])
+
+                if chunk_start == None:
+                    chunk_start = int(start_ms)
+
+                    self.save_checkpoint(chunk_start, end_ms, trade_id_last, 'running')
+
+                self.progress = BackfillProgress(int(start_ms), end_ms, callback=self.progress_callback)
+
+            while len(trades) > 0:
+                stream_return['result']['pages'] += 1
+
+                trade_docs = self.page_docs(trades, end_ms)
+
+                if len(trade_docs) > 0:
+                    insert_result = self.insert_page(trade_docs)
+
+                    stream_return['result']['inserted'] += insert_result['result']['inserted']
+                    stream_return['result']['duplicates'] += insert_result['result']['duplicates']
+                    stream_return['result']['trade_id_last'] = trade_docs[-1]['_id']
+
+                    self.progress.set_covered(trade_docs[-1]['trade_time'], len(trade_docs))
+
+                if len(trades) < self.page_limit or len(trade_docs) < len(trades):
+                    break
+
+                self.save_checkpoint(chunk_start, end_ms, stream_return['result']['trade_id_last'], 'running')
+
+                trades = self.request_trades(fromId=(int(trades[-1]['a']) + 1))
+
+            if self.progress != None:
+                self.progress.report(force=True)
+
+        except BackfillStopped:
+            logger.info('Backfill stopped.')
+
+            stream_return['success'] = False
+
+        except Exception as e:
+            logger.exception(e)
+
+            stream_return['success'] = False
+
+        finally:
+            if chunk_start != None:
+                if stream_return['success'] == True:
+                    self.save_checkpoint(chunk_start, end_ms, stream_return['result']['trade_id_last'], 'complete')
+                else:
+                    self.save_checkpoint(chunk_start, end_ms, stream_return['result']['trade_id_last'], 'failed')
+
+            stream_return['result']['duration'] = time.time() - stream_start
+
+            return stream_return
+
+
+if __name__ == '__main__':
+    import argparse
+    import configparser
+    import datetime
+
+    from storage import open_storage
+
+    parser = argparse.ArgumentParser(description='Show backfill checkpoint coverage for a market.')
+    parser.add_argument('-e', '--exchange', type=str, default='binance', help='Exchange name. [Default: binance]')
+    parser.add_argument('-m', '--market', type=str, required=True, help='Market (ex. XLMBTC).')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config/config.ini')
+
+    backfill = ChunkedBackfill(None, open_storage(config), args.exchange.lower(), args.market.upper())
+
+    for coverage in backfill.coverage_map():
+        print(datetime.datetime.fromtimestamp(coverage['start'] / 1000).strftime('%Y-%m-%d %H:%M') + ' - ' +
+              datetime.datetime.fromtimestamp(coverage['end'] / 1000).strftime('%Y-%m-%d %H:%M') + '  ' +
+              coverage['status'].upper() + ' (' + str(coverage['chunks']) + ' chunks)')
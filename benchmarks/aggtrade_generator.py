@@ -0,0 +1,104 @@
+import math
+import random
+import time
+
+
+class AggTradeGenerator:
+    """
+    Synthetic Binance aggTrade websocket messages
+
+    Produces the same e/E/s/a/p/q/f/l/T/m/M dictionaries the aggTrade stream delivers (and
+    process_message() parses), with per-market random walk prices, log-normal quantities and
+    consecutive aggregate/breakdown trade ids.
+
+    markets - Number of markets, or list of market names
+    rate - Mean messages per second across all markets (sets T/E spacing and paced replay speed)
+    burstiness - Coefficient of variation of inter-arrival times (0 = evenly spaced, 1 = Poisson, >1 = bursty)
+    buy_ratio - Fraction of trades where the buyer is the taker (m = False)
+    start_ms - Trade time of the first message (Default: now)
+    seed - Random seed for repeatable runs
+    """
+
+    def __init__(self, markets=1, rate=1000, burstiness=1.0, buy_ratio=0.5, start_ms=None, seed=None):
+        if isinstance(markets, int):
+            markets = ['SYN' + str(x) + 'BTC' for x in range(markets)]
+
+        self.markets = list(markets)
+
+        self.rate = rate
+        self.burstiness = burstiness
+        self.buy_ratio = buy_ratio
+
+        self.random = random.Random(seed)
+
+        if start_ms == None:
+            start_ms = int(time.time() * 1000)
+
+        # Arrival clock in fractional ms, message times are truncated like the exchange's
+        self.clock_ms = float(start_ms)
+
+        # Roughly Zipf-like activity so a few markets carry most of the flow
+        weights = [1.0 / (x + 1) for x in range(len(self.markets))]
+        self.market_weights = [weight / sum(weights) for weight in weights]
+
+        self.state = {}
+        for market in self.markets:
+            self.state[market] = {
+                'price': self.random.uniform(0.00001, 0.1),
+                'agg_id': self.random.randint(1000000, 50000000),
+                'trade_id': self.random.randint(10000000, 500000000)
+            }
+
+    def interval_ms(self):
+        mean_ms = 1000.0 / self.rate
+
+        if self.burstiness <= 0:
+            return mean_ms
+
+        # Gamma inter-arrivals keep the mean rate while the coefficient of variation sets burstiness
+        shape = 1.0 / (self.burstiness ** 2)
+
+        return self.random.gammavariate(shape, mean_ms / shape)
+
+    def message(self):
+        self.clock_ms += self.interval_ms()
+
+        market = self.random.choices(self.markets, weights=self.market_weights)[0]
+
+        market_state = self.state[market]
+
+        market_state['price'] *= math.exp(self.random.gauss(0, 0.0005))
+
+        market_state['agg_id'] += 1
+
+        fill_count = 1 + int(self.random.expovariate(0.7))
+
+        first_trade_id = market_state['trade_id'] + 1
+        market_state['trade_id'] += fill_count
+
+        trade_time = int(self.clock_ms)
+
+        return {
+            'e': 'aggTrade',
+            'E': trade_time + self.random.randint(0, 5),
+            's': market,
+            'a': market_state['agg_id'],
+            'p': '{:.8f}'.format(market_state['price']),
+            'q': '{:.8f}'.format(round(self.random.lognormvariate(3.0, 1.5), 2)),
+            'f': first_trade_id,
+            'l': market_state['trade_id'],
+            'T': trade_time,
+            'm': self.random.random() >= self.buy_ratio,
+            'M': True
+        }
+
+    def messages(self, count):
+        for x in range(count):
+            yield self.message()
+
+    def arrival_offset(self, message, start_ms):
+        """
+        Seconds after the first message that this message would arrive (for paced replay)
+        """
+
+        return (message['T'] - start_ms) / 1000
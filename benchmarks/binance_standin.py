@@ -0,0 +1,716 @@
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from http import HTTPStatus
+
+from websockets.asyncio.server import serve
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, repo_path)
+
+from aggtrade_generator import AggTradeGenerator
+from flow_engine import interval_to_ms
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+default_symbols = ['XLMBTC', 'ETHBTC', 'BNBBTC', 'TRXBTC', 'ADABTC', 'LTCBTC', 'XRPBTC', 'EOSBTC']
+
+quote_currencies = ['USDT', 'BTC', 'ETH', 'BNB']
+
+# Matches AggTradeGenerator prices (8 decimals) and quantities (2 decimals)
+symbol_filters = [{'filterType': 'PRICE_FILTER', 'minPrice': '0.00000001', 'maxPrice': '100000.00000000', 'tickSize': '0.00000001'},
+                  {'filterType': 'LOT_SIZE', 'minQty': '0.01000000', 'maxQty': '90000000.00000000', 'stepSize': '0.01000000'}]
+
+error_frame = json.dumps({'e': 'error', 'm': 'Simulated stream error'})
+
+feed_tick = 0.005
+
+
+def split_symbol(symbol):
+    for quote_currency in quote_currencies:
+        if symbol.endswith(quote_currency) and len(symbol) > len(quote_currency):
+            return symbol[:-len(quote_currency)], quote_currency
+
+    return symbol[:-3], symbol[-3:]
+
+
+class SymbolFeed:
+    """
+    Simulated market for one symbol
+
+    Trades come from an AggTradeGenerator (rate/burstiness) stamped with the current time. Klines
+    are built from those trades and the order book is a band of levels around the last price
+    that drifts with it, published as depthUpdate diffs with consecutive update ids.
+    """
+
+    def __init__(self, symbol, rate=20, burstiness=1.0, seed=None, history=100000, book_levels=20):
+        self.symbol = symbol
+        self.rate = rate
+        self.history = history
+        self.book_levels = book_levels
+
+        self.random = random.Random(seed)
+
+        self.generator = AggTradeGenerator(markets=[symbol], rate=max(rate, 0.001), burstiness=burstiness, seed=seed)
+
+        # Trade history for REST aggTrades, kept as parallel lists for bisect on id and time
+        self.trades = []
+        self.trade_ids = []
+        self.trade_times = []
+
+        self.klines = {}
+
+        self.bids = {}
+        self.asks = {}
+        self.book_changes = {'b': {}, 'a': {}}
+        self.update_id = self.random.randint(100000000, 900000000)
+        self.update_id_published = self.update_id
+
+        # Book as of the last published diff, so REST snapshots line up exactly with the diff stream
+        self.bids_published = {}
+        self.asks_published = {}
+
+        self.price = self.generator.state[symbol]['price']
+
+        self.paused_until = 0
+
+        self.reprice_book()
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.generator.rate = max(rate, 0.001)
+
+    def due_trades(self, now_ms):
+        """
+        Trades whose generated arrival time has passed
+        """
+
+        if self.rate <= 0 or time.time() < self.paused_until:
+            # Stalled exchange, so don't release a burst of backdated trades afterwards
+            self.generator.clock_ms = float(now_ms)
+            return []
+
+        trades = []
+
+        while self.generator.clock_ms <= now_ms:
+            msg = self.generator.message()
+
+            msg['T'] = now_ms
+            msg['E'] = now_ms
+
+            self.price = float(msg['p'])
+
+            self.trades.append(msg)
+            self.trade_ids.append(msg['a'])
+            self.trade_times.append(msg['T'])
+
+            for interval in self.klines:
+                self.update_kline(interval, msg)
+
+            trades.append(msg)
+
+        if len(self.trades) > (2 * self.history):
+            self.trades = self.trades[-self.history:]
+            self.trade_ids = self.trade_ids[-self.history:]
+            self.trade_times = self.trade_times[-self.history:]
+
+        return trades
+
+    def update_kline(self, interval, msg):
+        interval_ms = interval_to_ms(interval)
+        start_ms = msg['T'] - (msg['T'] % interval_ms)
+
+        kline = self.klines[interval]
+
+        if kline['current'] != None and kline['current']['t'] != start_ms:
+            kline['current']['x'] = True
+            kline['closed'].append(kline['current'])
+            kline['current'] = None
+
+        price = msg['p']
+        quantity = float(msg['q'])
+
+        if kline['current'] == None:
+            kline['current'] = {'t': start_ms, 'T': start_ms + interval_ms - 1, 's': self.symbol, 'i': interval,
+                                'f': msg['a'], 'L': msg['a'], 'o': price, 'c': price, 'h': price, 'l': price,
+                                'v': 0.0, 'n': 0, 'x': False, 'q': 0.0, 'V': 0.0, 'Q': 0.0, 'B': '0'}
+
+        current = kline['current']
+
+        current['L'] = msg['a']
+        current['c'] = price
+        if float(price) > float(current['h']): current['h'] = price
+        if float(price) < float(current['l']): current['l'] = price
+        current['v'] += quantity
+        current['q'] += quantity * float(price)
+        current['n'] += 1
+        if msg['m'] == False:
+            current['V'] += quantity
+            current['Q'] += quantity * float(price)
+
+    def kline_events(self, interval, now_ms):
+        """
+        Closed klines since the last call plus the open one (Binance pushes the open kline periodically)
+        """
+
+        if interval not in self.klines:
+            self.klines[interval] = {'current': None, 'closed': []}
+
+        kline = self.klines[interval]
+
+        events = []
+        for kline_values in kline['closed'] + ([kline['current']] if kline['current'] != None else []):
+            k = kline_values.copy()
+            for key in ['v', 'q', 'V', 'Q']:
+                k[key] = "{:.8f}".format(k[key])
+
+            events.append({'e': 'kline', 'E': now_ms, 's': self.symbol, 'k': k})
+
+        kline['closed'] = []
+
+        return events
+
+    def set_level(self, side, price, quantity):
+        book = self.bids if side == 'b' else self.asks
+
+        if quantity == 0:
+            if price not in book:
+                return
+            del book[price]
+        else:
+            book[price] = quantity
+
+        self.book_changes[side][price] = "{:.8f}".format(quantity)
+
+        self.update_id += 1
+
+    def reprice_book(self):
+        step = self.price * 0.0005
+
+        for side, book, direction in [('b', self.bids, -1), ('a', self.asks, 1)]:
+            # Levels crossing or far from the current price go away
+            for price in list(book.keys()):
+                if (direction == -1 and float(price) >= self.price) or (direction == 1 and float(price) <= self.price) or \
+                        abs(float(price) - self.price) > (step * self.book_levels * 1.5):
+                    self.set_level(side, price, 0)
+
+            for level in range(1, self.book_levels + 1):
+                price = "{:.8f}".format(self.price + (direction * level * step))
+
+                if price not in book or self.random.random() < 0.2:
+                    self.set_level(side, price, round(self.random.lognormvariate(4.0, 1.2), 2))
+
+    def depth_event(self, now_ms):
+        """
+        depthUpdate diff of everything changed since the last event (None if nothing changed)
+        """
+
+        self.reprice_book()
+
+        if self.update_id == self.update_id_published:
+            return None
+
+        event = {'e': 'depthUpdate', 'E': now_ms, 's': self.symbol, 'U': self.update_id_published + 1, 'u': self.update_id,
+                 'b': [[price, quantity] for price, quantity in self.book_changes['b'].items()],
+                 'a': [[price, quantity] for price, quantity in self.book_changes['a'].items()]}
+
+        self.book_changes = {'b': {}, 'a': {}}
+        self.update_id_published = self.update_id
+
+        self.bids_published = dict(self.bids)
+        self.asks_published = dict(self.asks)
+
+        return event
+
+    def snapshot(self, limit=100):
+        return {
+            'lastUpdateId': self.update_id_published,
+            'bids': [[price, "{:.8f}".format(self.bids_published[price])] for price in sorted(self.bids_published, key=float, reverse=True)[:limit]],
+            'asks': [[price, "{:.8f}".format(self.asks_published[price])] for price in sorted(self.asks_published, key=float)[:limit]]
+        }
+
+    def agg_trades(self, from_id=None, start_time=None, end_time=None, limit=500):
+        limit = min(int(limit), 1000)
+
+        if from_id != None:
+            i = bisect.bisect_left(self.trade_ids, int(from_id))
+        elif start_time != None:
+            i = bisect.bisect_left(self.trade_times, int(start_time))
+        else:
+            i = max(len(self.trades) - limit, 0)
+
+        selected = []
+        for trade in self.trades[i:(i + limit)]:
+            if end_time != None and trade['T'] > int(end_time):
+                break
+
+            selected.append({key: trade[key] for key in ['a', 'p', 'q', 'f', 'l', 'T', 'm', 'M']})
+
+        return selected
+
+
+class StreamConnection:
+    """
+    One client websocket with its subscriptions and outgoing frame queue
+    """
+
+    def __init__(self, connection, streams, combined, queue_size):
+        self.connection = connection
+        self.streams = streams
+        self.combined = combined
+
+        self.frame_queue = asyncio.Queue(maxsize=queue_size)
+
+        self.connected = time.time()
+        self.frames_sent = 0
+
+
+class BinanceStandin:
+    """
+    Local stand-in for Binance's websocket streams and the public REST calls flowmeter uses
+
+    Streams (raw /ws/<stream>[/<stream>...] or combined /stream?streams=<stream>/<stream>):
+        <symbol>@aggTrade
+        <symbol>@kline_<interval>
+        <symbol>@depth, <symbol>@depth@100ms    (depthUpdate diffs)
+
+    REST (any /api/v<n>/ prefix): ping, time, exchangeInfo, depth, aggTrades, ticker/price
+
+    Control (plain GET): /standin/stats, /standin/event?action=<action>[&symbol=&rate=&seconds=]
+
+    Scenario (dict or JSON file), all keys optional:
+        rate - Default trades per second per symbol
+        burstiness - Inter-arrival coefficient of variation (see AggTradeGenerator)
+        symbols - {symbol: {'rate': ..., 'burstiness': ...}} (also listed in exchangeInfo)
+        disconnect_every - Drop each connection (no close frame) after this many seconds
+        expiry_seconds - Close each connection cleanly after this many seconds (Binance: 86400)
+        malformed_rate - Fraction of frames truncated into invalid JSON
+        error_rate - Fraction of frames replaced with {'e': 'error', ...}
+        queue_size - Frames buffered per connection before a slow client is disconnected
+        events - [{'at': seconds after start, 'action': disconnect|expire|error|malformed|pause|rate, ...}]
+                 (pause takes 'seconds', rate takes 'rate' and optional 'symbol')
+    """
+
+    def __init__(self, host='127.0.0.1', port=9443, scenario=None, seed=None):
+        self.host = host
+        self.port = port
+
+        self.scenario = scenario if scenario != None else {}
+
+        self.seed = seed
+        self.random = random.Random(seed)
+
+        self.feeds = {}
+        self.connections = set()
+
+        self.stats = {
+            'connections_total': 0,
+            'frames_sent': 0,
+            'frames_malformed': 0,
+            'frames_error': 0,
+            'disconnects_scripted': 0,
+            'disconnects_expiry': 0,
+            'disconnects_slow': 0,
+            'rest_requests': 0,
+            'trades_generated': 0
+        }
+
+        self.started = None
+        self.loop = None
+        self.server = None
+        self.stop_event = None
+
+        for symbol in self.scenario.get('symbols', {}):
+            self.feed(symbol.upper())
+
+    def feed(self, symbol):
+        if symbol not in self.feeds:
+            symbol_scenario = self.scenario.get('symbols', {}).get(symbol, {})
+
+            self.feeds[symbol] = SymbolFeed(symbol, rate=symbol_scenario.get('rate', self.scenario.get('rate', 20)),
+                                            burstiness=symbol_scenario.get('burstiness', self.scenario.get('burstiness', 1.0)),
+                                            seed=self.random.randint(0, 2 ** 31))
+
+        return self.feeds[symbol]
+
+    def parse_streams(self, path):
+        parsed = urllib.parse.urlparse(path)
+
+        if parsed.path.rstrip('/') == '/stream':
+            stream_names = urllib.parse.parse_qs(parsed.query).get('streams', [''])[0].split('/')
+            combined = True
+        elif parsed.path.startswith('/ws/'):
+            stream_names = parsed.path[len('/ws/'):].split('/')
+            combined = False
+        else:
+            return None, False
+
+        streams = []
+        for stream_name in stream_names:
+            if '@' not in stream_name:
+                continue
+
+            symbol, stream_type = stream_name.split('@', 1)
+
+            if stream_type == 'aggTrade':
+                streams.append({'name': stream_name, 'kind': 'aggTrade', 'symbol': symbol.upper()})
+            elif stream_type.startswith('kline_'):
+                streams.append({'name': stream_name, 'kind': 'kline', 'symbol': symbol.upper(), 'interval': stream_type[len('kline_'):]})
+            elif stream_type in ['depth', 'depth@100ms', 'depth@1000ms']:
+                streams.append({'name': stream_name, 'kind': 'depth', 'symbol': symbol.upper(), 'interval_ms': 100 if stream_type == 'depth@100ms' else 1000})
+            else:
+                logger.warning('Unsupported stream: ' + stream_name)
+
+        for stream in streams:
+            self.feed(stream['symbol'])
+
+        return streams, combined
+
+    def json_response(self, connection, body, status=HTTPStatus.OK):
+        response = connection.respond(status, json.dumps(body))
+
+        response.headers['Content-Type'] = 'application/json'
+
+        return response
+
+    def process_request(self, connection, request):
+        parsed = urllib.parse.urlparse(request.path)
+
+        params = {key: values[0] for key, values in urllib.parse.parse_qs(parsed.query).items()}
+
+        path_parts = parsed.path.strip('/').split('/')
+
+        if len(path_parts) >= 3 and path_parts[0] == 'api' and path_parts[1].startswith('v'):
+            self.stats['rest_requests'] += 1
+
+            endpoint = '/'.join(path_parts[2:])
+
+            if endpoint == 'ping':
+                return self.json_response(connection, {})
+
+            elif endpoint == 'time':
+                return self.json_response(connection, {'serverTime': int(time.time() * 1000)})
+
+            elif endpoint == 'exchangeInfo':
+                symbols = sorted(set(default_symbols) | set(self.feeds.keys()))
+
+                return self.json_response(connection, {'timezone': 'UTC', 'serverTime': int(time.time() * 1000), 'rateLimits': [],
+                                                       'symbols': [{'symbol': symbol, 'status': 'TRADING', 'baseAsset': split_symbol(symbol)[0],
+                                                                    'quoteAsset': split_symbol(symbol)[1], 'filters': symbol_filters}
+                                                                   for symbol in symbols if 'symbol' not in params or symbol == params['symbol'].upper()]})
+
+            elif endpoint == 'depth':
+                return self.json_response(connection, self.feed(params['symbol'].upper()).snapshot(int(params.get('limit', 100))))
+
+            elif endpoint == 'aggTrades':
+                return self.json_response(connection, self.feed(params['symbol'].upper()).agg_trades(
+                    from_id=params.get('fromId'), start_time=params.get('startTime'), end_time=params.get('endTime'), limit=params.get('limit', 500)))
+
+            elif endpoint == 'ticker/price':
+                if 'symbol' in params:
+                    return self.json_response(connection, {'symbol': params['symbol'].upper(), 'price': "{:.8f}".format(self.feed(params['symbol'].upper()).price)})
+
+                return self.json_response(connection, [{'symbol': symbol, 'price': "{:.8f}".format(feed.price)} for symbol, feed in self.feeds.items()])
+
+            return self.json_response(connection, {'code': -1000, 'msg': 'Not implemented by stand-in: ' + endpoint}, status=HTTPStatus.NOT_FOUND)
+
+        elif len(path_parts) == 2 and path_parts[0] == 'standin':
+            if path_parts[1] == 'stats':
+                return self.json_response(connection, self.get_stats())
+
+            elif path_parts[1] == 'event':
+                self.apply_event(params)
+
+                return self.json_response(connection, {'applied': params})
+
+        # Anything else continues as a websocket handshake
+        return None
+
+    async def handler(self, connection):
+        streams, combined = self.parse_streams(connection.request.path)
+
+        if streams == None or len(streams) == 0:
+            await connection.close(1008, 'No valid streams')
+            return
+
+        stream_connection = StreamConnection(connection, streams, combined, self.scenario.get('queue_size', 10000))
+
+        self.connections.add(stream_connection)
+
+        self.stats['connections_total'] += 1
+
+        lifetime = None
+        lifetime_action = None
+
+        if self.scenario.get('expiry_seconds') != None:
+            lifetime = self.scenario['expiry_seconds']
+            lifetime_action = 'expire'
+
+        if self.scenario.get('disconnect_every') != None and (lifetime == None or self.scenario['disconnect_every'] < lifetime):
+            lifetime = self.scenario['disconnect_every']
+            lifetime_action = 'disconnect'
+
+        sender_task = asyncio.create_task(self.sender(stream_connection))
+        receiver_task = asyncio.create_task(self.receiver(stream_connection))
+
+        try:
+            done, pending = await asyncio.wait([sender_task, receiver_task], timeout=lifetime, return_when=asyncio.FIRST_COMPLETED)
+
+            if len(done) == 0:
+                await self.end_connection(stream_connection, lifetime_action)
+
+        finally:
+            sender_task.cancel()
+            receiver_task.cancel()
+
+            self.connections.discard(stream_connection)
+
+    async def receiver(self, stream_connection):
+        # Client frames (ex. pongs handled by the library) are ignored, this just notices the close
+        async for message in stream_connection.connection:
+            pass
+
+    async def sender(self, stream_connection):
+        malformed_rate = self.scenario.get('malformed_rate', 0)
+        error_rate = self.scenario.get('error_rate', 0)
+
+        while True:
+            frame = await stream_connection.frame_queue.get()
+
+            if frame == None:
+                # Slow client, Binance drops connections that can't keep up
+                self.stats['disconnects_slow'] += 1
+                stream_connection.connection.transport.abort()
+                return
+
+            if malformed_rate > 0 and self.random.random() < malformed_rate:
+                frame = frame[:len(frame) // 2]
+                self.stats['frames_malformed'] += 1
+
+            elif error_rate > 0 and self.random.random() < error_rate:
+                frame = error_frame
+                self.stats['frames_error'] += 1
+
+            await stream_connection.connection.send(frame)
+
+            stream_connection.frames_sent += 1
+            self.stats['frames_sent'] += 1
+
+    async def end_connection(self, stream_connection, action):
+        if action == 'expire':
+            self.stats['disconnects_expiry'] += 1
+
+            await stream_connection.connection.close(1000, 'Connection expired')
+
+        else:
+            self.stats['disconnects_scripted'] += 1
+
+            # Abrupt drop without a close frame, like a network failure
+            stream_connection.connection.transport.abort()
+
+    def publish(self, stream_name, payload):
+        raw_frame = None
+        combined_frame = None
+
+        for stream_connection in list(self.connections):
+            if not any(stream['name'] == stream_name for stream in stream_connection.streams):
+                continue
+
+            if stream_connection.combined == True:
+                if combined_frame == None:
+                    combined_frame = json.dumps({'stream': stream_name, 'data': payload})
+                frame = combined_frame
+            else:
+                if raw_frame == None:
+                    raw_frame = json.dumps(payload)
+                frame = raw_frame
+
+            try:
+                stream_connection.frame_queue.put_nowait(frame)
+
+            except asyncio.QueueFull:
+                # Leave room for the disconnect marker
+                stream_connection.frame_queue.get_nowait()
+                stream_connection.frame_queue.put_nowait(None)
+
+    def subscribed_streams(self):
+        streams = {}
+
+        for stream_connection in self.connections:
+            for stream in stream_connection.streams:
+                streams[stream['name']] = stream
+
+        return streams
+
+    async def feed_loop(self):
+        kline_last = 0
+        depth_last = {100: 0, 1000: 0}
+
+        while True:
+            now = time.time()
+            now_ms = int(now * 1000)
+
+            streams = self.subscribed_streams()
+
+            for symbol, feed in list(self.feeds.items()):
+                for msg in feed.due_trades(now_ms):
+                    self.stats['trades_generated'] += 1
+
+                    aggtrade_stream = symbol.lower() + '@aggTrade'
+                    if aggtrade_stream in streams:
+                        self.publish(aggtrade_stream, msg)
+
+            for depth_interval in depth_last:
+                if ((now - depth_last[depth_interval]) * 1000) >= depth_interval:
+                    depth_last[depth_interval] = now
+
+                    for stream in streams.values():
+                        if stream['kind'] == 'depth' and stream['interval_ms'] == depth_interval:
+                            depth_event = self.feeds[stream['symbol']].depth_event(now_ms)
+
+                            if depth_event != None:
+                                self.publish(stream['name'], depth_event)
+
+            if (now - kline_last) >= 1:
+                kline_last = now
+
+                for stream in streams.values():
+                    if stream['kind'] == 'kline':
+                        for kline_event in self.feeds[stream['symbol']].kline_events(stream['interval'], now_ms):
+                            self.publish(stream['name'], kline_event)
+
+            await asyncio.sleep(feed_tick)
+
+    def apply_event(self, event):
+        action = event.get('action')
+
+        logger.info('Applying scripted event: ' + str(event))
+
+        if action in ['disconnect', 'expire']:
+            for stream_connection in list(self.connections):
+                if event.get('symbol') == None or any(stream['symbol'] == event['symbol'].upper() for stream in stream_connection.streams):
+                    asyncio.ensure_future(self.end_connection(stream_connection, action))
+
+        elif action in ['error', 'malformed']:
+            for stream_connection in list(self.connections):
+                frame = error_frame if action == 'error' else '{"e": "aggTrade", "s": '
+
+                try:
+                    stream_connection.frame_queue.put_nowait(frame)
+                except asyncio.QueueFull:
+                    pass
+
+        elif action == 'pause':
+            for symbol, feed in self.feeds.items():
+                if event.get('symbol') == None or event['symbol'].upper() == symbol:
+                    feed.paused_until = time.time() + float(event.get('seconds', 5))
+
+        elif action == 'rate':
+            for symbol, feed in self.feeds.items():
+                if event.get('symbol') == None or event['symbol'].upper() == symbol:
+                    feed.set_rate(float(event['rate']))
+
+        else:
+            logger.warning('Unknown scripted event action: ' + str(action))
+
+    async def event_loop(self):
+        for event in sorted(self.scenario.get('events', []), key=lambda event: event['at']):
+            await asyncio.sleep(max(self.started + event['at'] - time.time(), 0))
+
+            self.apply_event(event)
+
+    def get_stats(self):
+        standin_stats = self.stats.copy()
+
+        standin_stats['connections_open'] = len(self.connections)
+        standin_stats['uptime'] = (time.time() - self.started) if self.started != None else None
+        standin_stats['per_connection'] = [{'streams': [stream['name'] for stream in stream_connection.streams],
+                                            'frames_sent': stream_connection.frames_sent,
+                                            'queued': stream_connection.frame_queue.qsize(),
+                                            'age': time.time() - stream_connection.connected} for stream_connection in self.connections]
+
+        return standin_stats
+
+    async def main(self, ready_event=None):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+
+        async with serve(self.handler, self.host, self.port, process_request=self.process_request, max_queue=None) as server:
+            self.server = server
+            self.started = time.time()
+
+            logger.info('Binance stand-in listening on ws://' + self.host + ':' + str(self.port) + ' (REST at http://' + self.host + ':' + str(self.port) + '/api).')
+
+            if ready_event != None:
+                ready_event.set()
+
+            feed_task = asyncio.create_task(self.feed_loop())
+            event_task = asyncio.create_task(self.event_loop())
+
+            await self.stop_event.wait()
+
+            feed_task.cancel()
+            event_task.cancel()
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+
+        except KeyboardInterrupt:
+            logger.info('Exit signal received.')
+
+    def start_thread(self):
+        """
+        Run in a background thread (ex. inside a benchmark). Returns once the server is listening.
+        """
+
+        ready_event = threading.Event()
+
+        thread = threading.Thread(target=asyncio.run, args=(self.main(ready_event),), daemon=True)
+        thread.start()
+
+        ready_event.wait(10)
+
+        return thread
+
+    def stop(self):
+        if self.loop != None and self.stop_event != None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for Binance websocket streams and public REST endpoints.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Listen address. [Default: 127.0.0.1]')
+    parser.add_argument('-p', '--port', type=int, default=9443, help='Listen port (websocket and REST). [Default: 9443]')
+    parser.add_argument('-r', '--rate', type=float, default=None, help='Trades per second per symbol (overrides scenario). [Default: 20]')
+    parser.add_argument('-s', '--scenario', type=str, default=None, help='Scenario JSON file (see BinanceStandin).')
+    parser.add_argument('--disconnect-every', type=float, default=None, help='Drop each connection after this many seconds.')
+    parser.add_argument('--expiry', type=float, default=None, help='Close each connection cleanly after this many seconds (Binance: 86400).')
+    parser.add_argument('--malformed-rate', type=float, default=None, help='Fraction of frames sent as invalid JSON.')
+    parser.add_argument('--error-rate', type=float, default=None, help='Fraction of frames sent as error events.')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed.')
+    args = parser.parse_args()
+
+    scenario = {}
+
+    if args.scenario != None:
+        with open(args.scenario) as scenario_file:
+            scenario = json.load(scenario_file)
+
+    for key, value in [('rate', args.rate), ('disconnect_every', args.disconnect_every), ('expiry_seconds', args.expiry),
+                       ('malformed_rate', args.malformed_rate), ('error_rate', args.error_rate)]:
+        if value != None:
+            scenario[key] = value
+
+    BinanceStandin(host=args.host, port=args.port, scenario=scenario, seed=args.seed).run()
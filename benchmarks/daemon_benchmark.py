@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, repo_path)
+
+from aggtrade_generator import AggTradeGenerator
+from flow_engine import RollingWindowEngine
+from ingest_benchmark import git_commit, results_path
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# FlowMeter.backtest_durations, the intervals MarketDaemon analyzes every tick
+daemon_intervals = ['1m', '5m', '15m', '30m', '1h', '2h', '4h', '6h', '12h', '1d']
+
+retention_ms = (2 * 86400000) + 3600000
+
+
+class IntakeContext:
+    """
+    Per-market context with the attributes queue_live_trade() reads from a FlowMeter
+
+    FlowMeter loads config.ini at import time, so its observe_message() metrics are
+    reproduced here with metrics of the same types.
+    """
+
+    def __init__(self, market, messages_received, receive_lag_seconds):
+        from backfill import LiveMerge
+
+        self.user_exchange = 'binance'
+        self.user_trade_currency = market[:-3]
+        self.user_quote_currency = market[-3:]
+
+        self.live_merge = LiveMerge()
+
+        self.recorder = None
+        self.flow_bars = None
+        self.publisher = None
+
+        self.messages_received = messages_received
+        self.receive_lag_seconds = receive_lag_seconds
+
+    def observe_message(self, msg):
+        self.messages_received.labels(msg['s']).inc()
+        self.receive_lag_seconds.labels(msg['s']).observe(time.time() - (msg['E'] / 1000))
+
+
+def engine_benchmark(markets, trades_per_market, ticks, seed):
+    """
+    Memory held by RollingWindowEngine and analyze_all() time per market for the daemon's intervals
+    """
+
+    now_ms = int(time.time()) * 1000
+
+    # One generator per market so every market's trades are spread evenly over the retention period
+    market_messages = {}
+    for x in range(markets):
+        generator = AggTradeGenerator(markets=['SYN' + str(x) + 'BTC'], rate=trades_per_market / (retention_ms / 1000),
+                                      burstiness=1.0, start_ms=(now_ms - retention_ms), seed=(seed + x))
+
+        messages = []
+        while True:
+            message = generator.message()
+
+            if message['T'] >= now_ms:
+                break
+
+            messages.append(message)
+
+        market_messages['SYN' + str(x) + 'BTC'] = messages
+
+    held_trades = sum(len(messages) for messages in market_messages.values())
+
+    tracemalloc.start()
+
+    memory_start = tracemalloc.get_traced_memory()[0]
+
+    engine = RollingWindowEngine(retention=retention_ms)
+
+    # Same path as MarketDaemon.analysis_tick(): one add_trade_doc() per written trade
+    for market in market_messages:
+        for message in market_messages[market]:
+            engine.add_trade('binance', market, message['a'], message['T'], float(message['p']), float(message['q']),
+                             'sell' if message['m'] else 'buy')
+
+    memory_loaded = tracemalloc.get_traced_memory()[0]
+
+    # First analysis consolidates pending trades into the column and prefix sum arrays
+    engine.analyze_all(daemon_intervals, now_ms=now_ms)
+
+    memory_held, memory_peak = tracemalloc.get_traced_memory()
+
+    tracemalloc.stop()
+
+    tick_times = []
+    for tick in range(ticks):
+        tick_start = time.perf_counter()
+
+        engine.analyze_all(daemon_intervals, now_ms=now_ms)
+
+        tick_times.append(time.perf_counter() - tick_start)
+
+    return {
+        'markets': markets,
+        'trades_per_market': trades_per_market,
+        'intervals': len(daemon_intervals),
+        'bytes_per_market_pending': (memory_loaded - memory_start) / markets,
+        'bytes_per_market_held': (memory_held - memory_start) / markets,
+        'trades_held': held_trades,
+        'bytes_per_trade_held': (memory_held - memory_start) / held_trades,
+        'bytes_per_market_peak': (memory_peak - memory_start) / markets,
+        'analyze_ms_per_market_median': (statistics.median(tick_times) / markets) * 1000,
+        'analyze_ms_per_market_max': (max(tick_times) / markets) * 1000
+    }
+
+
+def intake_benchmark(markets, message_count, seed):
+    """
+    Time per combined stream message to parse, gap check, dedupe and queue (parse_aggtrade() + queue_live_trade())
+    """
+
+    import metrics
+    from async_runtime import parse_aggtrade, queue_live_trade
+    from gap_refill import GapTracker
+
+    generator = AggTradeGenerator(markets=markets, rate=1000, seed=seed)
+
+    messages = [json.dumps({'stream': message['s'].lower() + '@aggTrade', 'data': message}) for message in generator.messages(message_count)]
+
+    messages_received = metrics.counter('daemon_benchmark_messages_total', 'Benchmark messages received.', ['market'])
+    receive_lag_seconds = metrics.histogram('daemon_benchmark_receive_lag_seconds', 'Benchmark receive lag.', ['market'])
+
+    contexts = {market: IntakeContext(market, messages_received, receive_lag_seconds) for market in generator.markets}
+
+    gap_tracker = GapTracker()
+
+    stats = {'received': 0, 'duplicates': 0, 'dropped': 0}
+
+    async def run_intake():
+        trade_queue = asyncio.Queue(maxsize=(message_count + 1))
+
+        intake_start = time.perf_counter()
+
+        for message in messages:
+            payload = parse_aggtrade(message)
+
+            queue_live_trade(contexts[payload['s']], payload, trade_queue, gap_tracker, 'daemon_benchmark', stats)
+
+        return time.perf_counter() - intake_start
+
+    intake_time = asyncio.run(run_intake())
+
+    return {
+        'messages': message_count,
+        'us_per_message': (intake_time / message_count) * 1000000,
+        'queued': stats['received'] - stats['duplicates'] - stats['dropped']
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MarketDaemon per-market memory, analysis and intake cost benchmark.')
+    parser.add_argument('-m', '--markets', type=int, default=50, help='Number of markets. [Default: 50]')
+    parser.add_argument('-n', '--trades', type=int, default=20000, help='Trades held per market. [Default: 20000]')
+    parser.add_argument('--ticks', type=int, default=50, help='Timed analyze_all() ticks. [Default: 50]')
+    parser.add_argument('--messages', type=int, default=200000, help='Messages for the intake benchmark. [Default: 200000]')
+    parser.add_argument('--seed', type=int, default=1, help='Generator random seed. [Default: 1]')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Results file. [Default: benchmarks/results/daemon-<timestamp>.json]')
+    args = parser.parse_args()
+
+    # Thin windows (ex. 1m with no buys) are expected at this trade rate
+    logging.getLogger('flow_engine').setLevel(logging.ERROR)
+
+    benchmark_params = {
+        'markets': args.markets,
+        'trades': args.trades,
+        'ticks': args.ticks,
+        'messages': args.messages,
+        'seed': args.seed
+    }
+
+    benchmark_results = {
+        'engine': engine_benchmark(args.markets, args.trades, args.ticks, args.seed),
+        'intake': intake_benchmark(args.markets, args.messages, args.seed)
+    }
+
+    logger.info('Engine: ' + str(benchmark_results['engine']))
+    logger.info('Intake: ' + str(benchmark_results['intake']))
+
+    benchmark_document = {
+        'benchmark': 'daemon',
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': benchmark_params,
+        'results': benchmark_results
+    }
+
+    output_path = args.output
+    if output_path == None:
+        os.makedirs(results_path, exist_ok=True)
+        output_path = os.path.join(results_path, 'daemon-' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+
+    with open(output_path, 'w') as output_file:
+        json.dump(benchmark_document, output_file, indent=2)
+
+    logger.info('Results written to ' + output_path)
@@ -0,0 +1,301 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, repo_path)
+
+from aggtrade_generator import AggTradeGenerator
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+results_path = os.path.join(repo_path, 'benchmarks', 'results')
+
+
+def open_benchmark_storage(backend, work_path):
+    from storage import ColumnarStorage, EmbeddedStorage
+
+    if backend == 'embedded':
+        return EmbeddedStorage(os.path.join(work_path, 'benchmark.db'))
+
+    elif backend == 'columnar':
+        from trade_store import ColumnarTradeStore
+
+        return ColumnarStorage(ColumnarTradeStore(os.path.join(work_path, 'trades')), EmbeddedStorage(os.path.join(work_path, 'documents.db')))
+
+    elif backend == 'mongo':
+        # Uses the database in config.ini, so point it somewhere disposable
+        import flowmeter
+        from storage import open_mongo_storage
+
+        return open_mongo_storage(flowmeter.config)
+
+    else:
+        raise ValueError('Unrecognized storage backend: ' + backend)
+
+
+def rss_kb():
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * (os.sysconf('SC_PAGE_SIZE') // 1024)
+
+    except (OSError, ValueError):
+        return None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_path, stderr=subprocess.DEVNULL).decode().strip()
+
+    except Exception:
+        return None
+
+
+def latency_summary(latencies):
+    latencies = np.asarray(latencies, dtype='f8')
+
+    latencies = latencies[~np.isnan(latencies)]
+
+    if len(latencies) == 0:
+        return None
+
+    return {
+        'count': int(len(latencies)),
+        'mean_us': float(latencies.mean() * 1e6),
+        'p50_us': float(np.percentile(latencies, 50) * 1e6),
+        'p90_us': float(np.percentile(latencies, 90) * 1e6),
+        'p99_us': float(np.percentile(latencies, 99) * 1e6),
+        'max_us': float(latencies.max() * 1e6)
+    }
+
+
+def run_ingest_benchmark(messages=100000, markets=1, rate=5000, burstiness=1.0, pace=False, backend='embedded', writer='batched',
+                         batch_size=500, flush_interval=1.0, seed=1, trace_memory=False, keep_logging=False):
+    """
+    Feed generated aggTrade messages through FlowMeter.process_message() into a storage backend
+
+    writer - batched (TradeWriter, same as the live websocket path) / direct (one insert_trade() per message)
+    pace - Replay at the generator's rate instead of as fast as possible
+
+    Returns results dictionary (also written to JSON by main)
+    """
+
+    import flowmeter
+    from backfill import LiveMerge
+    from trade_writer import TradeWriter
+
+    if keep_logging == False:
+        # process_message() logs every trade at INFO, which would dominate the measurement
+        flowmeter.logger.setLevel(logging.WARNING)
+
+    generator = AggTradeGenerator(markets=markets, rate=rate, burstiness=burstiness, seed=seed)
+
+    logger.info('Generating ' + str(messages) + ' messages for ' + str(markets) + ' markets.')
+
+    message_list = list(generator.messages(messages))
+
+    message_index = {}
+    for x in range(len(message_list)):
+        message_index[(message_list[x]['s'], message_list[x]['a'])] = x
+
+    work_path = tempfile.mkdtemp(prefix='flowmeter-bench-')
+
+    storage = open_benchmark_storage(backend, work_path)
+
+    submit_times = np.full(len(message_list), np.nan)
+    call_latencies = np.full(len(message_list), np.nan)
+    stored_times = np.full(len(message_list), np.nan)
+
+    ## Record when each trade reaches storage ##
+    storage_insert_trades = storage.insert_trades
+    storage_insert_trade = storage.insert_trade
+
+    def timed_insert_trades(trade_docs):
+        insert_result = storage_insert_trades(trade_docs)
+
+        stored_time = time.perf_counter()
+        for trade_doc in trade_docs:
+            stored_times[message_index[(trade_doc['market'], trade_doc['_id'])]] = stored_time
+
+        return insert_result
+
+    def timed_insert_trade(trade_doc):
+        insert_result = storage_insert_trade(trade_doc)
+
+        stored_times[message_index[(trade_doc['market'], trade_doc['_id'])]] = time.perf_counter()
+
+        return insert_result
+
+    storage.insert_trades = timed_insert_trades
+    storage.insert_trade = timed_insert_trade
+
+    flow_meter = flowmeter.FlowMeter(exchange='binance', market=generator.markets[0], storage=storage, autostart=False,
+                                     write_batch_size=batch_size, write_flush_interval=flush_interval)
+
+    flow_meter.user_trade_currency = generator.markets[0][:-3]
+    flow_meter.user_quote_currency = 'BTC'
+
+    flow_meter.live_merge = LiveMerge()
+
+    if writer == 'batched':
+        flow_meter.trade_writer = TradeWriter(storage, batch_size=batch_size, flush_interval=flush_interval,
+                                              max_queue=flow_meter.write_queue_size, stats_interval=None)
+        flow_meter.trade_writer.start()
+
+    if trace_memory == True:
+        tracemalloc.start()
+
+    rss_start = rss_kb()
+
+    failed_count = 0
+    schedule_lag_max = 0.0
+
+    first_trade_ms = message_list[0]['T']
+
+    logger.info('Running ingest benchmark. [' + backend + ' / ' + writer + (' / paced' if pace == True else ' / max speed') + ']')
+
+    run_start = time.perf_counter()
+
+    for x in range(len(message_list)):
+        if pace == True:
+            scheduled = run_start + generator.arrival_offset(message_list[x], first_trade_ms)
+            wait = scheduled - time.perf_counter()
+
+            if wait > 0:
+                time.sleep(wait)
+            elif -wait > schedule_lag_max:
+                schedule_lag_max = -wait
+
+        call_start = time.perf_counter()
+
+        if flow_meter.process_message(message_list[x]) == False:
+            failed_count += 1
+
+        call_end = time.perf_counter()
+
+        submit_times[x] = call_start
+        call_latencies[x] = call_end - call_start
+
+    intake_end = time.perf_counter()
+
+    if flow_meter.trade_writer != None:
+        flow_meter.trade_writer.stop()
+
+    run_end = time.perf_counter()
+
+    rss_end = rss_kb()
+
+    tracemalloc_peak = None
+    if trace_memory == True:
+        tracemalloc_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    stored_count = int(np.count_nonzero(~np.isnan(stored_times)))
+
+    benchmark_results = {
+        'messages': len(message_list),
+        'failed': failed_count,
+        'stored': stored_count,
+        'intake_seconds': intake_end - run_start,
+        'total_seconds': run_end - run_start,
+        'intake_msgs_per_sec': len(message_list) / (intake_end - run_start),
+        # Sustained rate includes draining the writer, so it can't outrun storage
+        'sustained_msgs_per_sec': stored_count / (run_end - run_start),
+        'schedule_lag_max_sec': schedule_lag_max if pace == True else None,
+        'call_latency': latency_summary(call_latencies),
+        'stored_latency': latency_summary(stored_times - submit_times),
+        'memory': {
+            'rss_start_kb': rss_start,
+            'rss_end_kb': rss_end,
+            'rss_growth_kb': (rss_end - rss_start) if rss_start != None and rss_end != None else None,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'tracemalloc_peak_bytes': tracemalloc_peak
+        }
+    }
+
+    if flow_meter.trade_writer != None:
+        benchmark_results['writer'] = flow_meter.trade_writer.get_stats()
+
+    storage.close()
+
+    shutil.rmtree(work_path, ignore_errors=True)
+
+    return benchmark_results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest throughput benchmark with synthetic aggTrade messages.')
+    parser.add_argument('-n', '--messages', type=int, default=100000, help='Number of messages. [Default: 100000]')
+    parser.add_argument('-m', '--markets', type=int, default=1, help='Number of markets. [Default: 1]')
+    parser.add_argument('-r', '--rate', type=float, default=5000, help='Mean messages per second (message timestamps, and replay speed with --pace). [Default: 5000]')
+    parser.add_argument('-b', '--burstiness', type=float, default=1.0, help='Inter-arrival coefficient of variation (0 = even, 1 = Poisson, >1 = bursty). [Default: 1.0]')
+    parser.add_argument('-s', '--storage', type=str, default='embedded', choices=['embedded', 'columnar', 'mongo'], help='Storage backend (mongo uses config.ini). [Default: embedded]')
+    parser.add_argument('-w', '--writer', type=str, default='batched', choices=['batched', 'direct'], help='Batched TradeWriter or one insert per message. [Default: batched]')
+    parser.add_argument('--batch-size', type=int, default=500, help='Writer batch size. [Default: 500]')
+    parser.add_argument('--flush-interval', type=float, default=1.0, help='Writer flush interval (seconds). [Default: 1.0]')
+    parser.add_argument('--pace', action='store_true', default=False, help='Replay messages at --rate instead of as fast as possible.')
+    parser.add_argument('--seed', type=int, default=1, help='Generator random seed. [Default: 1]')
+    parser.add_argument('--tracemalloc', action='store_true', default=False, help='Record Python allocation peak (slows the run).')
+    parser.add_argument('--keep-logging', action='store_true', default=False, help='Keep per-trade INFO logging from process_message().')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Results file. [Default: benchmarks/results/ingest-<timestamp>.json]')
+    args = parser.parse_args()
+
+    benchmark_params = {
+        'messages': args.messages,
+        'markets': args.markets,
+        'rate': args.rate,
+        'burstiness': args.burstiness,
+        'pace': args.pace,
+        'storage': args.storage,
+        'writer': args.writer,
+        'batch_size': args.batch_size,
+        'flush_interval': args.flush_interval,
+        'seed': args.seed,
+        'tracemalloc': args.tracemalloc,
+        'keep_logging': args.keep_logging
+    }
+
+    benchmark_results = run_ingest_benchmark(messages=args.messages, markets=args.markets, rate=args.rate, burstiness=args.burstiness,
+                                             pace=args.pace, backend=args.storage, writer=args.writer, batch_size=args.batch_size,
+                                             flush_interval=args.flush_interval, seed=args.seed, trace_memory=args.tracemalloc,
+                                             keep_logging=args.keep_logging)
+
+    benchmark_document = {
+        'benchmark': 'ingest',
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': benchmark_params,
+        'results': benchmark_results
+    }
+
+    output_path = args.output
+    if output_path == None:
+        os.makedirs(results_path, exist_ok=True)
+        output_path = os.path.join(results_path, 'ingest-' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+
+    with open(output_path, 'w') as output_file:
+        json.dump(benchmark_document, output_file, indent=2)
+
+    logger.info('Sustained: ' + "{:.0f}".format(benchmark_results['sustained_msgs_per_sec']) + ' msgs/sec, call p50/p99: ' +
+                "{:.1f}".format(benchmark_results['call_latency']['p50_us']) + '/' + "{:.1f}".format(benchmark_results['call_latency']['p99_us']) +
+                ' us, stored p50/p99: ' + "{:.1f}".format(benchmark_results['stored_latency']['p50_us']) + '/' +
+                "{:.1f}".format(benchmark_results['stored_latency']['p99_us']) + ' us.')
+
+    logger.info('Results written to ' + output_path + '.')
@@ -0,0 +1,232 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import bson
+import numpy as np
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, repo_path)
+
+from aggtrade_generator import AggTradeGenerator
+from ingest_benchmark import git_commit, results_path
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# AggTradeGenerator prices have 8 decimals and quantities 2
+generator_scales = ('0.00000001', '0.01000000')
+
+
+def open_schema_storages(backend, work_path):
+    """
+    (full schema storage, compact schema storage, size function) for backend
+    """
+
+    from storage import CompactEmbeddedStorage, CompactMongoStorage, EmbeddedStorage, MongoStorage
+
+    scale_source = lambda exchange, market: generator_scales
+
+    if backend == 'embedded':
+        full_storage = EmbeddedStorage(os.path.join(work_path, 'full.db'))
+        compact_storage = CompactEmbeddedStorage(os.path.join(work_path, 'compact.db'), scale_source=scale_source)
+
+        def storage_size(storage):
+            connection = storage.cursor()
+
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            connection.execute('VACUUM')
+
+            return {'file_bytes': os.path.getsize(storage.path)}
+
+        return full_storage, compact_storage, storage_size
+
+    elif backend == 'mongo':
+        # Uses the database in config.ini with throwaway schema_benchmark* collections
+        import flowmeter
+        from storage import open_mongo_storage
+
+        db = open_mongo_storage(flowmeter.config).db
+
+        full_storage = MongoStorage(db, {'data': 'schema_benchmark_full'})
+        compact_storage = CompactMongoStorage(db, {'data': 'schema_benchmark_compact'}, scale_source=scale_source)
+
+        for collection_name in db.list_collection_names():
+            if collection_name.startswith('schema_benchmark'):
+                db.drop_collection(collection_name)
+
+        # Same indexes as a live data collection (index_manager.py)
+        full_storage.db['schema_benchmark_full'].create_index([('exchange', 1), ('market', 1), ('trade_time', 1)])
+        full_storage.db['schema_benchmark_full'].create_index([('trade_time', 1)])
+
+        def storage_size(storage):
+            size = {'size_bytes': 0, 'storage_bytes': 0, 'index_bytes': 0}
+
+            for collection_name in db.list_collection_names():
+                if collection_name.startswith(storage.collections['data']):
+                    collection_stats = db.command('collStats', collection_name)
+
+                    size['size_bytes'] += collection_stats['size']
+                    size['storage_bytes'] += collection_stats['storageSize']
+                    size['index_bytes'] += collection_stats['totalIndexSize']
+
+            return size
+
+        return full_storage, compact_storage, storage_size
+
+    else:
+        raise ValueError('Unrecognized storage backend: ' + backend)
+
+
+def timed(function, repeats):
+    """
+    Median seconds of repeated calls
+    """
+
+    durations = []
+
+    for x in range(repeats):
+        call_start = time.perf_counter()
+
+        function()
+
+        durations.append(time.perf_counter() - call_start)
+
+    return float(np.median(durations))
+
+
+def run_schema_benchmark(trades=200000, markets=5, rate=50, backend='embedded', batch_size=1000, repeats=20, seed=1):
+    """
+    Write the same generated trades with the full and compact schemas, then compare size and query times
+
+    Trades are spread back from now at rate trades/sec, so the 1h windows queried hold recent trades.
+    """
+
+    from backfill import aggtrade_doc
+
+    generator = AggTradeGenerator(markets=markets, rate=rate, seed=seed, start_ms=int(time.time() * 1000) - int(trades / rate * 1000))
+
+    logger.info('Generating ' + str(trades) + ' trades for ' + str(markets) + ' markets.')
+
+    trade_docs = [aggtrade_doc(message, 'binance', message['s'], message['s'][:-3], 'BTC', doc_type='aggTrade')
+                  for message in generator.messages(trades)]
+
+    # Busiest market (generator activity is Zipf-like)
+    market = generator.markets[0]
+
+    work_path = tempfile.mkdtemp(prefix='flowmeter-schema-')
+
+    full_storage, compact_storage, storage_size = open_schema_storages(backend, work_path)
+
+    now_ms = int(time.time() * 1000)
+
+    benchmark_results = {
+        'bson_bytes_per_trade': {
+            'full': float(np.mean([len(bson.encode(trade_doc)) for trade_doc in trade_docs[:10000]])),
+            'compact': None
+        }
+    }
+
+    for schema, storage in [('full', full_storage), ('compact', compact_storage)]:
+        logger.info('Writing ' + schema + ' schema.')
+
+        insert_start = time.perf_counter()
+
+        for x in range(0, len(trade_docs), batch_size):
+            storage.insert_trades(trade_docs[x:(x + batch_size)])
+
+        insert_seconds = time.perf_counter() - insert_start
+
+        size = storage_size(storage)
+
+        benchmark_results[schema] = {
+            'insert_trades_per_sec': len(trade_docs) / insert_seconds,
+            'size': size,
+            'bytes_per_trade': {key: value / len(trade_docs) for key, value in size.items()},
+            'query_seconds': {
+                'window_aggregates_1h': timed(lambda: storage.window_aggregates('binance', market, now_ms - 3600000), repeats),
+                'analyze_1h': timed(lambda: storage.analyze('binance', market, '1h', now_ms=now_ms), repeats),
+                'trades_since_1h': timed(lambda: list(storage.trades_since('binance', market, start_ms=(now_ms - 3600000))), max(1, repeats // 4)),
+                'latest_trade': timed(lambda: storage.latest_trade('binance', market), repeats)
+            }
+        }
+
+    benchmark_results['bson_bytes_per_trade']['compact'] = float(np.mean([len(bson.encode(compact_storage.market_codec('binance', trade_doc['market']).encode(trade_doc)))
+                                                                          for trade_doc in trade_docs[:10000]]))
+
+    benchmark_results['compact_vs_full'] = {
+        'size': {key: benchmark_results['compact']['size'][key] / benchmark_results['full']['size'][key]
+                 for key in benchmark_results['full']['size'] if benchmark_results['full']['size'][key] > 0},
+        'query_seconds': {key: benchmark_results['compact']['query_seconds'][key] / benchmark_results['full']['query_seconds'][key]
+                          for key in benchmark_results['full']['query_seconds']}
+    }
+
+    if backend == 'mongo':
+        for collection_name in full_storage.db.list_collection_names():
+            if collection_name.startswith('schema_benchmark'):
+                full_storage.db.drop_collection(collection_name)
+
+    full_storage.close()
+    compact_storage.close()
+
+    shutil.rmtree(work_path, ignore_errors=True)
+
+    return benchmark_results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Full vs compact trade schema size and query time benchmark.')
+    parser.add_argument('-n', '--trades', type=int, default=200000, help='Number of trades. [Default: 200000]')
+    parser.add_argument('-m', '--markets', type=int, default=5, help='Number of markets. [Default: 5]')
+    parser.add_argument('-r', '--rate', type=float, default=50, help='Trades per second across all markets (sets the time span). [Default: 50]')
+    parser.add_argument('-s', '--storage', type=str, default='embedded', choices=['embedded', 'mongo'], help='Storage backend (mongo uses config.ini). [Default: embedded]')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Trades per insert_trades() call. [Default: 1000]')
+    parser.add_argument('--repeats', type=int, default=20, help='Calls per timed query. [Default: 20]')
+    parser.add_argument('--seed', type=int, default=1, help='Generator random seed. [Default: 1]')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Results file. [Default: benchmarks/results/schema-<timestamp>.json]')
+    args = parser.parse_args()
+
+    benchmark_params = {
+        'trades': args.trades,
+        'markets': args.markets,
+        'rate': args.rate,
+        'storage': args.storage,
+        'batch_size': args.batch_size,
+        'repeats': args.repeats,
+        'seed': args.seed
+    }
+
+    benchmark_results = run_schema_benchmark(trades=args.trades, markets=args.markets, rate=args.rate, backend=args.storage,
+                                             batch_size=args.batch_size, repeats=args.repeats, seed=args.seed)
+
+    benchmark_document = {
+        'benchmark': 'schema',
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': benchmark_params,
+        'results': benchmark_results
+    }
+
+    output_path = args.output
+    if output_path == None:
+        os.makedirs(results_path, exist_ok=True)
+        output_path = os.path.join(results_path, 'schema-' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+
+    with open(output_path, 'w') as output_file:
+        json.dump(benchmark_document, output_file, indent=2)
+
+    for schema in ['full', 'compact']:
+        logger.info(schema + ': ' + str({key: round(value, 1) for key, value in benchmark_results[schema]['bytes_per_trade'].items()}) + ' bytes/trade, ' +
+                    "{:.0f}".format(benchmark_results['bson_bytes_per_trade'][schema]) + ' BSON bytes/trade, queries ' +
+                    str({key: "{:.2f}".format(value * 1000) + ' ms' for key, value in benchmark_results[schema]['query_seconds'].items()}))
@@ -0,0 +1,298 @@
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+
+import numpy as np
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, repo_path)
+
+from binance_standin import BinanceStandin, default_symbols
+from ingest_benchmark import git_commit, results_path
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class SocketStats:
+    """
+    Per-socket receive counters: throughput, event-to-receive latency, reconnect gaps and missed trade ids
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+        self.messages = 0
+        self.errors = 0
+        self.malformed = 0
+        self.reconnects = 0
+        self.missed_ids = 0
+
+        self.latencies_ms = []
+        self.reconnect_gaps = []
+
+        # symbol -> last aggregate trade id, combined sockets carry several symbols
+        self.agg_id_last = {}
+        self.disconnected_at = None
+
+        self.lock = threading.Lock()
+
+    def disconnected(self):
+        with self.lock:
+            if self.disconnected_at == None:
+                self.disconnected_at = time.time()
+
+    def receive(self, payload):
+        receive_time = time.time()
+
+        with self.lock:
+            if self.disconnected_at != None:
+                self.reconnects += 1
+                self.reconnect_gaps.append(receive_time - self.disconnected_at)
+                self.disconnected_at = None
+
+            if payload == None:
+                self.malformed += 1
+                return
+
+            if 'data' in payload:
+                payload = payload['data']
+
+            if payload.get('e') == 'error':
+                self.errors += 1
+                return
+
+            self.messages += 1
+
+            if 'E' in payload:
+                self.latencies_ms.append((receive_time * 1000) - payload['E'])
+
+            if payload.get('e') == 'aggTrade':
+                agg_id_last = self.agg_id_last.get(payload['s'])
+
+                if agg_id_last != None and payload['a'] > (agg_id_last + 1):
+                    self.missed_ids += payload['a'] - agg_id_last - 1
+
+                self.agg_id_last[payload['s']] = max(payload['a'], agg_id_last) if agg_id_last != None else payload['a']
+
+    def summary(self, duration):
+        latencies = np.asarray(self.latencies_ms, dtype='f8')
+
+        return {
+            'socket': self.name,
+            'messages': self.messages,
+            'msgs_per_sec': self.messages / duration,
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) > 0 else None,
+            'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) > 0 else None,
+            'errors': self.errors,
+            'malformed': self.malformed,
+            'reconnects': self.reconnects,
+            'reconnect_gap_max_sec': max(self.reconnect_gaps) if len(self.reconnect_gaps) > 0 else None,
+            'reconnect_gap_avg_sec': (sum(self.reconnect_gaps) / len(self.reconnect_gaps)) if len(self.reconnect_gaps) > 0 else None,
+            'missed_ids': self.missed_ids
+        }
+
+
+def parse_frame(message):
+    try:
+        return json.loads(message)
+    except ValueError:
+        return None
+
+
+async def websockets_client(url, socket_stats, reconnect_delay):
+    """
+    Same connect/reconnect pattern as AsyncRuntime.intake()
+    """
+
+    import websockets
+
+    while True:
+        try:
+            async with websockets.connect(url, max_size=None) as websocket:
+                async for message in websocket:
+                    socket_stats.receive(parse_frame(message))
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            pass
+
+        socket_stats.disconnected()
+
+        await asyncio.sleep(reconnect_delay)
+
+
+def run_websockets_clients(stream_url, socket_paths, socket_stats, duration, reconnect_delay):
+    async def main():
+        tasks = [asyncio.create_task(websockets_client(stream_url + socket_path, stats, reconnect_delay))
+                 for socket_path, stats in zip(socket_paths, socket_stats)]
+
+        await asyncio.sleep(duration)
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(main())
+
+
+def run_binance_clients(stream_url, socket_paths, socket_stats, duration):
+    """
+    python-binance BinanceSocketManager (Twisted), the socket path used by flowmeter.py and the GUIs
+    """
+
+    from binance.client import Client as BinanceClient
+    from binance.websockets import BinanceClientFactory, BinanceSocketManager
+
+    BinanceSocketManager.STREAM_URL = stream_url + '/'
+    BinanceClient.API_URL = stream_url.replace('ws://', 'http://') + '/api'
+
+    ## Note connection drops so reconnect gaps can be measured (the factory reconnects on its own) ##
+    client_connection_lost = BinanceClientFactory.clientConnectionLost
+
+    def connection_lost(factory, connector, reason):
+        if hasattr(factory.callback, 'socket_stats'):
+            factory.callback.socket_stats.disconnected()
+
+        client_connection_lost(factory, connector, reason)
+
+    BinanceClientFactory.clientConnectionLost = connection_lost
+
+    socket_manager = BinanceSocketManager(BinanceClient('', ''))
+
+    for socket_path, stats in zip(socket_paths, socket_stats):
+        # Malformed frames are dropped inside python-binance, so only parsed payloads arrive here
+        def callback(msg, stats=stats):
+            stats.receive(msg)
+
+        callback.socket_stats = stats
+
+        if socket_path.startswith('/stream?streams='):
+            socket_manager.start_multiplex_socket(socket_path[len('/stream?streams='):].split('/'), callback)
+        else:
+            socket_manager._start_socket(socket_path[len('/ws/'):], callback)
+
+    socket_manager.start()
+
+    time.sleep(duration)
+
+    socket_manager.close()
+
+    # close() leaves the reactor thread running
+    from twisted.internet import reactor
+
+    reactor.callFromThread(reactor.stop)
+
+
+def run_socket_benchmark(sockets=4, streams_per_socket=1, combined=False, stream_kind='aggTrade', rate=100, duration=20,
+                         client='websockets', port=9555, scenario=None, reconnect_delay=1.0, seed=1):
+    scenario = dict(scenario) if scenario != None else {}
+    scenario.setdefault('rate', rate)
+
+    standin = BinanceStandin(port=port, scenario=scenario, seed=seed)
+    standin.start_thread()
+
+    stream_url = 'ws://127.0.0.1:' + str(port)
+
+    socket_paths = []
+    socket_stats = []
+
+    symbol_index = 0
+    for x in range(sockets):
+        stream_names = []
+        for y in range(streams_per_socket):
+            # Separate symbols per socket so every socket sees its own trade id sequence
+            symbol = default_symbols[symbol_index % len(default_symbols)] if symbol_index < len(default_symbols) else 'SYN' + str(symbol_index) + 'BTC'
+            symbol_index += 1
+
+            stream_names.append(symbol.lower() + '@' + stream_kind)
+
+        if combined == True or len(stream_names) > 1:
+            socket_paths.append('/stream?streams=' + '/'.join(stream_names))
+        else:
+            socket_paths.append('/ws/' + stream_names[0])
+
+        socket_stats.append(SocketStats(socket_paths[-1]))
+
+    logger.info('Running ' + str(sockets) + ' ' + client + ' sockets for ' + str(duration) + ' sec at ' + str(scenario['rate']) + ' trades/sec per symbol.')
+
+    if client == 'websockets':
+        run_websockets_clients(stream_url, socket_paths, socket_stats, duration, reconnect_delay)
+    else:
+        run_binance_clients(stream_url, socket_paths, socket_stats, duration)
+
+    standin_stats = standin.get_stats()
+    standin_stats.pop('per_connection')
+
+    standin.stop()
+
+    socket_summaries = [stats.summary(duration) for stats in socket_stats]
+
+    return {
+        'sockets': socket_summaries,
+        'total_msgs_per_sec': sum(summary['msgs_per_sec'] for summary in socket_summaries),
+        'total_reconnects': sum(summary['reconnects'] for summary in socket_summaries),
+        'total_missed_ids': sum(summary['missed_ids'] for summary in socket_summaries),
+        'standin': standin_stats
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-socket throughput and reconnect benchmark against the local Binance stand-in.')
+    parser.add_argument('-n', '--sockets', type=int, default=4, help='Number of client sockets. [Default: 4]')
+    parser.add_argument('--streams', type=int, default=1, help='Streams per socket (more than one uses a combined stream). [Default: 1]')
+    parser.add_argument('--combined', action='store_true', default=False, help='Use /stream?streams= even for one stream.')
+    parser.add_argument('-k', '--kind', type=str, default='aggTrade', choices=['aggTrade', 'kline_1m', 'depth', 'depth@100ms'], help='Stream type. [Default: aggTrade]')
+    parser.add_argument('-r', '--rate', type=float, default=100, help='Trades per second per symbol. [Default: 100]')
+    parser.add_argument('-d', '--duration', type=float, default=20, help='Seconds to run. [Default: 20]')
+    parser.add_argument('-c', '--client', type=str, default='websockets', choices=['websockets', 'binance'], help='websockets (asyncio runtime) or binance (python-binance/Twisted). [Default: websockets]')
+    parser.add_argument('-p', '--port', type=int, default=9555, help='Stand-in port. [Default: 9555]')
+    parser.add_argument('-s', '--scenario', type=str, default=None, help='Stand-in scenario JSON file (disconnects, expiry, malformed/error frames, events).')
+    parser.add_argument('--reconnect-delay', type=float, default=1.0, help='websockets client reconnect delay (seconds). [Default: 1.0]')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Results file. [Default: benchmarks/results/sockets-<timestamp>.json]')
+    args = parser.parse_args()
+
+    scenario = None
+    if args.scenario != None:
+        with open(args.scenario) as scenario_file:
+            scenario = json.load(scenario_file)
+
+    benchmark_results = run_socket_benchmark(sockets=args.sockets, streams_per_socket=args.streams, combined=args.combined, stream_kind=args.kind,
+                                             rate=args.rate, duration=args.duration, client=args.client, port=args.port, scenario=scenario,
+                                             reconnect_delay=args.reconnect_delay)
+
+    benchmark_document = {
+        'benchmark': 'sockets',
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': vars(args),
+        'scenario': scenario,
+        'results': benchmark_results
+    }
+
+    output_path = args.output
+    if output_path == None:
+        os.makedirs(results_path, exist_ok=True)
+        output_path = os.path.join(results_path, 'sockets-' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+
+    with open(output_path, 'w') as output_file:
+        json.dump(benchmark_document, output_file, indent=2)
+
+    logger.info('Total: ' + "{:.0f}".format(benchmark_results['total_msgs_per_sec']) + ' msgs/sec, reconnects: ' +
+                str(benchmark_results['total_reconnects']) + ', missed ids: ' + str(benchmark_results['total_missed_ids']) + '.')
+
+    logger.info('Results written to ' + output_path + '.')
@@ -0,0 +1,41 @@
+import logging
+
+from binance.client import Client as BinanceClient
+from binance.websockets import BinanceSocketManager
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+binance_stream_url = 'wss://stream.binance.com:9443'
+
+
+def apply_endpoint_overrides(config):
+    """
+    Point python-binance (and the asyncio runtimes) at other endpoints when set in config.ini,
+    ex. the local stand-in server in benchmarks/binance_standin.py
+
+    [binance]
+    stream_url = ws://127.0.0.1:9443
+    api_url = http://127.0.0.1:9443/api
+
+    Must run before any BinanceClient is created, since the client pings the API on creation.
+    Returns websocket base URL (no trailing slash) for AsyncRuntime / MarketDaemon.
+    """
+
+    stream_url = binance_stream_url
+
+    if config.has_section('binance'):
+        if config['binance'].get('api_url', None) not in [None, '']:
+            BinanceClient.API_URL = config['binance']['api_url'].rstrip('/')
+
+            logger.info('Using Binance API URL override: ' + BinanceClient.API_URL)
+
+        if config['binance'].get('stream_url', None) not in [None, '']:
+            stream_url = config['binance']['stream_url'].rstrip('/')
+
+            BinanceSocketManager.STREAM_URL = stream_url + '/'
+
+            logger.info('Using Binance stream URL override: ' + stream_url)
+
+    return stream_url
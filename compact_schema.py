@@ -0,0 +1,291 @@
+import argparse
+import configparser
+import json
+import logging
+import sys
+import time
+import urllib.request
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+config_path = 'config/config.ini'
+
+# Binance lists every price and quantity with 8 decimals, so this is lossless when exchangeInfo is unavailable
+default_step = '0.00000001'
+
+# Trade document type <-> compact 'k' code (aggTrade, the common case, is left out of compact documents)
+trade_type_codes = {'aggTrade': 0, 'populate': 1, 'refill': 2}
+trade_type_names = {code: name for name, code in trade_type_codes.items()}
+
+
+def step_decimals(step):
+    """
+    Decimal places of a tick/step size string (ex. '0.00010000' -> 4, '1.00000000' -> 0)
+    """
+
+    if '.' not in step:
+        return 0
+
+    return len(step.rstrip('0').split('.')[1])
+
+
+def binance_symbol_scales(exchange, market):
+    """
+    (price tick, quantity step) strings from the exchangeInfo PRICE_FILTER and LOT_SIZE filters
+    """
+
+    if exchange != 'binance':
+        return default_step, default_step
+
+    from binance.client import Client as BinanceClient
+
+    # API_URL follows any [binance] api_url override applied by apply_endpoint_overrides()
+    with urllib.request.urlopen(BinanceClient.API_URL + '/v3/exchangeInfo?symbol=' + market, timeout=10) as response:
+        exchange_info = json.loads(response.read().decode())
+
+    price_tick = default_step
+    qty_step = default_step
+
+    for symbol_info in exchange_info['symbols']:
+        if symbol_info['symbol'] != market:
+            continue
+
+        for symbol_filter in symbol_info.get('filters', []):
+            if symbol_filter['filterType'] == 'PRICE_FILTER':
+                price_tick = symbol_filter['tickSize']
+            elif symbol_filter['filterType'] == 'LOT_SIZE':
+                qty_step = symbol_filter['stepSize']
+
+    return price_tick, qty_step
+
+
+def market_header(trade_doc, scale_source=None):
+    """
+    Header for a new market built from its first trade document
+
+    scale_source - Function of (exchange, market) returning (price tick, quantity step) strings
+    """
+
+    price_tick = default_step
+    qty_step = default_step
+
+    if scale_source != None:
+        try:
+            price_tick, qty_step = scale_source(trade_doc['exchange'], trade_doc['market'])
+
+        except Exception as e:
+            logger.warning('Failed to get ' + trade_doc['market'] + ' tick/step sizes (' + str(e) + '). Using ' + default_step + '.')
+
+    return {'exchange': trade_doc['exchange'], 'market': trade_doc['market'],
+            'trade_currency': trade_doc.get('trade_currency'), 'quote_currency': trade_doc.get('quote_currency'),
+            'price_tick': price_tick, 'qty_step': qty_step,
+            'price_decimals': step_decimals(price_tick), 'qty_decimals': step_decimals(qty_step),
+            'created': time.time()}
+
+
+class TradeCodec:
+    """
+    Converts trade documents to and from the compact schema of one market
+
+    Compact documents are {'_id': aggregate id, 't': trade time, 'p': price, 'q': quantity, 'b': buy[, 'k': type]}
+    with price and quantity as integers in units of the header's tick/step decimals. Exchange, market
+    and currencies only exist in the header.
+
+    header - Market header (see market_header())
+    """
+
+    def __init__(self, header):
+        self.header = header
+
+        self.price_scale = 10 ** header['price_decimals']
+        self.qty_scale = 10 ** header['qty_decimals']
+
+        # Trades with more precision than the header (ex. tick size reduced after the header was created)
+        self.lossy_count = 0
+
+    def encode(self, trade_doc):
+        price = int(round(trade_doc['price'] * self.price_scale))
+        quantity = int(round(trade_doc['quantity'] * self.qty_scale))
+
+        # Integer / power of ten is correctly rounded, so an exact value always comes back as the same float
+        if price / self.price_scale != trade_doc['price'] or quantity / self.qty_scale != trade_doc['quantity']:
+            if self.lossy_count == 0:
+                logger.warning(self.header['market'] + ' trade ' + str(trade_doc['_id']) + ' has more precision than the header (' +
+                               self.header['price_tick'] + ' / ' + self.header['qty_step'] + '). Rounding.')
+
+            self.lossy_count += 1
+
+        compact_doc = {'_id': trade_doc['_id'], 't': trade_doc['trade_time'], 'p': price, 'q': quantity, 'b': trade_doc['side'] == 'buy'}
+
+        type_code = trade_type_codes.get(trade_doc.get('type'), 0)
+        if type_code != 0:
+            compact_doc['k'] = type_code
+
+        return compact_doc
+
+    def decode(self, compact_doc):
+        return {'_id': compact_doc['_id'],
+                'type': trade_type_names[compact_doc.get('k', 0)],
+                'exchange': self.header['exchange'],
+                'market': self.header['market'],
+                'trade_currency': self.header['trade_currency'],
+                'quote_currency': self.header['quote_currency'],
+                'price': compact_doc['p'] / self.price_scale,
+                'quantity': compact_doc['q'] / self.qty_scale,
+                'trade_time': compact_doc['t'],
+                'side': 'buy' if compact_doc['b'] else 'sell'}
+
+    def decode_projection(self):
+        """
+        Aggregation $project stage turning compact documents back into full trade fields
+        """
+
+        return {'$project': {'_id': 1,
+                             'exchange': {'$literal': self.header['exchange']},
+                             'market': {'$literal': self.header['market']},
+                             'trade_time': '$t',
+                             'side': {'$cond': ['$b', 'buy', 'sell']},
+                             'price': {'$divide': ['$p', self.price_scale]},
+                             'quantity': {'$divide': ['$q', self.qty_scale]}}}
+
+
+def migrate_market(source, target, exchange, market, batch_size=5000):
+    """
+    Copy one market's trades between storage backends with different schemas
+
+    Trades already in target (ex. from an interrupted run, or live trades written after switching
+    schemas) are skipped by insert_trades(), so a migration can be rerun at any time.
+
+    Returns {'success': bool, 'result': {'copied', 'duplicates', 'duration'}}
+    """
+
+    migrate_return = {'success': True, 'result': {'copied': 0, 'duplicates': 0, 'duration': None}}
+
+    migrate_start = time.time()
+
+    try:
+        after_id = None
+
+        while True:
+            trade_docs = list(source.trades_since(exchange, market, after_id=after_id, limit=batch_size))
+
+            if len(trade_docs) == 0:
+                break
+
+            insert_result = target.insert_trades(trade_docs)
+
+            if insert_result['success'] == False:
+                raise RuntimeError('Failed to write ' + market + ' trades after ' + str(after_id) + '.')
+
+            migrate_return['result']['copied'] += insert_result['result']['inserted']
+            migrate_return['result']['duplicates'] += insert_result['result']['duplicates']
+
+            after_id = trade_docs[-1]['_id']
+
+            logger.info(exchange + '-' + market + ': ' + str(migrate_return['result']['copied']) + ' trades copied (through ' + str(after_id) + ').')
+
+        # Market metadata is shared by both schemas, recount from the trades now in target
+        target.refresh_market_meta(exchange, market)
+
+    except Exception as e:
+        logger.exception(e)
+
+        migrate_return['success'] = False
+
+    finally:
+        migrate_return['result']['duration'] = time.time() - migrate_start
+
+        return migrate_return
+
+
+def verify_market(source, target, exchange, market):
+    """
+    Compare count and volume/amount totals of a market in both backends
+    """
+
+    source_totals = source.window_aggregates(exchange, market, 0)
+    target_totals = target.window_aggregates(exchange, market, 0)
+
+    verify_result = {'source': source_totals['all'], 'target': target_totals['all'], 'match': True}
+
+    if source_totals['all'] == None or target_totals['all'] == None:
+        verify_result['match'] = (source_totals['all'] == target_totals['all'])
+
+    else:
+        for key in ['count', 'volume', 'amount']:
+            if abs(source_totals['all'][key] - target_totals['all'][key]) > 1e-9 * max(abs(source_totals['all'][key]), 1):
+                verify_result['match'] = False
+
+    return verify_result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate stored trades between the full, compact and bucket trade schemas.')
+    parser.add_argument('command', type=str, choices=['migrate', 'verify', 'markets'], help='migrate, verify or list markets.')
+    parser.add_argument('-s', '--storage', type=str, default=None, choices=['mongo', 'embedded'], help='Storage backend. [Default: [storage] backend]')
+    parser.add_argument('-e', '--exchange', type=str, default=None, help='Only this exchange.')
+    parser.add_argument('-m', '--market', type=str, default=None, help='Only this market.')
+    parser.add_argument('--from', dest='source_schema', type=str, default='full', choices=['full', 'compact', 'bucket'], help='Source schema. [Default: full]')
+    parser.add_argument('--to', type=str, default='compact', choices=['full', 'compact', 'bucket'], help='Target schema (bucket: mongo only). [Default: compact]')
+    parser.add_argument('-b', '--batch-size', type=int, default=5000, help='Trades per read/write batch. [Default: 5000]')
+    parser.add_argument('--delete-source', action='store_true', default=False, help='Delete each market from the source schema once verified.')
+    args = parser.parse_args()
+
+    from binance_endpoints import apply_endpoint_overrides
+    from storage import open_storage
+
+    config = configparser.ConfigParser()
+    config.read(config_path)
+
+    apply_endpoint_overrides(config)
+
+    if args.source_schema == args.to:
+        logger.error('Source and target schema are both ' + args.to + '.')
+
+        sys.exit(1)
+
+    source = open_storage(config, backend=args.storage, schema=args.source_schema)
+    target = open_storage(config, backend=args.storage, schema=args.to)
+
+    markets = [(exchange, market) for exchange, market in source.trade_markets()
+               if (args.exchange == None or exchange == args.exchange) and (args.market == None or market == args.market)]
+
+    if args.command == 'markets':
+        for exchange, market in markets:
+            print(exchange + '-' + market)
+
+        sys.exit(0)
+
+    failed_markets = []
+
+    for exchange, market in markets:
+        if args.command == 'migrate':
+            migrate_result = migrate_market(source, target, exchange, market, batch_size=args.batch_size)
+
+            logger.info('Migrated ' + exchange + '-' + market + ' to the ' + args.to + ' schema: ' + str(migrate_result['result']['copied']) +
+                        ' copied, ' + str(migrate_result['result']['duplicates']) + ' already present in ' +
+                        "{:.1f}".format(migrate_result['result']['duration']) + ' sec.')
+
+            if migrate_result['success'] == False:
+                failed_markets.append(market)
+                continue
+
+        verify_result = verify_market(source, target, exchange, market)
+
+        logger.info(exchange + '-' + market + ' verification: ' + str(verify_result))
+
+        if verify_result['match'] == False:
+            logger.error(exchange + '-' + market + ' totals differ between schemas.')
+
+            failed_markets.append(market)
+
+        elif args.command == 'migrate' and args.delete_source == True:
+            logger.info('Deleted ' + str(source.delete_market(exchange, market)) + ' ' + exchange + '-' + market + ' trades from the ' +
+                        args.source_schema + ' schema.')
+
+    if len(failed_markets) > 0:
+        logger.error('Failed markets: ' + ', '.join(failed_markets))
+
+        sys.exit(1)
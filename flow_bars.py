@@ -0,0 +1,478 @@
+import logging
+import threading
+import time
+
+from flow_engine import compile_analysis_result, interval_to_ms
+from id_ranges import IdRangeSet
+import metrics
+from storage import market_window_bounds, side_summary
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Finest to coarsest, each resolution a whole multiple of the one before
+bar_resolutions = [('1s', 1000), ('1m', 60000), ('1h', 3600000)]
+
+bar_sides = ['buy', 'sell', 'all']
+
+bar_flush_seconds = metrics.histogram('flowmeter_bar_flush_seconds', 'Time to roll up and write pending flow bars.')
+bar_flush_bars = metrics.counter('flowmeter_bar_writes_total', 'Flow bars written (all resolutions).')
+
+
+def bar_id(exchange, market, resolution, start):
+    return exchange + ':' + market + ':' + resolution + ':' + str(start)
+
+
+def state_id(exchange, market):
+    return exchange + ':' + market + ':state'
+
+
+def new_bar(exchange, market, resolution, resolution_ms, start):
+    bar = {'_id': bar_id(exchange, market, resolution, start),
+           'exchange': exchange,
+           'market': market,
+           'resolution': resolution,
+           'start': start,
+           'end': start + resolution_ms,
+           'open': None, 'high': None, 'low': None, 'close': None,
+           'open_id': None, 'close_id': None,
+           'updated': None}
+
+    for side in bar_sides:
+        bar[side] = {'volume': 0.0, 'amount': 0.0, 'count': 0, 'price_sum': 0.0}
+
+    return bar
+
+
+def fold_trade(bar, trade_doc):
+    """
+    Add one trade document to a bar's sums and open/high/low/close
+    """
+
+    price = trade_doc['price']
+    quantity = trade_doc['quantity']
+
+    for side in [trade_doc['side'], 'all']:
+        bar[side]['volume'] += quantity
+        bar[side]['amount'] += price * quantity
+        bar[side]['count'] += 1
+        bar[side]['price_sum'] += price
+
+    # Open/close follow aggregate ids, so trades can arrive in any order (refills, backfill catch-up)
+    if bar['open_id'] == None or trade_doc['_id'] < bar['open_id']:
+        bar['open'] = price
+        bar['open_id'] = trade_doc['_id']
+
+    if bar['close_id'] == None or trade_doc['_id'] > bar['close_id']:
+        bar['close'] = price
+        bar['close_id'] = trade_doc['_id']
+
+    if bar['high'] == None or price > bar['high']:
+        bar['high'] = price
+
+    if bar['low'] == None or price < bar['low']:
+        bar['low'] = price
+
+
+def merge_bar(bar, other):
+    """
+    Add the trades summarized by other (ex. a finer bar, or new trades of the same bar) to bar
+    """
+
+    if other['all']['count'] == 0:
+        return
+
+    for side in bar_sides:
+        for key in ['volume', 'amount', 'count', 'price_sum']:
+            bar[side][key] += other[side][key]
+
+    if bar['open_id'] == None or other['open_id'] < bar['open_id']:
+        bar['open'] = other['open']
+        bar['open_id'] = other['open_id']
+
+    if bar['close_id'] == None or other['close_id'] > bar['close_id']:
+        bar['close'] = other['close']
+        bar['close_id'] = other['close_id']
+
+    if bar['high'] == None or other['high'] > bar['high']:
+        bar['high'] = other['high']
+
+    if bar['low'] == None or other['low'] < bar['low']:
+        bar['low'] = other['low']
+
+
+def window_bar_ids(exchange, market, start_ms, end_ms):
+    """
+    Ids of the fewest bars exactly covering start_ms <= trade_time < end_ms (both whole seconds)
+
+    Whole hours come from 1h bars and the partial hours at each end from 1m and then 1s bars,
+    so a 1d window needs at most 24 + 2 * 59 + 2 * 59 bars.
+    """
+
+    bar_ids = []
+
+    def cover(start, end, level):
+        resolution, resolution_ms = bar_resolutions[level]
+
+        if level == 0:
+            aligned_start = start
+            aligned_end = end
+        else:
+            aligned_start = -(-start // resolution_ms) * resolution_ms
+            aligned_end = (end // resolution_ms) * resolution_ms
+
+            if aligned_start >= aligned_end:
+                cover(start, end, level - 1)
+                return
+
+            if aligned_start > start:
+                cover(start, aligned_start, level - 1)
+
+        for bar_start in range(aligned_start, aligned_end, resolution_ms):
+            bar_ids.append(bar_id(exchange, market, resolution, bar_start))
+
+        if aligned_end < end:
+            cover(aligned_end, end, level - 1)
+
+    if end_ms > start_ms:
+        cover(start_ms, end_ms, len(bar_resolutions) - 1)
+
+    return bar_ids
+
+
+def bar_window_aggregates(bars, bar_ids):
+    """
+    {'all', 'buy', 'sell'} window aggregates (see TradeStorage.window_aggregates()) from bars by id
+    """
+
+    side_sums = {side: {'volume': 0.0, 'amount': 0.0, 'count': 0, 'price_sum': 0.0} for side in ['buy', 'sell']}
+
+    for window_bar_id in bar_ids:
+        # Seconds/minutes/hours without trades have no bar
+        bar = bars.get(window_bar_id)
+
+        if bar == None:
+            continue
+
+        for side in ['buy', 'sell']:
+            for key in side_sums[side]:
+                side_sums[side][key] += bar[side][key]
+
+    return side_summary(side_sums)
+
+
+def analyze_bars(storage, exchange, market, intervals, now_ms=None):
+    """
+    Same return value as TradeStorage.analyze() for every interval, from one read of stored bars
+
+    Like the storage queries the current window is open ended, so it runs through the 1s bar of the
+    second in progress (trades flushed so far).
+
+    Returns {interval: analyze result}
+    """
+
+    if now_ms == None:
+        now_ms = int(time.time()) * 1000
+
+    # 1s bars are the finest resolution
+    now_ms = (now_ms // 1000) * 1000
+
+    window_ids = {}
+
+    for interval in intervals:
+        analysis_delta, analysis_start, analysis_start_last = market_window_bounds(interval, now_ms)
+
+        window_ids[interval] = (window_bar_ids(exchange, market, analysis_start, now_ms + 1000),
+                                window_bar_ids(exchange, market, analysis_start_last, analysis_start))
+
+    analysis_results = {}
+
+    try:
+        bar_ids = set()
+        for current_ids, last_ids in window_ids.values():
+            bar_ids.update(current_ids)
+            bar_ids.update(last_ids)
+
+        bars = {bar['_id']: bar for bar in storage.load_bars(list(bar_ids))}
+
+        for interval, (current_ids, last_ids) in window_ids.items():
+            window_metrics = {
+                'current': bar_window_aggregates(bars, current_ids),
+                'last': bar_window_aggregates(bars, last_ids)
+            }
+
+            analysis_results[interval] = compile_analysis_result(window_metrics, interval_to_ms(interval))
+
+    except Exception as e:
+        logger.exception(e)
+
+        for interval in intervals:
+            analysis_results[interval] = {'success': False, 'result': None}
+
+    return analysis_results
+
+
+class FlowBars(threading.Thread):
+    """
+    1s, 1m and 1h flow bars maintained from trades as they arrive
+
+    add_trades() folds trades into pending 1s bars (skipping aggregate ids already folded). Every
+    flush_interval seconds the pending 1s bars are rolled up into their 1m bars, those into their
+    1h bars, and every changed bar is written with storage.upsert_bars(). Only the two newest bars
+    of each resolution stay in memory, older ones are read back from storage when late trades
+    (refills, backfill catch-up) change them.
+
+    The folded id ranges of each market are stored with the bars ('<exchange>:<market>:state'), so a
+    restart continues from the last flushed trade instead of counting trades twice.
+
+    Bars hold {'buy', 'sell', 'all'} volume/amount/count/price_sum, open/high/low/close (with the
+    aggregate ids of the open and close trades), start and end (ms).
+    """
+
+    def __init__(self, storage, flush_interval=1.0):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.storage = storage
+        self.flush_interval = flush_interval
+
+        # (exchange, market) -> {1s bar start: bar of trades added since the last flush}
+        self.pending = {}
+
+        # (exchange, market) -> IdRangeSet of folded aggregate ids
+        self.folded = {}
+
+        # (exchange, market) -> highest id folded before this process started (None if no stored state)
+        self.stored_last = {}
+
+        # Latest trade time added per market (sets which bars stay in memory)
+        self.time_last = {}
+
+        # Bar id -> recently written bar
+        self.bars = {}
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+        self.stop_event = threading.Event()
+
+    def market_ranges(self, exchange, market):
+        """
+        Folded id ranges of market, loaded from the stored state on first use
+        """
+
+        if (exchange, market) not in self.folded:
+            stored_state = self.storage.load_bars([state_id(exchange, market)])
+
+            if len(stored_state) > 0:
+                self.folded[(exchange, market)] = IdRangeSet(stored_state[0]['ranges'])
+                self.stored_last[(exchange, market)] = self.folded[(exchange, market)].last()
+            else:
+                self.folded[(exchange, market)] = IdRangeSet()
+                self.stored_last[(exchange, market)] = None
+
+        return self.folded[(exchange, market)]
+
+    def add_trades(self, trade_docs):
+        """
+        Fold trade documents into pending 1s bars. Returns the number of new (not yet folded) trades.
+        """
+
+        added = 0
+
+        with self.lock:
+            for trade_doc in trade_docs:
+                market_key = (trade_doc['exchange'], trade_doc['market'])
+
+                if market_key not in self.folded:
+                    self.market_ranges(trade_doc['exchange'], trade_doc['market'])
+
+                if self.folded[market_key].add(trade_doc['_id']) == False:
+                    continue
+
+                second_start = (trade_doc['trade_time'] // 1000) * 1000
+
+                market_pending = self.pending.setdefault(market_key, {})
+
+                if second_start not in market_pending:
+                    market_pending[second_start] = new_bar(trade_doc['exchange'], trade_doc['market'], '1s', 1000, second_start)
+
+                fold_trade(market_pending[second_start], trade_doc)
+
+                if trade_doc['trade_time'] > self.time_last.get(market_key, 0):
+                    self.time_last[market_key] = trade_doc['trade_time']
+
+                added += 1
+
+        return added
+
+    def flush(self):
+        """
+        Roll pending 1s bars up into 1m and 1h bars and write every changed bar and the folded id ranges
+        """
+
+        flush_return = {'success': True, 'result': {'bars': 0}}
+
+        with self.flush_lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+
+                # Ids folded into pending bars, saved only once those bars are written
+                folded_ranges = {market_key: self.folded[market_key].ranges() for market_key in pending}
+                time_last = self.time_last.copy()
+
+            if len(pending) == 0:
+                return flush_return
+
+            flush_start = time.perf_counter()
+
+            try:
+                # Bar id -> new trades, finest resolution first so each level rolls up into the next
+                deltas = {}
+
+                for (exchange, market), market_pending in pending.items():
+                    finer_bars = list(market_pending.values())
+
+                    for resolution, resolution_ms in bar_resolutions:
+                        level_bars = {}
+
+                        for finer_bar in finer_bars:
+                            bar_start = (finer_bar['start'] // resolution_ms) * resolution_ms
+
+                            if bar_start not in level_bars:
+                                level_bars[bar_start] = new_bar(exchange, market, resolution, resolution_ms, bar_start)
+
+                            merge_bar(level_bars[bar_start], finer_bar)
+
+                        for level_bar in level_bars.values():
+                            deltas[level_bar['_id']] = level_bar
+
+                        finer_bars = list(level_bars.values())
+
+                # Bars not in memory were either never written or evicted
+                missing_ids = [delta_id for delta_id in deltas if delta_id not in self.bars]
+
+                if len(missing_ids) > 0:
+                    for stored_bar in self.storage.load_bars(missing_ids):
+                        self.bars[stored_bar['_id']] = stored_bar
+
+                updated = time.time()
+
+                changed_bars = []
+
+                for delta_id, delta in deltas.items():
+                    if delta_id not in self.bars:
+                        self.bars[delta_id] = new_bar(delta['exchange'], delta['market'], delta['resolution'], delta['end'] - delta['start'], delta['start'])
+
+                    merge_bar(self.bars[delta_id], delta)
+
+                    self.bars[delta_id]['updated'] = updated
+
+                    changed_bars.append(self.bars[delta_id])
+
+                for (exchange, market), ranges in folded_ranges.items():
+                    changed_bars.append({'_id': state_id(exchange, market), 'exchange': exchange, 'market': market, 'resolution': 'state',
+                                         'start': None, 'end': None, 'ranges': [list(id_range) for id_range in ranges], 'updated': updated})
+
+                self.storage.upsert_bars(changed_bars)
+
+                flush_return['result']['bars'] = len(changed_bars) - len(folded_ranges)
+
+                bar_flush_bars.inc(flush_return['result']['bars'])
+
+                self.evict(time_last)
+
+            except Exception as e:
+                logger.exception(e)
+
+                # Put the trades back so the next flush retries them
+                with self.lock:
+                    for market_key, market_pending in pending.items():
+                        current_pending = self.pending.setdefault(market_key, {})
+
+                        for second_start, pending_bar in market_pending.items():
+                            if second_start in current_pending:
+                                merge_bar(current_pending[second_start], pending_bar)
+                            else:
+                                current_pending[second_start] = pending_bar
+
+                # Cached bars may already include the failed deltas
+                self.bars = {}
+
+                flush_return['success'] = False
+
+            bar_flush_seconds.observe(time.perf_counter() - flush_start)
+
+        return flush_return
+
+    def evict(self, time_last):
+        """
+        Drop bars older than the previous bar of their resolution
+        """
+
+        resolution_ms = dict(bar_resolutions)
+
+        for cached_id in list(self.bars.keys()):
+            bar = self.bars[cached_id]
+
+            market_time_last = time_last.get((bar['exchange'], bar['market']))
+
+            if market_time_last == None or bar['end'] < market_time_last - resolution_ms[bar['resolution']]:
+                del self.bars[cached_id]
+
+    def catch_up(self, exchange, market, start_ms=None, page_size=50000):
+        """
+        Fold stored trades that are not in the bars yet (ex. backfilled while stopped)
+
+        Continues after the highest id folded before the last restart, or reads from start_ms when the
+        market has no stored bar state (ex. first run with flow bars). Live trades folded in the
+        meantime are skipped.
+
+        Returns number of trades folded
+        """
+
+        folded_count = 0
+
+        self.market_ranges(exchange, market)
+
+        after_id = self.stored_last[(exchange, market)]
+
+        if after_id != None:
+            start_ms = None
+
+        while True:
+            trade_docs = list(self.storage.trades_since(exchange, market, after_id=after_id, start_ms=start_ms, limit=page_size))
+
+            if len(trade_docs) == 0:
+                break
+
+            folded_count += self.add_trades(trade_docs)
+
+            # Keeps memory to one page, since old bars are evicted after writing
+            self.flush()
+
+            after_id = trade_docs[-1]['_id']
+
+            if len(trade_docs) < page_size:
+                break
+
+        logger.info('Flow bars caught up for ' + exchange + '-' + market + '. [' + str(folded_count) + ' stored trades folded]')
+
+        return folded_count
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+
+            except Exception as e:
+                logger.exception(e)
+
+    def stop(self, timeout=10):
+        self.stop_event.set()
+
+        if self.is_alive():
+            self.join(timeout)
+
+        self.flush()
@@ -0,0 +1,569 @@
+import logging
+import time
+
+import numpy as np
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+metric_names = ['volume', 'price', 'amount', 'count', 'rate_volume', 'rate_amount', 'rate_count']
+match_inputs = ['all', 'buy', 'sell']
+
+interval_multipliers = {'s': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000, 'w': 604800000}
+
+
+def interval_to_ms(interval):
+    """
+    Convert interval string (ex. 30s / 15m / 3h / 1d / 3w) to milliseconds
+    """
+
+    numerical = ''
+    identifier = ''
+    for char in interval:
+        if char.isnumeric():
+            numerical += char
+        else:
+            identifier = char
+            break
+
+    if identifier not in interval_multipliers or numerical == '':
+        raise ValueError('Unrecognized interval: ' + str(interval))
+
+    return int(numerical) * interval_multipliers[identifier]
+
+
+def empty_analysis_result():
+    analysis_result = {}
+
+    for window in ['current', 'last']:
+        analysis_result[window] = {}
+
+        for metric in metric_names:
+            analysis_result[window][metric] = {'all': None, 'buy': None, 'sell': None}
+
+        analysis_result[window]['flow_differential'] = None
+
+    analysis_result['difference'] = {}
+
+    for metric in metric_names:
+        analysis_result['difference'][metric] = {}
+
+        for match in match_inputs:
+            analysis_result['difference'][metric][match] = {'absolute': None, 'percent': None}
+
+    analysis_result['difference']['flow_differential'] = {'absolute': None, 'percent': None}
+
+    return analysis_result
+
+
+def compile_analysis_result(window_metrics, analysis_delta):
+    """
+    Build analyze_data() return dictionary from per-window aggregate values
+
+    window_metrics - {'current': {'all': {'volume', 'price', 'amount', 'count'} or None, 'buy': ..., 'sell': ...}, 'last': {...}}
+    analysis_delta - Duration (ms) of each analysis window
+    """
+
+    compile_return = {'success': True, 'result': empty_analysis_result()}
+
+    analysis_delta_sec = analysis_delta / 1000
+
+    for match in match_inputs:
+        result_current = window_metrics['current'][match]
+        result_last = window_metrics['last'][match]
+
+        # Matches aggregation pipeline behavior where an empty window returns no group document
+        if result_current == None or result_last == None:
+            logger.debug('No trades in one or both windows for ' + match + '.')
+            continue
+
+        values = {'current': {}, 'last': {}}
+
+        for window, result in [('current', result_current), ('last', result_last)]:
+            values[window]['volume'] = result['volume']
+            values[window]['price'] = result['price']
+            values[window]['amount'] = result['amount']
+            values[window]['count'] = result['count']
+            values[window]['rate_volume'] = result['volume'] / analysis_delta_sec
+            values[window]['rate_amount'] = result['amount'] / analysis_delta_sec
+            values[window]['rate_count'] = result['count'] / analysis_delta_sec
+
+        for metric in metric_names:
+            compile_return['result']['current'][metric][match] = values['current'][metric]
+            compile_return['result']['last'][metric][match] = values['last'][metric]
+
+            difference_absolute = values['current'][metric] - values['last'][metric]
+
+            compile_return['result']['difference'][metric][match]['absolute'] = difference_absolute
+            if values['last'][metric] != 0:
+                compile_return['result']['difference'][metric][match]['percent'] = difference_absolute / values['last'][metric]
+
+    # Flow Differential Calculation
+    try:
+        result = compile_return['result']
+
+        result['current']['flow_differential'] = (result['current']['rate_volume']['buy'] / result['current']['rate_volume']['all']) * 100
+        result['last']['flow_differential'] = (result['last']['rate_volume']['buy'] / result['last']['rate_volume']['all']) * 100
+        result['difference']['flow_differential']['absolute'] = result['current']['flow_differential'] - result['last']['flow_differential']
+        result['difference']['flow_differential']['percent'] = result['difference']['flow_differential']['absolute'] / result['last']['flow_differential']
+
+    except Exception as e:
+        logger.warning('Unable to calculate flow differential: ' + str(e))
+
+        compile_return['success'] = False
+
+    return compile_return
+
+
+def summarize_trades(price, quantity, is_buy):
+    """
+    Per-side window aggregates ({'all', 'buy', 'sell'}) from trade arrays, in the form used by compile_analysis_result()
+    """
+
+    summary = {}
+
+    for side, side_mask in [('all', None), ('buy', is_buy), ('sell', ~is_buy)]:
+        if side_mask is None:
+            side_price = price
+            side_quantity = quantity
+        else:
+            side_price = price[side_mask]
+            side_quantity = quantity[side_mask]
+
+        if len(side_price) == 0:
+            summary[side] = None
+        else:
+            summary[side] = {'volume': float(side_quantity.sum()),
+                             'price': float(side_price.mean()),
+                             'amount': float((side_price * side_quantity).sum()),
+                             'count': int(len(side_price))}
+
+    return summary
+
+
+class MarketSeries:
+    """
+    Time-ordered trade arrays for a single market with prefix sums
+
+    cum_* arrays have one more element than the trade arrays so the sum over trades [i, j)
+    is cum[j] - cum[i].
+    """
+
+    def __init__(self):
+        self.trade_id = np.zeros(0, dtype='i8')
+        self.trade_time = np.zeros(0, dtype='i8')
+        self.price = np.zeros(0, dtype='f8')
+        self.quantity = np.zeros(0, dtype='f8')
+        self.is_buy = np.zeros(0, dtype='?')
+
+        self.cum = {}
+        for side in ['all', 'buy']:
+            for value in ['volume', 'price', 'amount', 'count']:
+                self.cum[side + '_' + value] = np.zeros(1, dtype='f8')
+
+        self.pending = []
+
+        self.trade_id_last = None
+
+        self.rebuild_required = False
+
+    def append(self, trade_id, trade_time, price, quantity, is_buy):
+        if self.trade_id_last != None and trade_id <= self.trade_id_last:
+            # Older or repeated trade (ex. backfill) breaks time order, so arrays are rebuilt on next read
+            self.rebuild_required = True
+        else:
+            self.trade_id_last = trade_id
+
+        self.pending.append((trade_id, trade_time, price, quantity, is_buy))
+
+    def extend(self, trade_id, trade_time, price, quantity, is_buy):
+        """
+        Append column arrays (ex. read from a ColumnarTradeStore or received from another process)
+        """
+
+        self.consolidate()
+
+        if len(trade_id) == 0:
+            return
+
+        new_id = np.asarray(trade_id, dtype='i8')
+
+        self.merge_arrays(new_id, np.asarray(trade_time, dtype='i8'), np.asarray(price, dtype='f8'),
+                          np.asarray(quantity, dtype='f8'), np.asarray(is_buy, dtype='?'))
+
+        if self.trade_id_last == None or new_id.max() > self.trade_id_last:
+            self.trade_id_last = int(new_id.max())
+
+    def consolidate(self):
+        if len(self.pending) == 0 and self.rebuild_required == False:
+            return
+
+        if len(self.pending) > 0:
+            pending = self.pending
+            self.pending = []
+
+            new_id = np.fromiter((trade[0] for trade in pending), dtype='i8', count=len(pending))
+            new_time = np.fromiter((trade[1] for trade in pending), dtype='i8', count=len(pending))
+            new_price = np.fromiter((trade[2] for trade in pending), dtype='f8', count=len(pending))
+            new_quantity = np.fromiter((trade[3] for trade in pending), dtype='f8', count=len(pending))
+            new_is_buy = np.fromiter((trade[4] for trade in pending), dtype='?', count=len(pending))
+
+        else:
+            new_id = np.zeros(0, dtype='i8')
+            new_time = np.zeros(0, dtype='i8')
+            new_price = np.zeros(0, dtype='f8')
+            new_quantity = np.zeros(0, dtype='f8')
+            new_is_buy = np.zeros(0, dtype='?')
+
+        self.merge_arrays(new_id, new_time, new_price, new_quantity, new_is_buy)
+
+    def merge_arrays(self, new_id, new_time, new_price, new_quantity, new_is_buy):
+        if len(self.trade_time) > 0 and len(new_time) > 0 and new_time[0] < self.trade_time[-1]:
+            self.rebuild_required = True
+        elif len(self.trade_id) > 0 and len(new_id) > 0 and new_id.min() <= self.trade_id[-1]:
+            self.rebuild_required = True
+        elif len(new_time) > 1 and (np.any(np.diff(new_time) < 0) or np.any(np.diff(new_id) <= 0)):
+            self.rebuild_required = True
+
+        self.trade_id = np.concatenate((self.trade_id, new_id))
+        self.trade_time = np.concatenate((self.trade_time, new_time))
+        self.price = np.concatenate((self.price, new_price))
+        self.quantity = np.concatenate((self.quantity, new_quantity))
+        self.is_buy = np.concatenate((self.is_buy, new_is_buy))
+
+        if self.rebuild_required == True:
+            # Drop duplicate ids and restore time order, then recompute prefix sums from scratch
+            unique_id, unique_index = np.unique(self.trade_id, return_index=True)
+            order = unique_index[np.lexsort((self.trade_id[unique_index], self.trade_time[unique_index]))]
+
+            self.trade_id = self.trade_id[order]
+            self.trade_time = self.trade_time[order]
+            self.price = self.price[order]
+            self.quantity = self.quantity[order]
+            self.is_buy = self.is_buy[order]
+
+            if len(self.trade_id) > 0:
+                self.trade_id_last = int(self.trade_id.max())
+
+            self.cum = self.prefix_sums(self.price, self.quantity, self.is_buy, None)
+
+            self.rebuild_required = False
+
+        else:
+            new_cum = self.prefix_sums(new_price, new_quantity, new_is_buy, self.cum)
+
+            for key in self.cum:
+                self.cum[key] = np.concatenate((self.cum[key], new_cum[key][1:]))
+
+    @staticmethod
+    def prefix_sums(price, quantity, is_buy, cum_previous):
+        amount = price * quantity
+        buy = is_buy.astype('f8')
+
+        columns = {
+            'all_volume': quantity,
+            'all_price': price,
+            'all_amount': amount,
+            'all_count': np.ones(len(price), dtype='f8'),
+            'buy_volume': quantity * buy,
+            'buy_price': price * buy,
+            'buy_amount': amount * buy,
+            'buy_count': buy
+        }
+
+        cum = {}
+        for key in columns:
+            base = 0.0 if cum_previous == None else cum_previous[key][-1]
+            cum[key] = np.concatenate(([base], base + np.cumsum(columns[key])))
+
+        return cum
+
+    def prune(self, before_ms):
+        self.consolidate()
+
+        cut = int(np.searchsorted(self.trade_time, before_ms, side='left'))
+
+        if cut > 0:
+            self.trade_id = self.trade_id[cut:]
+            self.trade_time = self.trade_time[cut:]
+            self.price = self.price[cut:]
+            self.quantity = self.quantity[cut:]
+            self.is_buy = self.is_buy[cut:]
+
+            # Only differences of prefix sums are used, so remaining offsets don't need rebasing
+            for key in self.cum:
+                self.cum[key] = self.cum[key][cut:]
+
+        return cut
+
+    def window(self, start_ms, end_ms=None):
+        """
+        Volume/price/amount/count for trades with start_ms <= trade_time < end_ms (end_ms=None for open-ended)
+        """
+
+        self.consolidate()
+
+        i = int(np.searchsorted(self.trade_time, start_ms, side='left'))
+        if end_ms == None:
+            j = len(self.trade_time)
+        else:
+            j = int(np.searchsorted(self.trade_time, end_ms, side='left'))
+
+        sums = {}
+        for key in self.cum:
+            sums[key] = float(self.cum[key][j] - self.cum[key][i])
+
+        return self.sums_metrics(sums)
+
+    def window_sums(self, boundaries):
+        """
+        Prefix sum values at each boundary time, for many windows with one searchsorted call
+
+        Returns {cum key: array} where value[b] - value[a] is the sum over trades in [boundaries[a], boundaries[b])
+        """
+
+        self.consolidate()
+
+        index = np.searchsorted(self.trade_time, boundaries, side='left')
+
+        return {key: self.cum[key][index] for key in self.cum}
+
+    def sums_metrics(self, sums):
+        """
+        {'all', 'buy', 'sell'} window metrics from summed prefix values
+        """
+
+        window_metrics = {}
+
+        for side in ['all', 'buy']:
+            window_metrics[side] = self.side_metrics(sums[side + '_volume'], sums[side + '_price'], sums[side + '_amount'], sums[side + '_count'])
+
+        window_metrics['sell'] = self.side_metrics(sums['all_volume'] - sums['buy_volume'],
+                                                   sums['all_price'] - sums['buy_price'],
+                                                   sums['all_amount'] - sums['buy_amount'],
+                                                   sums['all_count'] - sums['buy_count'])
+
+        return window_metrics
+
+    @staticmethod
+    def side_metrics(volume, price_sum, amount, count):
+        count = int(round(count))
+
+        if count <= 0:
+            return None
+
+        return {'volume': volume, 'price': price_sum / count, 'amount': amount, 'count': count}
+
+    def __len__(self):
+        return len(self.trade_time) + len(self.pending)
+
+
+class RollingWindowEngine:
+    """
+    In-process replacement for analyze_data()'s aggregation pipelines
+
+    Keeps per-market trade arrays with cumulative sums so every window aggregate is two
+    binary searches and a handful of subtractions.
+
+    retention - Duration (ms) of trade data kept in memory
+    """
+
+    def __init__(self, retention=((2 * 86400000) + 3600000)):
+        self.retention = retention
+
+        self.markets = {}
+
+        self.sync_last = {}
+
+    def series(self, exchange, market):
+        market_key = (exchange, market)
+
+        if market_key not in self.markets:
+            self.markets[market_key] = MarketSeries()
+
+        return self.markets[market_key]
+
+    def add_trade(self, exchange, market, trade_id, trade_time, price, quantity, side):
+        self.series(exchange, market).append(int(trade_id), int(trade_time), float(price), float(quantity), side == 'buy')
+
+    def add_trade_doc(self, trade_doc):
+        self.add_trade(trade_doc['exchange'], trade_doc['market'], trade_doc['_id'], trade_doc['trade_time'],
+                       trade_doc['price'], trade_doc['quantity'], trade_doc['side'])
+
+    def sync_storage(self, storage, exchange, market, full=False):
+        """
+        Load trades newer than the last synchronized trade id from a TradeStorage backend
+
+        full - Reload whole retention period (picks up trades inserted out of order, ex. gap refills)
+        """
+
+        market_key = (exchange, market)
+
+        if full == True or market_key not in self.sync_last:
+            self.markets[market_key] = MarketSeries()
+
+            trade_docs = storage.trades_since(exchange, market, start_ms=(int(time.time() * 1000) - self.retention))
+        else:
+            trade_docs = storage.trades_since(exchange, market, after_id=self.sync_last[market_key])
+
+        series = self.series(exchange, market)
+
+        synced_count = 0
+        for trade_doc in trade_docs:
+            series.append(int(trade_doc['_id']), int(trade_doc['trade_time']), float(trade_doc['price']),
+                          float(trade_doc['quantity']), trade_doc['side'] == 'buy')
+
+            synced_count += 1
+
+        if series.trade_id_last != None:
+            self.sync_last[market_key] = series.trade_id_last
+
+        logger.debug('Synchronized ' + str(synced_count) + ' trades for ' + exchange + '-' + market + '.')
+
+        return synced_count
+
+    def sync_columnar(self, trade_store, exchange, market, full=False):
+        """
+        Same as sync_storage() but reads column arrays straight from a ColumnarTradeStore (no trade documents)
+        """
+
+        market_key = (exchange, market)
+
+        if full == True or market_key not in self.sync_last:
+            self.markets[market_key] = MarketSeries()
+
+            range_columns = trade_store.read_range(exchange, market, int(time.time() * 1000) - self.retention)
+        else:
+            series = self.series(exchange, market)
+
+            series.consolidate()
+
+            if len(series.trade_time) > 0:
+                # Reads from the last synchronized trade's time, anything already held is dropped by id below
+                read_start = int(series.trade_time[-1])
+            else:
+                read_start = int(time.time() * 1000) - self.retention
+
+            range_columns = trade_store.read_range(exchange, market, read_start)
+
+            new_trades = range_columns['trade_id'] > self.sync_last[market_key]
+
+            range_columns = {column: range_columns[column][new_trades] for column in range_columns}
+
+        series = self.series(exchange, market)
+
+        series.extend(range_columns['trade_id'], range_columns['trade_time'], range_columns['price'],
+                      range_columns['quantity'], range_columns['side'] == 1)
+
+        if series.trade_id_last != None:
+            self.sync_last[market_key] = series.trade_id_last
+
+        return len(range_columns['trade_id'])
+
+    def prune(self, before_ms=None):
+        if before_ms == None:
+            before_ms = int(time.time() * 1000) - self.retention
+
+        pruned_count = 0
+        for market_key in self.markets:
+            pruned_count += self.markets[market_key].prune(before_ms)
+
+        return pruned_count
+
+    def analyze(self, exchange, market, interval='1h', start=None, now_ms=None):
+        """
+        Same arguments and return value as FlowMeter.analyze_data()
+        """
+
+        analyze_return = {'success': True, 'result': empty_analysis_result()}
+
+        try:
+            if now_ms == None:
+                now_ms = int(time.time()) * 1000
+
+            analysis_delta = interval_to_ms(interval)
+
+            if start != None:
+                analysis_start = int(time.mktime(start.timetuple()) * 1000)
+            else:
+                analysis_start = now_ms - analysis_delta
+
+            analysis_start_last = analysis_start - analysis_delta
+
+            series = self.series(exchange, market)
+
+            window_metrics = {
+                'current': series.window(analysis_start),
+                'last': series.window(analysis_start_last, analysis_start)
+            }
+
+            analyze_return = compile_analysis_result(window_metrics, analysis_delta)
+
+        except Exception as e:
+            logger.exception(e)
+
+            analyze_return['success'] = False
+
+        return analyze_return
+
+    def analyze_all(self, intervals, now_ms=None, markets=None):
+        """
+        Analyze every market for every interval in one pass
+
+        Each market needs a single searchsorted over all window boundaries, so the cost is one
+        vectorized lookup per market plus building the result dictionaries.
+
+        intervals - Interval strings (ex. ['1m', '5m', '1h'])
+        markets - (exchange, market) keys to analyze (Default: every market held)
+
+        Returns {(exchange, market): {interval: analyze() return value}}
+        """
+
+        if now_ms == None:
+            now_ms = int(time.time()) * 1000
+
+        if markets == None:
+            markets = list(self.markets.keys())
+
+        analysis_deltas = np.array([interval_to_ms(interval) for interval in intervals], dtype='i8')
+
+        # [last window starts | current window starts]
+        boundaries = np.concatenate((now_ms - (2 * analysis_deltas), now_ms - analysis_deltas))
+
+        interval_count = len(intervals)
+
+        analyze_all_return = {}
+
+        for market_key in markets:
+            analyze_all_return[market_key] = {}
+
+            try:
+                series = self.series(market_key[0], market_key[1])
+
+                boundary_sums = series.window_sums(boundaries)
+
+                for x in range(interval_count):
+                    sums_current = {}
+                    sums_last = {}
+
+                    for key in boundary_sums:
+                        # Current window is open-ended like analyze(), so it runs to the last stored trade
+                        sums_current[key] = float(series.cum[key][-1] - boundary_sums[key][interval_count + x])
+                        sums_last[key] = float(boundary_sums[key][interval_count + x] - boundary_sums[key][x])
+
+                    window_metrics = {
+                        'current': series.sums_metrics(sums_current),
+                        'last': series.sums_metrics(sums_last)
+                    }
+
+                    analyze_all_return[market_key][intervals[x]] = compile_analysis_result(window_metrics, int(analysis_deltas[x]))
+
+            except Exception as e:
+                logger.exception(e)
+
+                for interval in intervals:
+                    if interval not in analyze_all_return[market_key]:
+                        analyze_all_return[market_key][interval] = {'success': False, 'result': empty_analysis_result()}
+
+        return analyze_all_return
@@ -6,232 +6,192 @@ import time
 import argparse
 import configparser
 import datetime
-from multiprocessing import Process
+from multiprocessing import Event, Process, Queue
 from pprint import pprint
-#import threading
+import queue
+import threading
 
 from binance.client import Client as BinanceClient
 from binance.websockets import BinanceSocketManager
 
 import dateparser
-from pymongo import MongoClient
 from twisted.internet import reactor
 
+from backfill import ChunkedBackfill, LiveMerge, aggtrade_doc
+from binance_endpoints import apply_endpoint_overrides
+from flow_bars import FlowBars, analyze_bars
+from flow_engine import RollingWindowEngine, compile_analysis_result, interval_to_ms
+from gap_refill import GapRefillWorker, GapTracker
+from index_manager import IndexManager
+import metrics
+import profiling
+from pubsub import open_publisher
+from storage import BucketMongoStorage, MongoStorage, open_storage, trade_fields
+from trade_tape import TradeTape
+from trade_writer import TradeWriter
+
 #config_path = 'config/config.ini'
 config_path = 'config/config.ini'
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-e', '--exchange', type=str, default=None, help='Exchange for analysis (ex. binance / poloniex).')
-parser.add_argument('-m', '--market', type=str, default=None, help='Market for analysis (ex. XLMBTC).')
-parser.add_argument('-l', '--loop', type=int, default=30, help='Time (seconds) between each analysis run (ex. 15). [Default: 30]')
-parser.add_argument('-c', '--clear', action='store_true', default=False, help='Clear all documents for requested market from database and start fresh.')
-parser.add_argument('--debug', action='store_true', default=False, help='Enable debug level output.')
-args = parser.parse_args()
-
-debug_mode = args.debug
-
 logging.basicConfig()
 logger = logging.getLogger(__name__)
-
-if debug_mode == True:
-    logger.setLevel(logging.DEBUG)
-else:
-    logger.setLevel(logging.INFO)
+logger.setLevel(logging.INFO)
 
 config = configparser.ConfigParser()
 config.read(config_path)
 
-mongo_uri = config['mongodb']['uri']
-
-if mongo_uri == 'localhost':
-    mongo_uri = None
-
-db = MongoClient(mongo_uri)[config['mongodb']['db']]
-
-collections = {
-    'data': config['mongodb']['collection_data'],
-    'analysis': config['mongodb']['collection_analysis'],
-    'historical': config['mongodb']['collection_historical']
-}
-
-binance_api = config['binance']['api']
-binance_secret = config['binance']['secret']
-
-binance_client = BinanceClient(binance_api, binance_secret)
-binance_ws = BinanceSocketManager(binance_client)
-
-
-class FlowMeter:
-
-    def __init__(self, exchange=None, market=None, loop_time=10, cleanup_interval=3600, save_flow_historical=False, clear_db=False):
-        try:
-            self.user_exchange = exchange
-            self.user_market = market
-
-            self.save_flow_historical = save_flow_historical
-
-            self.loop_time = loop_time
-            self.cleanup_interval = cleanup_interval
-
-            self.backtest_durations = [('1m', '1 minute'), ('5m', '5 minutes'), ('15m', '15 minutes'), ('30m', '30 minutes'), ('1h', '1 hour'),
-                                       ('2h', '2 hours'), ('4h', '4 hours'), ('6h', '6 hours'), ('12h', '12 hours'), ('1d', '1 day')]
-
-            trade_sockets = {}
-
-            available_exchanges = ['binance']#, 'poloniex']
-
-            available_exchanges.sort()
+# Websocket base URL for the asyncio runtime ([binance] stream_url / api_url overrides also apply to python-binance)
+stream_url = apply_endpoint_overrides(config)
 
-            ## Gather desired settings from user input ##
-            if self.user_exchange == None:
-                print()
-                print('Available Exchanges:')
-                print()
+# Created by connect_binance() on first use, since the client constructor contacts the API
+binance_client = None
+binance_ws = None
 
-                for exch in available_exchanges:
-                    print(str(available_exchanges.index(exch) + 1) + ' - ' + exch.capitalize())
-                print()
+messages_received = metrics.counter('flowmeter_messages_received_total', 'Trade messages received from the websocket.', ['market'])
+receive_lag_seconds = metrics.histogram('flowmeter_receive_lag_seconds', 'Exchange event time (E) to local receive time.', ['market'],
+                                        buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+analysis_seconds = metrics.histogram('flowmeter_analysis_seconds', 'Time to analyze one backtest interval (interval "all" for facet mode).',
+                                     ['market', 'interval', 'mode'])
+analysis_pass_seconds = metrics.histogram('flowmeter_analysis_pass_seconds', 'Time for one analysis pass over every interval.', ['market'])
+cleanup_seconds = metrics.histogram('flowmeter_cleanup_seconds', 'Time to delete old trade documents.')
+cleanup_deleted = metrics.counter('flowmeter_cleanup_deleted_total', 'Old trade documents deleted by cleanup.')
+cleanup_deleted_last = metrics.gauge('flowmeter_cleanup_deleted_last', 'Trade documents deleted by the last cleanup.')
 
-                exchange_input = int(input('Choose an exchange: '))
-
-                try:
-                    self.user_exchange = available_exchanges[exchange_input - 1]
-                except:
-                    logger.error('Unrecognized exchange choice. Exiting.')
-                    sys.exit(1)
+# Recorded by analysis_loop(), so copied back to the main process when analysis runs in its own process
+analysis_metric_names = ['flowmeter_analysis_seconds', 'flowmeter_analysis_pass_seconds', 'flowmeter_cleanup_seconds',
+                         'flowmeter_cleanup_deleted_total', 'flowmeter_cleanup_deleted_last']
 
-            elif self.user_exchange not in available_exchanges:
-                logger.error('Unrecognized exchange name. Exiting.')
-                sys.exit(1)
 
-            available_markets = []
+def connect_binance():
+    global binance_client, binance_ws
 
-            if self.user_exchange == 'binance':
-                ## Get list of available Binance markets to verify user input ##
-                binance_info = binance_client.get_exchange_info()
+    if binance_client == None:
+        binance_api = config['binance']['api']
+        binance_secret = config['binance']['secret']
 
-                for product in binance_info['symbols']:
-                    available_markets.append(product['baseAsset'] + product['quoteAsset'])
+        binance_client = BinanceClient(binance_api, binance_secret)
+        binance_ws = BinanceSocketManager(binance_client)
 
-            if self.user_market == None:
-                self.user_trade_currency = input('Choose a trade currency (ex. ETH): ').upper()
-                logger.debug('self.user_trade_currency: ' + self.user_trade_currency)
-                self.user_quote_currency = input('Choose a quote currency (ex. BTC): ').upper()
-                logger.debug('self.user_quote_currency: ' + self.user_quote_currency)
+    return binance_client
 
-                self.user_market = (self.user_trade_currency + self.user_quote_currency).upper()
-                logger.debug('self.user_market: ' + self.user_market)
 
-                print()
-                print('Selected ' + self.user_exchange.capitalize() + '-' + self.user_market + '.')
-                market_confirmation = input('Is this correct? [y/n]: ')
+class FlowMeter:
 
-                if market_confirmation.lower() == 'y':
-                    logger.info('Selected ' + self.user_exchange.capitalize() + ' market ' + self.user_market + '.')
-                elif market_confirmation.lower() == 'n':
-                    logger.info('Cancelled selection of ' + self.user_exchange.capitalize() + ' market ' + self.user_market + '. Exiting.')
-                    sys.exit()
-                else:
-                    logger.error('Unrecognized selection for confirmation of market selection. Exiting.')
-                    sys.exit(1)
+    def __init__(self, exchange=None, market=None, loop_time=10, cleanup_interval=3600, save_flow_historical=False, clear_db=False,
+                 write_batch_size=500, write_flush_interval=1.0, write_queue_size=100000, analysis_mode='aggregate', strict_indexes=False,
+                 storage=None, autostart=True, backfill_workers=4, backfill_chunk_minutes=60, backfill_progress_callback=None,
+                 live_wait=30, record_path=None, refill_gaps=True, flow_bars=True):
+        """
+        storage - TradeStorage backend (Default: backend selected in config.ini)
+        backfill_workers - Concurrent REST workers for historical backfill
+        backfill_chunk_minutes - Time span of each backfill chunk (max 60)
+        backfill_progress_callback - Called with BackfillProgress.snapshot() dicts while backfilling
+        live_wait - Maximum time (seconds) to wait for the first live trade before backfilling up to now instead
+        autostart - Run market selection, backfill and analysis immediately (False to only configure, ex. for benchmarks)
+        record_path - Directory to record raw websocket messages to (see recording.py for replay)
+        refill_gaps - Fetch aggregate ids missing from the live stream (or dropped before storage) in the background
+        flow_bars - Maintain 1s/1m/1h flow bars from live, backfilled and refilled trades (see flow_bars.py, analysis_mode='bars')
+        """
 
-                if self.user_market not in available_markets:
-                    logger.error(self.user_market + ' is not a valid Binance market. Exiting.')
-                    sys.exit(1)
-                else:
-                    logger.debug('self.user_market: ' + self.user_market)
+        self.user_exchange = exchange
+        self.user_market = market
+        self.user_trade_currency = None
+        self.user_quote_currency = None
 
-            ## Check for existing documents for exchange/market and calculate duration of missing trades ##
-            trade_id_last = None
-            trade_dt_first = None
-            populate_extended = False
+        self.save_flow_historical = save_flow_historical
+        self.clear_db = clear_db
 
-            ## Delete existing data for market from database, if requested ##
-            if clear_db == True:
-                print('WARNING: Selected option to delete all database documents for ' + self.user_exchange.capitalize() + '-' + self.user_market.upper() + '.')
-                clear_db_confirmation = input('Continue with deletion? [y/n]: ')
+        self.loop_time = loop_time
+        self.cleanup_interval = cleanup_interval
 
-                if clear_db_confirmation.lower() == 'y':
-                    logger.info('Deleting existing ' + self.user_exchange.capitalize() + '-' + self.user_market.upper() + ' documents from database.')
+        self.backtest_durations = [('1m', '1 minute'), ('5m', '5 minutes'), ('15m', '15 minutes'), ('30m', '30 minutes'), ('1h', '1 hour'),
+                                   ('2h', '2 hours'), ('4h', '4 hours'), ('6h', '6 hours'), ('12h', '12 hours'), ('1d', '1 day')]
 
-                    delete_result = db[collections['data']].delete_many({'exchange': self.user_exchange, 'market': self.user_market})
-                    logger.debug('delete_result.deleted_count: ' + str(delete_result.deleted_count))
+        self.write_batch_size = write_batch_size
+        self.write_flush_interval = write_flush_interval
+        self.write_queue_size = write_queue_size
 
-                elif clear_db_confirmation.lower() == 'n':
-                    logger.info('Cancelled deletion of ' + self.user_exchange.capitalize() + '-' + self.user_market.upper() + ' documents from database.')
+        self.analysis_mode = analysis_mode
+        self.analysis_engine = None
 
-                else:
-                    logger.error('Unrecognized selection for confirmation of database deletion. Exiting.')
-                    sys.exit(1)
+        self.strict_indexes = strict_indexes
 
-            #if clear_db == False:
-            else:
-                missing_trades_result = self.check_missing_trades(self.user_exchange, self.user_market)
+        self.backfill_workers = backfill_workers
+        self.backfill_chunk_minutes = backfill_chunk_minutes
+        self.backfill_progress_callback = backfill_progress_callback
+        self.live_wait = live_wait
 
-                if missing_trades_result['success'] == True and missing_trades_result['result']['missing_duration'] != None:
-                    # Present duration of missing trade data and ask user if filling-in missing data desired
-                    print('Last documented trade was ' + missing_trades_result['result']['missing_duration'] + ' ago.')
+        if storage == None:
+            storage = open_storage(config)
 
-                    missing_duration_message = missing_trades_result['result']['missing_duration']
-                    logger.debug('missing_duration_message: ' + missing_duration_message)
+        self.storage = storage
 
-                    logger.info('Filling-in database with recent missing trade data.')
+        self.trade_writer = None
+        self.live_merge = None
+        self.backfill = None
 
-                    trade_id_last = missing_trades_result['result']['trade_id_last']
-                    logger.debug('trade_id_last: ' + str(trade_id_last))
+        self.record_path = record_path
+        self.recorder = None
 
-                    trade_dt_first = missing_trades_result['result']['trade_dt_first']
-                    logger.debug('trade_dt_first: ' + str(trade_dt_first))
+        # Live id continuity is always tracked (gap metrics), refills only run with refill_gaps
+        self.refill_gaps = refill_gaps
+        self.gap_tracker = GapTracker()
+        self.gap_refill = None
+        self.refill_resync = None
 
-                    if trade_dt_first > dateparser.parse('1 day ago'):
-                        logger.info('Performing extended backfill of trade data up to 2 days.')
+        self.maintain_flow_bars = flow_bars
+        self.flow_bars = None
 
-                        populate_extended = True
-                    else:
-                        logger.info('Database populated with >= 2 days of trade data. Skipping extended database backfill.')
+        # Latest trades per market for GUIs, updated after each written batch
+        self.trade_tape = TradeTape(self.storage, size=config.getint('storage', 'recent_trades', fallback=100))
 
-                elif missing_trades_result['result']['missing_duration'] == None:
-                    print('No trade data found in database for ' + self.user_exchange.capitalize() + '-' + self.user_market.upper() + '.')
+        # Trades and analysis pushed to GUIs ([pubsub] in config.ini), through publish_queue from an analysis process
+        self.publisher = None
+        self.publish_queue = None
 
-                    populate_extended = True
+        if autostart == True:
+            self.run()
 
-                else:
-                    logger.error('Error while checking duration of missing trade data. Exiting.')
-                    sys.exit(1)
+    def run(self):
+        try:
+            trade_sockets = {}
 
-            ## Populate database with historical trade data for extended backtesting/analysis ##
-            logger.info('Populating database with historical trade data.')
+            self.select_market()
 
-            populate_starts = []
+            self.verify_indexes()
 
-            arguments = tuple()
-            keyword_arguments_base = {'exchange': self.user_exchange, 'market': self.user_market}
+            backfill_plan = self.plan_backfill()
 
-            if populate_extended == True:
-                backtest_delta = datetime.datetime.now(datetime.timezone.utc) - dateparser.parse('1 day ago UTC')
-                logger.debug('backtest_delta: ' + str(backtest_delta))
+            self.open_publisher()
 
-                populate_delta = (backtest_delta * 2) + datetime.timedelta(hours=1) # Populate with 2x + 1 extra hour of data
-                logger.debug('populate_delta: ' + str(populate_delta))
+            ## Start buffered writer for live trade documents ##
+            self.trade_writer = TradeWriter(self.storage, batch_size=self.write_batch_size, flush_interval=self.write_flush_interval,
+                                            max_queue=self.write_queue_size, failure_callback=self.report_failed_docs,
+                                            written_callback=self.trade_tape.add_trades)
 
-                populate_start_dt = datetime.datetime.now() - populate_delta
-                logger.debug('populate_start_dt: ' + str(populate_start_dt))
+            logger.debug('Starting trade writer.')
+            self.trade_writer.start()
 
-                populate_start = int(time.mktime(populate_start_dt.timetuple()) * 1000)
-                logger.debug('populate_start:' + str(populate_start))
+            self.start_flow_bars()
 
-                populate_starts.append(('start_time', populate_start))
+            # Set by the refill worker so the analysis engine reloads refilled (out of order) trades from storage
+            self.refill_resync = Event()
 
-            if trade_id_last != None:
-                populate_starts.append(('trade_id_last', trade_id_last))
+            self.start_gap_refill(callback=self.refilled_trades)
 
-            logger.debug('populate_starts: ' + str(populate_starts))
+            # Backfill stops at the first live trade, and both sides claim ids here before writing
+            self.live_merge = LiveMerge()
 
             ## Initialize aggregated trade websocket for market ##
             logger.info('Initializing trade websocket for ' + self.user_exchange.capitalize() + '-' + self.user_market.upper() + '.')
 
             if self.user_exchange == 'binance':
-                trade_sockets[self.user_market] = binance_ws.start_aggtrade_socket(self.user_market, self.process_message)
+                aggtrade_callback = self.process_message
+
+                if self.open_recorder() != None:
+                    aggtrade_callback = self.recorder.wrap('aggTrade', self.process_message)
+
+                trade_sockets[self.user_market] = binance_ws.start_aggtrade_socket(self.user_market, aggtrade_callback)
 
                 ## Start websocket for market and begin processing data ##
                 logger.info('Starting websocket connection for ' + self.user_market + '.')
@@ -242,37 +202,57 @@ class FlowMeter:
                 logger.error('Only Binance functions currently implemented. Exiting.')
                 sys.exit(1)
 
-            populate_count = len(populate_starts)
-            logger.debug('populate_count: ' + str(populate_count))
+            live_first_id = None
+            live_first_time = None
 
-            count = 0
-            for pop in populate_starts:
-                count += 1
+            if backfill_plan['populate_start'] != None or backfill_plan['trade_id_last'] != None:
+                logger.info('Waiting for first live trade to set backfill end point.')
 
-                keyword_arguments = keyword_arguments_base.copy()
-                keyword_arguments[pop[0]] = pop[1]
+                live_first_id = self.live_merge.wait_first_live(timeout=self.live_wait)
 
-                logger.debug('keyword_arguments: ' + str(keyword_arguments))
+                if live_first_id != None:
+                    live_first_time = self.live_merge.first_live_time
 
-                populate_proc = Process(target=self.populate_historical, args=arguments, kwargs=keyword_arguments)
+                    logger.info('Backfilling up to first live trade ' + str(live_first_id) + '.')
+                else:
+                    # Quiet market, so backfill up to now and let claimed ids absorb any overlap
+                    logger.info('No live trade within ' + str(self.live_wait) + ' sec. Backfilling up to current time.')
 
-                logger.debug('Starting populate database process #' + str(count) + ' of ' + str(populate_count) + '.')
-                populate_proc.start()
-                logger.debug('Joining populate database process #' + str(count) + ' of ' + str(populate_count) + '.')
-                populate_proc.join()
-                logger.debug('Populate database process #' + str(count) + ' of ' + str(populate_count) + ' complete.')
+            self.populate_to_live(backfill_plan, end_id=live_first_id, end_time=live_first_time)
+
+            self.catch_up_flow_bars()
 
             logger.info('Database ready for analysis.')
 
             arguments = tuple()
             keyword_arguments = {}
 
-            analysis_proc = Process(target=self.analysis_loop, args=arguments, kwargs=keyword_arguments)
+            metrics_queue = None
+
+            if self.storage.shared_across_processes == True:
+                metrics_queue = Queue()
+                keyword_arguments['metrics_queue'] = metrics_queue
+
+                if self.publisher != None:
+                    keyword_arguments['publish_queue'] = Queue()
+
+                    self.publisher.forward(keyword_arguments['publish_queue'])
+
+                analysis_proc = Process(target=self.analysis_loop, args=arguments, kwargs=keyword_arguments)
+            else:
+                analysis_proc = threading.Thread(target=self.analysis_loop, args=arguments, kwargs=keyword_arguments, daemon=True)
 
             logger.info('Starting analysis.')
 
             logger.debug('Starting analysis process.')
             analysis_proc.start()
+
+            while metrics_queue != None and analysis_proc.is_alive():
+                try:
+                    metrics.registry.load_state(metrics_queue.get(timeout=1))
+                except queue.Empty:
+                    pass
+
             logger.debug('Joining analysis process.')
             analysis_proc.join()
 
@@ -294,7 +274,325 @@ class FlowMeter:
             else:
                 logger.info('No websocket connected or reactor running.')
 
-            logger.debug('Exiting __init__.')
+            if self.gap_refill != None:
+                self.gap_refill.stop()
+
+            if self.trade_writer != None:
+                logger.info('Stopping trade writer.')
+                self.trade_writer.stop()
+
+            if self.flow_bars != None:
+                logger.info('Writing pending flow bars.')
+                self.flow_bars.stop()
+
+            if self.publisher != None:
+                self.publisher.stop()
+
+            if self.recorder != None:
+                self.recorder.close()
+
+            logger.debug('Exiting run().')
+
+    def start_gap_refill(self, callback=None):
+        """
+        Start background refill of live stream gaps (if refill_gaps). callback - See GapRefillWorker.
+        """
+
+        if self.refill_gaps == True and self.gap_refill == None:
+            self.gap_refill = GapRefillWorker(connect_binance(), self.storage, self.user_exchange,
+                                              currencies=lambda market: (self.user_trade_currency, self.user_quote_currency), callback=callback)
+
+            self.gap_tracker.gap_callback = self.gap_refill.submit
+
+            self.gap_refill.start()
+
+        return self.gap_refill
+
+    def refilled_trades(self, market, trade_docs):
+        """
+        Gap refill callback for the threaded runtime
+        """
+
+        # Analysis engine reloads refilled (out of order) trades from storage
+        self.refill_resync.set()
+
+        if self.flow_bars != None:
+            self.flow_bars.add_trades(trade_docs)
+
+    def start_flow_bars(self):
+        """
+        Start the flow bar flush thread (if flow bars are maintained). Returns the FlowBars (or None).
+        """
+
+        if self.maintain_flow_bars == True and self.flow_bars == None:
+            self.flow_bars = FlowBars(self.storage)
+
+            self.flow_bars.start()
+
+        return self.flow_bars
+
+    def catch_up_flow_bars(self):
+        """
+        Fold backfilled trades into the flow bars once the backfill is done
+        """
+
+        if self.flow_bars != None:
+            # Same span cleanup keeps in storage
+            retention_start = int((time.time() - (49 * 3600)) * 1000)
+
+            try:
+                self.flow_bars.catch_up(self.user_exchange, self.user_market, start_ms=retention_start)
+
+            except Exception as e:
+                logger.exception(e)
+
+    def open_publisher(self):
+        """
+        Start publishing live trades and analysis documents for GUIs ([pubsub] in config.ini). Returns the publisher (or None).
+        """
+
+        if self.publisher == None:
+            self.publisher = open_publisher(config, self.user_exchange, self.user_market)
+
+        return self.publisher
+
+    def publish(self, channel, key, document):
+        if self.publish_queue != None:
+            self.publish_queue.put((channel, key, document))
+
+        elif self.publisher != None:
+            self.publisher.publish(channel, key, document)
+
+    def report_failed_docs(self, trade_docs):
+        self.gap_tracker.report_docs(trade_docs, 'write')
+
+    def open_recorder(self):
+        """
+        Start recording raw websocket messages if a record path was given. Returns the recorder (or None).
+        """
+
+        if self.record_path != None and self.recorder == None:
+            from recording import MessageRecorder
+
+            self.recorder = MessageRecorder(self.record_path, prefix=self.user_exchange + '-' + self.user_market.lower())
+
+        return self.recorder
+
+
+    def select_market(self):
+        """
+        Choose exchange/market (prompting for anything not given) and look up its currencies
+        """
+
+        available_exchanges = ['binance']#, 'poloniex']
+
+        available_exchanges.sort()
+
+        ## Gather desired settings from user input ##
+        if self.user_exchange == None:
+            print()
+            print('Available Exchanges:')
+            print()
+
+            for exch in available_exchanges:
+                print(str(available_exchanges.index(exch) + 1) + ' - ' + exch.capitalize())
+            print()
+
+            exchange_input = int(input('Choose an exchange: '))
+
+            try:
+                self.user_exchange = available_exchanges[exchange_input - 1]
+            except:
+                logger.error('Unrecognized exchange choice. Exiting.')
+                sys.exit(1)
+
+        elif self.user_exchange not in available_exchanges:
+            logger.error('Unrecognized exchange name. Exiting.')
+            sys.exit(1)
+
+        available_markets = []
+        market_currencies = {}
+
+        if self.user_exchange == 'binance':
+            connect_binance()
+
+            ## Get list of available Binance markets to verify user input ##
+            binance_info = binance_client.get_exchange_info()
+
+            for product in binance_info['symbols']:
+                available_markets.append(product['baseAsset'] + product['quoteAsset'])
+                market_currencies[product['baseAsset'] + product['quoteAsset']] = (product['baseAsset'], product['quoteAsset'])
+
+        if self.user_market == None:
+            self.user_trade_currency = input('Choose a trade currency (ex. ETH): ').upper()
+            logger.debug('self.user_trade_currency: ' + self.user_trade_currency)
+            self.user_quote_currency = input('Choose a quote currency (ex. BTC): ').upper()
+            logger.debug('self.user_quote_currency: ' + self.user_quote_currency)
+
+            self.user_market = (self.user_trade_currency + self.user_quote_currency).upper()
+            logger.debug('self.user_market: ' + self.user_market)
+
+            print()
+            print('Selected ' + self.user_exchange.capitalize() + '-' + self.user_market + '.')
+            market_confirmation = input('Is this correct? [y/n]: ')
+
+            if market_confirmation.lower() == 'y':
+                logger.info('Selected ' + self.user_exchange.capitalize() + ' market ' + self.user_market + '.')
+            elif market_confirmation.lower() == 'n':
+                logger.info('Cancelled selection of ' + self.user_exchange.capitalize() + ' market ' + self.user_market + '. Exiting.')
+                sys.exit()
+            else:
+                logger.error('Unrecognized selection for confirmation of market selection. Exiting.')
+                sys.exit(1)
+
+            if self.user_market not in available_markets:
+                logger.error(self.user_market + ' is not a valid Binance market. Exiting.')
+                sys.exit(1)
+            else:
+                logger.debug('self.user_market: ' + self.user_market)
+
+        elif self.user_trade_currency == None and self.user_market in market_currencies:
+            # Market given as argument, so look up currencies instead of prompting
+            self.user_trade_currency, self.user_quote_currency = market_currencies[self.user_market]
+
+
+    def verify_indexes(self):
+        ## Build required indexes and confirm hot queries use them ##
+        logger.info('Verifying database indexes.')
+
+        if isinstance(self.storage, MongoStorage):
+            index_manager = IndexManager(self.storage.db, self.storage.collections, exchange=self.user_exchange, market=self.user_market,
+                                         storage=self.storage)
+
+            ensure_indexes_result = index_manager.ensure_indexes()
+
+            if ensure_indexes_result['success'] == False:
+                logger.error('Error while building database indexes.')
+
+            # Raises IndexPlanError if strict and any hot query still uses a collection scan
+            index_manager.verify_query_plans(strict=self.strict_indexes)
+
+
+    def plan_backfill(self):
+        """
+        Check stored trades (or clear them if requested) and decide what to backfill
+
+        Returns {'populate_start', 'trade_id_last', 'trade_time_last'}
+        """
+
+        ## Check for existing documents for exchange/market and calculate duration of missing trades ##
+        trade_id_last = None
+        trade_time_last = None
+        trade_dt_first = None
+        populate_extended = False
+
+        ## Delete existing data for market from database, if requested ##
+        if self.clear_db == True:
+            print('WARNING: Selected option to delete all database documents for ' + self.user_exchange.capitalize() + '-' + self.user_market.upper() + '.')
+            clear_db_confirmation = input('Continue with deletion? [y/n]: ')
+
+            if clear_db_confirmation.lower() == 'y':
+                logger.info('Deleting existing ' + self.user_exchange.capitalize() + '-' + self.user_market.upper() + ' documents from database.')
+
+                deleted_count = self.storage.delete_market(self.user_exchange, self.user_market)
+                logger.debug('deleted_count: ' + str(deleted_count))
+
+                self.storage.delete_checkpoints(exchange=self.user_exchange, market=self.user_market)
+
+                self.storage.delete_bars(exchange=self.user_exchange, market=self.user_market)
+
+                self.storage.delete_recent_trades(exchange=self.user_exchange, market=self.user_market)
+
+                self.storage.delete_market_meta(exchange=self.user_exchange, market=self.user_market)
+
+            elif clear_db_confirmation.lower() == 'n':
+                logger.info('Cancelled deletion of ' + self.user_exchange.capitalize() + '-' + self.user_market.upper() + ' documents from database.')
+
+            else:
+                logger.error('Unrecognized selection for confirmation of database deletion. Exiting.')
+                sys.exit(1)
+
+        #if clear_db == False:
+        else:
+            missing_trades_result = self.check_missing_trades(self.user_exchange, self.user_market)
+
+            if missing_trades_result['success'] == True and missing_trades_result['result']['missing_duration'] != None:
+                # Present duration of missing trade data and ask user if filling-in missing data desired
+                print('Last documented trade was ' + missing_trades_result['result']['missing_duration'] + ' ago.')
+
+                missing_duration_message = missing_trades_result['result']['missing_duration']
+                logger.debug('missing_duration_message: ' + missing_duration_message)
+
+                logger.info('Filling-in database with recent missing trade data.')
+
+                trade_id_last = missing_trades_result['result']['trade_id_last']
+                logger.debug('trade_id_last: ' + str(trade_id_last))
+
+                trade_time_last = missing_trades_result['result']['trade_time_last']
+
+                trade_dt_first = missing_trades_result['result']['trade_dt_first']
+                logger.debug('trade_dt_first: ' + str(trade_dt_first))
+
+                if trade_dt_first > dateparser.parse('1 day ago'):
+                    logger.info('Performing extended backfill of trade data up to 2 days.')
+
+                    populate_extended = True
+                else:
+                    logger.info('Database populated with >= 2 days of trade data. Skipping extended database backfill.')
+
+            elif missing_trades_result['result']['missing_duration'] == None:
+                print('No trade data found in database for ' + self.user_exchange.capitalize() + '-' + self.user_market.upper() + '.')
+
+                populate_extended = True
+
+            else:
+                logger.error('Error while checking duration of missing trade data. Exiting.')
+                sys.exit(1)
+
+        ## Populate database with historical trade data for extended backtesting/analysis ##
+        logger.info('Populating database with historical trade data.')
+
+        populate_start = None
+
+        if populate_extended == True:
+            backtest_delta = datetime.datetime.now(datetime.timezone.utc) - dateparser.parse('1 day ago UTC')
+            logger.debug('backtest_delta: ' + str(backtest_delta))
+
+            populate_delta = (backtest_delta * 2) + datetime.timedelta(hours=1) # Populate with 2x + 1 extra hour of data
+            logger.debug('populate_delta: ' + str(populate_delta))
+
+            populate_start_dt = datetime.datetime.now() - populate_delta
+            logger.debug('populate_start_dt: ' + str(populate_start_dt))
+
+            populate_start = int(time.mktime(populate_start_dt.timetuple()) * 1000)
+            logger.debug('populate_start:' + str(populate_start))
+
+        return {'populate_start': populate_start, 'trade_id_last': trade_id_last, 'trade_time_last': trade_time_last}
+
+
+    def populate_to_live(self, backfill_plan, end_id=None, end_time=None):
+        """
+        Run the planned backfill, stopping before the first live trade if known
+        """
+
+        populate_start = backfill_plan['populate_start']
+        trade_id_last = backfill_plan['trade_id_last']
+        trade_time_last = backfill_plan['trade_time_last']
+
+        if populate_start != None:
+            # Extended range also covers everything after trade_id_last
+            populate_result = self.populate_historical(self.user_exchange, self.user_market, start_time=populate_start,
+                                                       end_id=end_id, end_time=end_time)
+
+            if populate_result['success'] == False:
+                logger.error('Historical backfill incomplete. Failed chunks: ' + str(populate_result['result']['failed_chunks']))
+
+        elif trade_id_last != None:
+            populate_result = self.populate_historical(self.user_exchange, self.user_market, trade_id_last=trade_id_last, trade_time_last=trade_time_last,
+                                                       end_id=end_id, end_time=end_time)
+
+            if populate_result['success'] == False:
+                logger.error('Error while filling-in missing trade data.')
 
 
     def process_message(self, msg, populate=False, exchange=None, market=None):
@@ -335,25 +633,17 @@ class FlowMeter:
                     }
                     """
 
-                    trade_doc['_id'] = int(msg['a'])        # Aggregate Trade ID
                     if populate == True:
-                        trade_doc['type'] = 'populate'
+                        doc_type = 'populate'
                     else:
-                        trade_doc['type'] = msg['e']
-                    trade_doc['exchange'] = exchange
-                    trade_doc['market'] = market
-                    trade_doc['trade_currency'] = self.user_trade_currency
-                    trade_doc['quote_currency'] = self.user_quote_currency
-                    trade_doc['price'] = float(msg['p'])
-                    trade_doc['quantity'] = float(msg['q'])
-                    trade_doc['trade_time'] = int(msg['T'])
-                    if msg['m'] == True:
-                        trade_doc['side'] = 'sell'
-                    else:
-                        trade_doc['side'] = 'buy'
-                    #trade_doc['event_time'] = int(msg['E'])
-                    #trade_doc['trade_id_first'] = int(msg['f'])
-                    #trade_doc['trade_id_last'] = int(msg['l'])
+                        doc_type = msg['e']
+
+                    trade_doc = aggtrade_doc(msg, exchange, market, self.user_trade_currency, self.user_quote_currency, doc_type=doc_type)
+
+                    if populate == False:
+                        self.observe_message(msg)
+
+                        self.gap_tracker.observe(market, trade_doc['_id'])
 
                     update_required = True
 
@@ -372,9 +662,33 @@ class FlowMeter:
 
                     process_message_success = False
 
+            if update_required == True and populate == False and self.live_merge != None:
+                if self.live_merge.claim_live(trade_doc) == False:
+                    # Already written by backfill or redelivered after a reconnect
+                    logger.debug('Skipping duplicate live trade ' + str(trade_doc['_id']) + '.')
+
+                    update_required = False
+
+            if update_required == True and populate == False and self.flow_bars != None:
+                self.flow_bars.add_trades([trade_doc])
+
+            if update_required == True and populate == False and self.publisher != None:
+                self.publisher.publish('trade', market, trade_doc)
+
             if update_required == True:
                 try:
-                    inserted_id = db[collections['data']].insert_one(trade_doc).inserted_id
+                    if populate == False and self.trade_writer != None:
+                        # Live trades are batched by the writer thread instead of one round trip per trade
+                        if self.trade_writer.submit(trade_doc) == False:
+                            logger.warning('Trade writer queue full. Dropped trade ' + str(trade_doc['_id']) + '.')
+
+                            self.gap_tracker.report_docs([trade_doc], 'dropped')
+
+                            process_message_success = False
+                    elif self.storage.insert_trade(trade_doc) == False:
+                        raise ValueError('Trade ' + str(trade_doc['_id']) + ' already in storage.')
+                    else:
+                        self.storage.record_written([trade_doc], 1)
 
                     logger_message = trade_doc['exchange'].capitalize() + '-' + trade_doc['market'] + ' - ' + trade_doc['side'].upper() + ' '
                     if trade_doc['side'] == 'buy': logger_message += ' '
@@ -400,155 +714,128 @@ class FlowMeter:
             return process_message_success
 
 
-    def check_missing_trades(self, exchange, market):
-        check_missing_return = {'success': True, 'result': {'trade_dt_first': None, 'trade_id_last': None, 'missing_timedelta': None, 'missing_duration': None}}
-
-        try:
-            aggregation_pipeline = []
+    def observe_message(self, msg):
+        """
+        Receive metrics for a live aggTrade message (also called by the asyncio runtime and market daemon)
+        """
 
-            match_pipeline = {'$match': {'exchange': exchange, 'market': market}}
-            logger.debug('match_pipeline: ' + str(match_pipeline))
+        messages_received.labels(msg['s']).inc()
 
-            aggregation_pipeline.append(match_pipeline)
+        if 'E' in msg:
+            receive_lag_seconds.labels(msg['s']).observe(time.time() - (msg['E'] / 1000))
 
-            sort_pipeline = {'$sort': {'_id': -1}}
-            logger.debug('sort_pipeline' + str(sort_pipeline))
+    def check_missing_trades(self, exchange, market):
+        check_missing_return = {'success': True, 'result': {'trade_dt_first': None, 'trade_id_last': None, 'trade_time_last': None, 'missing_timedelta': None, 'missing_duration': None}}
 
-            aggregation_pipeline.append(sort_pipeline)
+        try:
+            # Newest/oldest trade from the market metadata instead of sorting the trades
+            market_meta = self.storage.market_meta(exchange, market)
 
-            limit_pipeline = {'$limit': 1}
-            logger.debug('limit_pipeline' + str(limit_pipeline))
+            if market_meta == None or market_meta['last_id'] == None:
+                # Trades written before the metadata existed (or none at all)
+                market_meta = self.storage.refresh_market_meta(exchange, market)
 
-            aggregation_pipeline.append(limit_pipeline)
+            trade_last = None
 
-            logger.debug('aggregation_pipeline' + str(aggregation_pipeline))
+            if market_meta != None and market_meta['last_id'] != None:
+                trade_last = {'_id': market_meta['last_id'], 'trade_time': market_meta['last_time']}
 
-            aggregation_result = db.command('aggregate', collections['data'], cursor={}, pipeline=aggregation_pipeline)
+            if trade_last != None:
+                logger.debug('trade_last: ' + str(trade_last))
 
-            logger.debug('aggregation_result[\'ok\']: ' + str(aggregation_result['ok']))
+                check_missing_return['result']['trade_id_last'] = trade_last['_id']
+                check_missing_return['result']['trade_time_last'] = trade_last['trade_time']
 
-            if aggregation_result['ok'] == 1:
-                if len(aggregation_result['cursor']['firstBatch']) > 0:
-                    trade_last = aggregation_result['cursor']['firstBatch'][0]
-                    logger.debug('trade_last: ' + str(trade_last))
+                check_missing_return['result']['missing_timedelta'] = datetime.datetime.now() - datetime.datetime.fromtimestamp(float(trade_last['trade_time']) / 1000)
 
-                    check_missing_return['result']['trade_id_last'] = trade_last['_id']
+                missing_times = [['years', None], ['months', None],
+                                 ['weeks', None], ['days', None],
+                                 ['hours', None], ['minutes', None],
+                                 ['seconds', None]]
 
-                    check_missing_return['result']['missing_timedelta'] = datetime.datetime.now() - datetime.datetime.fromtimestamp(float(trade_last['trade_time']) / 1000)
+                missing_days = check_missing_return['result']['missing_timedelta'].days
+                logger.debug('missing_days: ' + str(missing_days))
 
-                    missing_times = [['years', None], ['months', None],
-                                     ['weeks', None], ['days', None],
-                                     ['hours', None], ['minutes', None],
-                                     ['seconds', None]]
+                if missing_days >= 365:
+                    missing_times[0][1] = missing_days // 365
+                    logger.debug('missing_times[0]: ' + str(missing_times[0]))
 
-                    missing_days = check_missing_return['result']['missing_timedelta'].days
+                    missing_days = missing_days % 365
                     logger.debug('missing_days: ' + str(missing_days))
 
-                    if missing_days >= 365:
-                        missing_times[0][1] = missing_days // 365
-                        logger.debug('missing_times[0]: ' + str(missing_times[0]))
+                if missing_days >= 30:
+                    missing_times[1][1] = missing_days // 30
+                    logger.debug('missing_times[1]: ' + str(missing_times[1]))
 
-                        missing_days = missing_days % 365
-                        logger.debug('missing_days: ' + str(missing_days))
+                    missing_days = missing_days % 30
+                    logger.debug('missing_days: ' + str(missing_days))
 
-                    if missing_days >= 30:
-                        missing_times[1][1] = missing_days // 30
-                        logger.debug('missing_times[1]: ' + str(missing_times[1]))
+                if missing_days >= 7:
+                    missing_times[2][1] = missing_days // 7
+                    logger.debug('missing_times[2]: ' + str(missing_times[2]))
 
-                        missing_days = missing_days % 30
-                        logger.debug('missing_days: ' + str(missing_days))
+                    missing_days = missing_days % 7
+                    logger.debug('missing_days: ' + str(missing_days))
 
-                    if missing_days >= 7:
-                        missing_times[2][1] = missing_days // 7
-                        logger.debug('missing_times[2]: ' + str(missing_times[2]))
+                if missing_days >= 1:
+                    missing_times[3][1] = missing_days
+                    logger.debug('missing_times[3]: ' + str(missing_times[3]))
 
-                        missing_days = missing_days % 7
-                        logger.debug('missing_days: ' + str(missing_days))
+                missing_seconds = check_missing_return['result']['missing_timedelta'].seconds
+                logger.debug('missing_seconds: ' + str(missing_seconds))
 
-                    if missing_days >= 1:
-                        missing_times[3][1] = missing_days
-                        logger.debug('missing_times[3]: ' + str(missing_times[3]))
+                if missing_seconds >= 3600:
+                    missing_times[4][1] = missing_seconds // 3600
+                    logger.debug('missing_times[4]: ' + str(missing_times[4]))
 
-                    missing_seconds = check_missing_return['result']['missing_timedelta'].seconds
+                    missing_seconds = missing_seconds % 3600
                     logger.debug('missing_seconds: ' + str(missing_seconds))
 
-                    if missing_seconds >= 3600:
-                        missing_times[4][1] = missing_seconds // 3600
-                        logger.debug('missing_times[4]: ' + str(missing_times[4]))
+                if missing_seconds >= 60:
+                    missing_times[5][1] = missing_seconds // 60
+                    logger.debug('missing_times[5]: ' + str(missing_times[5]))
 
-                        missing_seconds = missing_seconds % 3600
-                        logger.debug('missing_seconds: ' + str(missing_seconds))
-
-                    if missing_seconds >= 60:
-                        missing_times[5][1] = missing_seconds // 60
-                        logger.debug('missing_times[5]: ' + str(missing_times[5]))
-
-                        missing_seconds = missing_seconds % 60
-                        logger.debug('missing_seconds: ' + str(missing_seconds))
-
-                    missing_times[6][1] = missing_seconds
-                    logger.debug('missing_times[6]: ' + str(missing_times[6]))
-
-                    duration_readable = ''
-
-                    for missing in missing_times:
-                        interval = missing[0]
-                        logger.debug('interval: ' + interval)
-
-                        quantity = missing[1]
-                        logger.debug('quantity: ' + str(quantity))
-
-                        if quantity != None:
-                            if quantity == 1:
-                                interval_str = interval[:-1]
-                            else:
-                                interval_str = interval
-
-                            if duration_readable != '':
-                                duration_readable += ' '
-                                if interval == 'seconds':
-                                    duration_readable += 'and '
-
-                            duration_readable += str(quantity) + ' ' + interval_str
-                            logger.debug('duration_readable: ' + duration_readable)
-
-                    check_missing_return['result']['missing_duration'] = duration_readable
-                    logger.debug('check_missing_return[\'result\'][\'missing_duration\']: ' + check_missing_return['result']['missing_duration'])
-
-                    # Get datetime of first trade in database
-                    aggregation_pipeline = []
-
-                    match_pipeline = {'$match': {'exchange': exchange, 'market': market}}
-                    logger.debug('match_pipeline: ' + str(match_pipeline))
+                    missing_seconds = missing_seconds % 60
+                    logger.debug('missing_seconds: ' + str(missing_seconds))
 
-                    aggregation_pipeline.append(match_pipeline)
+                missing_times[6][1] = missing_seconds
+                logger.debug('missing_times[6]: ' + str(missing_times[6]))
 
-                    sort_pipeline = {'$sort': {'_id': 1}}
-                    logger.debug('sort_pipeline' + str(sort_pipeline))
+                duration_readable = ''
 
-                    aggregation_pipeline.append(sort_pipeline)
+                for missing in missing_times:
+                    interval = missing[0]
+                    logger.debug('interval: ' + interval)
 
-                    limit_pipeline = {'$limit': 1}
-                    logger.debug('limit_pipeline' + str(limit_pipeline))
+                    quantity = missing[1]
+                    logger.debug('quantity: ' + str(quantity))
 
-                    aggregation_pipeline.append(limit_pipeline)
+                    if quantity != None:
+                        if quantity == 1:
+                            interval_str = interval[:-1]
+                        else:
+                            interval_str = interval
 
-                    logger.debug('aggregation_pipeline' + str(aggregation_pipeline))
+                        if duration_readable != '':
+                            duration_readable += ' '
+                            if interval == 'seconds':
+                                duration_readable += 'and '
 
-                    aggregation_result = db.command('aggregate', collections['data'], cursor={}, pipeline=aggregation_pipeline)
+                        duration_readable += str(quantity) + ' ' + interval_str
+                        logger.debug('duration_readable: ' + duration_readable)
 
-                    logger.debug('aggregation_result[\'ok\']: ' + str(aggregation_result['ok']))
+                check_missing_return['result']['missing_duration'] = duration_readable
+                logger.debug('check_missing_return[\'result\'][\'missing_duration\']: ' + check_missing_return['result']['missing_duration'])
 
-                    if aggregation_result['ok'] == 1:
-                        if len(aggregation_result['cursor']['firstBatch']) > 0:
-                            trade_first = aggregation_result['cursor']['firstBatch'][0]
-                            logger.debug('trade_first: ' + str(trade_first))
+                # Get datetime of first trade in database
+                if market_meta['first_time'] != None:
+                    logger.debug('market_meta: ' + str(market_meta))
 
-                            check_missing_return['result']['trade_dt_first'] = datetime.datetime.fromtimestamp(float(trade_first['trade_time']) / 1000)
-                            logger.debug('check_missing_return[\'result\'][\'trade_dt_first\']: ' + str(check_missing_return['result']['trade_dt_first']))
+                    check_missing_return['result']['trade_dt_first'] = datetime.datetime.fromtimestamp(float(market_meta['first_time']) / 1000)
+                    logger.debug('check_missing_return[\'result\'][\'trade_dt_first\']: ' + str(check_missing_return['result']['trade_dt_first']))
 
-                else:
-                    logger.info('No trade data found for ' + exchange.capitalize() + '-' + market.upper() + '.')
+            else:
+                logger.info('No trade data found for ' + exchange.capitalize() + '-' + market.upper() + '.')
 
         except Exception as e:
             logger.exception(e)
@@ -559,44 +846,69 @@ class FlowMeter:
             return check_missing_return
 
 
-    def populate_historical(self, exchange, market, start_time=None, trade_id_last=None):
-        if exchange == 'binance':
-            keyword_arguments = {'symbol': market}
+    def populate_historical(self, exchange, market, start_time=None, trade_id_last=None, trade_time_last=None, end_id=None, end_time=None):
+        """
+        Backfill historical trades in a single pass (no page is fetched twice)
 
-            if trade_id_last == None:
-                keyword_arguments['start_str'] = start_time
-            else:
-                keyword_arguments['last_id'] = trade_id_last
+        start_time - Fill [start_time, now) with concurrent time chunks (milliseconds)
+        trade_id_last - Otherwise stream every trade after this aggregate id
+        trade_time_last - Trade time of trade_id_last, used for progress reporting
+        end_id - Stop before this aggregate id (ex. first live trade)
+        end_time - Stop at this trade time (Default: now)
+        """
 
-            # Get historical aggregated trade data as generator object and count number of historical trades
-            historical_trades = binance_client.aggregate_trade_iter(**keyword_arguments)
+        populate_return = {'success': True, 'result': None}
 
-            logger.info('Counting historical trades for database population.')
+        try:
+            if exchange == 'binance':
+                backfill = ChunkedBackfill(connect_binance(), self.storage, exchange, market,
+                                           trade_currency=self.user_trade_currency, quote_currency=self.user_quote_currency,
+                                           workers=self.backfill_workers, chunk_minutes=self.backfill_chunk_minutes,
+                                           weight_per_minute=config.getint('backfill', 'weight_per_minute', fallback=600),
+                                           request_weight=config.getint('backfill', 'request_weight', fallback=1),
+                                           progress_callback=self.backfill_progress_callback, merge=self.live_merge)
+
+                # Kept so another thread or runtime can stop() it
+                self.backfill = backfill
+
+                # Include trades sharing the first live trade's timestamp, end_id excludes the live ones
+                if end_time != None:
+                    end_time += 1
+
+                if start_time != None:
+                    populate_return = backfill.run(start_time, end_ms=end_time, end_id=end_id)
+                else:
+                    populate_return = backfill.stream(trade_id_last, start_ms=trade_time_last, end_ms=end_time, end_id=end_id)
 
-            trade_count = sum(1 for trade in historical_trades)
-            logger.debug('trade_count: ' + str(trade_count))
+                # Chunks left incomplete by an earlier run, possibly older than anything requested now
+                resume_result = backfill.resume(end_id=end_id)
 
-            # Get historical aggregated trade data again to refresh generator object (May make total count off by few trades)
-            historical_trades = binance_client.aggregate_trade_iter(**keyword_arguments)
+                if resume_result['success'] == False:
+                    logger.error('Failed to resume ' + str(len(resume_result['result']['failed_chunks'])) + ' incomplete backfill chunks.')
 
-            count = 0
-            for trade in historical_trades:
-                process_result = self.process_message(trade, populate=True, exchange=exchange, market=market)
+                for coverage in backfill.coverage_map():
+                    logger.debug('Backfill coverage: ' + str(coverage))
 
-                if process_result == False:
-                    logger.info('Database population complete.')
-                    break
-                else:
-                    count += 1
-                    completion_percentage = "{:.2f}".format((count / trade_count) * 100)
-                    logger.info('Processed ' + str(count) + ' of ~' + str(trade_count) + ' historical trades. [' + completion_percentage + '%]')
+                logger.info('Backfill inserted ' + str(populate_return['result']['inserted']) + ' trades (' +
+                            str(populate_return['result']['duplicates']) + ' already stored) in ' +
+                            "{:.1f}".format(populate_return['result']['duration']) + ' sec.')
 
-        elif exchange == 'poloniex':
-            logger.warning('POLONIEX DATABASE POPULATION NOT YET IMPLEMENTED.')
+            elif exchange == 'poloniex':
+                logger.warning('POLONIEX DATABASE POPULATION NOT YET IMPLEMENTED.')
 
-        else:
-            logger.error('Unrecognized exchange passed to populate_historical(). Exiting.')
-            sys.exit(1)
+                populate_return['success'] = False
+
+            else:
+                logger.error('Unrecognized exchange passed to populate_historical(). Exiting.')
+                sys.exit(1)
+
+        except Exception as e:
+            logger.exception(e)
+
+            populate_return['success'] = False
+
+        finally:
+            return populate_return
 
 
     #def analyze_data(market, feature, data, parameter, interval='1h', start=None):
@@ -702,18 +1014,14 @@ class FlowMeter:
                 pipeline_current = []
                 pipeline_last = []
 
-                # Match Stage
-                match_pipeline_current = {'$match': {'exchange': exchange, 'market': market, 'trade_time': {'$gte': analysis_start}}}
-                match_pipeline_last = {'$match': {'exchange': exchange, 'market': market, 'trade_time': {'$gte': analysis_start_last, '$lt': analysis_start}}}
-
+                # Match Stage (field names depend on the storage trade schema)
                 if match == 'all':
-                    pass
-                elif match == 'buy':
-                    match_pipeline_current['$match']['side'] = 'buy'
-                    match_pipeline_last['$match']['side'] = 'buy'
-                elif match == 'sell':
-                    match_pipeline_current['$match']['side'] = 'sell'
-                    match_pipeline_last['$match']['side'] = 'sell'
+                    match_side = None
+                else:
+                    match_side = match
+
+                match_pipeline_current = {'$match': self.storage.trade_match(exchange, market, {'$gte': analysis_start}, side=match_side)}
+                match_pipeline_last = {'$match': self.storage.trade_match(exchange, market, {'$gte': analysis_start_last, '$lt': analysis_start}, side=match_side)}
 
                 logger.debug('match_pipeline_current: ' + str(match_pipeline_current))
                 logger.debug('match_pipeline_last: ' + str(match_pipeline_last))
@@ -729,17 +1037,14 @@ class FlowMeter:
                 pipeline_current.append(sort_pipeline)
                 pipeline_last.append(sort_pipeline)
 
-                # Calculate total time between first and last document
-                doc_structure = db[collections['data']].find({})[0]
+                # Decode Stage (compact and bucket trade schemas only)
+                pipeline_current.extend(self.storage.decode_stages(exchange, market, {'$gte': analysis_start}, side=match_side))
+                pipeline_last.extend(self.storage.decode_stages(exchange, market, {'$gte': analysis_start_last, '$lt': analysis_start}, side=match_side))
 
-                # Project Stage
+                # Project Stage (trade fields are fixed, no need to read a trade for them)
                 project_pipeline = {'$project': {}}
 
-                doc_fields = []
-                for key in doc_structure:
-                    doc_fields.append(key)
-
-                for field in doc_fields:
+                for field in trade_fields:
                     project_pipeline['$project'][field] = 1
 
                 project_pipeline['$project']['amount'] = {'$multiply': ['$price', '$quantity']}
@@ -762,9 +1067,9 @@ class FlowMeter:
                 pipeline_last.append(group_pipeline)
 
                 ## Run Aggregation Pipelines ##
-                aggregate_result_current = db.command('aggregate', collections['data'], cursor={}, pipeline=pipeline_current)
+                aggregate_result_current = self.storage.db.command('aggregate', self.storage.trade_collection(exchange, market), cursor={}, pipeline=pipeline_current)
                 #aggregate_result_current = db[collections['data']].aggregate(pipeline_current)
-                aggregate_result_last = db.command('aggregate', collections['data'], cursor={}, pipeline=pipeline_last)
+                aggregate_result_last = self.storage.db.command('aggregate', self.storage.trade_collection(exchange, market), cursor={}, pipeline=pipeline_last)
                 #aggregate_result_last = db[collections['data']].aggregate(pipeline_last)
 
                 for key in aggregate_result_current:
@@ -854,15 +1159,156 @@ class FlowMeter:
             return analyze_return
 
 
+    def analyze_data_facet(self, exchange, market, intervals):
+        """
+        Analyze every interval, side and window (current/last) with a single $facet aggregation
+
+        exchange - Exchange to analyze (ex. binance)
+        market - Market to analyze (ex. XLMBTC)
+        intervals - List of durations to analyze (ex. ['1m', '1h', '1d'])
+
+        Returns {'success': bool, 'result': {interval: <analyze_data() return value>}}
+        """
+
+        analyze_facet_return = {'success': True, 'result': {}}
+
+        try:
+            unix_time_ms = int(time.mktime(datetime.datetime.now().timetuple()) * 1000)
+            logger.debug('unix_time_ms: ' + str(unix_time_ms))
+
+            analysis_deltas = {}
+            for interval in intervals:
+                analysis_deltas[interval] = interval_to_ms(interval)
+            logger.debug('analysis_deltas: ' + str(analysis_deltas))
+
+            aggregation_pipeline = []
+
+            # Match Stage (covers current and last windows of longest interval)
+            facet_time_match = {'$gte': unix_time_ms - (2 * max(analysis_deltas.values()))}
+
+            match_pipeline = {'$match': self.storage.trade_match(exchange, market, facet_time_match)}
+            logger.debug('match_pipeline: ' + str(match_pipeline))
+
+            aggregation_pipeline.append(match_pipeline)
+
+            # Decode Stage (compact and bucket trade schemas only)
+            aggregation_pipeline.extend(self.storage.decode_stages(exchange, market, facet_time_match))
+
+            # Project Stage (explicit fields, so no schema probe of the collection is needed)
+            project_pipeline = {'$project': {'_id': 0, 'trade_time': 1, 'side': 1, 'price': 1, 'quantity': 1,
+                                             'amount': {'$multiply': ['$price', '$quantity']}}}
+            logger.debug('project_pipeline: ' + str(project_pipeline))
+
+            aggregation_pipeline.append(project_pipeline)
+
+            # Facet Stage (one sub-pipeline per interval and window, grouped by side)
+            facet_pipeline = {'$facet': {}}
+
+            for interval in intervals:
+                analysis_start = unix_time_ms - analysis_deltas[interval]
+                analysis_start_last = analysis_start - analysis_deltas[interval]
+
+                windows = [('current', {'$gte': analysis_start}),
+                           ('last', {'$gte': analysis_start_last, '$lt': analysis_start})]
+
+                for window, time_match in windows:
+                    facet_pipeline['$facet'][interval + '_' + window] = [
+                        {'$match': {'trade_time': time_match}},
+                        {'$group': {'_id': '$side',
+                                    'volume': {'$sum': '$quantity'},
+                                    'price_sum': {'$sum': '$price'},
+                                    'amount': {'$sum': '$amount'},
+                                    'count': {'$sum': 1}}}
+                    ]
+
+            logger.debug('facet_pipeline: ' + str(facet_pipeline))
+
+            aggregation_pipeline.append(facet_pipeline)
+
+            ## Run Aggregation Pipeline ##
+            aggregate_result = self.storage.db.command('aggregate', self.storage.trade_collection(exchange, market), cursor={}, pipeline=aggregation_pipeline)
+
+            logger.debug('aggregate_result[\'ok\']: ' + str(aggregate_result['ok']))
+
+            if aggregate_result['ok'] == 1:
+                facet_result = aggregate_result['cursor']['firstBatch'][0]
+
+                for interval in intervals:
+                    window_metrics = {}
+
+                    for window in ['current', 'last']:
+                        side_sums = {}
+                        for group in facet_result[interval + '_' + window]:
+                            side_sums[group['_id']] = group
+
+                        window_metrics[window] = {'all': None, 'buy': None, 'sell': None}
+
+                        all_sums = {'volume': 0, 'price_sum': 0, 'amount': 0, 'count': 0}
+
+                        for side in ['buy', 'sell']:
+                            if side in side_sums:
+                                window_metrics[window][side] = {'volume': side_sums[side]['volume'],
+                                                                'price': side_sums[side]['price_sum'] / side_sums[side]['count'],
+                                                                'amount': side_sums[side]['amount'],
+                                                                'count': side_sums[side]['count']}
+
+                                for key in all_sums:
+                                    all_sums[key] += side_sums[side][key]
+
+                        if all_sums['count'] > 0:
+                            window_metrics[window]['all'] = {'volume': all_sums['volume'],
+                                                             'price': all_sums['price_sum'] / all_sums['count'],
+                                                             'amount': all_sums['amount'],
+                                                             'count': all_sums['count']}
+
+                    analyze_facet_return['result'][interval] = compile_analysis_result(window_metrics, analysis_deltas[interval])
+
+            else:
+                logger.error('Error returned from $facet aggregation pipeline.')
+
+                analyze_facet_return['success'] = False
+
+        except Exception as e:
+            logger.exception(e)
+
+            analyze_facet_return['success'] = False
+
+        except KeyboardInterrupt:
+            logger.info('Exit signal received while analyzing data.')
+            raise
+
+        finally:
+            return analyze_facet_return
+
+
     def cleanup_database(self, delete_before):
         cleanup_database_return = {'success': True, 'result': {'deleted_count': None}}
 
         try:
             delete_before_ms = time.mktime(dateparser.parse(delete_before).timetuple()) * 1000
 
-            delete_result = db[collections['data']].delete_many({'trade_time': {'$lt': delete_before_ms}})
+            cleanup_start = time.perf_counter()
+
+            delete_result = self.storage.delete_before(int(delete_before_ms))
+
+            # Checkpoints for deleted ranges would otherwise mark them complete
+            self.storage.delete_checkpoints(before_ms=int(delete_before_ms))
+
+            self.storage.delete_bars(before_ms=int(delete_before_ms))
+
+            # First trade and count change only for markets with trades before the cutoff
+            self.storage.refresh_expired_meta(int(delete_before_ms))
 
-            cleanup_database_return['result']['deleted_count'] = delete_result.deleted_count
+            cleanup_seconds.observe(time.perf_counter() - cleanup_start)
+
+            cleanup_database_return['result']['deleted_count'] = delete_result['result']['deleted_count']
+
+            if delete_result['result']['deleted_count'] != None:
+                cleanup_deleted.inc(delete_result['result']['deleted_count'])
+                cleanup_deleted_last.set(delete_result['result']['deleted_count'])
+
+            if delete_result['success'] == False:
+                cleanup_database_return['success'] = False
 
         except Exception as e:
             logger.exception(e)
@@ -872,92 +1318,196 @@ class FlowMeter:
         finally:
             return cleanup_database_return
 
-    def analysis_loop(self):
-        delay_start = 0
-        cleanup_last = 0
+    def prepare_analysis(self):
+        if self.analysis_mode in ['aggregate', 'facet'] and not isinstance(self.storage, MongoStorage):
+            logger.warning('Analysis mode ' + self.analysis_mode + ' requires MongoDB storage. Using storage backend analysis.')
 
-        while (True):
-            try:
-                if (time.time() - cleanup_last) > self.cleanup_interval:
-                    logger.info('Deleting old trade documents from database.')
+            self.analysis_mode = 'storage'
 
-                    cleanup_database_result = self.cleanup_database(delete_before='49 hours ago')
+        elif self.analysis_mode in ['aggregate', 'facet'] and isinstance(self.storage, BucketMongoStorage):
+            # Pipelines would unwind every bucket, storage analysis adds whole-minute bucket sums
+            logger.info('Bucket trade schema. Using storage backend analysis instead of ' + self.analysis_mode + '.')
 
-                    if cleanup_database_result['success'] == True:
-                        logger.info('Successfully deleted ' + str(cleanup_database_result['result']['deleted_count']) + ' old documents.')
+            self.analysis_mode = 'storage'
 
-                        cleanup_last = time.time()
-                    else:
-                        logger.error('Error while deleting old trade documents from database.')
+        if self.analysis_mode == 'bars' and self.maintain_flow_bars == False:
+            logger.warning('Analysis mode bars requires flow bars. Using storage backend analysis.')
 
-                while (time.time() - delay_start) < self.loop_time:
-                    time.sleep(1)
+            self.analysis_mode = 'storage'
 
-                logger.info('Analyzing trade data.')
+        if self.analysis_mode == 'engine':
+            # Created here so the arrays live in the analysis process
+            self.analysis_engine = RollingWindowEngine()
 
-                if self.save_flow_historical == True:
-                    flow_differential_values = {
-                        '_id': None,
-                        'time': None,
-                        'exchange': self.user_exchange,
-                        'market': self.user_market,
-                        'trade_currency': self.user_trade_currency,
-                        'quote_currency': self.user_quote_currency,
-                        'values': {}
-                    }
+    def cleanup_pass(self):
+        logger.info('Deleting old trade documents from database.')
 
-                for backtest in self.backtest_durations:
-                    logger.debug('backtest: ' + str(backtest))
+        cleanup_database_result = self.cleanup_database(delete_before='49 hours ago')
 
-                    analysis_results = self.analyze_data(exchange=self.user_exchange, market=self.user_market, interval=backtest[0])
+        if cleanup_database_result['success'] == True:
+            logger.info('Successfully deleted ' + str(cleanup_database_result['result']['deleted_count']) + ' old documents.')
+        else:
+            logger.error('Error while deleting old trade documents from database.')
 
-                    if analysis_results['success'] == True:
-                        analysis_document = analysis_results['result'].copy()
-                        analysis_document['_id'] = self.user_exchange + '-' + self.user_market.lower() + '-' + backtest[0]
-                        analysis_document['module'] = 'flowmeter'
-                        analysis_document['exchange'] = self.user_exchange
-                        analysis_document['market'] = self.user_market
-                        analysis_document['trade_currency'] = self.user_trade_currency
-                        analysis_document['quote_currency'] = self.user_quote_currency
-                        analysis_document['interval'] = backtest[1]
-                        analysis_document['updated'] = time.mktime(datetime.datetime.now().timetuple())
-                        #analysis_document['updated'] = datetime.datetime.now().isoformat()
+        if self.analysis_engine != None:
+            # Full reload also picks up any trades inserted out of order since last reload
+            logger.info('Reloading in-memory analysis engine.')
 
-                        pprint(analysis_document)
+            self.analysis_engine.sync_storage(self.storage, self.user_exchange, self.user_market, full=True)
 
-                        logger.info('Updating analysis database.')
+        return cleanup_database_result['success']
 
-                        update_result = db[collections['analysis']].update_one({'_id': analysis_document['_id']},
-                                                                               {'$set': analysis_document}, upsert=True)
-                        logger.debug('update_result.matched_count: ' + str(update_result.matched_count))
-                        logger.debug('update_result.modified_count: ' + str(update_result.modified_count))
+    def analysis_pass(self, sync_engine=True):
+        """
+        Analyze every backtest interval once, update analysis documents and archive flow differential
 
-                        if self.save_flow_historical == True:
-                            flow_differential_values['values'][backtest[0]] = analysis_document['current']['flow_differential']
+        sync_engine - Pull new trades from storage into the in-memory engine first (False if the caller feeds it)
+        """
 
-                    else:
-                        logger.error('Error while analyzing trade data.')
+        logger.info('Analyzing trade data.')
+
+        pass_start = time.perf_counter()
+
+        if self.analysis_engine != None and sync_engine == True:
+            resync_refilled = self.refill_resync != None and self.refill_resync.is_set()
+
+            if resync_refilled == True:
+                self.refill_resync.clear()
+
+            self.analysis_engine.sync_storage(self.storage, self.user_exchange, self.user_market, full=resync_refilled)
+
+        if self.save_flow_historical == True:
+            flow_differential_values = {
+                '_id': None,
+                'time': None,
+                'exchange': self.user_exchange,
+                'market': self.user_market,
+                'trade_currency': self.user_trade_currency,
+                'quote_currency': self.user_quote_currency,
+                'values': {}
+            }
+
+        if self.analysis_mode == 'facet':
+            facet_results = self.analyze_data_facet(exchange=self.user_exchange, market=self.user_market,
+                                                    intervals=[backtest[0] for backtest in self.backtest_durations])
+
+            analysis_seconds.labels(self.user_market, 'all', self.analysis_mode).observe(time.perf_counter() - pass_start)
+
+        elif self.analysis_mode == 'bars':
+            # Every interval from one read of at most a few hundred bars each
+            bar_results = analyze_bars(self.storage, self.user_exchange, self.user_market,
+                                       intervals=[backtest[0] for backtest in self.backtest_durations])
+
+            analysis_seconds.labels(self.user_market, 'all', self.analysis_mode).observe(time.perf_counter() - pass_start)
+
+        analysis_meta = {'analysis_updated': None, 'analysis_intervals': []}
+
+        for backtest in self.backtest_durations:
+            logger.debug('backtest: ' + str(backtest))
+
+            analysis_start = time.perf_counter()
+
+            if self.analysis_mode == 'facet':
+                if facet_results['success'] == True:
+                    analysis_results = facet_results['result'][backtest[0]]
+                else:
+                    analysis_results = {'success': False}
+            elif self.analysis_mode == 'bars':
+                analysis_results = bar_results[backtest[0]]
+            elif self.analysis_mode == 'storage':
+                analysis_results = self.storage.analyze(exchange=self.user_exchange, market=self.user_market, interval=backtest[0])
+            elif self.analysis_engine != None:
+                analysis_results = self.analysis_engine.analyze(exchange=self.user_exchange, market=self.user_market, interval=backtest[0])
+            else:
+                analysis_results = self.analyze_data(exchange=self.user_exchange, market=self.user_market, interval=backtest[0])
+
+            if self.analysis_mode not in ['facet', 'bars']:
+                analysis_seconds.labels(self.user_market, backtest[0], self.analysis_mode).observe(time.perf_counter() - analysis_start)
+
+            if analysis_results['success'] == True:
+                analysis_document = analysis_results['result'].copy()
+                analysis_document['_id'] = self.user_exchange + '-' + self.user_market.lower() + '-' + backtest[0]
+                analysis_document['module'] = 'flowmeter'
+                analysis_document['exchange'] = self.user_exchange
+                analysis_document['market'] = self.user_market
+                analysis_document['trade_currency'] = self.user_trade_currency
+                analysis_document['quote_currency'] = self.user_quote_currency
+                analysis_document['interval'] = backtest[1]
+                analysis_document['updated'] = time.mktime(datetime.datetime.now().timetuple())
+                #analysis_document['updated'] = datetime.datetime.now().isoformat()
+
+                pprint(analysis_document)
+
+                logger.info('Updating analysis database.')
+
+                update_result = self.storage.upsert_analysis(analysis_document)
+                logger.debug('update_result: ' + str(update_result))
+
+                self.publish('analysis', analysis_document['interval'], analysis_document)
+
+                analysis_meta['analysis_updated'] = analysis_document['updated']
+                analysis_meta['analysis_intervals'].append(analysis_document['interval'])
 
                 if self.save_flow_historical == True:
-                    # Get current market prices to archive with flow differential data
-                    flow_differential_values['market_prices'] = {
-                        self.user_market: binance_client.get_symbol_ticker(symbol=self.user_market)['price'],
-                        'BTCUSDT': binance_client.get_symbol_ticker(symbol='BTCUSDT')['price']
-                    }
-                    logger.debug('flow_differential_values[\'market_prices\']: ' + str(flow_differential_values['market_prices']))
+                    flow_differential_values['values'][backtest[0]] = analysis_document['current']['flow_differential']
 
-                    timestamp_current = int(time.mktime(datetime.datetime.now().timetuple()))
+            else:
+                logger.error('Error while analyzing trade data.')
+
+        if analysis_meta['analysis_updated'] != None:
+            # GUIs list analyzed markets and their intervals from the market metadata
+            self.storage.set_market_meta(self.user_exchange, self.user_market, analysis_meta)
+
+        if self.save_flow_historical == True:
+            # Get current market prices to archive with flow differential data
+            flow_differential_values['market_prices'] = {
+                self.user_market: connect_binance().get_symbol_ticker(symbol=self.user_market)['price'],
+                'BTCUSDT': connect_binance().get_symbol_ticker(symbol='BTCUSDT')['price']
+            }
+            logger.debug('flow_differential_values[\'market_prices\']: ' + str(flow_differential_values['market_prices']))
 
-                    flow_differential_values['time'] = timestamp_current
-                    flow_differential_values['_id'] = self.user_exchange + '-' + self.user_market.lower() + '-' + str(timestamp_current)
+            timestamp_current = int(time.mktime(datetime.datetime.now().timetuple()))
 
-                    logger.debug('flow_differential_values: ' + str(flow_differential_values))
+            flow_differential_values['time'] = timestamp_current
+            flow_differential_values['_id'] = self.user_exchange + '-' + self.user_market.lower() + '-' + str(timestamp_current)
 
-                    historical_flow_id = db[collections['historical']].insert_one(flow_differential_values).inserted_id
-                    logger.debug('historical_flow_id: ' + str(historical_flow_id))
+            logger.debug('flow_differential_values: ' + str(flow_differential_values))
+
+            historical_flow_id = self.storage.insert_historical(flow_differential_values)
+            logger.debug('historical_flow_id: ' + str(historical_flow_id))
+
+        analysis_pass_seconds.labels(self.user_market).observe(time.perf_counter() - pass_start)
+
+    def analysis_loop(self, metrics_queue=None, publish_queue=None):
+        """
+        metrics_queue - Queue to send analysis metrics back to the main process on (when run as a separate process)
+        publish_queue - Queue to send analysis documents to the main process publisher on (when run as a separate process)
+        """
+
+        if publish_queue != None:
+            self.publish_queue = publish_queue
+
+        delay_start = 0
+        cleanup_last = 0
+
+        self.prepare_analysis()
+
+        while (True):
+            try:
+                if (time.time() - cleanup_last) > self.cleanup_interval:
+                    if self.cleanup_pass() == True:
+                        cleanup_last = time.time()
+
+                while (time.time() - delay_start) < self.loop_time:
+                    time.sleep(1)
+
+                self.analysis_pass()
 
                 delay_start = time.time()
 
+                if metrics_queue != None:
+                    metrics_queue.put(metrics.registry.state(analysis_metric_names))
+
             except Exception as e:
                 logger.exception(e)
 
@@ -973,14 +1523,57 @@ class Display:
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--exchange', type=str, default=None, help='Exchange for analysis (ex. binance / poloniex).')
+    parser.add_argument('-m', '--market', type=str, default=None, help='Market for analysis (ex. XLMBTC).')
+    parser.add_argument('-l', '--loop', type=int, default=30, help='Time (seconds) between each analysis run (ex. 15). [Default: 30]')
+    parser.add_argument('-a', '--analysis-mode', type=str, default='aggregate', choices=['aggregate', 'facet', 'engine', 'storage', 'bars'], help='Analysis method (aggregate = database aggregation pipelines / facet = single $facet aggregation per loop / engine = in-memory rolling windows / storage = storage backend window queries / bars = 1s/1m/1h flow bars). [Default: aggregate]')
+    parser.add_argument('-c', '--clear', action='store_true', default=False, help='Clear all documents for requested market from database and start fresh.')
+    parser.add_argument('-w', '--backfill-workers', type=int, default=4, help='Concurrent workers for historical backfill. [Default: 4]')
+    parser.add_argument('-r', '--runtime', type=str, default='threaded', choices=['threaded', 'asyncio'], help='Runtime (threaded = Twisted websocket with writer/analysis threads or processes / asyncio = single event loop with cooperating tasks). [Default: threaded]')
+    parser.add_argument('--record', type=str, default=None, help='Record raw websocket messages to this directory (replay with recording.py).')
+    parser.add_argument('--no-gap-refill', action='store_true', default=False, help='Only count aggregate id gaps (metrics) instead of refilling them.')
+    parser.add_argument('--no-flow-bars', action='store_true', default=False, help='Don\'t maintain 1s/1m/1h flow bars (required by --analysis-mode bars).')
+    parser.add_argument('--strict-indexes', action='store_true', default=False, help='Exit if any hot query falls back to a collection scan.')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve Prometheus metrics on this local port. [Default: [metrics] flowmeter_port in config.ini]')
+    parser.add_argument('--metrics-snapshot', type=str, default=None, help='Write JSON metrics snapshots to this file. [Default: [metrics] flowmeter_snapshot in config.ini]')
+    parser.add_argument('--profile-dir', type=str, default=None, help='Enable profiling signals (USR1/USR2) and /debug endpoints, writing to this directory. [Default: [profiling] path in config.ini]')
+    parser.add_argument('--debug', action='store_true', default=False, help='Enable debug level output.')
+    args = parser.parse_args()
+
+    debug_mode = args.debug
+
+    if debug_mode == True:
+        logger.setLevel(logging.DEBUG)
+
     # Gather varialbles from program arguments
     user_exchange = args.exchange
     user_market = args.market
     loop_time = args.loop
+    analysis_mode = args.analysis_mode
+    strict_indexes = args.strict_indexes
+    backfill_workers = args.backfill_workers
+    runtime = args.runtime
+    record_path = args.record
 
     if user_exchange != None:
         user_exchange = user_exchange.lower()
     if user_market != None:
         user_market = user_market.upper()
 
-    flow_meter = FlowMeter(exchange=user_exchange, market=user_market, loop_time=loop_time, save_flow_historical=True)
+    metrics_exporter = metrics.open_metrics_exporter(config, 'flowmeter', port=args.metrics_port, snapshot_path=args.metrics_snapshot)
+
+    profiling.open_profiling_hooks(config, output_path=args.profile_dir)
+
+    flow_meter = FlowMeter(exchange=user_exchange, market=user_market, loop_time=loop_time, save_flow_historical=True, analysis_mode=analysis_mode, strict_indexes=strict_indexes,
+                           backfill_workers=backfill_workers, record_path=record_path, refill_gaps=(args.no_gap_refill == False),
+                           flow_bars=(args.no_flow_bars == False), autostart=(runtime == 'threaded'))
+
+    if runtime == 'asyncio':
+        # Optional dependency (websockets), only needed for this runtime
+        from async_runtime import AsyncRuntime
+
+        AsyncRuntime(flow_meter, stream_url=stream_url).run()
+
+    if metrics_exporter != None:
+        metrics_exporter.stop()
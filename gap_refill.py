@@ -0,0 +1,235 @@
+import logging
+import queue
+import threading
+
+from backfill import WeightLimiter, aggtrade_doc
+from id_ranges import IdRangeSet
+import metrics
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# aggregate_trade_iter() pages with the default limit (500) and drops the repeated first trade of each page
+iter_page_trades = 499
+
+# source - stream (id jump in received messages) / dropped (write queue full) / write (failed insert)
+gaps_detected = metrics.counter('flowmeter_gaps_detected_total', 'Aggregate trade id gaps detected.', ['market', 'source'])
+gap_missing_trades = metrics.counter('flowmeter_gap_missing_trades_total', 'Trades missing from detected gaps.', ['market', 'source'])
+gap_refilled_trades = metrics.counter('flowmeter_gap_refilled_trades_total', 'Missing trades fetched and written by the refill worker.', ['market'])
+gap_refill_failures = metrics.counter('flowmeter_gap_refill_failures_total', 'Gaps given up on after repeated refill errors.', ['market'])
+gap_pending_trades = metrics.gauge('flowmeter_gap_pending_trades', 'Missing trades queued or being refilled.')
+
+
+class GapTracker:
+    """
+    Per-market aggregate trade id continuity
+
+    Binance aggregate ids are contiguous per symbol, so each market only needs its highest id
+    seen. A message that skips ahead reports the ids in between as a gap. Older or repeated ids
+    (redelivery after a reconnect) are ignored. Trades that were received but never stored
+    (dropped from a full write queue, failed inserts) are reported through report_docs().
+
+    gap_callback - Called with (market, first_id, last_id, source) for every gap (ex. GapRefillWorker.submit)
+    """
+
+    def __init__(self, gap_callback=None):
+        self.gap_callback = gap_callback
+
+        self.last_ids = {}
+
+    def observe(self, market, trade_id):
+        last_id = self.last_ids.get(market)
+
+        if last_id == None or trade_id == last_id + 1:
+            self.last_ids[market] = trade_id
+
+        elif trade_id > last_id + 1:
+            self.last_ids[market] = trade_id
+
+            self.report(market, last_id + 1, trade_id - 1, 'stream')
+
+    def report(self, market, first_id, last_id, source):
+        gaps_detected.labels(market, source).inc()
+        gap_missing_trades.labels(market, source).inc(last_id - first_id + 1)
+
+        logger.warning('Missing ' + str(last_id - first_id + 1) + ' ' + market + ' trades (' + str(first_id) + '-' + str(last_id) + ', ' + source + ').')
+
+        if self.gap_callback != None:
+            self.gap_callback(market, first_id, last_id, source)
+
+    def report_docs(self, trade_docs, source):
+        """
+        Report trade documents that never reached storage, collapsed into id ranges per market
+        """
+
+        market_ids = {}
+        for trade_doc in trade_docs:
+            market_ids.setdefault(trade_doc['market'], []).append(trade_doc['_id'])
+
+        for market, trade_ids in market_ids.items():
+            for first_id, last_id in IdRangeSet.from_ids(trade_ids).ranges():
+                self.report(market, first_id, last_id, source)
+
+
+class GapRefillWorker(threading.Thread):
+    """
+    Fetches exactly the missing aggregate ids of queued gaps and writes them to storage
+
+    Each gap is read with aggregate_trade_iter(last_id=first_id - 1) and written in batches of
+    batch_size with insert_trades(), which skips anything that arrived in the meantime. Requests
+    share one WeightLimiter, failed gaps are retried after retry_delay from the last written id, and gaps
+    are given up on (and counted) after max_retries.
+
+    currencies - Function of market returning (trade currency, quote currency) for trade documents
+    callback - Called with (market, trade documents) after each written batch (ex. to feed an in-memory engine)
+    """
+
+    def __init__(self, client, storage, exchange, currencies, callback=None, max_queue=10000, weight_per_minute=300,
+                 batch_size=1000, max_retries=3, retry_delay=5):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.client = client
+        self.storage = storage
+        self.exchange = exchange
+        self.currencies = currencies
+        self.callback = callback
+
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self.limiter = WeightLimiter(weight_per_minute)
+
+        self.gap_queue = queue.Queue(maxsize=max_queue)
+
+        self.pending_trades = 0
+        self.pending_lock = threading.Lock()
+
+        gap_pending_trades.set_function(lambda: self.pending_trades)
+
+        self.stop_event = threading.Event()
+
+    def submit(self, market, first_id, last_id, source=None):
+        try:
+            self.gap_queue.put_nowait((market, first_id, last_id, 0))
+
+        except queue.Full:
+            logger.error('Gap refill queue full. Not refilling ' + market + ' ' + str(first_id) + '-' + str(last_id) + '.')
+
+            gap_refill_failures.labels(market).inc()
+
+            return False
+
+        with self.pending_lock:
+            self.pending_trades += last_id - first_id + 1
+
+        return True
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                market, first_id, last_id, attempts = self.gap_queue.get(timeout=1)
+
+            except queue.Empty:
+                continue
+
+            refill_result = self.refill(market, first_id, last_id)
+
+            if refill_result['success'] == True:
+                with self.pending_lock:
+                    self.pending_trades -= last_id - first_id + 1
+
+                continue
+
+            # Retry whatever is still missing after the last written id
+            resume_id = refill_result['result']['trade_id_last'] + 1 if refill_result['result']['trade_id_last'] != None else first_id
+
+            with self.pending_lock:
+                self.pending_trades -= resume_id - first_id
+
+            if attempts + 1 >= self.max_retries:
+                logger.error('Giving up on ' + market + ' trades ' + str(resume_id) + '-' + str(last_id) + ' after ' + str(attempts + 1) + ' attempts.')
+
+                gap_refill_failures.labels(market).inc()
+
+                with self.pending_lock:
+                    self.pending_trades -= last_id - resume_id + 1
+
+                continue
+
+            if self.stop_event.wait(self.retry_delay):
+                break
+
+            self.gap_queue.put((market, resume_id, last_id, attempts + 1))
+
+    def refill(self, market, first_id, last_id):
+        refill_return = {'success': True, 'result': {'inserted': 0, 'duplicates': 0, 'trade_id_last': None}}
+
+        try:
+            trade_currency, quote_currency = self.currencies(market)
+
+            trade_docs = []
+            trade_count = 0
+
+            self.limiter.acquire()
+
+            for trade in self.client.aggregate_trade_iter(symbol=market, last_id=first_id - 1):
+                if int(trade['a']) > last_id or self.stop_event.is_set():
+                    break
+
+                trade_docs.append(aggtrade_doc(trade, self.exchange, market, trade_currency, quote_currency, doc_type='refill'))
+
+                trade_count += 1
+
+                if int(trade['a']) == last_id:
+                    break
+
+                if len(trade_docs) >= self.batch_size:
+                    self.write_batch(market, trade_docs, refill_return)
+
+                    trade_docs = []
+
+                if trade_count % iter_page_trades == 0:
+                    # Next trade comes from a new request
+                    self.limiter.acquire()
+
+            if len(trade_docs) > 0:
+                self.write_batch(market, trade_docs, refill_return)
+
+            logger.info('Refilled ' + market + ' trades ' + str(first_id) + '-' + str(last_id) + '. [' +
+                        str(refill_return['result']['inserted']) + ' inserted, ' + str(refill_return['result']['duplicates']) + ' already stored]')
+
+        except Exception as e:
+            logger.warning('Error while refilling ' + market + ' trades ' + str(first_id) + '-' + str(last_id) + ' (' + str(e) + ').')
+
+            refill_return['success'] = False
+
+        finally:
+            return refill_return
+
+    def write_batch(self, market, trade_docs, refill_return):
+        insert_result = self.storage.insert_trades(trade_docs)
+
+        if insert_result['success'] == False:
+            raise RuntimeError('Storage error while writing refilled trades.')
+
+        refill_return['result']['inserted'] += insert_result['result']['inserted']
+        refill_return['result']['duplicates'] += insert_result['result']['duplicates']
+        refill_return['result']['trade_id_last'] = trade_docs[-1]['_id']
+
+        gap_refilled_trades.labels(market).inc(insert_result['result']['inserted'])
+
+        self.storage.record_written(trade_docs, insert_result['result']['inserted'])
+
+        if self.callback != None:
+            self.callback(market, trade_docs)
+
+    def stop(self, timeout=10):
+        self.stop_event.set()
+
+        if self.is_alive():
+            self.join(timeout)
+
+        if self.gap_queue.qsize() > 0:
+            logger.warning(str(self.gap_queue.qsize()) + ' gaps left unfilled at exit.')
@@ -9,13 +9,18 @@ from pprint import pprint
 import time
 import threading
 
-from pymongo import MongoClient
 
 from binance.client import Client as BinanceClient
-from binance.depthcache import DepthCacheManager
 from binance.websockets import BinanceSocketManager
 from twisted.internet import reactor
 
+from recording import open_depth_cache_manager
+from binance_endpoints import apply_endpoint_overrides
+import metrics
+import profiling
+from pubsub import MarketSubscription
+from storage import open_storage
+
 import tkinter as tk
 from tkinter import font
 from tkinter import ttk
@@ -29,18 +34,15 @@ config_path = 'config/config.ini'
 config = configparser.ConfigParser()
 config.read(config_path)
 
-mongo_uri = config['mongodb']['uri']
+# Storage backend selected by [storage] backend in config.ini (Default: mongo)
+storage = open_storage(config)
 
-if mongo_uri == 'localhost':
-    mongo_uri = None
+# Raw depth messages are recorded when [recording] path is set in config.ini (replay with recording.py)
+record_path = config.get('recording', 'path', fallback=None)
 
-db = MongoClient(mongo_uri)[config['mongodb']['db']]
+apply_endpoint_overrides(config)
 
-collections = {
-    'data': config['mongodb']['collection_data'],
-    'analysis': config['mongodb']['collection_analysis'],
-    'candles': config['mongodb']['collection_candles']
-}
+display_refresh_seconds = metrics.histogram('gui_display_refresh_seconds', 'Time to refresh one display panel from storage.', ['panel'])
 
 binance_api = config['binance']['api']
 binance_secret = config['binance']['secret']
@@ -318,6 +320,9 @@ class Display(threading.Thread):
         self.combobox_markets = None
         self.combobox_intervals = None
 
+        # Trades and analysis pushed by flowmeter.py for the selected market ([pubsub] in config.ini)
+        self.subscription = None
+
         # Binance Websocket-based Features
         self.binance_dcm = None
 
@@ -1134,7 +1139,12 @@ class Display(threading.Thread):
         process_combobox_return = {'success': True}
 
         try:
-            analysis_documents = db[collections['analysis']].find({})
+            # Analyzed markets from the market metadata (one document per market)
+            analysis_documents = [doc for doc in storage.market_catalog() if doc['analysis_updated'] != None]
+
+            if len(analysis_documents) == 0:
+                # Analysis written before the market metadata existed
+                analysis_documents = storage.analysis_catalog()
 
             for doc in analysis_documents:
                 if doc['exchange'] not in self.available_analysis:
@@ -1167,14 +1177,20 @@ class Display(threading.Thread):
             else:
                 logger.info('Current Selection (Market): ' + self.variables['menu']['market'].get())
 
-            analysis_documents = db[collections['analysis']].find({'exchange': self.variables['menu']['exchange'].get().lower(),
-                                                                   'market': self.variables['menu']['market'].get()})
+            market_meta = storage.market_meta(self.variables['menu']['exchange'].get().lower(), self.variables['menu']['market'].get())
 
             self.combobox_intervals = []
 
-            for doc in analysis_documents:
-                if doc['interval'] not in self.combobox_intervals:
-                    self.combobox_intervals.append(doc['interval'])
+            if market_meta != None and market_meta['analysis_intervals'] != None:
+                self.combobox_intervals = list(market_meta['analysis_intervals'])
+
+            else:
+                analysis_documents = storage.analysis_catalog(exchange=self.variables['menu']['exchange'].get().lower(),
+                                                            market=self.variables['menu']['market'].get())
+
+                for doc in analysis_documents:
+                    if doc['interval'] not in self.combobox_intervals:
+                        self.combobox_intervals.append(doc['interval'])
 
             logger.debug('self.combobox_intervals: ' + str(self.combobox_intervals))
 
@@ -1193,6 +1209,14 @@ class Display(threading.Thread):
             else:
                 logger.info('Current Selection (Interval): ' + self.variables['menu']['interval'].get())
 
+            if (self.subscription == None or self.subscription.exchange != self.variables['menu']['exchange'].get().lower() or
+                self.subscription.market != self.variables['menu']['market'].get()):
+                if self.subscription != None:
+                    self.subscription.close()
+
+                self.subscription = MarketSubscription(config, storage, self.variables['menu']['exchange'].get().lower(),
+                                                       self.variables['menu']['market'].get())
+
             # Set Trade Frame Titles
             active_market_main = self.variables['menu']['exchange'].get() + ' - ' + self.variables['menu']['market'].get()
             logger.debug('active_market_main: ' + active_market_main)
@@ -1218,7 +1242,7 @@ class Display(threading.Thread):
                     self.binance_dcm.close()
 
                     logger.debug('Opening new depth cache manager.')
-                    self.binance_dcm = DepthCacheManager(binance_client, symbol=self.variables['menu']['market'].get(), callback=self.orderbook_handler, refresh_interval=300)
+                    self.binance_dcm = open_depth_cache_manager(binance_client, symbol=self.variables['menu']['market'].get(), callback=self.orderbook_handler, refresh_interval=300, record_path=record_path)
 
         except Exception as e:
             logger.exception(e)
@@ -1313,7 +1337,8 @@ class Display(threading.Thread):
                 ## Update Trade Display Values ##
                 #logger.debug('Updating trade display.')
 
-                update_trade_result = self.update_trade_values()
+                with display_refresh_seconds.labels('trade').time():
+                    update_trade_result = self.update_trade_values()
 
                 if update_trade_result['success'] == False:
                     logger.error('Error while updating trade display.')
@@ -1321,8 +1346,10 @@ class Display(threading.Thread):
                 ## Update Analysis Display Values ##
                 #logger.debug('Updating analysis display.')
 
-                if (time.time() - analysis_check_last) > self.analysis_update_interval:
-                    update_analysis_result = self.update_analysis_values()
+                # Pushed analysis documents are shown right away, polling covers a missing publisher
+                if (time.time() - analysis_check_last) > self.analysis_update_interval or (self.subscription != None and self.subscription.take_analysis_update() == True):
+                    with display_refresh_seconds.labels('analysis').time():
+                        update_analysis_result = self.update_analysis_values()
 
                     if update_analysis_result['success'] == False:
                         logger.error('Error while updating analysis display.')
@@ -1351,7 +1378,7 @@ class Display(threading.Thread):
                 # Open depth cache manager for orderbook if not yet initialized
                 elif self.binance_dcm == None:
                     logger.debug('Initializing depth cache manager.')
-                    self.binance_dcm = DepthCacheManager(binance_client, symbol=self.variables['menu']['market'].get(), callback=self.orderbook_handler, refresh_interval=300)
+                    self.binance_dcm = open_depth_cache_manager(binance_client, symbol=self.variables['menu']['market'].get(), callback=self.orderbook_handler, refresh_interval=300, record_path=record_path)
 
                 # Check if database values are up-to-date
                 status_warning = False
@@ -1385,6 +1412,7 @@ class Display(threading.Thread):
                 while (time.time() - delay_start) < self.trade_update_interval:
                     if self.display_active == False: break
                     time.sleep(0.1)
+                    if self.subscription != None and self.subscription.take_update() == True: break
 
             except Exception as e:
                 logger.exception(e)
@@ -1401,6 +1429,9 @@ class Display(threading.Thread):
 
         self.root.quit()
 
+        if self.subscription != None:
+            self.subscription.close()
+
         if reactor.running:
             logger.debug('Closing depth cache manager.')
             self.binance_dcm.close()
@@ -1414,34 +1445,12 @@ class Display(threading.Thread):
         update_return = {'success': True}
 
         try:
-            ## Get most recent trade info from database ##
+            ## Get most recent trade info (pushed, or from database) ##
             #logger.debug('Retrieving most recent trade from database.')
 
-            trade_pipeline = []
-
-            # Match stage to retrieve documents for selected exchange and market
-            match_pipeline = {'$match': {
-                'exchange': self.variables['menu']['exchange'].get().lower(),
-                'market': self.variables['menu']['market'].get()
-            }}
-
-            # Sort stage to order with most recent trade first
-            sort_pipeline = {'$sort': {'_id': -1}}
-            trade_pipeline.append(sort_pipeline)
-
-            # Limit stage to retrieve only most recent trade
-            limit_pipeline = {'$limit': 1}
-            trade_pipeline.append(limit_pipeline)
+            trade_last = self.subscription.latest_trade()
 
-            # Run aggregation pipeline
-            #logger.debug('trade_pipeline: ' + str(trade_pipeline))
-
-            aggregate_result = db.command('aggregate', collections['data'], cursor={}, pipeline=trade_pipeline)
-
-            #logger.debug('aggregate_result[\'ok\']: ' + str(aggregate_result['ok']))
-
-            if aggregate_result['ok'] == 1:
-                trade_last = aggregate_result['cursor']['firstBatch'][0]
+            if trade_last != None:
 
                 #pprint(trade_last)
 
@@ -1461,7 +1470,7 @@ class Display(threading.Thread):
                     self.trade_data_ready = True
 
             else:
-                logger.error('Error returned from aggregation pipeline while retrieving most recent trade document.')
+                logger.error('No trade document found for selected market.')
 
                 update_result['success'] = False
 
@@ -1480,36 +1489,12 @@ class Display(threading.Thread):
         update_return = {'success': True}
 
         try:
-            ## Get most recent analysis info from database ##
+            ## Get most recent analysis info (pushed, or from database) ##
             #logger.debug('Retrieving most recent analysis from database.')
 
-            analysis_pipeline = []
-
-            # Match stage to retrieve documents for selected exchange, market, and interval
-            match_pipeline = {'$match': {
-                'exchange': self.variables['menu']['exchange'].get().lower(),
-                'market': self.variables['menu']['market'].get(),
-                'interval': self.variables['menu']['interval'].get()
-            }}
-            analysis_pipeline.append(match_pipeline)
-
-            # Sort stage to order with most recent analysis first
-            sort_pipeline = {'$sort': {'time': -1}}
-            analysis_pipeline.append(sort_pipeline)
-
-            # Limit stage to retrieve only most recent analysis
-            limit_pipeline = {'$limit': 1}
-            analysis_pipeline.append(limit_pipeline)
+            analysis_last = self.subscription.latest_analysis(self.variables['menu']['interval'].get())
 
-            # Run aggregation pipeline
-            #logger.debug('analysis_pipeline: ' + str(analysis_pipeline))
-
-            aggregate_result = db.command('aggregate', collections['analysis'], cursor={}, pipeline=analysis_pipeline)
-
-            #logger.debug('aggregate_result[\'ok\']: ' + str(aggregate_result['ok']))
-
-            if aggregate_result['ok'] == 1:
-                analysis_last = aggregate_result['cursor']['firstBatch'][0]
+            if analysis_last != None:
 
                 #pprint(analysis_last)
 
@@ -1756,7 +1741,7 @@ class Display(threading.Thread):
                     self.analysis_data_ready = True
 
             else:
-                logger.error('Error returned from aggregation pipeline while retrieving most recent analysis document.')
+                logger.error('No analysis document found for selected market and interval.')
 
         except Exception as e:
             logger.exception(e)
@@ -1818,12 +1803,20 @@ class Display(threading.Thread):
 
 
 def main():
+    # [metrics] gui_port / gui_snapshot and [profiling] path in config.ini
+    metrics_exporter = metrics.open_metrics_exporter(config, 'gui')
+
+    profiling.open_profiling_hooks(config)
+
     root = tk.Tk()
     display = Display(root)
     display.get_widget_attributes()
     root.mainloop()
     root.destroy()
 
+    if metrics_exporter != None:
+        metrics_exporter.stop()
+
 
 if __name__ == '__main__':
     main()
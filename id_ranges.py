@@ -0,0 +1,124 @@
+import bisect
+
+
+class IdRangeSet:
+    """
+    Set of integer ids stored as sorted, non-overlapping [first, last] ranges
+
+    Binance aggregate trade ids are contiguous per symbol, so a market's stored trades collapse
+    to a handful of ranges and in-order appends only ever extend the final range.
+    """
+
+    def __init__(self, ranges=None):
+        self.firsts = []
+        self.lasts = []
+
+        if ranges != None:
+            for first, last in ranges:
+                self.add_range(first, last)
+
+    def __contains__(self, trade_id):
+        index = bisect.bisect_right(self.firsts, trade_id) - 1
+
+        return index >= 0 and trade_id <= self.lasts[index]
+
+    def __len__(self):
+        return len(self.firsts)
+
+    def add(self, trade_id):
+        """
+        Add single id. Returns False if id was already present.
+        """
+
+        # Fast path for in-order appends
+        if len(self.lasts) > 0 and trade_id == self.lasts[-1] + 1:
+            self.lasts[-1] = trade_id
+            return True
+
+        if trade_id in self:
+            return False
+
+        self.add_range(trade_id, trade_id)
+
+        return True
+
+    def add_range(self, first, last):
+        if last < first:
+            return
+
+        index = bisect.bisect_left(self.firsts, first)
+
+        # Merge with previous range if overlapping or adjacent
+        if index > 0 and self.lasts[index - 1] >= first - 1:
+            index -= 1
+            first = self.firsts[index]
+            last = max(last, self.lasts[index])
+            del self.firsts[index]
+            del self.lasts[index]
+
+        # Absorb following ranges covered by the new one
+        while index < len(self.firsts) and self.firsts[index] <= last + 1:
+            last = max(last, self.lasts[index])
+            del self.firsts[index]
+            del self.lasts[index]
+
+        self.firsts.insert(index, first)
+        self.lasts.insert(index, last)
+
+    def remove_below(self, trade_id):
+        """
+        Forget every id lower than trade_id (ex. after retention cleanup)
+        """
+
+        while len(self.firsts) > 0 and self.lasts[0] < trade_id:
+            del self.firsts[0]
+            del self.lasts[0]
+
+        if len(self.firsts) > 0 and self.firsts[0] < trade_id:
+            self.firsts[0] = trade_id
+
+    def ranges(self):
+        return list(zip(self.firsts, self.lasts))
+
+    def gaps(self):
+        """
+        Missing [first, last] ranges between stored ranges
+        """
+
+        return [(self.lasts[x] + 1, self.firsts[x + 1] - 1) for x in range(len(self.firsts) - 1)]
+
+    def first(self):
+        return self.firsts[0] if len(self.firsts) > 0 else None
+
+    def last(self):
+        return self.lasts[-1] if len(self.lasts) > 0 else None
+
+    def count(self):
+        return sum((self.lasts[x] - self.firsts[x] + 1) for x in range(len(self.firsts)))
+
+    @classmethod
+    def from_ids(cls, trade_ids):
+        """
+        Build from an iterable or numpy array of ids (any order, duplicates allowed)
+        """
+
+        id_ranges = cls()
+
+        sorted_ids = sorted(set(int(trade_id) for trade_id in trade_ids))
+
+        if len(sorted_ids) == 0:
+            return id_ranges
+
+        first = sorted_ids[0]
+        last = first
+        for trade_id in sorted_ids[1:]:
+            if trade_id != last + 1:
+                id_ranges.firsts.append(first)
+                id_ranges.lasts.append(last)
+                first = trade_id
+            last = trade_id
+
+        id_ranges.firsts.append(first)
+        id_ranges.lasts.append(last)
+
+        return id_ranges
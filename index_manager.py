@@ -0,0 +1,220 @@
+import logging
+import time
+
+from pymongo import ASCENDING, DESCENDING
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Indexes required by the hot queries of flowmeter.py, gui_framework*.py and analyze_historical.py
+required_indexes = {
+    'data': [
+        # analyze_data() $match (all trades) and cleanup scoped to a market
+        [('exchange', ASCENDING), ('market', ASCENDING), ('trade_time', ASCENDING)],
+        # analyze_data() $match (buy/sell trades)
+        [('exchange', ASCENDING), ('market', ASCENDING), ('side', ASCENDING), ('trade_time', ASCENDING)],
+        # latest_trade() $sort: {_id: -1} (market metadata refresh, GUI fallback without a recent trade ring)
+        [('exchange', ASCENDING), ('market', ASCENDING), ('_id', DESCENDING)],
+        # cleanup_database() trade_time range delete across all markets
+        [('trade_time', ASCENDING)]
+    ],
+    'analysis': [
+        # Display.update_analysis_values() and process_combobox_selections()
+        [('exchange', ASCENDING), ('market', ASCENDING), ('interval', ASCENDING)]
+    ],
+    'historical': [
+        # analyze_historical.py sort=[('time', 1)]
+        [('exchange', ASCENDING), ('market', ASCENDING), ('time', ASCENDING)]
+    ],
+    'candles': [
+        [('exchange', ASCENDING), ('market', ASCENDING), ('time', ASCENDING)]
+    ],
+    'backfill': [
+        # Backfill checkpoint load and retention cleanup
+        [('exchange', ASCENDING), ('market', ASCENDING), ('chunk_start', ASCENDING)],
+        [('chunk_end', ASCENDING)]
+    ],
+    'bars': [
+        # FlowBars range reads and retention cleanup (window analysis reads bars by _id)
+        [('exchange', ASCENDING), ('market', ASCENDING), ('resolution', ASCENDING), ('start', ASCENDING)],
+        [('end', ASCENDING)]
+    ]
+}
+
+
+class IndexPlanError(Exception):
+    pass
+
+
+def find_plan_stages(explain_result):
+    """
+    Collect every stage name found inside the winning plan(s) of an explain result
+    """
+
+    stages = []
+
+    def walk(node, in_plan):
+        if isinstance(node, dict):
+            if in_plan == True and 'stage' in node:
+                stages.append(node['stage'])
+
+            for key in node:
+                walk(node[key], in_plan or key in ['winningPlan', 'queryPlan'])
+
+        elif isinstance(node, list):
+            for item in node:
+                walk(item, in_plan)
+
+    walk(explain_result, False)
+
+    return stages
+
+
+class IndexManager:
+    """
+    Declares and builds the indexes required by the hot queries, then verifies with explain
+    that none of those queries fall back to a collection scan.
+
+    collections - Collection name dictionary as built by each module from config.ini (missing keys are skipped)
+    exchange/market - Sample values used when building hot queries for explain
+    storage - Mongo storage object the trades are written with (Default: None). Trade indexes and hot queries
+              then come from its schema (storage.trade_indexes() / trade_hot_queries()) instead of the 'data' collection.
+    """
+
+    def __init__(self, db, collections, exchange='binance', market='BTCUSDT', storage=None):
+        self.db = db
+        self.collections = collections
+
+        self.exchange = exchange
+        self.market = market
+
+        self.storage = storage
+
+    def collection_indexes(self, collection_key):
+        """
+        (collection name, index keys) pairs to build for a collection key
+        """
+
+        if collection_key == 'data' and self.storage != None:
+            return self.storage.trade_indexes(self.exchange, self.market)
+
+        return [(self.collections[collection_key], index_keys) for index_keys in required_indexes[collection_key]]
+
+    def ensure_indexes(self, collection_keys=None):
+        ensure_indexes_return = {'success': True, 'result': {}}
+
+        try:
+            if collection_keys == None:
+                collection_keys = list(required_indexes.keys())
+
+            for collection_key in collection_keys:
+                if collection_key not in self.collections:
+                    logger.debug('No ' + collection_key + ' collection configured. Skipping indexes.')
+                    continue
+
+                ensure_indexes_return['result'][collection_key] = []
+
+                for collection_name, index_keys in self.collection_indexes(collection_key):
+                    build_start = time.time()
+
+                    # create_index is a no-op if an identical index already exists
+                    index_name = self.db[collection_name].create_index(index_keys)
+
+                    logger.debug('Index ' + collection_name + '.' + index_name + ' ready in ' +
+                                 "{:.2f}".format(time.time() - build_start) + ' sec.')
+
+                    ensure_indexes_return['result'][collection_key].append(index_name)
+
+        except Exception as e:
+            logger.exception(e)
+
+            ensure_indexes_return['success'] = False
+
+        finally:
+            return ensure_indexes_return
+
+    def hot_queries(self):
+        """
+        Explain commands for each hot query, as (name, collection name, explain command)
+        """
+
+        now_ms = int(time.time() * 1000)
+        market_match = {'exchange': self.exchange, 'market': self.market}
+
+        queries = []
+
+        def aggregate(collection_key, pipeline):
+            return {'aggregate': self.collections[collection_key], 'pipeline': pipeline, 'cursor': {}}
+
+        def find(collection_key, query_filter, sort=None, limit=None):
+            find_command = {'find': self.collections[collection_key], 'filter': query_filter}
+            if sort != None:
+                find_command['sort'] = sort
+            if limit != None:
+                find_command['limit'] = limit
+            return find_command
+
+        def delete(collection_key, query_filter):
+            return {'delete': self.collections[collection_key], 'deletes': [{'q': query_filter, 'limit': 0}]}
+
+        if self.storage != None:
+            # Trade collection(s) and filters of the configured schema (compact/bucket trades aren't in 'data')
+            queries.extend(self.storage.trade_hot_queries(self.exchange, self.market, now_ms))
+
+        elif 'data' in self.collections:
+            analysis_match = dict(market_match, trade_time={'$gte': now_ms - 86400000})
+            analysis_match_side = dict(analysis_match, side='buy')
+
+            queries.append(('analyze_data (all)', self.collections['data'], aggregate('data', [{'$match': analysis_match}, {'$sort': {'_id': 1}}])))
+            queries.append(('analyze_data (side)', self.collections['data'], aggregate('data', [{'$match': analysis_match_side}, {'$sort': {'_id': 1}}])))
+            queries.append(('latest_trade', self.collections['data'], aggregate('data', [{'$match': market_match}, {'$sort': {'_id': -1}}, {'$limit': 1}])))
+            queries.append(('cleanup_database', self.collections['data'], delete('data', {'trade_time': {'$lt': now_ms - (49 * 3600000)}})))
+
+        if 'analysis' in self.collections:
+            queries.append(('update_analysis_values', self.collections['analysis'],
+                            find('analysis', dict(market_match, interval='1 hour'), sort={'time': -1}, limit=1)))
+
+        if 'historical' in self.collections:
+            queries.append(('analyze_historical', self.collections['historical'], find('historical', market_match, sort={'time': 1})))
+
+        return queries
+
+    def verify_query_plans(self, strict=False):
+        """
+        Explain each hot query and report any collection scans
+
+        strict - Raise IndexPlanError instead of logging when a query uses COLLSCAN
+        """
+
+        verify_plans_return = {'success': True, 'result': {'plans': {}, 'collscan': []}}
+
+        for query_name, collection_name, command in self.hot_queries():
+            try:
+                explain_result = self.db.command('explain', command, verbosity='queryPlanner')
+
+                plan_stages = find_plan_stages(explain_result)
+                logger.debug(query_name + ' plan: ' + str(plan_stages))
+
+                verify_plans_return['result']['plans'][query_name] = plan_stages
+
+                if 'COLLSCAN' in plan_stages:
+                    logger.warning('Query ' + query_name + ' on ' + collection_name + ' uses a collection scan.')
+
+                    verify_plans_return['result']['collscan'].append(query_name)
+
+            except Exception as e:
+                logger.exception(e)
+
+                verify_plans_return['success'] = False
+
+        if len(verify_plans_return['result']['collscan']) > 0:
+            verify_plans_return['success'] = False
+
+            if strict == True:
+                raise IndexPlanError('Collection scan in hot queries: ' + ', '.join(verify_plans_return['result']['collscan']))
+
+        else:
+            logger.info('All hot queries use indexes.')
+
+        return verify_plans_return
@@ -0,0 +1,475 @@
+import argparse
+import asyncio
+import configparser
+import datetime
+import functools
+import logging
+import signal
+import time
+
+from analysis_pool import ShardedAnalysisPool
+from async_runtime import batch_writer, parse_aggtrade, queue_live_trade, stream_intake, write_trades
+from backfill import LiveMerge
+from flow_engine import RollingWindowEngine
+from gap_refill import GapRefillWorker, GapTracker
+import metrics
+import profiling
+from trade_tape import TradeTape
+from trade_writer import write_queue_depth
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+config_path = 'config/config.ini'
+
+# Binance allows up to 1024 streams on one combined stream connection
+max_streams_per_connection = 1024
+
+
+class MarketDaemon:
+    """
+    One process tracking many markets over Binance combined streams
+
+    Markets are split round-robin into shards. Each shard owns one combined stream connection,
+    parses its own messages and has its own trade queue and writer task, so parsing and storage
+    writes are spread across shards (writes run concurrently in the default executor). Written
+    batches go to a single analysis task that feeds one RollingWindowEngine and runs
+    analyze_all() over every market and interval once per tick.
+
+    Backfill reuses FlowMeter's planning and ChunkedBackfill one market at a time, so the REST
+    weight budget is shared rather than multiplied, and each market stops at its first live trade.
+
+    Per-market cost measured with benchmarks/daemon_benchmark.py (50 markets, 10 intervals, 20k trades
+    per market spread over 49 hours; tracemalloc and perf_counter, 3 runs on one machine, so treat as estimates):
+        - Memory: ~97 bytes per trade held by the engine (5 trade columns + 8 prefix sum columns), ~1.9 MB
+          per market at 20k trades. Trades added since the last analysis are held as tuples until it
+          consolidates them (~2.7 MB per market, ~2.8 MB peak while consolidating a fully pending load).
+        - Analysis: 0.4-0.7 ms median per market per tick (10 intervals), up to ~1.8 ms on the slowest
+          tick, dominated by building result documents.
+        - Intake: 8-14 us per combined stream message to parse, gap check, dedupe and queue.
+    Storage write cost depends on the backend and is shared by batching (one insert per batch per shard).
+
+    With analysis_workers > 0 the analysis pass is split across a ShardedAnalysisPool instead of
+    running in this process. Workers read the columnar store directly when it's the storage
+    backend, otherwise written trades are forwarded to them each tick. Per-shard latency is logged
+    after every pass.
+    """
+
+    def __init__(self, markets, storage=None, exchange='binance', shards=4, loop_time=10, cleanup_interval=3600,
+                 stream_url=None, write_batch_size=500, write_flush_interval=1.0, queue_size=100000,
+                 backfill_workers=4, live_wait=30, save_flow_historical=False, analysis_workers=0):
+        # flowmeter is imported here because it loads config.ini at import time
+        import flowmeter
+
+        self.flowmeter = flowmeter
+
+        self.exchange = exchange
+        self.markets = [market.upper() for market in markets]
+
+        if storage == None:
+            from storage import open_storage
+
+            storage = open_storage(flowmeter.config)
+
+        self.storage = storage
+
+        # Latest trades per market for GUIs, updated after each written batch
+        self.trade_tape = TradeTape(storage, size=flowmeter.config.getint('storage', 'recent_trades', fallback=100))
+
+        shard_count = max(shards, -(-len(self.markets) // max_streams_per_connection))
+        shard_count = min(shard_count, len(self.markets))
+
+        self.shards = [self.markets[x::shard_count] for x in range(shard_count)]
+
+        self.loop_time = loop_time
+        self.cleanup_interval = cleanup_interval
+        # Default follows [binance] stream_url in config.ini
+        self.stream_url = stream_url if stream_url != None else flowmeter.stream_url
+        self.write_batch_size = write_batch_size
+        self.write_flush_interval = write_flush_interval
+        self.queue_size = queue_size
+        self.save_flow_historical = save_flow_historical
+
+        # One FlowMeter per market (never started) for backfill planning, currencies and analysis labels
+        self.contexts = {}
+        for market in self.markets:
+            self.contexts[market] = flowmeter.FlowMeter(exchange=exchange, market=market, storage=storage, autostart=False,
+                                                        backfill_workers=backfill_workers, live_wait=live_wait)
+            self.contexts[market].live_merge = LiveMerge()
+
+        self.backtest_durations = self.contexts[self.markets[0]].backtest_durations
+
+        self.engine = RollingWindowEngine()
+
+        self.gap_tracker = GapTracker()
+        self.gap_refill = None
+
+        self.analysis_pool = None
+
+        if analysis_workers > 0:
+            from storage import ColumnarStorage
+
+            store_path = storage.trade_store.root_path if isinstance(storage, ColumnarStorage) else None
+
+            self.analysis_pool = ShardedAnalysisPool([(exchange, market) for market in self.markets],
+                                                     [backtest[0] for backtest in self.backtest_durations],
+                                                     workers=analysis_workers, store_path=store_path, retention=self.engine.retention)
+
+        # Created inside the running loop
+        self.trade_queues = None
+        self.analysis_queue = None
+        self.resync_queue = None
+        self.stop_event = None
+
+        self.stats = {
+            'received': 0,
+            'duplicates': 0,
+            'dropped': 0,
+            'inserted': 0,
+            'write_duplicates': 0,
+            'write_errors': 0,
+            'flushes': 0,
+            'reconnects': 0,
+            'analysis_passes': 0,
+            'analysis_latency_last': None,
+            'backfilled_markets': 0
+        }
+
+    def lookup_currencies(self):
+        binance_info = self.flowmeter.connect_binance().get_exchange_info()
+
+        market_currencies = {}
+        for product in binance_info['symbols']:
+            market_currencies[product['baseAsset'] + product['quoteAsset']] = (product['baseAsset'], product['quoteAsset'])
+
+        for market in self.markets:
+            if market not in market_currencies:
+                raise ValueError(market + ' is not a valid Binance market.')
+
+            self.contexts[market].user_trade_currency, self.contexts[market].user_quote_currency = market_currencies[market]
+
+    def stream_path(self, shard_markets):
+        return '/stream?streams=' + '/'.join(market.lower() + '@aggTrade' for market in shard_markets)
+
+    def handle_message(self, shard, message):
+        payload = parse_aggtrade(message)
+
+        if payload != None:
+            queue_live_trade(self.contexts[payload['s']], payload, self.trade_queues[shard], self.gap_tracker, 'shard' + str(shard), self.stats)
+
+    async def intake(self, shard):
+        await stream_intake(self.stream_url + self.stream_path(self.shards[shard]), functools.partial(self.handle_message, shard), self.stats,
+                            'shard ' + str(shard) + ' (' + str(len(self.shards[shard])) + ' markets)')
+
+    def report_failed_docs(self, trade_docs):
+        self.gap_tracker.report_docs(trade_docs, 'write')
+
+    async def flush(self, shard, batch):
+        await write_trades(self.storage, batch, 'shard' + str(shard), self.stats, self.report_failed_docs, self.trade_tape)
+
+        self.analysis_queue.put_nowait(batch)
+
+    async def writer(self, shard):
+        await batch_writer(self.trade_queues[shard], functools.partial(self.flush, shard), self.write_batch_size, self.write_flush_interval)
+
+    async def backfill(self):
+        loop = asyncio.get_running_loop()
+
+        current_context = None
+
+        try:
+            for market in self.markets:
+                current_context = self.contexts[market]
+
+                backfill_plan = await loop.run_in_executor(None, current_context.plan_backfill)
+
+                if backfill_plan['populate_start'] != None or backfill_plan['trade_id_last'] != None:
+                    wait_start = loop.time()
+                    while current_context.live_merge.first_live_id == None and (loop.time() - wait_start) < current_context.live_wait:
+                        await asyncio.sleep(0.1)
+
+                    await loop.run_in_executor(None, functools.partial(current_context.populate_to_live, backfill_plan,
+                                                                       end_id=current_context.live_merge.first_live_id,
+                                                                       end_time=current_context.live_merge.first_live_time))
+
+                self.stats['backfilled_markets'] += 1
+
+                self.resync_queue.put_nowait(market)
+
+            logger.info('Backfill complete for all ' + str(len(self.markets)) + ' markets.')
+
+        except asyncio.CancelledError:
+            if current_context != None and current_context.backfill != None:
+                current_context.backfill.stop()
+
+            raise
+
+    def analysis_tick(self, resync_markets, trade_docs, cleanup):
+        if cleanup == True:
+            delete_before_ms = int(time.time() * 1000) - self.engine.retention
+
+            cleanup_start = time.perf_counter()
+
+            delete_result = self.storage.delete_before(delete_before_ms)
+
+            # First trade and count change only for markets with trades before the cutoff
+            self.storage.refresh_expired_meta(delete_before_ms)
+
+            self.flowmeter.cleanup_seconds.observe(time.perf_counter() - cleanup_start)
+
+            if delete_result['result']['deleted_count'] != None:
+                self.flowmeter.cleanup_deleted.inc(delete_result['result']['deleted_count'])
+                self.flowmeter.cleanup_deleted_last.set(delete_result['result']['deleted_count'])
+
+            self.storage.delete_checkpoints(before_ms=delete_before_ms)
+
+            if self.analysis_pool != None:
+                self.analysis_pool.prune(delete_before_ms)
+
+                logger.info('Deleted ' + str(delete_result['result']['deleted_count']) + ' old trades.')
+            else:
+                logger.info('Deleted ' + str(delete_result['result']['deleted_count']) + ' old trades. Pruned ' +
+                            str(self.engine.prune()) + ' trades from memory.')
+
+        if self.analysis_pool != None:
+            for market in resync_markets:
+                self.analysis_pool.resync(self.exchange, market, storage=self.storage)
+
+            self.analysis_pool.push(trade_docs)
+
+            analysis_results = self.analysis_pool.analyze()
+
+        else:
+            for market in resync_markets:
+                # Backfilled trades only exist in storage, so reload the market once its backfill is done
+                self.engine.sync_storage(self.storage, self.exchange, market, full=True)
+
+            for trade_doc in trade_docs:
+                self.engine.add_trade_doc(trade_doc)
+
+            analysis_results = self.engine.analyze_all([backtest[0] for backtest in self.backtest_durations],
+                                                       markets=[(self.exchange, market) for market in self.markets])
+
+        if self.save_flow_historical == True:
+            ticker_prices = {ticker['symbol']: ticker['price'] for ticker in self.flowmeter.connect_binance().get_all_tickers()}
+
+        timestamp_current = int(time.mktime(datetime.datetime.now().timetuple()))
+
+        for market in self.markets:
+            context = self.contexts[market]
+
+            flow_differential_values = {}
+            analysis_intervals = []
+
+            for backtest in self.backtest_durations:
+                analysis_result = analysis_results.get((self.exchange, market), {}).get(backtest[0])
+
+                if analysis_result == None or analysis_result['success'] == False:
+                    continue
+
+                analysis_document = analysis_result['result'].copy()
+                analysis_document['_id'] = self.exchange + '-' + market.lower() + '-' + backtest[0]
+                analysis_document['module'] = 'flowmeter'
+                analysis_document['exchange'] = self.exchange
+                analysis_document['market'] = market
+                analysis_document['trade_currency'] = context.user_trade_currency
+                analysis_document['quote_currency'] = context.user_quote_currency
+                analysis_document['interval'] = backtest[1]
+                analysis_document['updated'] = timestamp_current
+
+                self.storage.upsert_analysis(analysis_document)
+
+                flow_differential_values[backtest[0]] = analysis_document['current']['flow_differential']
+                analysis_intervals.append(backtest[1])
+
+            if len(analysis_intervals) > 0:
+                # GUIs list analyzed markets and their intervals from the market metadata
+                self.storage.set_market_meta(self.exchange, market, {'analysis_updated': timestamp_current, 'analysis_intervals': analysis_intervals})
+
+            if self.save_flow_historical == True:
+                self.storage.insert_historical({
+                    '_id': self.exchange + '-' + market.lower() + '-' + str(timestamp_current),
+                    'time': timestamp_current,
+                    'exchange': self.exchange,
+                    'market': market,
+                    'trade_currency': context.user_trade_currency,
+                    'quote_currency': context.user_quote_currency,
+                    'values': flow_differential_values,
+                    'market_prices': {market: ticker_prices.get(market), 'BTCUSDT': ticker_prices.get('BTCUSDT')}
+                })
+
+    async def analysis(self):
+        loop = asyncio.get_running_loop()
+
+        cleanup_last = time.time()
+
+        while True:
+            tick_start = loop.time()
+
+            resync_markets = []
+            while not self.resync_queue.empty():
+                resync_markets.append(self.resync_queue.get_nowait())
+
+            trade_docs = []
+            while not self.analysis_queue.empty():
+                trade_docs.extend(self.analysis_queue.get_nowait())
+
+            cleanup = (time.time() - cleanup_last) > self.cleanup_interval
+            if cleanup == True:
+                cleanup_last = time.time()
+
+            try:
+                await loop.run_in_executor(None, self.analysis_tick, resync_markets, trade_docs, cleanup)
+
+            except Exception as e:
+                logger.exception(e)
+
+            self.stats['analysis_passes'] += 1
+            self.stats['analysis_latency_last'] = loop.time() - tick_start
+
+            # One pass covers every market
+            self.flowmeter.analysis_pass_seconds.labels('all').observe(self.stats['analysis_latency_last'])
+
+            logger.info('Analyzed ' + str(len(self.markets)) + ' markets in ' + "{:.3f}".format(self.stats['analysis_latency_last']) + ' sec.')
+            logger.debug('Daemon stats: ' + str(self.get_stats()))
+
+            if self.analysis_pool != None:
+                for shard_stats in self.analysis_pool.get_stats():
+                    if shard_stats['round_trip_last'] != None:
+                        logger.info('Analysis shard ' + str(shard_stats['shard']) + ': ' + str(shard_stats['markets']) + ' markets, ' +
+                                    str(shard_stats['held']) + ' trades, sync ' + "{:.3f}".format(shard_stats['sync_last']) +
+                                    ' sec, analyze ' + "{:.3f}".format(shard_stats['analyze_last']) + ' sec, round trip ' +
+                                    "{:.3f}".format(shard_stats['round_trip_last']) + ' sec (p50 ' + "{:.3f}".format(shard_stats['round_trip_p50']) +
+                                    ', max ' + "{:.3f}".format(shard_stats['round_trip_max']) + ').')
+
+            await asyncio.sleep(max(self.loop_time - (loop.time() - tick_start), 0))
+
+    def get_stats(self):
+        daemon_stats = self.stats.copy()
+
+        if self.trade_queues != None:
+            daemon_stats['trade_queue_depth'] = [trade_queue.qsize() for trade_queue in self.trade_queues]
+
+        if self.analysis_pool != None:
+            daemon_stats['analysis_shards'] = self.analysis_pool.get_stats()
+
+        return daemon_stats
+
+    def request_stop(self):
+        if not self.stop_event.is_set():
+            logger.info('Exit signal received.')
+
+            self.stop_event.set()
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+
+        self.trade_queues = [asyncio.Queue(maxsize=self.queue_size) for shard in self.shards]
+        self.analysis_queue = asyncio.Queue()
+        self.resync_queue = asyncio.Queue()
+        self.stop_event = asyncio.Event()
+
+        for shard in range(len(self.shards)):
+            write_queue_depth.labels('shard' + str(shard)).set_function(self.trade_queues[shard].qsize)
+
+        # Refilled trades reach the engine (or analysis pool) through the analysis queue like written batches
+        self.gap_refill = GapRefillWorker(self.flowmeter.connect_binance(), self.storage, self.exchange,
+                                          currencies=lambda market: (self.contexts[market].user_trade_currency, self.contexts[market].user_quote_currency),
+                                          callback=lambda market, trade_docs: loop.call_soon_threadsafe(self.analysis_queue.put_nowait, trade_docs))
+
+        self.gap_tracker.gap_callback = self.gap_refill.submit
+
+        self.gap_refill.start()
+
+        for signal_number in [signal.SIGINT, signal.SIGTERM]:
+            try:
+                loop.add_signal_handler(signal_number, self.request_stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        intake_tasks = [asyncio.create_task(self.intake(shard)) for shard in range(len(self.shards))]
+        writer_tasks = [asyncio.create_task(self.writer(shard)) for shard in range(len(self.shards))]
+        backfill_task = asyncio.create_task(self.backfill())
+        analysis_task = asyncio.create_task(self.analysis())
+        stop_task = asyncio.create_task(self.stop_event.wait())
+
+        done, pending = await asyncio.wait(intake_tasks + writer_tasks + [analysis_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+
+        for task in done:
+            if task is not stop_task and task.exception() != None:
+                logger.error('Daemon task failed: ' + repr(task.exception()))
+
+        for task in intake_tasks + [backfill_task, analysis_task, stop_task]:
+            task.cancel()
+
+        await asyncio.gather(*intake_tasks, backfill_task, analysis_task, stop_task, return_exceptions=True)
+
+        for task in writer_tasks:
+            task.cancel()
+
+        await asyncio.gather(*writer_tasks, return_exceptions=True)
+
+        self.gap_refill.stop()
+
+        logger.info('Daemon final stats: ' + str(self.get_stats()))
+
+    def run(self):
+        logger.info('Tracking ' + str(len(self.markets)) + ' markets on ' + str(len(self.shards)) + ' shards.')
+
+        self.lookup_currencies()
+
+        self.contexts[self.markets[0]].verify_indexes()
+
+        if self.analysis_pool != None:
+            self.analysis_pool.start()
+
+        try:
+            asyncio.run(self.main())
+
+        except KeyboardInterrupt:
+            logger.info('Exit signal received.')
+
+        finally:
+            if self.analysis_pool != None:
+                self.analysis_pool.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Track flow analysis for many markets from one process.')
+    parser.add_argument('-m', '--markets', type=str, default=None, help='Comma separated markets (ex. XLMBTC,ETHBTC). [Default: [daemon] markets in config.ini]')
+    parser.add_argument('-s', '--shards', type=int, default=4, help='Websocket/writer shards. [Default: 4]')
+    parser.add_argument('-l', '--loop', type=int, default=10, help='Time (seconds) between analysis passes. [Default: 10]')
+    parser.add_argument('-w', '--analysis-workers', type=int, default=0, help='Analysis worker processes (0 to analyze in the daemon process). [Default: 0]')
+    parser.add_argument('--save-historical', action='store_true', default=False, help='Archive flow differential values every pass.')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve Prometheus metrics on this local port. [Default: [metrics] daemon_port in config.ini]')
+    parser.add_argument('--metrics-snapshot', type=str, default=None, help='Write JSON metrics snapshots to this file. [Default: [metrics] daemon_snapshot in config.ini]')
+    parser.add_argument('--profile-dir', type=str, default=None, help='Enable profiling signals (USR1/USR2) and /debug endpoints, writing to this directory. [Default: [profiling] path in config.ini]')
+    parser.add_argument('--debug', action='store_true', default=False, help='Enable debug level output.')
+    args = parser.parse_args()
+
+    if args.debug == True:
+        logger.setLevel(logging.DEBUG)
+
+    config = configparser.ConfigParser()
+    config.read(config_path)
+
+    if args.markets != None:
+        daemon_markets = args.markets.split(',')
+    else:
+        daemon_markets = config.get('daemon', 'markets', fallback='').split(',')
+
+    daemon_markets = [market.strip() for market in daemon_markets if market.strip() != '']
+
+    if len(daemon_markets) == 0:
+        logger.error('No markets given. Exiting.')
+    else:
+        metrics_exporter = metrics.open_metrics_exporter(config, 'daemon', port=args.metrics_port, snapshot_path=args.metrics_snapshot)
+
+        profiling.open_profiling_hooks(config, output_path=args.profile_dir)
+
+        MarketDaemon(daemon_markets, shards=args.shards, loop_time=args.loop, save_flow_historical=args.save_historical,
+                     analysis_workers=args.analysis_workers).run()
+
+        if metrics_exporter != None:
+            metrics_exporter.stop()
@@ -0,0 +1,529 @@
+import bisect
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Seconds, from sub-millisecond message handling up to slow cleanup passes
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class CounterValue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def get(self):
+        return self.value
+
+    def load(self, value):
+        self.value = value
+
+
+class GaugeValue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set_function(self, function):
+        """
+        Read value from function when collected (ex. queue.qsize), so nothing runs on the hot path
+        """
+
+        self.function = function
+
+    def get(self):
+        if self.function != None:
+            try:
+                return float(self.function())
+            except Exception:
+                return float('nan')
+
+        return self.value
+
+    def load(self, value):
+        self.value = value
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        # Last slot counts observations above the largest bucket (+Inf)
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        bucket_index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            self.bucket_counts[bucket_index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return HistogramTimer(self)
+
+    def get(self):
+        with self.lock:
+            return {'bucket_counts': list(self.bucket_counts), 'sum': self.sum, 'count': self.count}
+
+    def load(self, value):
+        self.bucket_counts = list(value['bucket_counts'])
+        self.sum = value['sum']
+        self.count = value['count']
+
+    def quantile(self, q):
+        """
+        Estimate from bucket counts (upper bound of the bucket holding the q-th observation)
+        """
+
+        with self.lock:
+            bucket_counts = list(self.bucket_counts)
+            count = self.count
+
+        if count == 0:
+            return None
+
+        rank = q * count
+        cumulative = 0
+        for x in range(len(self.buckets)):
+            cumulative += bucket_counts[x]
+
+            if cumulative >= rank:
+                return self.buckets[x]
+
+        return float('inf')
+
+
+class HistogramTimer:
+    """
+    with histogram.time(): ...
+    """
+
+    def __init__(self, histogram_value):
+        self.histogram_value = histogram_value
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram_value.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    """
+    Named metric with optional labels. Unlabeled metrics are used directly (counter.inc()),
+    labeled ones through a cached child per label combination (counter.labels('XLMBTC').inc()).
+    """
+
+    metric_type = None
+
+    def __init__(self, name, description, labels=(), buckets=None):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets) if buckets != None else None
+
+        self.lock = threading.Lock()
+
+        self.children = {}
+
+        if len(self.label_names) == 0:
+            self.default_child = self.labels()
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *label_values):
+        try:
+            return self.children[label_values]
+
+        except KeyError:
+            if len(label_values) != len(self.label_names):
+                raise ValueError(self.name + ' expects labels ' + str(self.label_names) + ', got ' + str(label_values))
+
+            with self.lock:
+                child = self.children.get(label_values)
+
+                if child == None:
+                    child = self.new_child()
+
+                    self.children[label_values] = child
+
+            return child
+
+    def collect_children(self):
+        with self.lock:
+            children = list(self.children.items())
+
+        return [(tuple(str(label_value) for label_value in label_values), child) for label_values, child in children]
+
+    def collect(self):
+        """
+        Returns [(label dict, value)] for every label combination seen so far
+        """
+
+        return [(dict(zip(self.label_names, label_values)), child.get()) for label_values, child in self.collect_children()]
+
+    def state(self):
+        return [[list(label_values), child.get()] for label_values, child in self.collect_children()]
+
+    def load_state(self, state):
+        for label_values, value in state:
+            self.labels(*label_values).load(value)
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def new_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.default_child.inc(amount)
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def new_child(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self.default_child.set(value)
+
+    def inc(self, amount=1):
+        self.default_child.inc(amount)
+
+    def dec(self, amount=1):
+        self.default_child.dec(amount)
+
+    def set_function(self, function):
+        self.default_child.set_function(function)
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=default_buckets):
+        Metric.__init__(self, name, description, labels=labels, buckets=sorted(buckets))
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.default_child.observe(value)
+
+    def time(self):
+        return self.default_child.time()
+
+
+class MetricsRegistry:
+    """
+    Process-wide set of metrics, rendered as Prometheus text or a JSON snapshot
+
+    Declaring a metric that already exists returns the existing one, so modules can share
+    metrics (ex. the threaded and asyncio runtimes count the same messages).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.metrics = {}
+
+    def register(self, metric_class, name, description, labels=(), **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+
+            if metric == None:
+                metric = metric_class(name, description, labels=labels, **kwargs)
+
+                self.metrics[name] = metric
+
+            elif not isinstance(metric, metric_class) or metric.label_names != tuple(labels):
+                raise ValueError('Metric ' + name + ' already registered as ' + metric.metric_type + ' with labels ' + str(metric.label_names) + '.')
+
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter, name, description, labels=labels)
+
+    def gauge(self, name, description, labels=()):
+        return self.register(Gauge, name, description, labels=labels)
+
+    def histogram(self, name, description, labels=(), buckets=default_buckets):
+        return self.register(Histogram, name, description, labels=labels, buckets=buckets)
+
+    def render_prometheus(self):
+        """
+        Prometheus text exposition format (version 0.0.4)
+        """
+
+        lines = []
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        for metric in metrics:
+            lines.append('# HELP ' + metric.name + ' ' + metric.description.replace('\\', '\\\\').replace('\n', '\\n'))
+            lines.append('# TYPE ' + metric.name + ' ' + metric.metric_type)
+
+            for label_dict, value in metric.collect():
+                if metric.metric_type == 'histogram':
+                    cumulative = 0
+                    for x in range(len(metric.buckets)):
+                        cumulative += value['bucket_counts'][x]
+
+                        lines.append(metric.name + '_bucket' + format_labels(label_dict, le=format_value(metric.buckets[x])) + ' ' + str(cumulative))
+
+                    lines.append(metric.name + '_bucket' + format_labels(label_dict, le='+Inf') + ' ' + str(value['count']))
+                    lines.append(metric.name + '_sum' + format_labels(label_dict) + ' ' + format_value(value['sum']))
+                    lines.append(metric.name + '_count' + format_labels(label_dict) + ' ' + str(value['count']))
+
+                else:
+                    lines.append(metric.name + format_labels(label_dict) + ' ' + format_value(value))
+
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        JSON-friendly values. Histograms are summarized as count/sum/avg with p50/p90/p99 bucket estimates.
+        """
+
+        snapshot_metrics = {}
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        for metric in metrics:
+            values = []
+
+            for label_values, child in metric.collect_children():
+                value_doc = {'labels': dict(zip(metric.label_names, label_values))}
+
+                if metric.metric_type == 'histogram':
+                    histogram_value = child.get()
+
+                    value_doc['count'] = histogram_value['count']
+                    value_doc['sum'] = histogram_value['sum']
+                    value_doc['avg'] = (histogram_value['sum'] / histogram_value['count']) if histogram_value['count'] > 0 else None
+                    value_doc['p50'] = child.quantile(0.5)
+                    value_doc['p90'] = child.quantile(0.9)
+                    value_doc['p99'] = child.quantile(0.99)
+
+                else:
+                    value_doc['value'] = child.get()
+
+                values.append(value_doc)
+
+            snapshot_metrics[metric.name] = {'type': metric.metric_type, 'help': metric.description, 'values': values}
+
+        return snapshot_metrics
+
+    def state(self, names):
+        """
+        Picklable raw values of the named metrics, for load_state() in another process
+        """
+
+        return {name: self.metrics[name].state() for name in names if name in self.metrics}
+
+    def load_state(self, state):
+        """
+        Replace values with those from state(). Only for metrics that are updated in the other process alone.
+        """
+
+        for name, metric_state in state.items():
+            if name in self.metrics:
+                self.metrics[name].load_state(metric_state)
+
+
+def format_value(value):
+    if value != value:
+        return 'NaN'
+    elif value == float('inf'):
+        return '+Inf'
+    elif value == float('-inf'):
+        return '-Inf'
+
+    return repr(float(value))
+
+
+def format_labels(label_dict, **extra_labels):
+    label_dict = dict(label_dict, **extra_labels)
+
+    if len(label_dict) == 0:
+        return ''
+
+    return '{' + ','.join(label_name + '="' + str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                          for label_name, label_value in label_dict.items()) + '}'
+
+
+registry = MetricsRegistry()
+
+# Extra GET endpoints served by MetricsExporter: path -> function(query dict) returning (content type, text), ex. profiling.py
+routes = {}
+
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+
+        if path == '/metrics':
+            body = self.server.registry.render_prometheus().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+        elif path == '/metrics.json':
+            body = json.dumps(snapshot_document(self.server.registry)).encode()
+            content_type = 'application/json'
+
+        elif path in routes:
+            content_type, body = routes[path](urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query))
+            body = body.encode()
+
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics request: ' + (format % args))
+
+
+def snapshot_document(registry):
+    return {'time': time.time(), 'pid': os.getpid(), 'metrics': registry.snapshot()}
+
+
+class MetricsExporter:
+    """
+    Serves /metrics (Prometheus text) and /metrics.json on a local port and/or writes a JSON
+    snapshot file every snapshot_interval seconds (replaced atomically, so readers never see a partial file)
+
+    port - HTTP port (None for no server, 0 for any free port)
+    snapshot_path - JSON snapshot file (None for no snapshots)
+    """
+
+    def __init__(self, port=None, snapshot_path=None, snapshot_interval=15, host='127.0.0.1', registry=registry):
+        self.port = port
+        self.host = host
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.registry = registry
+
+        self.http_server = None
+        self.server_thread = None
+        self.snapshot_thread = None
+
+        self.stop_event = threading.Event()
+
+    def start(self):
+        if self.port != None:
+            self.http_server = http.server.ThreadingHTTPServer((self.host, self.port), MetricsRequestHandler)
+            self.http_server.daemon_threads = True
+            self.http_server.registry = self.registry
+
+            self.port = self.http_server.server_address[1]
+
+            self.server_thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+            self.server_thread.start()
+
+            logger.info('Serving metrics at http://' + self.host + ':' + str(self.port) + '/metrics')
+
+        if self.snapshot_path != None:
+            snapshot_directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+            os.makedirs(snapshot_directory, exist_ok=True)
+
+            self.snapshot_thread = threading.Thread(target=self.snapshot_loop, daemon=True)
+            self.snapshot_thread.start()
+
+            logger.info('Writing metrics snapshots to ' + self.snapshot_path + ' every ' + str(self.snapshot_interval) + ' sec.')
+
+        return self
+
+    def write_snapshot(self):
+        temp_path = self.snapshot_path + '.tmp'
+
+        try:
+            with open(temp_path, 'w') as snapshot_file:
+                json.dump(snapshot_document(self.registry), snapshot_file, indent=2)
+
+            os.replace(temp_path, self.snapshot_path)
+
+        except Exception as e:
+            logger.warning('Failed to write metrics snapshot (' + str(e) + ').')
+
+    def snapshot_loop(self):
+        while not self.stop_event.wait(self.snapshot_interval):
+            self.write_snapshot()
+
+    def stop(self):
+        self.stop_event.set()
+
+        if self.http_server != None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+
+        if self.snapshot_path != None:
+            # Final values on exit
+            self.write_snapshot()
+
+
+def open_metrics_exporter(config, program, port=None, snapshot_path=None):
+    """
+    Start exporter for program from [metrics] in config.ini (arguments override config). Returns None if neither is set.
+
+    [metrics]
+    flowmeter_port = 9108
+    flowmeter_snapshot = metrics/flowmeter.json
+    gui_port = 9109
+    snapshot_interval = 15
+    """
+
+    if port == None:
+        port = config.getint('metrics', program + '_port', fallback=None)
+
+    if snapshot_path == None:
+        snapshot_path = config.get('metrics', program + '_snapshot', fallback=None)
+
+    if port == None and snapshot_path in [None, '']:
+        return None
+
+    snapshot_interval = config.getfloat('metrics', 'snapshot_interval', fallback=15)
+
+    return MetricsExporter(port=port, snapshot_path=snapshot_path or None, snapshot_interval=snapshot_interval).start()
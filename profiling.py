@@ -0,0 +1,396 @@
+import datetime
+import io
+import logging
+import marshal
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+import metrics
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def thread_descriptions():
+    """
+    Thread id -> 'name (class)', ex. 'Thread-2 (BinanceSocketManager)' for the reactor thread
+    """
+
+    descriptions = {}
+
+    for thread in threading.enumerate():
+        descriptions[thread.ident] = thread.name + ' (' + type(thread).__name__ + (', daemon' if thread.daemon == True else '') + ')'
+
+    return descriptions
+
+
+def format_thread_stacks():
+    """
+    Current stack of every thread. DepthCacheManager and socket callbacks show up under the reactor thread.
+    """
+
+    descriptions = thread_descriptions()
+
+    lines = []
+
+    for thread_id, frame in sys._current_frames().items():
+        lines.append('Thread ' + str(thread_id) + ' - ' + descriptions.get(thread_id, 'unknown (not started by threading)'))
+        lines.extend(line.rstrip('\n') for line in traceback.format_stack(frame))
+        lines.append('')
+
+    return '\n'.join(lines) + '\n'
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of every other thread each interval seconds
+
+    cProfile only instruments the thread that enables it, so a live process with reactor, writer,
+    analysis and Display threads is sampled instead. Samples are converted to cProfile's stats
+    format, so the output loads with pstats (or snakeviz) like any cProfile dump. Times are
+    sample counts x interval, and call counts are sample counts.
+    """
+
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.interval = interval
+
+        # (filename, first line, function) -> [self samples, total samples, {caller: samples}]
+        self.functions = {}
+        self.thread_samples = {}
+        self.sample_count = 0
+
+        self.stop_event = threading.Event()
+
+    def run(self):
+        descriptions = thread_descriptions()
+
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+
+                if thread_id not in descriptions:
+                    descriptions = thread_descriptions()
+
+                self.record(frame)
+
+                thread_description = descriptions.get(thread_id, str(thread_id))
+                self.thread_samples[thread_description] = self.thread_samples.get(thread_description, 0) + 1
+
+            self.sample_count += 1
+
+    def record(self, frame):
+        stack = []
+        while frame != None:
+            stack.append((frame.f_code.co_filename, frame.f_code.co_firstlineno, frame.f_code.co_name))
+            frame = frame.f_back
+
+        # stack[0] is the running function, each entry is called by the next one
+        seen = set()
+        for x in range(len(stack)):
+            function_stats = self.functions.get(stack[x])
+
+            if function_stats == None:
+                function_stats = [0, 0, {}]
+                self.functions[stack[x]] = function_stats
+
+            if x == 0:
+                function_stats[0] += 1
+
+            # Recursive functions only count once per sample
+            if stack[x] not in seen:
+                function_stats[1] += 1
+                seen.add(stack[x])
+
+            if (x + 1) < len(stack):
+                function_stats[2][stack[x + 1]] = function_stats[2].get(stack[x + 1], 0) + 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+    def stats(self):
+        """
+        cProfile stats dictionary: {function: (primitive calls, calls, self time, total time, {caller: (..)})}
+        """
+
+        profile_stats = {}
+
+        for function, (self_samples, total_samples, callers) in self.functions.items():
+            caller_stats = {}
+            for caller, caller_samples in callers.items():
+                caller_stats[caller] = (caller_samples, caller_samples, 0.0, caller_samples * self.interval)
+
+            profile_stats[function] = (total_samples, total_samples, self_samples * self.interval, total_samples * self.interval, caller_stats)
+
+        return profile_stats
+
+
+class ProfilingHooks:
+    """
+    On-demand diagnostics for a running process, written to timestamped files in output_path
+
+    Signals (Unix):
+        SIGUSR1 - Thread stacks, then profile_seconds of sampled profile
+        SIGUSR2 - Thread stacks, then allocation_seconds of tracemalloc capture
+
+    HTTP (on the metrics exporter port):
+        /debug/stacks
+        /debug/profile?seconds=30
+        /debug/allocations?seconds=30
+
+    Files: stacks-<time>-<pid>.txt, profile-<time>-<pid>.prof (load with pstats) and .txt, allocations-<time>-<pid>.txt
+    """
+
+    def __init__(self, output_path='profiles', profile_seconds=30, allocation_seconds=30, sample_interval=0.005, top=40):
+        self.output_path = output_path
+        self.profile_seconds = profile_seconds
+        self.allocation_seconds = allocation_seconds
+        self.sample_interval = sample_interval
+        self.top = top
+
+        # One capture of each kind at a time
+        self.profile_lock = threading.Lock()
+        self.allocation_lock = threading.Lock()
+
+    def output_file(self, kind, extension):
+        os.makedirs(self.output_path, exist_ok=True)
+
+        return os.path.join(self.output_path, kind + '-' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '-' +
+                            str(os.getpid()) + extension)
+
+    def dump_stacks(self):
+        dump_stacks_return = {'success': True, 'result': {'path': None, 'summary': None}}
+
+        try:
+            stack_text = format_thread_stacks()
+
+            stack_path = self.output_file('stacks', '.txt')
+
+            with open(stack_path, 'w') as stack_file:
+                stack_file.write(stack_text)
+
+            dump_stacks_return['result']['path'] = stack_path
+            dump_stacks_return['result']['summary'] = stack_text
+
+            logger.info('Thread stacks written to ' + stack_path + '.')
+
+        except Exception as e:
+            logger.exception(e)
+
+            dump_stacks_return['success'] = False
+
+        finally:
+            return dump_stacks_return
+
+    def capture_profile(self, seconds=None):
+        capture_return = {'success': True, 'result': {'path': None, 'summary': None}}
+
+        if seconds == None:
+            seconds = self.profile_seconds
+
+        if not self.profile_lock.acquire(blocking=False):
+            logger.warning('Profile capture already running.')
+
+            capture_return['success'] = False
+
+            return capture_return
+
+        try:
+            logger.info('Profiling all threads for ' + str(seconds) + ' sec.')
+
+            sampler = StackSampler(interval=self.sample_interval)
+            sampler.start()
+
+            time.sleep(seconds)
+
+            sampler.stop()
+
+            profile_path = self.output_file('profile', '.prof')
+
+            with open(profile_path, 'wb') as profile_file:
+                marshal.dump(sampler.stats(), profile_file)
+
+            summary = io.StringIO()
+            summary.write('Sampled ' + str(sampler.sample_count) + ' times over ' + str(seconds) + ' sec (every ' +
+                          str(self.sample_interval) + ' sec). Times are samples x interval.\n\nSamples per thread:\n')
+
+            for thread_description, thread_samples in sorted(sampler.thread_samples.items(), key=lambda item: -item[1]):
+                summary.write('    ' + str(thread_samples) + '  ' + thread_description + '\n')
+
+            summary.write('\n')
+
+            profile_stats = pstats.Stats(profile_path, stream=summary)
+            profile_stats.sort_stats('tottime').print_stats(self.top)
+            profile_stats.sort_stats('cumulative').print_stats(self.top)
+
+            with open(profile_path[:-len('.prof')] + '.txt', 'w') as summary_file:
+                summary_file.write(summary.getvalue())
+
+            capture_return['result']['path'] = profile_path
+            capture_return['result']['summary'] = summary.getvalue()
+
+            logger.info('Profile written to ' + profile_path + '.')
+
+        except Exception as e:
+            logger.exception(e)
+
+            capture_return['success'] = False
+
+        finally:
+            self.profile_lock.release()
+
+            return capture_return
+
+    def capture_allocations(self, seconds=None):
+        """
+        Top live allocations and growth over the window. tracemalloc only sees allocations made while
+        tracing, so unless it was already running this covers memory allocated during the window.
+        """
+
+        capture_return = {'success': True, 'result': {'path': None, 'summary': None}}
+
+        if seconds == None:
+            seconds = self.allocation_seconds
+
+        if not self.allocation_lock.acquire(blocking=False):
+            logger.warning('Allocation capture already running.')
+
+            capture_return['success'] = False
+
+            return capture_return
+
+        started_tracing = False
+
+        try:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                started_tracing = True
+
+            logger.info('Tracing allocations for ' + str(seconds) + ' sec.')
+
+            snapshot_filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')]
+
+            snapshot_start = tracemalloc.take_snapshot().filter_traces(snapshot_filters)
+
+            time.sleep(seconds)
+
+            snapshot_end = tracemalloc.take_snapshot().filter_traces(snapshot_filters)
+
+            traced_current, traced_peak = tracemalloc.get_traced_memory()
+
+            summary = io.StringIO()
+            summary.write('Traced ' + ('since capture start' if started_tracing == True else 'since tracemalloc start') + ', ' +
+                          str(seconds) + ' sec window. Current ' + str(traced_current // 1024) + ' KiB, peak ' + str(traced_peak // 1024) + ' KiB.\n\n')
+
+            summary.write('Top allocations by line:\n')
+            for statistic in snapshot_end.statistics('lineno')[:self.top]:
+                summary.write('    ' + str(statistic) + '\n')
+
+            summary.write('\nGrowth during window:\n')
+            for statistic in snapshot_end.compare_to(snapshot_start, 'lineno')[:self.top]:
+                summary.write('    ' + str(statistic) + '\n')
+
+            summary.write('\nTop allocation tracebacks:\n')
+            for statistic in snapshot_end.statistics('traceback')[:5]:
+                summary.write('    ' + str(statistic.count) + ' blocks, ' + str(statistic.size // 1024) + ' KiB\n')
+                for line in statistic.traceback.format():
+                    summary.write('        ' + line + '\n')
+
+            allocation_path = self.output_file('allocations', '.txt')
+
+            with open(allocation_path, 'w') as allocation_file:
+                allocation_file.write(summary.getvalue())
+
+            capture_return['result']['path'] = allocation_path
+            capture_return['result']['summary'] = summary.getvalue()
+
+            logger.info('Allocations written to ' + allocation_path + '.')
+
+        except Exception as e:
+            logger.exception(e)
+
+            capture_return['success'] = False
+
+        finally:
+            if started_tracing == True:
+                tracemalloc.stop()
+
+            self.allocation_lock.release()
+
+            return capture_return
+
+    def capture_in_background(self, capture_function):
+        # Signal handlers must return quickly, so captures run on their own thread
+        self.dump_stacks()
+
+        threading.Thread(target=capture_function, daemon=True).start()
+
+    def install_signal_handlers(self):
+        if not hasattr(signal, 'SIGUSR1'):
+            logger.warning('SIGUSR1/SIGUSR2 not available on this platform. Use the /debug endpoints instead.')
+            return False
+
+        try:
+            signal.signal(signal.SIGUSR1, lambda signal_number, frame: self.capture_in_background(self.capture_profile))
+            signal.signal(signal.SIGUSR2, lambda signal_number, frame: self.capture_in_background(self.capture_allocations))
+
+        except ValueError:
+            logger.warning('Profiling signals can only be installed from the main thread.')
+            return False
+
+        logger.info('Profiling hooks installed. [kill -USR1 ' + str(os.getpid()) + ' = profile / kill -USR2 ' + str(os.getpid()) + ' = allocations]')
+
+        return True
+
+    def route_response(self, capture_return):
+        if capture_return['success'] == True:
+            return 'text/plain; charset=utf-8', 'Written to ' + capture_return['result']['path'] + '\n\n' + capture_return['result']['summary']
+
+        return 'text/plain; charset=utf-8', 'Capture failed or already running.\n'
+
+    def install_routes(self):
+        def query_seconds(query, default):
+            try:
+                return float(query['seconds'][0])
+            except (KeyError, IndexError, ValueError):
+                return default
+
+        metrics.routes['/debug/stacks'] = lambda query: self.route_response(self.dump_stacks())
+        metrics.routes['/debug/profile'] = lambda query: self.route_response(self.capture_profile(query_seconds(query, self.profile_seconds)))
+        metrics.routes['/debug/allocations'] = lambda query: self.route_response(self.capture_allocations(query_seconds(query, self.allocation_seconds)))
+
+
+def open_profiling_hooks(config, output_path=None):
+    """
+    Install signal handlers and /debug endpoints when [profiling] path is set in config.ini (or output_path given)
+
+    [profiling]
+    path = profiles
+    profile_seconds = 30
+    allocation_seconds = 30
+    """
+
+    if output_path == None:
+        output_path = config.get('profiling', 'path', fallback=None)
+
+    if output_path in [None, '']:
+        return None
+
+    profiling_hooks = ProfilingHooks(output_path=output_path,
+                                     profile_seconds=config.getfloat('profiling', 'profile_seconds', fallback=30),
+                                     allocation_seconds=config.getfloat('profiling', 'allocation_seconds', fallback=30))
+
+    profiling_hooks.install_signal_handlers()
+    profiling_hooks.install_routes()
+
+    return profiling_hooks
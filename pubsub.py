@@ -0,0 +1,502 @@
+import json
+import logging
+import os
+import select
+import socket
+import tempfile
+import threading
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def socket_path(socket_dir, exchange, market):
+    return os.path.join(socket_dir, 'flowmeter-' + exchange + '-' + market.lower() + '.sock')
+
+
+def pubsub_settings(config):
+    """
+    (transport, socket directory) from config.ini
+
+    [pubsub]
+    transport = socket | changestream | none  (Default: socket)
+    socket_dir = /tmp                         (Default: system temp directory)
+    """
+
+    transport = config.get('pubsub', 'transport', fallback='socket')
+
+    if transport not in ['socket', 'changestream', 'none']:
+        raise ValueError('Unrecognized pub/sub transport: ' + transport)
+
+    if transport == 'socket' and not hasattr(socket, 'AF_UNIX'):
+        logger.warning('Unix domain sockets not available on this platform. Disabling pub/sub.')
+
+        transport = 'none'
+
+    return transport, config.get('pubsub', 'socket_dir', fallback=tempfile.gettempdir())
+
+
+class MarketPublisher(threading.Thread):
+    """
+    Publishes last-trade events and analysis snapshots of one market on a Unix domain socket
+
+    Messages are JSON lines {'channel': 'trade' | 'analysis', 'key': market | interval, 'document': {...}}.
+    Only the newest document per channel and key is kept, so bursts are conflated instead of queued and
+    the sending cost depends on the update rate, not the number of subscribers. New subscribers first
+    receive the newest document of every key. Subscribers that block a send for longer than
+    send_timeout are disconnected.
+
+    path - Socket file (see socket_path())
+    """
+
+    def __init__(self, path, send_timeout=1.0):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.path = path
+        self.send_timeout = send_timeout
+
+        self.lock = threading.Lock()
+
+        # (channel, key) -> newest document
+        self.latest = {}
+        self.pending = {}
+
+        self.clients = []
+
+        self.server = None
+
+        # Written by publish() to wake the select() loop
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_writer.setblocking(False)
+
+        self.stop_event = threading.Event()
+
+        self.stats = {'published': 0, 'sent': 0, 'subscribers': 0, 'dropped_subscribers': 0}
+
+    def open(self):
+        if os.path.exists(self.path):
+            # Left behind by a publisher that didn't exit cleanly
+            os.remove(self.path)
+
+        if os.path.dirname(self.path) != '':
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(16)
+        self.server.setblocking(False)
+
+        logger.info('Publishing trades and analysis on ' + self.path + '.')
+
+    def publish(self, channel, key, document):
+        with self.lock:
+            self.latest[(channel, key)] = document
+            self.pending[(channel, key)] = document
+
+            self.stats['published'] += 1
+
+        try:
+            self.wake_writer.send(b'\0')
+
+        except (BlockingIOError, OSError):
+            # Wake-up already pending
+            pass
+
+    def forward(self, publish_queue):
+        """
+        Publish (channel, key, document) tuples put on a multiprocessing queue (ex. by the analysis process)
+        """
+
+        def forward_loop():
+            while not self.stop_event.is_set():
+                try:
+                    channel, key, document = publish_queue.get(timeout=1)
+
+                except Exception:
+                    continue
+
+                self.publish(channel, key, document)
+
+        forward_thread = threading.Thread(target=forward_loop, daemon=True)
+        forward_thread.start()
+
+        return forward_thread
+
+    def encode(self, documents):
+        return b''.join((json.dumps({'channel': channel, 'key': key, 'document': document}, default=str) + '\n').encode()
+                        for (channel, key), document in documents.items())
+
+    def send(self, client, message):
+        try:
+            client.sendall(message)
+
+            return True
+
+        except OSError:
+            logger.info('Dropping pub/sub subscriber that stopped reading.')
+
+            self.stats['dropped_subscribers'] += 1
+
+            client.close()
+
+            return False
+
+    def run(self):
+        if self.server == None:
+            self.open()
+
+        while not self.stop_event.is_set():
+            try:
+                readable, _, _ = select.select([self.server, self.wake_reader] + self.clients, [], [], 1)
+
+            except (OSError, ValueError):
+                # A client closed between loops
+                self.clients = [client for client in self.clients if client.fileno() != -1]
+                continue
+
+            for ready in readable:
+                if ready is self.server:
+                    try:
+                        client, _ = self.server.accept()
+
+                    except OSError:
+                        continue
+
+                    client.setblocking(True)
+                    client.settimeout(self.send_timeout)
+
+                    with self.lock:
+                        snapshot = self.encode(self.latest)
+
+                    if self.send(client, snapshot) == True:
+                        self.clients.append(client)
+
+                        self.stats['subscribers'] += 1
+
+                elif ready is self.wake_reader:
+                    self.wake_reader.recv(4096)
+
+                elif ready in self.clients:
+                    # Subscribers never send, so readable means closed
+                    try:
+                        closed = (ready.recv(4096) == b'')
+                    except OSError:
+                        closed = True
+
+                    if closed == True:
+                        ready.close()
+                        self.clients.remove(ready)
+
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+
+            if len(pending) > 0 and len(self.clients) > 0:
+                message = self.encode(pending)
+
+                self.clients = [client for client in self.clients if self.send(client, message) == True]
+
+                self.stats['sent'] += len(pending) * len(self.clients)
+
+        for client in self.clients:
+            client.close()
+
+        self.server.close()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def stop(self, timeout=5):
+        self.stop_event.set()
+
+        try:
+            self.wake_writer.send(b'\0')
+        except OSError:
+            pass
+
+        if self.is_alive():
+            self.join(timeout)
+
+        logger.info('Publisher stats: ' + str(self.stats))
+
+
+class SocketSubscriber(threading.Thread):
+    """
+    Receives documents from a MarketPublisher, reconnecting every retry_interval while it isn't running
+
+    callback - Called with (channel, document) from the subscriber thread
+    """
+
+    def __init__(self, path, callback, retry_interval=5):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.path = path
+        self.callback = callback
+        self.retry_interval = retry_interval
+
+        self.connected = False
+        self.connection = None
+
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.connection.connect(self.path)
+
+                self.connected = True
+
+                logger.info('Subscribed to ' + self.path + '.')
+
+                for line in self.connection.makefile('r'):
+                    message = json.loads(line)
+
+                    self.callback(message['channel'], message['document'])
+
+            except (OSError, ValueError) as e:
+                logger.debug('Pub/sub connection to ' + self.path + ' unavailable (' + str(e) + ').')
+
+            if self.connected == True:
+                logger.info('Publisher ' + self.path + ' disconnected. Reading from storage.')
+
+            self.connected = False
+
+            if self.connection != None:
+                self.connection.close()
+
+            self.stop_event.wait(self.retry_interval)
+
+    def stop(self):
+        self.stop_event.set()
+
+        if self.connection != None:
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class ChangeStreamSubscriber(threading.Thread):
+    """
+    Same callbacks as SocketSubscriber from MongoDB change streams on the analysis and trade collections
+
+    Needs a replica set (or sharded cluster). Trades of the bucket schema only change whole bucket
+    documents, so only analysis is streamed for it and trades are still read from storage.
+    """
+
+    def __init__(self, storage, exchange, market, callback, retry_interval=5):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.storage = storage
+        self.exchange = exchange
+        self.market = market
+        self.callback = callback
+        self.retry_interval = retry_interval
+
+        self.connected = False
+
+        self.stop_event = threading.Event()
+
+    def watch(self, collection, pipeline, channel, decode=None):
+        with collection.watch(pipeline, full_document='updateLookup', max_await_time_ms=1000) as change_stream:
+            self.connected = True
+
+            while not self.stop_event.is_set():
+                change = change_stream.try_next()
+
+                if change == None or change.get('fullDocument') == None:
+                    continue
+
+                document = change['fullDocument']
+
+                if decode != None:
+                    document = decode(document)
+
+                self.callback(channel, document)
+
+    def run(self):
+        from storage import BucketMongoStorage, CompactMongoStorage
+
+        analysis_pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']},
+                                         'fullDocument.exchange': self.exchange, 'fullDocument.market': self.market}}]
+
+        watches = [(self.storage.db[self.storage.collections['analysis']], analysis_pipeline, 'analysis', None)]
+
+        if isinstance(self.storage, CompactMongoStorage):
+            # One collection per market with compact documents
+            watches.append((self.storage.db[self.storage.trade_collection(self.exchange, self.market)],
+                            [{'$match': {'operationType': 'insert'}}], 'trade',
+                            lambda compact_doc: self.storage.market_codec(self.exchange, self.market).decode(compact_doc)))
+
+        elif not isinstance(self.storage, BucketMongoStorage):
+            watches.append((self.storage.db[self.storage.collections['data']],
+                            [{'$match': {'operationType': 'insert', 'fullDocument.exchange': self.exchange, 'fullDocument.market': self.market}}],
+                            'trade', None))
+
+        watch_threads = []
+
+        for collection, pipeline, channel, decode in watches[1:]:
+            watch_threads.append(threading.Thread(target=self.watch_loop, args=(collection, pipeline, channel, decode), daemon=True))
+            watch_threads[-1].start()
+
+        self.watch_loop(*watches[0])
+
+    def watch_loop(self, collection, pipeline, channel, decode):
+        while not self.stop_event.is_set():
+            try:
+                self.watch(collection, pipeline, channel, decode)
+
+            except Exception as e:
+                logger.warning('Change stream on ' + collection.name + ' unavailable (' + str(e) + '). Reading from storage.')
+
+            self.connected = False
+
+            self.stop_event.wait(self.retry_interval)
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def open_publisher(config, exchange, market):
+    """
+    Start a MarketPublisher for market if [pubsub] transport is socket. Returns the publisher (or None).
+
+    With transport = changestream subscribers watch the database writes instead, so nothing is published.
+    """
+
+    transport, socket_dir = pubsub_settings(config)
+
+    if transport != 'socket':
+        return None
+
+    publisher = MarketPublisher(socket_path(socket_dir, exchange, market))
+
+    try:
+        publisher.open()
+
+    except OSError as e:
+        logger.warning('Unable to open pub/sub socket ' + publisher.path + ' (' + str(e) + '). Not publishing.')
+
+        return None
+
+    publisher.start()
+
+    return publisher
+
+
+class MarketSubscription:
+    """
+    Newest pushed trade and analysis documents of one market for a display
+
+    latest_trade() / latest_analysis() return pushed documents while subscribed and read storage
+    otherwise (no publisher running, transport = none, or nothing pushed yet for an interval).
+    Stored trades come from the market's recent trade ring, falling back to the trade collection
+    for markets written before rings existed.
+    """
+
+    def __init__(self, config, storage, exchange, market):
+        self.storage = storage
+        self.exchange = exchange
+        self.market = market
+
+        self.lock = threading.Lock()
+
+        self.trade_last = None
+        self.analysis = {}
+
+        self.update_event = threading.Event()
+        self.analysis_updated = False
+
+        transport, socket_dir = pubsub_settings(config)
+
+        self.subscriber = None
+
+        if transport == 'socket':
+            self.subscriber = SocketSubscriber(socket_path(socket_dir, exchange, market), self.receive)
+
+        elif transport == 'changestream':
+            from storage import MongoStorage
+
+            if isinstance(storage, MongoStorage):
+                self.subscriber = ChangeStreamSubscriber(storage, exchange, market, self.receive)
+            else:
+                logger.warning('Change stream pub/sub requires MongoDB storage. Reading from storage.')
+
+        if self.subscriber != None:
+            self.subscriber.start()
+
+    def receive(self, channel, document):
+        with self.lock:
+            if channel == 'trade':
+                self.trade_last = document
+
+            elif channel == 'analysis':
+                self.analysis[document['interval']] = document
+
+                self.analysis_updated = True
+
+        self.update_event.set()
+
+    def connected(self):
+        return self.subscriber != None and self.subscriber.connected == True
+
+    def latest_trade(self):
+        if self.connected() == True:
+            with self.lock:
+                trade_last = self.trade_last
+
+            if trade_last != None:
+                return trade_last
+
+        recent_trades = self.storage.recent_trades(self.exchange, self.market, limit=1)
+
+        if len(recent_trades) > 0:
+            return recent_trades[-1]
+
+        return self.storage.latest_trade(self.exchange, self.market)
+
+    def recent_trades(self, limit=None):
+        """
+        Time-and-sales list of the last limit trades (Default: whole ring), oldest first
+        """
+
+        return self.storage.recent_trades(self.exchange, self.market, limit=limit)
+
+    def latest_analysis(self, interval):
+        if self.connected() == True:
+            with self.lock:
+                analysis_last = self.analysis.get(interval)
+
+            if analysis_last != None:
+                return analysis_last
+
+        return self.storage.latest_analysis(self.exchange, self.market, interval)
+
+    def take_update(self):
+        """
+        True if anything was pushed since the last call
+        """
+
+        if self.update_event.is_set():
+            self.update_event.clear()
+
+            return True
+
+        return False
+
+    def take_analysis_update(self):
+        """
+        True if an analysis document was pushed since the last call
+        """
+
+        with self.lock:
+            analysis_updated = self.analysis_updated
+            self.analysis_updated = False
+
+        return analysis_updated
+
+    def close(self):
+        if self.subscriber != None:
+            self.subscriber.stop()
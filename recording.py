@@ -0,0 +1,413 @@
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+from binance.depthcache import DepthCache, DepthCacheManager
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+recording_suffix = '.jsonl.gz'
+
+
+class MessageRecorder:
+    """
+    Append-only gzip JSON lines log of raw websocket messages
+
+    Each line is {'r': receive time (epoch sec), 'k': kind, 'm': raw message} where kind is one of
+    aggTrade / kline / depth / depth_snapshot. A new file <prefix>-<YYYYmmdd-HHMMSS>.jsonl.gz is
+    started every rotate_minutes, and the stream is sync flushed every flush_interval seconds so
+    a crash loses at most that much (readers stop cleanly at a truncated tail).
+    """
+
+    def __init__(self, record_path, prefix='flowmeter', rotate_minutes=60, flush_interval=5):
+        self.record_path = record_path
+        self.prefix = prefix
+        self.rotate_minutes = rotate_minutes
+        self.flush_interval = flush_interval
+
+        os.makedirs(self.record_path, exist_ok=True)
+
+        self.lock = threading.Lock()
+
+        self.record_file = None
+        self.file_path = None
+        self.file_opened = None
+        self.flush_last = time.time()
+
+        self.counts = {}
+
+    def open_file(self):
+        if self.record_file != None:
+            self.record_file.close()
+
+        self.file_path = os.path.join(self.record_path, self.prefix + '-' + datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S') + recording_suffix)
+
+        self.record_file = gzip.open(self.file_path, 'ab')
+        self.file_opened = time.time()
+
+        logger.info('Recording websocket messages to ' + self.file_path + '.')
+
+    def record(self, kind, msg):
+        line = json.dumps({'r': time.time(), 'k': kind, 'm': msg}, separators=(',', ':')).encode() + b'\n'
+
+        with self.lock:
+            if self.record_file == None or (self.rotate_minutes != None and (time.time() - self.file_opened) > (self.rotate_minutes * 60)):
+                self.open_file()
+
+            self.record_file.write(line)
+
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+            if (time.time() - self.flush_last) > self.flush_interval:
+                self.record_file.flush()
+                self.flush_last = time.time()
+
+    def wrap(self, kind, callback):
+        """
+        Websocket callback that records each message before passing it on
+        """
+
+        def recording_callback(msg):
+            try:
+                self.record(kind, msg)
+            except Exception as e:
+                logger.exception(e)
+
+            return callback(msg)
+
+        return recording_callback
+
+    def close(self):
+        with self.lock:
+            if self.record_file != None:
+                self.record_file.close()
+                self.record_file = None
+
+        logger.info('Recorded messages: ' + str(self.counts))
+
+
+class RecordingDepthCacheManager(DepthCacheManager):
+    """
+    DepthCacheManager that also records depth diffs and the order book state after each REST snapshot
+    """
+
+    def __init__(self, client, symbol, recorder, **kwargs):
+        self.recorder = recorder
+
+        DepthCacheManager.__init__(self, client, symbol, **kwargs)
+
+    def _depth_event(self, msg):
+        self.recorder.record('depth', msg)
+
+        DepthCacheManager._depth_event(self, msg)
+
+    def _init_cache(self):
+        DepthCacheManager._init_cache(self)
+
+        # Book after the snapshot and any buffered diffs, so replay can start from it exactly
+        self.recorder.record('depth_snapshot', {
+            's': self._symbol,
+            'lastUpdateId': self._last_update_id,
+            'bids': [[price, "{:.8f}".format(quantity)] for price, quantity in self._depth_cache._bids.items()],
+            'asks': [[price, "{:.8f}".format(quantity)] for price, quantity in self._depth_cache._asks.items()]
+        })
+
+
+def open_depth_cache_manager(client, symbol, callback=None, refresh_interval=300, record_path=None):
+    """
+    DepthCacheManager, recording to record_path if given
+    """
+
+    if record_path == None:
+        return DepthCacheManager(client, symbol=symbol, callback=callback, refresh_interval=refresh_interval)
+
+    return RecordingDepthCacheManager(client, symbol, MessageRecorder(record_path, prefix='depth-' + symbol.lower()),
+                                      callback=callback, refresh_interval=refresh_interval)
+
+
+def recording_files(paths):
+    """
+    Expand files/directories into recording files in time order
+    """
+
+    if isinstance(paths, str):
+        paths = [paths]
+
+    files = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in os.listdir(path) if name.endswith(recording_suffix))
+        else:
+            files.append(path)
+
+    # Timestamp is the last part of each name, so sort on it across prefixes
+    return sorted(files, key=lambda file_path: (os.path.basename(file_path)[-(len(recording_suffix) + 15):], file_path))
+
+
+def read_recording(paths):
+    """
+    Yield recorded lines ({'r', 'k', 'm'}) from recording files in order
+    """
+
+    for file_path in recording_files(paths):
+        try:
+            with gzip.open(file_path, 'rb') as record_file:
+                for line in record_file:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        logger.warning('Skipping partial line in ' + file_path + '.')
+
+        except (EOFError, zlib.error, OSError) as e:
+            # Unflushed tail after a crash
+            logger.warning('Recording ' + file_path + ' ends early (' + str(e) + ').')
+
+
+class ReplayDepthCache:
+    """
+    Rebuild order books from recorded depth snapshots and diffs, calling an orderbook_handler()-style callback
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+        self.depth_caches = {}
+        self.last_update_ids = {}
+
+    def snapshot(self, msg):
+        depth_cache = DepthCache(msg['s'])
+
+        for bid in msg['bids']:
+            depth_cache.add_bid(bid)
+        for ask in msg['asks']:
+            depth_cache.add_ask(ask)
+
+        self.depth_caches[msg['s']] = depth_cache
+        self.last_update_ids[msg['s']] = msg['lastUpdateId']
+
+    def update(self, msg):
+        symbol = msg['s']
+
+        # Diffs before the first snapshot (or already in it) are covered by the snapshot
+        if symbol not in self.depth_caches or msg['u'] <= self.last_update_ids[symbol]:
+            return
+
+        depth_cache = self.depth_caches[symbol]
+
+        for bid in msg['b']:
+            depth_cache.add_bid(bid)
+        for ask in msg['a']:
+            depth_cache.add_ask(ask)
+
+        depth_cache.update_time = msg['E']
+
+        self.last_update_ids[symbol] = msg['u']
+
+        self.callback(depth_cache)
+
+
+class ReplayDriver:
+    """
+    Feed a recording back into message handlers at recorded speed, N times faster or as fast as possible
+
+    handlers - {kind: callable(msg)} (ex. {'aggTrade': flow_meter.process_message, 'kline': candle_handler})
+    depth_callback - Called with a DepthCache after every depth update (ex. Display.orderbook_handler)
+    speed - 1 = recorded pace, N = N times faster, None or 0 = no waiting
+    """
+
+    def __init__(self, paths, handlers=None, depth_callback=None, speed=1.0):
+        self.paths = paths
+        self.handlers = handlers if handlers != None else {}
+        self.speed = speed
+
+        self.depth_replay = None
+        if depth_callback != None:
+            self.depth_replay = ReplayDepthCache(depth_callback)
+
+        self.replay_active = False
+
+        self.stats = {'messages': 0, 'by_kind': {}, 'errors': 0, 'seconds': None, 'recorded_seconds': None, 'lag_max': 0.0}
+
+    def dispatch(self, kind, msg):
+        if kind in self.handlers:
+            self.handlers[kind](msg)
+
+        if self.depth_replay != None:
+            if kind == 'depth_snapshot':
+                self.depth_replay.snapshot(msg)
+            elif kind == 'depth':
+                self.depth_replay.update(msg)
+
+    def run(self):
+        self.replay_active = True
+
+        replay_start = time.time()
+        recorded_start = None
+        recorded_last = None
+
+        for line in read_recording(self.paths):
+            if self.replay_active == False:
+                logger.info('Replay stopped.')
+                break
+
+            if recorded_start == None:
+                recorded_start = line['r']
+
+            recorded_last = line['r']
+
+            if self.speed:
+                wait = replay_start + ((line['r'] - recorded_start) / self.speed) - time.time()
+
+                if wait > 0:
+                    time.sleep(wait)
+                elif -wait > self.stats['lag_max']:
+                    self.stats['lag_max'] = -wait
+
+            try:
+                self.dispatch(line['k'], line['m'])
+
+            except Exception as e:
+                logger.exception(e)
+
+                self.stats['errors'] += 1
+
+            self.stats['messages'] += 1
+            self.stats['by_kind'][line['k']] = self.stats['by_kind'].get(line['k'], 0) + 1
+
+        self.stats['seconds'] = time.time() - replay_start
+
+        if recorded_start != None:
+            self.stats['recorded_seconds'] = recorded_last - recorded_start
+
+        self.replay_active = False
+
+        return self.stats
+
+    def stop(self):
+        self.replay_active = False
+
+
+def replay_flowmeter(paths, speed=None, storage_backend='embedded', analysis_interval=None, analysis_output=None):
+    """
+    Replay recorded aggTrades through FlowMeter.process_message() into storage
+
+    analysis_interval - Every this many seconds of recorded time, run the rolling window analysis as of
+                        the recorded clock and write results to analysis_output (JSON lines) for offline backtests
+    """
+
+    import flowmeter
+    from backfill import LiveMerge
+    from flow_engine import RollingWindowEngine
+    from storage import EmbeddedStorage, open_storage
+    from trade_writer import TradeWriter
+
+    if storage_backend == 'embedded':
+        storage = EmbeddedStorage()
+    else:
+        storage = open_storage(flowmeter.config, backend=storage_backend)
+
+    flow_meter = flowmeter.FlowMeter(exchange='binance', storage=storage, autostart=False)
+
+    flow_meter.live_merge = LiveMerge()
+    flow_meter.trade_writer = TradeWriter(storage, stats_interval=None)
+    flow_meter.trade_writer.start()
+
+    engine = RollingWindowEngine()
+
+    intervals = [backtest[0] for backtest in flow_meter.backtest_durations]
+
+    analysis_file = open(analysis_output, 'w') if analysis_output != None else None
+
+    analysis_state = {'next_ms': None}
+
+    def aggtrade_handler(msg):
+        if flow_meter.user_market == None:
+            flow_meter.user_market = msg['s']
+            flow_meter.user_trade_currency, flow_meter.user_quote_currency = split_market(msg['s'])
+
+        flow_meter.process_message(msg)
+
+        if analysis_interval != None:
+            engine.add_trade(flow_meter.user_exchange, msg['s'], msg['a'], msg['T'], msg['p'], msg['q'], 'sell' if msg['m'] == True else 'buy')
+
+            if analysis_state['next_ms'] == None:
+                analysis_state['next_ms'] = msg['T'] + int(analysis_interval * 1000)
+
+            elif msg['T'] >= analysis_state['next_ms']:
+                analysis_results = engine.analyze_all(intervals, now_ms=analysis_state['next_ms'])
+
+                if analysis_file != None:
+                    for market_key in analysis_results:
+                        analysis_file.write(json.dumps({'time': analysis_state['next_ms'], 'exchange': market_key[0], 'market': market_key[1],
+                                                        'results': analysis_results[market_key]}) + '\n')
+
+                analysis_state['next_ms'] += int(analysis_interval * 1000)
+
+    flowmeter.logger.setLevel(logging.WARNING)
+
+    replay_driver = ReplayDriver(paths, handlers={'aggTrade': aggtrade_handler}, speed=speed)
+
+    try:
+        replay_stats = replay_driver.run()
+
+    except KeyboardInterrupt:
+        replay_stats = replay_driver.stats
+
+    finally:
+        flow_meter.trade_writer.stop()
+
+        if analysis_file != None:
+            analysis_file.close()
+
+    return replay_stats
+
+
+def split_market(market):
+    for quote_currency in ['USDT', 'BTC', 'ETH', 'BNB', 'PAX', 'TUSD', 'USDC']:
+        if market.endswith(quote_currency):
+            return market[:-len(quote_currency)], quote_currency
+
+    return market, None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or replay recorded websocket messages.')
+    parser.add_argument('command', choices=['info', 'replay'], help='info = message counts and time span / replay = feed aggTrades through FlowMeter.process_message()')
+    parser.add_argument('paths', nargs='+', help='Recording files or directories.')
+    parser.add_argument('-s', '--speed', type=float, default=0, help='Replay speed (1 = recorded pace, N = N times faster, 0 = max speed). [Default: 0]')
+    parser.add_argument('--storage', type=str, default='embedded', help='Storage backend for replayed trades (embedded = in memory SQLite). [Default: embedded]')
+    parser.add_argument('--analysis-interval', type=float, default=None, help='Run analysis every N seconds of recorded time.')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON lines file for analysis results.')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        recording_info = {'messages': 0, 'by_kind': {}, 'first': None, 'last': None}
+
+        for line in read_recording(args.paths):
+            recording_info['messages'] += 1
+            recording_info['by_kind'][line['k']] = recording_info['by_kind'].get(line['k'], 0) + 1
+
+            if recording_info['first'] == None:
+                recording_info['first'] = line['r']
+            recording_info['last'] = line['r']
+
+        for boundary in ['first', 'last']:
+            if recording_info[boundary] != None:
+                recording_info[boundary] = datetime.datetime.utcfromtimestamp(recording_info[boundary]).isoformat() + 'Z'
+
+        print(json.dumps(recording_info, indent=2))
+
+    else:
+        replay_stats = replay_flowmeter(args.paths, speed=args.speed, storage_backend=args.storage,
+                                        analysis_interval=args.analysis_interval, analysis_output=args.output)
+
+        logger.info('Replay stats: ' + str(replay_stats))
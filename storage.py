@@ -0,0 +1,2124 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from compact_schema import TradeCodec, binance_symbol_scales, market_header
+from flow_engine import compile_analysis_result, interval_to_ms
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Fields of a trade document (compact and bucket schemas decode back to these)
+trade_fields = ['_id', 'exchange', 'market', 'trade_currency', 'quote_currency', 'type', 'price', 'quantity', 'trade_time', 'side']
+
+# Per-market metadata fields besides exchange/market/updated (see TradeStorage.market_meta())
+market_meta_fields = ['first_id', 'first_time', 'last_id', 'last_time', 'trade_count', 'analysis_updated', 'analysis_intervals']
+
+
+def market_window_bounds(interval, now_ms=None):
+    """
+    (analysis_delta, analysis_start, analysis_start_last) for an interval ending now
+    """
+
+    if now_ms == None:
+        now_ms = int(time.time()) * 1000
+
+    analysis_delta = interval_to_ms(interval)
+
+    analysis_start = now_ms - analysis_delta
+    analysis_start_last = analysis_start - analysis_delta
+
+    return analysis_delta, analysis_start, analysis_start_last
+
+
+def side_summary(side_sums):
+    """
+    Convert {'buy': {'volume', 'price_sum', 'amount', 'count'}, 'sell': {...}} sums to window aggregates
+    """
+
+    summary = {'all': None, 'buy': None, 'sell': None}
+
+    all_sums = {'volume': 0, 'price_sum': 0, 'amount': 0, 'count': 0}
+
+    for side in ['buy', 'sell']:
+        if side in side_sums and side_sums[side]['count'] > 0:
+            summary[side] = {'volume': side_sums[side]['volume'],
+                             'price': side_sums[side]['price_sum'] / side_sums[side]['count'],
+                             'amount': side_sums[side]['amount'],
+                             'count': side_sums[side]['count']}
+
+            for key in all_sums:
+                all_sums[key] += side_sums[side][key]
+
+    if all_sums['count'] > 0:
+        summary['all'] = {'volume': all_sums['volume'],
+                          'price': all_sums['price_sum'] / all_sums['count'],
+                          'amount': all_sums['amount'],
+                          'count': all_sums['count']}
+
+    return summary
+
+
+class TradeStorage:
+    """
+    Storage operations used by FlowMeter, Display and analyze_historical
+
+    Trade documents use the data collection fields (_id = aggregate trade id, exchange, market,
+    trade_currency, quote_currency, type, price, quantity, trade_time, side).
+
+    shared_across_processes - False if data written in one process is invisible to forked processes
+    """
+
+    shared_across_processes = True
+
+    ## Trades ##
+    def insert_trade(self, trade_doc):
+        """
+        Returns False if the trade already exists or could not be written
+        """
+
+        insert_result = self.insert_trades([trade_doc])
+
+        return insert_result['success'] == True and insert_result['result']['inserted'] == 1
+
+    def insert_trades(self, trade_docs):
+        """
+        Returns {'success': bool, 'result': {'inserted': int, 'duplicates': int}}
+        """
+
+        raise NotImplementedError
+
+    def latest_trade(self, exchange, market):
+        raise NotImplementedError
+
+    def first_trade(self, exchange, market):
+        raise NotImplementedError
+
+    def trades_since(self, exchange, market, after_id=None, start_ms=None, limit=None):
+        """
+        List of trade documents in id order with _id > after_id and/or trade_time >= start_ms
+
+        limit - Maximum number of documents (ex. to page through a market with after_id)
+        """
+
+        raise NotImplementedError
+
+    def trade_markets(self):
+        """
+        List of (exchange, market) with stored trades
+        """
+
+        raise NotImplementedError
+
+    def window_aggregates(self, exchange, market, start_ms, end_ms=None):
+        """
+        {'all', 'buy', 'sell'} volume/price/amount/count for start_ms <= trade_time < end_ms (None if no trades)
+        """
+
+        raise NotImplementedError
+
+    def analyze(self, exchange, market, interval='1h', now_ms=None):
+        """
+        Same return value as FlowMeter.analyze_data()
+        """
+
+        analyze_return = {'success': True, 'result': None}
+
+        try:
+            analysis_delta, analysis_start, analysis_start_last = market_window_bounds(interval, now_ms)
+
+            window_metrics = {
+                'current': self.window_aggregates(exchange, market, analysis_start),
+                'last': self.window_aggregates(exchange, market, analysis_start_last, analysis_start)
+            }
+
+            analyze_return = compile_analysis_result(window_metrics, analysis_delta)
+
+        except Exception as e:
+            logger.exception(e)
+
+            analyze_return['success'] = False
+
+        return analyze_return
+
+    def delete_before(self, before_ms):
+        """
+        Returns {'success': bool, 'result': {'deleted_count': int}}
+        """
+
+        raise NotImplementedError
+
+    def delete_market(self, exchange, market):
+        raise NotImplementedError
+
+    ## Analysis ##
+    def upsert_analysis(self, analysis_document):
+        raise NotImplementedError
+
+    def latest_analysis(self, exchange, market, interval):
+        raise NotImplementedError
+
+    def analysis_catalog(self, exchange=None, market=None):
+        """
+        List of {'exchange', 'market', 'interval'} for every stored analysis document
+        """
+
+        raise NotImplementedError
+
+    ## Historical Flow Differential ##
+    def insert_historical(self, historical_document):
+        raise NotImplementedError
+
+    def historical_range(self, exchange, market=None, start=None, end=None):
+        """
+        Iterate historical documents sorted by time
+        """
+
+        raise NotImplementedError
+
+    ## Backfill Checkpoints ##
+    def save_checkpoint(self, checkpoint):
+        """
+        Upsert {'_id', 'exchange', 'market', 'chunk_start', 'chunk_end', 'trade_id_last', 'status', 'updated'}
+        """
+
+        raise NotImplementedError
+
+    def load_checkpoints(self, exchange, market):
+        """
+        Checkpoints for market sorted by chunk_start
+        """
+
+        raise NotImplementedError
+
+    def delete_checkpoints(self, exchange=None, market=None, before_ms=None):
+        """
+        Delete checkpoints for exchange/market, or every checkpoint with chunk_end <= before_ms
+        """
+
+        raise NotImplementedError
+
+    ## Recent Trades ##
+    def push_recent_trades(self, exchange, market, trade_docs, keep):
+        """
+        Append trade documents (newer than any already in the ring) to the market's ring of the last keep trades
+        """
+
+        raise NotImplementedError
+
+    def recent_trades(self, exchange, market, limit=None):
+        """
+        Last limit trades of the market's ring (Default: whole ring), oldest first
+        """
+
+        raise NotImplementedError
+
+    def delete_recent_trades(self, exchange=None, market=None):
+        raise NotImplementedError
+
+    ## Flow Bars ##
+    def upsert_bars(self, bar_docs):
+        """
+        Replace or insert flow bar documents by _id (see flow_bars.py)
+        """
+
+        raise NotImplementedError
+
+    def load_bars(self, bar_ids):
+        """
+        List of the stored bars with the given ids (missing ids are left out)
+        """
+
+        raise NotImplementedError
+
+    def bar_range(self, exchange, market, resolution, start_ms, end_ms=None):
+        """
+        Bars of one resolution with start_ms <= start < end_ms, sorted by start
+        """
+
+        raise NotImplementedError
+
+    def delete_bars(self, exchange=None, market=None, before_ms=None):
+        """
+        Delete bars (and folded id state) for exchange/market, or every bar with end <= before_ms
+        """
+
+        raise NotImplementedError
+
+    ## Market Metadata ##
+    def update_market_meta(self, exchange, market, first_id, first_time, last_id, last_time, trade_count):
+        """
+        Widen the market's first/last trade id and time to include the given ones and add trade_count written trades
+        """
+
+        raise NotImplementedError
+
+    def set_market_meta(self, exchange, market, fields):
+        """
+        Set metadata fields (first_id, first_time, last_id, last_time, trade_count, analysis_updated, analysis_intervals)
+        """
+
+        raise NotImplementedError
+
+    def market_meta(self, exchange, market):
+        """
+        {'_id', 'exchange', 'market', 'first_id', 'first_time', 'last_id', 'last_time', 'trade_count',
+         'analysis_updated', 'analysis_intervals', 'updated'} or None
+        """
+
+        raise NotImplementedError
+
+    def market_catalog(self, exchange=None):
+        """
+        Metadata documents of every market (of exchange)
+        """
+
+        raise NotImplementedError
+
+    def delete_market_meta(self, exchange=None, market=None):
+        raise NotImplementedError
+
+    def count_trades(self, exchange, market):
+        all_sums = self.window_aggregates(exchange, market, 0)['all']
+
+        return all_sums['count'] if all_sums != None else 0
+
+    def record_written(self, trade_docs, inserted=None):
+        """
+        Fold a batch of written trades into the metadata of its markets
+
+        inserted - Trades the batch actually inserted. Counts of single-market batches leave duplicates out,
+                   batches spanning several markets count every trade until refresh_market_meta() recounts.
+        """
+
+        market_batches = {}
+
+        for trade_doc in trade_docs:
+            market_batches.setdefault((trade_doc['exchange'], trade_doc['market']), []).append(trade_doc)
+
+        for (exchange, market), market_docs in market_batches.items():
+            trade_first = min(market_docs, key=lambda trade_doc: trade_doc['_id'])
+            trade_last = max(market_docs, key=lambda trade_doc: trade_doc['_id'])
+
+            trade_count = len(market_docs)
+            if inserted != None and len(market_batches) == 1:
+                trade_count = inserted
+
+            try:
+                self.update_market_meta(exchange, market, trade_first['_id'], trade_first['trade_time'],
+                                        trade_last['_id'], trade_last['trade_time'], trade_count)
+
+            except Exception as e:
+                # Trades are already stored, check_missing_trades() and cleanup recount if the metadata is off
+                logger.warning('Unable to update ' + exchange + '-' + market + ' metadata (' + str(e) + ').')
+
+    def refresh_market_meta(self, exchange, market):
+        """
+        Rebuild the market's trade watermarks and count from the stored trades (ex. after cleanup).
+        Returns market_meta() (None for a market without trades or metadata).
+        """
+
+        trade_first = self.first_trade(exchange, market)
+        trade_last = self.latest_trade(exchange, market)
+
+        if trade_first == None and self.market_meta(exchange, market) == None:
+            return None
+
+        meta_fields = {'first_id': None, 'first_time': None, 'last_id': None, 'last_time': None, 'trade_count': 0}
+
+        if trade_first != None and trade_last != None:
+            meta_fields = {'first_id': trade_first['_id'], 'first_time': trade_first['trade_time'],
+                           'last_id': trade_last['_id'], 'last_time': trade_last['trade_time'],
+                           'trade_count': self.count_trades(exchange, market)}
+
+        self.set_market_meta(exchange, market, meta_fields)
+
+        return self.market_meta(exchange, market)
+
+    def refresh_expired_meta(self, before_ms):
+        """
+        Refresh the metadata of markets whose first trade is older than before_ms (after delete_before()).
+        Markets with only newer trades are left alone. Returns list of refreshed (exchange, market).
+        """
+
+        refreshed_markets = []
+
+        for meta_doc in self.market_catalog():
+            if meta_doc['first_time'] != None and meta_doc['first_time'] < before_ms:
+                self.refresh_market_meta(meta_doc['exchange'], meta_doc['market'])
+
+                refreshed_markets.append((meta_doc['exchange'], meta_doc['market']))
+
+        return refreshed_markets
+
+    def close(self):
+        pass
+
+
+class MongoStorage(TradeStorage):
+
+    def __init__(self, db, collections):
+        self.db = db
+        self.collections = collections
+
+    def insert_trade(self, trade_doc):
+        from pymongo.errors import DuplicateKeyError
+
+        try:
+            self.db[self.collections['data']].insert_one(trade_doc)
+
+        except DuplicateKeyError:
+            return False
+
+        return True
+
+    ## Trade Schema (overridden by CompactMongoStorage) ##
+    def trade_collection(self, exchange, market):
+        return self.collections['data']
+
+    def trade_match(self, exchange, market, time_match=None, side=None):
+        """
+        Query / $match filter for a market's trades (ex. in analyze_data() pipelines)
+
+        time_match - Condition on trade time (ex. {'$gte': start_ms})
+        side - 'buy' or 'sell' (Default: both)
+        """
+
+        query = {'exchange': exchange, 'market': market}
+
+        if time_match != None:
+            query['trade_time'] = time_match
+        if side != None:
+            query['side'] = side
+
+        return query
+
+    def decode_stages(self, exchange, market, time_match=None, side=None):
+        """
+        Pipeline stages to place after trade_match() so later stages see the full trade fields
+
+        time_match/side - Same as passed to trade_match() (for schemas that can only apply them per trade)
+        """
+
+        return []
+
+    def retention_match(self, before_ms):
+        """
+        Filter for the trade documents delete_before() removes
+        """
+
+        return {'trade_time': {'$lt': before_ms}}
+
+    def trade_indexes(self, exchange, market):
+        """
+        (collection name, index keys) pairs needed by the market's trade queries under this schema
+        """
+
+        from index_manager import required_indexes
+
+        return [(self.trade_collection(exchange, market), index_keys) for index_keys in required_indexes['data']]
+
+    def trade_hot_queries(self, exchange, market, now_ms):
+        """
+        (query name, collection name, command) for the market's hot trade queries, explained by IndexManager
+        """
+
+        collection_name = self.trade_collection(exchange, market)
+
+        def aggregate(pipeline):
+            return {'aggregate': collection_name, 'pipeline': pipeline, 'cursor': {}}
+
+        analysis_match = self.trade_match(exchange, market, {'$gte': now_ms - 86400000})
+        analysis_match_side = self.trade_match(exchange, market, {'$gte': now_ms - 86400000}, side='buy')
+
+        return [('analyze_data (all)', collection_name, aggregate([{'$match': analysis_match}, {'$sort': {'_id': 1}}])),
+                ('analyze_data (side)', collection_name, aggregate([{'$match': analysis_match_side}, {'$sort': {'_id': 1}}])),
+                ('latest_trade', collection_name, aggregate([{'$match': self.trade_match(exchange, market)}, {'$sort': {'_id': -1}}, {'$limit': 1}])),
+                ('cleanup_database', collection_name, {'delete': collection_name,
+                                                       'deletes': [{'q': self.retention_match(now_ms - (49 * 3600000)), 'limit': 0}]})]
+
+    def trade_batches(self, trade_docs):
+        """
+        (collection name, documents) pairs to write for a batch of trade documents
+        """
+
+        return [(self.collections['data'], trade_docs)]
+
+    def insert_trades(self, trade_docs):
+        from pymongo.errors import BulkWriteError
+
+        insert_return = {'success': True, 'result': {'inserted': 0, 'duplicates': 0}}
+
+        try:
+            for collection_name, documents in self.trade_batches(trade_docs):
+                try:
+                    insert_result = self.db[collection_name].insert_many(documents, ordered=False)
+
+                    insert_return['result']['inserted'] += len(insert_result.inserted_ids)
+
+                except BulkWriteError as bwe:
+                    # Unordered writes continue past failures, so only count what went wrong
+                    insert_return['result']['inserted'] += bwe.details['nInserted']
+
+                    for write_error in bwe.details['writeErrors']:
+                        if write_error['code'] == 11000:
+                            insert_return['result']['duplicates'] += 1
+                        else:
+                            insert_return['success'] = False
+
+                    if insert_return['success'] == False:
+                        logger.error('Errors while writing trade batch: ' + str(bwe.details['writeErrors'][:3]))
+
+        except Exception as e:
+            logger.exception(e)
+
+            insert_return['success'] = False
+
+        return insert_return
+
+    def latest_trade(self, exchange, market):
+        for trade_doc in self.db[self.collections['data']].find({'exchange': exchange, 'market': market}).sort('_id', -1).limit(1):
+            return trade_doc
+
+        return None
+
+    def first_trade(self, exchange, market):
+        for trade_doc in self.db[self.collections['data']].find({'exchange': exchange, 'market': market}).sort('_id', 1).limit(1):
+            return trade_doc
+
+        return None
+
+    def trades_since(self, exchange, market, after_id=None, start_ms=None, limit=None):
+        query = {'exchange': exchange, 'market': market}
+
+        if after_id != None:
+            query['_id'] = {'$gt': after_id}
+        if start_ms != None:
+            query['trade_time'] = {'$gte': start_ms}
+
+        trade_cursor = self.db[self.collections['data']].find(query).sort('_id', 1)
+
+        if limit != None:
+            trade_cursor = trade_cursor.limit(limit)
+
+        return list(trade_cursor)
+
+    def trade_markets(self):
+        return [(group['_id']['exchange'], group['_id']['market']) for group in
+                self.db[self.collections['data']].aggregate([{'$group': {'_id': {'exchange': '$exchange', 'market': '$market'}}},
+                                                             {'$sort': {'_id': 1}}])]
+
+    def window_aggregates(self, exchange, market, start_ms, end_ms=None):
+        time_match = {'$gte': start_ms}
+        if end_ms != None:
+            time_match['$lt'] = end_ms
+
+        pipeline = [
+            {'$match': {'exchange': exchange, 'market': market, 'trade_time': time_match}},
+            {'$group': {'_id': '$side',
+                        'volume': {'$sum': '$quantity'},
+                        'price_sum': {'$sum': '$price'},
+                        'amount': {'$sum': {'$multiply': ['$price', '$quantity']}},
+                        'count': {'$sum': 1}}}
+        ]
+
+        side_sums = {}
+        for group in self.db[self.collections['data']].aggregate(pipeline):
+            side_sums[group['_id']] = group
+
+        return side_summary(side_sums)
+
+    def delete_before(self, before_ms):
+        delete_return = {'success': True, 'result': {'deleted_count': None}}
+
+        try:
+            delete_result = self.db[self.collections['data']].delete_many(self.retention_match(before_ms))
+
+            delete_return['result']['deleted_count'] = delete_result.deleted_count
+
+        except Exception as e:
+            logger.exception(e)
+
+            delete_return['success'] = False
+
+        return delete_return
+
+    def delete_market(self, exchange, market):
+        return self.db[self.collections['data']].delete_many({'exchange': exchange, 'market': market}).deleted_count
+
+    def upsert_analysis(self, analysis_document):
+        return self.db[self.collections['analysis']].update_one({'_id': analysis_document['_id']},
+                                                                {'$set': analysis_document}, upsert=True)
+
+    def latest_analysis(self, exchange, market, interval):
+        for analysis_document in self.db[self.collections['analysis']].find({'exchange': exchange, 'market': market, 'interval': interval}).sort('time', -1).limit(1):
+            return analysis_document
+
+        return None
+
+    def analysis_catalog(self, exchange=None, market=None):
+        query = {}
+        if exchange != None:
+            query['exchange'] = exchange
+        if market != None:
+            query['market'] = market
+
+        return list(self.db[self.collections['analysis']].find(query, {'_id': 0, 'exchange': 1, 'market': 1, 'interval': 1}))
+
+    def insert_historical(self, historical_document):
+        return self.db[self.collections['historical']].insert_one(historical_document).inserted_id
+
+    def historical_range(self, exchange, market=None, start=None, end=None):
+        query = {'exchange': exchange}
+        if market != None:
+            query['market'] = market
+        if start != None or end != None:
+            query['time'] = {}
+            if start != None:
+                query['time']['$gte'] = start
+            if end != None:
+                query['time']['$lt'] = end
+
+        return self.db[self.collections['historical']].find(query, sort=[('time', 1)])
+
+    def save_checkpoint(self, checkpoint):
+        self.db[self.collections['backfill']].replace_one({'_id': checkpoint['_id']}, checkpoint, upsert=True)
+
+    def load_checkpoints(self, exchange, market):
+        return list(self.db[self.collections['backfill']].find({'exchange': exchange, 'market': market}, sort=[('chunk_start', 1)]))
+
+    def delete_checkpoints(self, exchange=None, market=None, before_ms=None):
+        query = {}
+        if exchange != None:
+            query['exchange'] = exchange
+        if market != None:
+            query['market'] = market
+        if before_ms != None:
+            query['chunk_end'] = {'$lte': before_ms}
+
+        return self.db[self.collections['backfill']].delete_many(query).deleted_count
+
+    def push_recent_trades(self, exchange, market, trade_docs, keep):
+        # One document per market, so a busy market can't push a quiet one out of the ring
+        self.db[self.collections['recent']].update_one({'_id': exchange + ':' + market},
+                                                       {'$push': {'trades': {'$each': trade_docs, '$sort': {'_id': 1}, '$slice': -keep}},
+                                                        '$set': {'exchange': exchange, 'market': market, 'updated': time.time()}},
+                                                       upsert=True)
+
+    def recent_trades(self, exchange, market, limit=None):
+        projection = {'trades': 1}
+        if limit != None:
+            projection['trades'] = {'$slice': -limit}
+
+        recent_doc = self.db[self.collections['recent']].find_one({'_id': exchange + ':' + market}, projection)
+
+        if recent_doc == None:
+            return []
+
+        return recent_doc['trades']
+
+    def delete_recent_trades(self, exchange=None, market=None):
+        query = {}
+        if exchange != None:
+            query['exchange'] = exchange
+        if market != None:
+            query['market'] = market
+
+        return self.db[self.collections['recent']].delete_many(query).deleted_count
+
+    def upsert_bars(self, bar_docs):
+        from pymongo import ReplaceOne
+
+        if len(bar_docs) > 0:
+            self.db[self.collections['bars']].bulk_write([ReplaceOne({'_id': bar_doc['_id']}, bar_doc, upsert=True) for bar_doc in bar_docs],
+                                                         ordered=False)
+
+    def load_bars(self, bar_ids):
+        if len(bar_ids) == 0:
+            return []
+
+        return list(self.db[self.collections['bars']].find({'_id': {'$in': bar_ids}}))
+
+    def bar_range(self, exchange, market, resolution, start_ms, end_ms=None):
+        query = {'exchange': exchange, 'market': market, 'resolution': resolution, 'start': {'$gte': start_ms}}
+        if end_ms != None:
+            query['start']['$lt'] = end_ms
+
+        return list(self.db[self.collections['bars']].find(query, sort=[('start', 1)]))
+
+    def delete_bars(self, exchange=None, market=None, before_ms=None):
+        query = {}
+        if exchange != None:
+            query['exchange'] = exchange
+        if market != None:
+            query['market'] = market
+        if before_ms != None:
+            query['end'] = {'$lte': before_ms}
+
+        return self.db[self.collections['bars']].delete_many(query).deleted_count
+
+    def count_trades(self, exchange, market):
+        return self.db[self.trade_collection(exchange, market)].count_documents(self.trade_match(exchange, market))
+
+    def update_market_meta(self, exchange, market, first_id, first_time, last_id, last_time, trade_count):
+        self.db[self.collections['meta']].update_one({'_id': exchange + ':' + market},
+                                                     {'$min': {'first_id': first_id, 'first_time': first_time},
+                                                      '$max': {'last_id': last_id, 'last_time': last_time},
+                                                      '$inc': {'trade_count': trade_count},
+                                                      '$set': {'exchange': exchange, 'market': market, 'updated': time.time()}},
+                                                     upsert=True)
+
+    def set_market_meta(self, exchange, market, fields):
+        meta_update = {'$set': {'exchange': exchange, 'market': market, 'updated': time.time()}}
+
+        for field, value in fields.items():
+            if value != None:
+                meta_update['$set'][field] = value
+            else:
+                # null sorts below numbers, so a stored null would stick through $min
+                meta_update.setdefault('$unset', {})[field] = ''
+
+        self.db[self.collections['meta']].update_one({'_id': exchange + ':' + market}, meta_update, upsert=True)
+
+    def meta_doc(self, meta_document):
+        for field in market_meta_fields:
+            meta_document.setdefault(field, None)
+
+        return meta_document
+
+    def market_meta(self, exchange, market):
+        meta_document = self.db[self.collections['meta']].find_one({'_id': exchange + ':' + market})
+
+        return self.meta_doc(meta_document) if meta_document != None else None
+
+    def market_catalog(self, exchange=None):
+        query = {}
+        if exchange != None:
+            query['exchange'] = exchange
+
+        return [self.meta_doc(meta_document) for meta_document in self.db[self.collections['meta']].find(query, sort=[('exchange', 1), ('market', 1)])]
+
+    def delete_market_meta(self, exchange=None, market=None):
+        query = {}
+        if exchange != None:
+            query['exchange'] = exchange
+        if market != None:
+            query['market'] = market
+
+        return self.db[self.collections['meta']].delete_many(query).deleted_count
+
+
+class CompactMongoStorage(MongoStorage):
+    """
+    MongoStorage with the compact trade schema (compact_schema.py)
+
+    Each market's trades are kept in their own collection (<data>.<exchange>.<market>) as
+    {_id, t, p, q, b[, k]} documents with fixed-point price/quantity, and the market's identity and
+    scales in a header document in <data>.headers. Trades are decoded on read, so callers still get
+    full trade documents.
+
+    scale_source - Function of (exchange, market) returning (price tick, quantity step) strings for new markets
+    """
+
+    def __init__(self, db, collections, scale_source=None):
+        MongoStorage.__init__(self, db, collections)
+
+        self.scale_source = scale_source
+
+        self.codecs = {}
+        self.codec_lock = threading.Lock()
+
+    def header_collection(self):
+        return self.collections.get('headers', self.collections['data'] + '.headers')
+
+    def trade_collection(self, exchange, market):
+        return self.collections['data'] + '.' + exchange + '.' + market
+
+    def market_codec(self, exchange, market, trade_doc=None):
+        """
+        Codec for a market's header, creating the header from trade_doc if the market is new (else None)
+        """
+
+        codec_key = (exchange, market)
+
+        if codec_key in self.codecs:
+            return self.codecs[codec_key]
+
+        with self.codec_lock:
+            header = self.db[self.header_collection()].find_one({'_id': exchange + ':' + market})
+
+            if header == None:
+                if trade_doc == None:
+                    return None
+
+                # Another process may create the same header first, so whichever was stored is used
+                self.db[self.header_collection()].update_one({'_id': exchange + ':' + market},
+                                                             {'$setOnInsert': market_header(trade_doc, self.scale_source)}, upsert=True)
+
+                header = self.db[self.header_collection()].find_one({'_id': exchange + ':' + market})
+
+                for collection_name, index_keys in self.trade_indexes(exchange, market):
+                    self.db[collection_name].create_index(index_keys)
+
+                logger.info('Created compact schema header for ' + exchange + '-' + market + ' (price tick ' + header['price_tick'] +
+                            ', quantity step ' + header['qty_step'] + ').')
+
+            self.codecs[codec_key] = TradeCodec(header)
+
+        return self.codecs[codec_key]
+
+    def trade_match(self, exchange, market, time_match=None, side=None):
+        query = {}
+
+        if time_match != None:
+            query['t'] = time_match
+        if side != None:
+            query['b'] = (side == 'buy')
+
+        return query
+
+    def retention_match(self, before_ms):
+        return {'t': {'$lt': before_ms}}
+
+    def trade_indexes(self, exchange, market):
+        # Window scans by time (and side), latest/first trade use _id
+        return [(self.trade_collection(exchange, market), [('t', 1)]),
+                (self.trade_collection(exchange, market), [('b', 1), ('t', 1)])]
+
+    def decode_stages(self, exchange, market, time_match=None, side=None):
+        codec = self.market_codec(exchange, market)
+
+        if codec == None:
+            return []
+
+        return [codec.decode_projection()]
+
+    def trade_batches(self, trade_docs):
+        market_docs = {}
+        for trade_doc in trade_docs:
+            market_docs.setdefault((trade_doc['exchange'], trade_doc['market']), []).append(trade_doc)
+
+        trade_batches = []
+        for (exchange, market), documents in market_docs.items():
+            codec = self.market_codec(exchange, market, documents[0])
+
+            trade_batches.append((self.trade_collection(exchange, market), [codec.encode(trade_doc) for trade_doc in documents]))
+
+        return trade_batches
+
+    def insert_trade(self, trade_doc):
+        return TradeStorage.insert_trade(self, trade_doc)
+
+    def query_trade(self, exchange, market, direction):
+        codec = self.market_codec(exchange, market)
+
+        if codec == None:
+            return None
+
+        for compact_doc in self.db[self.trade_collection(exchange, market)].find().sort('_id', direction).limit(1):
+            return codec.decode(compact_doc)
+
+        return None
+
+    def latest_trade(self, exchange, market):
+        return self.query_trade(exchange, market, -1)
+
+    def first_trade(self, exchange, market):
+        return self.query_trade(exchange, market, 1)
+
+    def trades_since(self, exchange, market, after_id=None, start_ms=None, limit=None):
+        codec = self.market_codec(exchange, market)
+
+        if codec == None:
+            return []
+
+        query = self.trade_match(exchange, market, time_match=({'$gte': start_ms} if start_ms != None else None))
+
+        if after_id != None:
+            query['_id'] = {'$gt': after_id}
+
+        trade_cursor = self.db[self.trade_collection(exchange, market)].find(query).sort('_id', 1)
+
+        if limit != None:
+            trade_cursor = trade_cursor.limit(limit)
+
+        return [codec.decode(compact_doc) for compact_doc in trade_cursor]
+
+    def trade_markets(self):
+        return [(header['exchange'], header['market']) for header in self.db[self.header_collection()].find(sort=[('_id', 1)])]
+
+    def window_aggregates(self, exchange, market, start_ms, end_ms=None):
+        codec = self.market_codec(exchange, market)
+
+        if codec == None:
+            return side_summary({})
+
+        time_match = {'$gte': start_ms}
+        if end_ms != None:
+            time_match['$lt'] = end_ms
+
+        # Integer sums are scaled once per group instead of once per trade (amount starts as a double so it can't overflow)
+        pipeline = [
+            {'$match': self.trade_match(exchange, market, time_match)},
+            {'$group': {'_id': '$b',
+                        'volume': {'$sum': '$q'},
+                        'price_sum': {'$sum': '$p'},
+                        'amount': {'$sum': {'$multiply': [1.0, '$p', '$q']}},
+                        'count': {'$sum': 1}}}
+        ]
+
+        side_sums = {}
+        for group in self.db[self.trade_collection(exchange, market)].aggregate(pipeline):
+            side_sums['buy' if group['_id'] else 'sell'] = {'volume': group['volume'] / codec.qty_scale,
+                                                           'price_sum': group['price_sum'] / codec.price_scale,
+                                                           'amount': group['amount'] / (codec.price_scale * codec.qty_scale),
+                                                           'count': group['count']}
+
+        return side_summary(side_sums)
+
+    def delete_before(self, before_ms):
+        delete_return = {'success': True, 'result': {'deleted_count': None}}
+
+        try:
+            deleted_count = 0
+
+            for exchange, market in self.trade_markets():
+                deleted_count += self.db[self.trade_collection(exchange, market)].delete_many(self.retention_match(before_ms)).deleted_count
+
+            delete_return['result']['deleted_count'] = deleted_count
+
+        except Exception as e:
+            logger.exception(e)
+
+            delete_return['success'] = False
+
+        return delete_return
+
+    def delete_market(self, exchange, market):
+        # Header is kept, so the market keeps its scales if trades are written again
+        return self.db[self.trade_collection(exchange, market)].delete_many({}).deleted_count
+
+
+class BucketMongoStorage(MongoStorage):
+    """
+    MongoStorage with trades appended to per-market, per-minute bucket documents
+
+    Bucket documents (_id '<exchange>:<market>:<minute ms>', in <data>.buckets) hold parallel ids/t/p/q/b arrays plus
+    running buy/sell/all volume, price_sum, amount and count sums. Window aggregates add whole-bucket
+    sums and only read individual trades from the partial minutes at the window edges, and retention
+    deletes whole minutes. Reads unpack buckets back to full trade documents (type is not kept, so
+    every trade reads back as aggTrade).
+    """
+
+    bucket_ms = 60000
+
+    def __init__(self, db, collections):
+        MongoStorage.__init__(self, db, collections)
+
+        # Kept apart from the data collection so both schemas can exist side by side (ex. while migrating)
+        self.bucket_collection = collections.get('buckets', collections['data'] + '.buckets')
+
+        self.indexes_ready = False
+
+    def trade_collection(self, exchange, market):
+        return self.bucket_collection
+
+    def bucket_minute(self, trade_time):
+        return trade_time - (trade_time % self.bucket_ms)
+
+    def bucket_id(self, exchange, market, minute):
+        return exchange + ':' + market + ':' + str(minute)
+
+    def ensure_bucket_indexes(self):
+        for collection_name, index_keys in self.trade_indexes(None, None):
+            self.db[collection_name].create_index(index_keys)
+
+        self.indexes_ready = True
+
+    def retention_match(self, before_ms):
+        # Whole minutes only, so a bucket is kept until all of its trades are older than before_ms
+        return {'minute': {'$lte': before_ms - self.bucket_ms}}
+
+    def trade_indexes(self, exchange, market):
+        # One bucket collection for every market
+        return [(self.bucket_collection, index_keys) for index_keys in [[('exchange', 1), ('market', 1), ('minute', 1)],
+                                                                        [('exchange', 1), ('market', 1), ('id_last', -1)],
+                                                                        [('exchange', 1), ('market', 1), ('id_first', 1)],
+                                                                        [('minute', 1)]]]
+
+    def trade_hot_queries(self, exchange, market, now_ms):
+        def find(query_filter, sort=None, limit=None):
+            find_command = {'find': self.bucket_collection, 'filter': query_filter}
+            if sort != None:
+                find_command['sort'] = sort
+            if limit != None:
+                find_command['limit'] = limit
+            return find_command
+
+        return [('window_aggregates', self.bucket_collection, find(self.trade_match(exchange, market, {'$gte': now_ms - 86400000}))),
+                ('latest_trade', self.bucket_collection, find({'exchange': exchange, 'market': market}, sort={'id_last': -1}, limit=1)),
+                ('first_trade', self.bucket_collection, find({'exchange': exchange, 'market': market}, sort={'id_first': 1}, limit=1)),
+                ('cleanup_database', self.bucket_collection, {'delete': self.bucket_collection,
+                                                              'deletes': [{'q': self.retention_match(now_ms - (49 * 3600000)), 'limit': 0}]})]
+
+    def bucket_trades(self, bucket):
+        return [{'_id': bucket['ids'][x], 'type': 'aggTrade', 'exchange': bucket['exchange'], 'market': bucket['market'],
+                 'trade_currency': bucket.get('trade_currency'), 'quote_currency': bucket.get('quote_currency'),
+                 'price': bucket['p'][x], 'quantity': bucket['q'][x], 'trade_time': bucket['t'][x],
+                 'side': 'buy' if bucket['b'][x] else 'sell'} for x in range(len(bucket['ids']))]
+
+    def trade_match(self, exchange, market, time_match=None, side=None):
+        # Buckets that can hold matching trades, trade time and side are matched after decode_stages()
+        query = {'exchange': exchange, 'market': market}
+
+        if time_match != None:
+            query['minute'] = {}
+
+            for operator, value in time_match.items():
+                if operator in ['$gte', '$gt']:
+                    query['minute']['$gte'] = self.bucket_minute(value)
+                else:
+                    query['minute'][operator] = value
+
+        return query
+
+    def decode_stages(self, exchange, market, time_match=None, side=None):
+        trade_match = {}
+        if time_match != None:
+            trade_match['trade_time'] = time_match
+        if side != None:
+            trade_match['side'] = side
+
+        stages = [{'$unwind': {'path': '$ids', 'includeArrayIndex': 'i'}},
+                  {'$project': {'_id': '$ids', 'exchange': 1, 'market': 1,
+                                'trade_time': {'$arrayElemAt': ['$t', '$i']},
+                                'price': {'$arrayElemAt': ['$p', '$i']},
+                                'quantity': {'$arrayElemAt': ['$q', '$i']},
+                                'side': {'$cond': [{'$arrayElemAt': ['$b', '$i']}, 'buy', 'sell']}}}]
+
+        if len(trade_match) > 0:
+            stages.append({'$match': trade_match})
+
+        return stages
+
+    def bucket_update(self, bucket_docs):
+        """
+        Update appending trade documents (all from one bucket) to the arrays and sums
+        """
+
+        bucket_update = {'$setOnInsert': {'exchange': bucket_docs[0]['exchange'], 'market': bucket_docs[0]['market'],
+                                          'trade_currency': bucket_docs[0].get('trade_currency'),
+                                          'quote_currency': bucket_docs[0].get('quote_currency'),
+                                          'minute': self.bucket_minute(bucket_docs[0]['trade_time'])},
+                         '$push': {'ids': {'$each': [trade_doc['_id'] for trade_doc in bucket_docs]},
+                                   't': {'$each': [trade_doc['trade_time'] for trade_doc in bucket_docs]},
+                                   'p': {'$each': [trade_doc['price'] for trade_doc in bucket_docs]},
+                                   'q': {'$each': [trade_doc['quantity'] for trade_doc in bucket_docs]},
+                                   'b': {'$each': [trade_doc['side'] == 'buy' for trade_doc in bucket_docs]}},
+                         '$inc': {},
+                         '$min': {'id_first': min(trade_doc['_id'] for trade_doc in bucket_docs)},
+                         '$max': {'id_last': max(trade_doc['_id'] for trade_doc in bucket_docs)}}
+
+        for trade_doc in bucket_docs:
+            for side in [trade_doc['side'], 'all']:
+                for key, value in [('volume', trade_doc['quantity']), ('price_sum', trade_doc['price']),
+                                   ('amount', trade_doc['price'] * trade_doc['quantity']), ('count', 1)]:
+                    sum_key = 'sums.' + side + '.' + key
+
+                    bucket_update['$inc'][sum_key] = bucket_update['$inc'].get(sum_key, 0) + value
+
+        return bucket_update
+
+    def insert_trades(self, trade_docs):
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError
+
+        insert_return = {'success': True, 'result': {'inserted': 0, 'duplicates': 0}}
+
+        try:
+            if self.indexes_ready == False:
+                self.ensure_bucket_indexes()
+
+            buckets = {}
+            for trade_doc in trade_docs:
+                bucket_id = self.bucket_id(trade_doc['exchange'], trade_doc['market'], self.bucket_minute(trade_doc['trade_time']))
+
+                bucket_docs = buckets.setdefault(bucket_id, {})
+
+                if trade_doc['_id'] in bucket_docs:
+                    insert_return['result']['duplicates'] += 1
+                else:
+                    bucket_docs[trade_doc['_id']] = trade_doc
+
+            bucket_ids = list(buckets.keys())
+
+            # Only matches (or creates) a bucket holding none of the ids, so trades are never appended twice
+            operations = [UpdateOne({'_id': bucket_id, 'ids': {'$nin': list(buckets[bucket_id].keys())}},
+                                    self.bucket_update(list(buckets[bucket_id].values())), upsert=True) for bucket_id in bucket_ids]
+
+            retry_ids = []
+
+            try:
+                self.db[self.bucket_collection].bulk_write(operations, ordered=False)
+
+                insert_return['result']['inserted'] += sum(len(buckets[bucket_id]) for bucket_id in bucket_ids)
+
+            except BulkWriteError as bwe:
+                failed_ids = set()
+
+                for write_error in bwe.details['writeErrors']:
+                    failed_ids.add(bucket_ids[write_error['index']])
+
+                    # Duplicate _id: the bucket exists and already holds some of the ids
+                    if write_error['code'] == 11000:
+                        retry_ids.append(bucket_ids[write_error['index']])
+                    else:
+                        insert_return['success'] = False
+
+                        logger.error('Error while writing trade bucket ' + bucket_ids[write_error['index']] + ': ' + str(write_error.get('errmsg')))
+
+                insert_return['result']['inserted'] += sum(len(buckets[bucket_id]) for bucket_id in bucket_ids if bucket_id not in failed_ids)
+
+            for bucket_id in retry_ids:
+                stored_bucket = self.db[self.bucket_collection].find_one({'_id': bucket_id}, {'ids': 1})
+
+                stored_ids = set(stored_bucket['ids']) if stored_bucket != None else set()
+
+                new_docs = [trade_doc for trade_id, trade_doc in buckets[bucket_id].items() if trade_id not in stored_ids]
+
+                insert_return['result']['duplicates'] += len(buckets[bucket_id]) - len(new_docs)
+
+                if len(new_docs) == 0:
+                    continue
+
+                update_result = self.db[self.bucket_collection].update_one({'_id': bucket_id, 'ids': {'$nin': [trade_doc['_id'] for trade_doc in new_docs]}},
+                                                                             self.bucket_update(new_docs))
+
+                if update_result.modified_count == 1:
+                    insert_return['result']['inserted'] += len(new_docs)
+                else:
+                    # Another writer changed the bucket in between
+                    logger.error('Failed to append ' + str(len(new_docs)) + ' trades to bucket ' + bucket_id + '.')
+
+                    insert_return['success'] = False
+
+        except Exception as e:
+            logger.exception(e)
+
+            insert_return['success'] = False
+
+        return insert_return
+
+    def insert_trade(self, trade_doc):
+        return TradeStorage.insert_trade(self, trade_doc)
+
+    def latest_trade(self, exchange, market):
+        for bucket in self.db[self.bucket_collection].find({'exchange': exchange, 'market': market}).sort('id_last', -1).limit(1):
+            return max(self.bucket_trades(bucket), key=lambda trade_doc: trade_doc['_id'])
+
+        return None
+
+    def first_trade(self, exchange, market):
+        for bucket in self.db[self.bucket_collection].find({'exchange': exchange, 'market': market}).sort('id_first', 1).limit(1):
+            return min(self.bucket_trades(bucket), key=lambda trade_doc: trade_doc['_id'])
+
+        return None
+
+    def trades_since(self, exchange, market, after_id=None, start_ms=None, limit=None):
+        query = {'exchange': exchange, 'market': market}
+
+        if after_id != None:
+            query['id_last'] = {'$gt': after_id}
+        if start_ms != None:
+            query['minute'] = {'$gte': self.bucket_minute(start_ms)}
+
+        trade_docs = []
+
+        # Ids within and across buckets are only roughly ordered (ex. refilled trades), so collect until no later bucket can hold a lower id
+        for bucket in self.db[self.bucket_collection].find(query).sort('id_first', 1):
+            if limit != None and len(trade_docs) >= limit:
+                trade_docs.sort(key=lambda trade_doc: trade_doc['_id'])
+                trade_docs = trade_docs[:limit]
+
+                if bucket['id_first'] > trade_docs[-1]['_id']:
+                    break
+
+            for trade_doc in self.bucket_trades(bucket):
+                if (after_id == None or trade_doc['_id'] > after_id) and (start_ms == None or trade_doc['trade_time'] >= start_ms):
+                    trade_docs.append(trade_doc)
+
+        trade_docs.sort(key=lambda trade_doc: trade_doc['_id'])
+
+        if limit != None:
+            trade_docs = trade_docs[:limit]
+
+        return trade_docs
+
+    def window_aggregates(self, exchange, market, start_ms, end_ms=None):
+        # Whole minutes inside the window come from bucket sums, partial edge minutes from their trades
+        full_start = self.bucket_minute(start_ms + self.bucket_ms - 1)
+        edge_minutes = []
+
+        if full_start != start_ms:
+            edge_minutes.append(self.bucket_minute(start_ms))
+
+        full_match = {'$gte': full_start}
+
+        if end_ms != None:
+            full_match['$lt'] = self.bucket_minute(end_ms)
+
+            if end_ms % self.bucket_ms != 0 and self.bucket_minute(end_ms) not in edge_minutes:
+                edge_minutes.append(self.bucket_minute(end_ms))
+
+        side_sums = {side: {'volume': 0, 'price_sum': 0, 'amount': 0, 'count': 0} for side in ['buy', 'sell']}
+
+        if end_ms == None or full_match['$lt'] > full_start:
+            group_stage = {'_id': None}
+            for side in ['buy', 'sell']:
+                for key in ['volume', 'price_sum', 'amount', 'count']:
+                    group_stage[side + '_' + key] = {'$sum': '$sums.' + side + '.' + key}
+
+            for group in self.db[self.bucket_collection].aggregate([{'$match': {'exchange': exchange, 'market': market, 'minute': full_match}},
+                                                                      {'$group': group_stage}]):
+                for side in ['buy', 'sell']:
+                    for key in side_sums[side]:
+                        side_sums[side][key] += group[side + '_' + key]
+
+        for bucket in self.db[self.bucket_collection].find({'_id': {'$in': [self.bucket_id(exchange, market, minute) for minute in edge_minutes]}}):
+            for x in range(len(bucket['ids'])):
+                if bucket['t'][x] >= start_ms and (end_ms == None or bucket['t'][x] < end_ms):
+                    side = 'buy' if bucket['b'][x] else 'sell'
+
+                    side_sums[side]['volume'] += bucket['q'][x]
+                    side_sums[side]['price_sum'] += bucket['p'][x]
+                    side_sums[side]['amount'] += bucket['p'][x] * bucket['q'][x]
+                    side_sums[side]['count'] += 1
+
+        return side_summary(side_sums)
+
+    def trade_markets(self):
+        return [(group['_id']['exchange'], group['_id']['market']) for group in
+                self.db[self.bucket_collection].aggregate([{'$group': {'_id': {'exchange': '$exchange', 'market': '$market'}}},
+                                                             {'$sort': {'_id': 1}}])]
+
+    def count_trades(self, exchange, market):
+        # Sum of the buckets' running counts
+        return TradeStorage.count_trades(self, exchange, market)
+
+    def delete_buckets(self, query):
+        delete_return = {'success': True, 'result': {'deleted_count': None}}
+
+        try:
+            deleted_count = 0
+            for group in self.db[self.bucket_collection].aggregate([{'$match': query}, {'$group': {'_id': None, 'count': {'$sum': '$sums.all.count'}}}]):
+                deleted_count = group['count']
+
+            self.db[self.bucket_collection].delete_many(query)
+
+            delete_return['result']['deleted_count'] = deleted_count
+
+        except Exception as e:
+            logger.exception(e)
+
+            delete_return['success'] = False
+
+        return delete_return
+
+    def delete_before(self, before_ms):
+        return self.delete_buckets(self.retention_match(before_ms))
+
+    def delete_market(self, exchange, market):
+        return self.delete_buckets({'exchange': exchange, 'market': market})['result']['deleted_count']
+
+
+class EmbeddedStorage(TradeStorage):
+    """
+    SQLite-backed storage for offline runs and benchmarks (no database server required)
+
+    path - SQLite database file, or ':memory:' for a purely in-process store
+    """
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+
+        # In-memory databases are private to the process that created them
+        self.shared_across_processes = (path != ':memory:')
+
+        self.lock = threading.RLock()
+
+        self.connection = None
+        self.connection_pid = None
+
+        self.connect()
+
+    def connect(self):
+        if self.path != ':memory:' and os.path.dirname(self.path) != '':
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection_pid = os.getpid()
+
+        if self.path != ':memory:':
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS trades (
+                id INTEGER NOT NULL, exchange TEXT NOT NULL, market TEXT NOT NULL,
+                trade_currency TEXT, quote_currency TEXT, type TEXT,
+                price REAL NOT NULL, quantity REAL NOT NULL, trade_time INTEGER NOT NULL, side TEXT NOT NULL,
+                PRIMARY KEY (exchange, market, id));
+            CREATE INDEX IF NOT EXISTS trades_market_time ON trades (exchange, market, trade_time);
+            CREATE INDEX IF NOT EXISTS trades_time ON trades (trade_time);
+            CREATE TABLE IF NOT EXISTS analysis (
+                id TEXT PRIMARY KEY, exchange TEXT, market TEXT, interval TEXT, updated REAL, document TEXT);
+            CREATE INDEX IF NOT EXISTS analysis_market ON analysis (exchange, market, interval);
+            CREATE TABLE IF NOT EXISTS historical (
+                id TEXT PRIMARY KEY, exchange TEXT, market TEXT, time INTEGER, document TEXT);
+            CREATE INDEX IF NOT EXISTS historical_market_time ON historical (exchange, market, time);
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                id TEXT PRIMARY KEY, exchange TEXT, market TEXT, chunk_start INTEGER, chunk_end INTEGER,
+                trade_id_last INTEGER, status TEXT, updated REAL);
+            CREATE INDEX IF NOT EXISTS checkpoints_market ON checkpoints (exchange, market, chunk_start);
+            CREATE TABLE IF NOT EXISTS recent_trades (
+                exchange TEXT NOT NULL, market TEXT NOT NULL, id INTEGER NOT NULL, document TEXT,
+                PRIMARY KEY (exchange, market, id));
+            CREATE TABLE IF NOT EXISTS bars (
+                id TEXT PRIMARY KEY, exchange TEXT, market TEXT, resolution TEXT, start INTEGER, end INTEGER, document TEXT);
+            CREATE INDEX IF NOT EXISTS bars_market_start ON bars (exchange, market, resolution, start);
+            CREATE INDEX IF NOT EXISTS bars_end ON bars (end);
+            CREATE TABLE IF NOT EXISTS market_meta (
+                exchange TEXT NOT NULL, market TEXT NOT NULL, first_id INTEGER, first_time INTEGER, last_id INTEGER, last_time INTEGER,
+                trade_count INTEGER, analysis_updated REAL, analysis_intervals TEXT, updated REAL,
+                PRIMARY KEY (exchange, market));
+        """)
+
+    def cursor(self):
+        # sqlite connections must not be shared across fork
+        if self.connection_pid != os.getpid():
+            self.connect()
+
+        return self.connection
+
+    def trade_row_doc(self, row):
+        return {'_id': row[0], 'exchange': row[1], 'market': row[2], 'trade_currency': row[3], 'quote_currency': row[4],
+                'type': row[5], 'price': row[6], 'quantity': row[7], 'trade_time': row[8], 'side': row[9]}
+
+    def insert_trades(self, trade_docs):
+        insert_return = {'success': True, 'result': {'inserted': 0, 'duplicates': 0}}
+
+        try:
+            rows = [(trade_doc['_id'], trade_doc['exchange'], trade_doc['market'], trade_doc.get('trade_currency'),
+                     trade_doc.get('quote_currency'), trade_doc.get('type'), trade_doc['price'], trade_doc['quantity'],
+                     trade_doc['trade_time'], trade_doc['side']) for trade_doc in trade_docs]
+
+            with self.lock:
+                connection = self.cursor()
+
+                changes_before = connection.total_changes
+
+                connection.executemany('INSERT OR IGNORE INTO trades VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                connection.commit()
+
+                insert_return['result']['inserted'] = connection.total_changes - changes_before
+
+            insert_return['result']['duplicates'] = len(rows) - insert_return['result']['inserted']
+
+        except Exception as e:
+            logger.exception(e)
+
+            insert_return['success'] = False
+
+        return insert_return
+
+    def query_trade(self, exchange, market, order):
+        with self.lock:
+            row = self.cursor().execute('SELECT * FROM trades WHERE exchange = ? AND market = ? ORDER BY id ' + order + ' LIMIT 1',
+                                        (exchange, market)).fetchone()
+
+        return self.trade_row_doc(row) if row != None else None
+
+    def latest_trade(self, exchange, market):
+        return self.query_trade(exchange, market, 'DESC')
+
+    def first_trade(self, exchange, market):
+        return self.query_trade(exchange, market, 'ASC')
+
+    def trades_since(self, exchange, market, after_id=None, start_ms=None, limit=None):
+        query = 'SELECT * FROM trades WHERE exchange = ? AND market = ?'
+        parameters = [exchange, market]
+
+        if after_id != None:
+            query += ' AND id > ?'
+            parameters.append(after_id)
+        if start_ms != None:
+            query += ' AND trade_time >= ?'
+            parameters.append(start_ms)
+
+        query += ' ORDER BY id'
+
+        if limit != None:
+            query += ' LIMIT ?'
+            parameters.append(limit)
+
+        with self.lock:
+            rows = self.cursor().execute(query, parameters).fetchall()
+
+        return [self.trade_row_doc(row) for row in rows]
+
+    def trade_markets(self):
+        with self.lock:
+            rows = self.cursor().execute('SELECT DISTINCT exchange, market FROM trades ORDER BY exchange, market').fetchall()
+
+        return [(row[0], row[1]) for row in rows]
+
+    def window_aggregates(self, exchange, market, start_ms, end_ms=None):
+        query = ('SELECT side, SUM(quantity), SUM(price), SUM(price * quantity), COUNT(*) FROM trades '
+                 'WHERE exchange = ? AND market = ? AND trade_time >= ?')
+        parameters = [exchange, market, start_ms]
+
+        if end_ms != None:
+            query += ' AND trade_time < ?'
+            parameters.append(end_ms)
+
+        with self.lock:
+            rows = self.cursor().execute(query + ' GROUP BY side', parameters).fetchall()
+
+        side_sums = {}
+        for row in rows:
+            side_sums[row[0]] = {'volume': row[1], 'price_sum': row[2], 'amount': row[3], 'count': row[4]}
+
+        return side_summary(side_sums)
+
+    def delete_before(self, before_ms):
+        delete_return = {'success': True, 'result': {'deleted_count': None}}
+
+        try:
+            with self.lock:
+                connection = self.cursor()
+
+                delete_result = connection.execute('DELETE FROM trades WHERE trade_time < ?', (before_ms,))
+                connection.commit()
+
+            delete_return['result']['deleted_count'] = delete_result.rowcount
+
+        except Exception as e:
+            logger.exception(e)
+
+            delete_return['success'] = False
+
+        return delete_return
+
+    def delete_market(self, exchange, market):
+        with self.lock:
+            connection = self.cursor()
+
+            delete_result = connection.execute('DELETE FROM trades WHERE exchange = ? AND market = ?', (exchange, market))
+            connection.commit()
+
+        return delete_result.rowcount
+
+    def upsert_analysis(self, analysis_document):
+        with self.lock:
+            connection = self.cursor()
+
+            connection.execute('INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?, ?)',
+                               (analysis_document['_id'], analysis_document['exchange'], analysis_document['market'],
+                                analysis_document['interval'], analysis_document.get('updated'), json.dumps(analysis_document)))
+            connection.commit()
+
+    def latest_analysis(self, exchange, market, interval):
+        with self.lock:
+            row = self.cursor().execute('SELECT document FROM analysis WHERE exchange = ? AND market = ? AND interval = ? ORDER BY updated DESC LIMIT 1',
+                                        (exchange, market, interval)).fetchone()
+
+        return json.loads(row[0]) if row != None else None
+
+    def analysis_catalog(self, exchange=None, market=None):
+        query = 'SELECT exchange, market, interval FROM analysis WHERE 1 = 1'
+        parameters = []
+
+        if exchange != None:
+            query += ' AND exchange = ?'
+            parameters.append(exchange)
+        if market != None:
+            query += ' AND market = ?'
+            parameters.append(market)
+
+        with self.lock:
+            rows = self.cursor().execute(query, parameters).fetchall()
+
+        return [{'exchange': row[0], 'market': row[1], 'interval': row[2]} for row in rows]
+
+    def insert_historical(self, historical_document):
+        with self.lock:
+            connection = self.cursor()
+
+            connection.execute('INSERT INTO historical VALUES (?, ?, ?, ?, ?)',
+                               (historical_document['_id'], historical_document['exchange'], historical_document['market'],
+                                historical_document['time'], json.dumps(historical_document)))
+            connection.commit()
+
+        return historical_document['_id']
+
+    def historical_range(self, exchange, market=None, start=None, end=None):
+        query = 'SELECT document FROM historical WHERE exchange = ?'
+        parameters = [exchange]
+
+        if market != None:
+            query += ' AND market = ?'
+            parameters.append(market)
+        if start != None:
+            query += ' AND time >= ?'
+            parameters.append(start)
+        if end != None:
+            query += ' AND time < ?'
+            parameters.append(end)
+
+        with self.lock:
+            rows = self.cursor().execute(query + ' ORDER BY time', parameters).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    def save_checkpoint(self, checkpoint):
+        with self.lock:
+            connection = self.cursor()
+
+            connection.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (checkpoint['_id'], checkpoint['exchange'], checkpoint['market'], checkpoint['chunk_start'],
+                                checkpoint['chunk_end'], checkpoint['trade_id_last'], checkpoint['status'], checkpoint['updated']))
+            connection.commit()
+
+    def load_checkpoints(self, exchange, market):
+        with self.lock:
+            rows = self.cursor().execute('SELECT * FROM checkpoints WHERE exchange = ? AND market = ? ORDER BY chunk_start',
+                                         (exchange, market)).fetchall()
+
+        return [{'_id': row[0], 'exchange': row[1], 'market': row[2], 'chunk_start': row[3], 'chunk_end': row[4],
+                 'trade_id_last': row[5], 'status': row[6], 'updated': row[7]} for row in rows]
+
+    def delete_checkpoints(self, exchange=None, market=None, before_ms=None):
+        query = 'DELETE FROM checkpoints WHERE 1 = 1'
+        parameters = []
+
+        if exchange != None:
+            query += ' AND exchange = ?'
+            parameters.append(exchange)
+        if market != None:
+            query += ' AND market = ?'
+            parameters.append(market)
+        if before_ms != None:
+            query += ' AND chunk_end <= ?'
+            parameters.append(before_ms)
+
+        with self.lock:
+            connection = self.cursor()
+
+            delete_result = connection.execute(query, parameters)
+            connection.commit()
+
+        return delete_result.rowcount
+
+    def push_recent_trades(self, exchange, market, trade_docs, keep):
+        with self.lock:
+            connection = self.cursor()
+
+            connection.executemany('INSERT OR IGNORE INTO recent_trades VALUES (?, ?, ?, ?)',
+                                   [(exchange, market, trade_doc['_id'], json.dumps(trade_doc)) for trade_doc in trade_docs])
+
+            connection.execute('DELETE FROM recent_trades WHERE exchange = ? AND market = ? AND id <= '
+                               '(SELECT id FROM recent_trades WHERE exchange = ? AND market = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                               (exchange, market, exchange, market, keep))
+            connection.commit()
+
+    def recent_trades(self, exchange, market, limit=None):
+        with self.lock:
+            rows = self.cursor().execute('SELECT document FROM recent_trades WHERE exchange = ? AND market = ? ORDER BY id DESC LIMIT ?',
+                                         (exchange, market, limit if limit != None else -1)).fetchall()
+
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    def delete_recent_trades(self, exchange=None, market=None):
+        query = 'DELETE FROM recent_trades WHERE 1 = 1'
+        parameters = []
+
+        if exchange != None:
+            query += ' AND exchange = ?'
+            parameters.append(exchange)
+        if market != None:
+            query += ' AND market = ?'
+            parameters.append(market)
+
+        with self.lock:
+            connection = self.cursor()
+
+            delete_result = connection.execute(query, parameters)
+            connection.commit()
+
+        return delete_result.rowcount
+
+    def upsert_bars(self, bar_docs):
+        with self.lock:
+            connection = self.cursor()
+
+            connection.executemany('INSERT OR REPLACE INTO bars VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   [(bar_doc['_id'], bar_doc['exchange'], bar_doc['market'], bar_doc['resolution'],
+                                     bar_doc['start'], bar_doc['end'], json.dumps(bar_doc)) for bar_doc in bar_docs])
+            connection.commit()
+
+    def load_bars(self, bar_ids):
+        bar_docs = []
+
+        with self.lock:
+            connection = self.cursor()
+
+            # Stays under the SQLite bound parameter limit
+            for x in range(0, len(bar_ids), 500):
+                id_batch = bar_ids[x:(x + 500)]
+
+                rows = connection.execute('SELECT document FROM bars WHERE id IN (' + ', '.join(['?'] * len(id_batch)) + ')', id_batch).fetchall()
+
+                bar_docs.extend(json.loads(row[0]) for row in rows)
+
+        return bar_docs
+
+    def bar_range(self, exchange, market, resolution, start_ms, end_ms=None):
+        query = 'SELECT document FROM bars WHERE exchange = ? AND market = ? AND resolution = ? AND start >= ?'
+        parameters = [exchange, market, resolution, start_ms]
+
+        if end_ms != None:
+            query += ' AND start < ?'
+            parameters.append(end_ms)
+
+        with self.lock:
+            rows = self.cursor().execute(query + ' ORDER BY start', parameters).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    def delete_bars(self, exchange=None, market=None, before_ms=None):
+        query = 'DELETE FROM bars WHERE 1 = 1'
+        parameters = []
+
+        if exchange != None:
+            query += ' AND exchange = ?'
+            parameters.append(exchange)
+        if market != None:
+            query += ' AND market = ?'
+            parameters.append(market)
+        if before_ms != None:
+            query += ' AND end <= ?'
+            parameters.append(before_ms)
+
+        with self.lock:
+            connection = self.cursor()
+
+            delete_result = connection.execute(query, parameters)
+            connection.commit()
+
+        return delete_result.rowcount
+
+    def count_trades(self, exchange, market):
+        with self.lock:
+            row = self.cursor().execute('SELECT COUNT(*) FROM trades WHERE exchange = ? AND market = ?', (exchange, market)).fetchone()
+
+        return row[0]
+
+    def meta_row_doc(self, row):
+        return {'_id': row[0] + ':' + row[1], 'exchange': row[0], 'market': row[1], 'first_id': row[2], 'first_time': row[3],
+                'last_id': row[4], 'last_time': row[5], 'trade_count': row[6], 'analysis_updated': row[7],
+                'analysis_intervals': json.loads(row[8]) if row[8] != None else None, 'updated': row[9]}
+
+    def update_market_meta(self, exchange, market, first_id, first_time, last_id, last_time, trade_count):
+        with self.lock:
+            connection = self.cursor()
+
+            connection.execute('INSERT INTO market_meta (exchange, market, first_id, first_time, last_id, last_time, trade_count, updated) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (exchange, market) DO UPDATE SET '
+                               'first_id = MIN(COALESCE(first_id, excluded.first_id), excluded.first_id), '
+                               'first_time = MIN(COALESCE(first_time, excluded.first_time), excluded.first_time), '
+                               'last_id = MAX(COALESCE(last_id, excluded.last_id), excluded.last_id), '
+                               'last_time = MAX(COALESCE(last_time, excluded.last_time), excluded.last_time), '
+                               'trade_count = COALESCE(trade_count, 0) + excluded.trade_count, updated = excluded.updated',
+                               (exchange, market, first_id, first_time, last_id, last_time, trade_count, time.time()))
+            connection.commit()
+
+    def set_market_meta(self, exchange, market, fields):
+        meta_fields = dict(fields, updated=time.time())
+
+        if 'analysis_intervals' in meta_fields and meta_fields['analysis_intervals'] != None:
+            meta_fields['analysis_intervals'] = json.dumps(meta_fields['analysis_intervals'])
+
+        # Column names come from the known metadata fields only
+        meta_columns = [column for column in market_meta_fields + ['updated'] if column in meta_fields]
+
+        with self.lock:
+            connection = self.cursor()
+
+            connection.execute('INSERT OR IGNORE INTO market_meta (exchange, market) VALUES (?, ?)', (exchange, market))
+            connection.execute('UPDATE market_meta SET ' + ', '.join(column + ' = ?' for column in meta_columns) + ' WHERE exchange = ? AND market = ?',
+                               [meta_fields[column] for column in meta_columns] + [exchange, market])
+            connection.commit()
+
+    def market_meta(self, exchange, market):
+        with self.lock:
+            row = self.cursor().execute('SELECT * FROM market_meta WHERE exchange = ? AND market = ?', (exchange, market)).fetchone()
+
+        return self.meta_row_doc(row) if row != None else None
+
+    def market_catalog(self, exchange=None):
+        query = 'SELECT * FROM market_meta'
+        parameters = []
+
+        if exchange != None:
+            query += ' WHERE exchange = ?'
+            parameters.append(exchange)
+
+        with self.lock:
+            rows = self.cursor().execute(query + ' ORDER BY exchange, market', parameters).fetchall()
+
+        return [self.meta_row_doc(row) for row in rows]
+
+    def delete_market_meta(self, exchange=None, market=None):
+        query = 'DELETE FROM market_meta WHERE 1 = 1'
+        parameters = []
+
+        if exchange != None:
+            query += ' AND exchange = ?'
+            parameters.append(exchange)
+        if market != None:
+            query += ' AND market = ?'
+            parameters.append(market)
+
+        with self.lock:
+            connection = self.cursor()
+
+            delete_result = connection.execute(query, parameters)
+            connection.commit()
+
+        return delete_result.rowcount
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class CompactEmbeddedStorage(EmbeddedStorage):
+    """
+    EmbeddedStorage with the compact trade schema (compact_schema.py)
+
+    Trades are (market key, t, id, p, q, b, k) integer rows in a WITHOUT ROWID table clustered by
+    market and trade time, so window scans read rows in order without index lookups. Each market's
+    identity and fixed-point scales are in the trade_headers table. Analysis, historical and
+    checkpoint tables are the same as EmbeddedStorage.
+
+    scale_source - Function of (exchange, market) returning (price tick, quantity step) strings for new markets
+    """
+
+    def __init__(self, path=':memory:', scale_source=None):
+        self.scale_source = scale_source
+
+        self.codecs = {}
+
+        EmbeddedStorage.__init__(self, path)
+
+    def connect(self):
+        EmbeddedStorage.connect(self)
+
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS trade_headers (
+                market_key INTEGER PRIMARY KEY, exchange TEXT NOT NULL, market TEXT NOT NULL,
+                trade_currency TEXT, quote_currency TEXT, price_tick TEXT NOT NULL, qty_step TEXT NOT NULL,
+                price_decimals INTEGER NOT NULL, qty_decimals INTEGER NOT NULL, created REAL,
+                UNIQUE (exchange, market));
+            CREATE TABLE IF NOT EXISTS trades_compact (
+                m INTEGER NOT NULL, t INTEGER NOT NULL, id INTEGER NOT NULL, p INTEGER NOT NULL, q INTEGER NOT NULL,
+                b INTEGER NOT NULL, k INTEGER NOT NULL, PRIMARY KEY (m, t, id)) WITHOUT ROWID;
+            CREATE UNIQUE INDEX IF NOT EXISTS trades_compact_id ON trades_compact (m, id);
+        """)
+
+    def market_codec(self, exchange, market, trade_doc=None):
+        """
+        Codec for a market's header, creating the header from trade_doc if the market is new (else None)
+        """
+
+        codec_key = (exchange, market)
+
+        if codec_key in self.codecs:
+            return self.codecs[codec_key]
+
+        header_query = ('SELECT market_key, exchange, market, trade_currency, quote_currency, price_tick, qty_step, '
+                        'price_decimals, qty_decimals, created FROM trade_headers WHERE exchange = ? AND market = ?')
+
+        with self.lock:
+            connection = self.cursor()
+
+            row = connection.execute(header_query, (exchange, market)).fetchone()
+
+            if row == None:
+                if trade_doc == None:
+                    return None
+
+                header = market_header(trade_doc, self.scale_source)
+
+                # Another process may create the same header first, so whichever was stored is used
+                connection.execute('INSERT OR IGNORE INTO trade_headers VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (header['exchange'], header['market'], header['trade_currency'], header['quote_currency'],
+                                    header['price_tick'], header['qty_step'], header['price_decimals'], header['qty_decimals'], header['created']))
+                connection.commit()
+
+                row = connection.execute(header_query, (exchange, market)).fetchone()
+
+                logger.info('Created compact schema header for ' + exchange + '-' + market + ' (price tick ' + row[5] +
+                            ', quantity step ' + row[6] + ').')
+
+        self.codecs[codec_key] = TradeCodec({'market_key': row[0], 'exchange': row[1], 'market': row[2], 'trade_currency': row[3],
+                                             'quote_currency': row[4], 'price_tick': row[5], 'qty_step': row[6],
+                                             'price_decimals': row[7], 'qty_decimals': row[8], 'created': row[9]})
+
+        return self.codecs[codec_key]
+
+    def compact_row_doc(self, codec, row):
+        return codec.decode({'_id': row[0], 't': row[1], 'p': row[2], 'q': row[3], 'b': row[4], 'k': row[5]})
+
+    def insert_trades(self, trade_docs):
+        insert_return = {'success': True, 'result': {'inserted': 0, 'duplicates': 0}}
+
+        try:
+            rows = []
+            for trade_doc in trade_docs:
+                codec = self.market_codec(trade_doc['exchange'], trade_doc['market'], trade_doc)
+
+                compact_doc = codec.encode(trade_doc)
+
+                rows.append((codec.header['market_key'], compact_doc['t'], compact_doc['_id'], compact_doc['p'], compact_doc['q'],
+                             compact_doc['b'], compact_doc.get('k', 0)))
+
+            with self.lock:
+                connection = self.cursor()
+
+                changes_before = connection.total_changes
+
+                connection.executemany('INSERT OR IGNORE INTO trades_compact VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                connection.commit()
+
+                insert_return['result']['inserted'] = connection.total_changes - changes_before
+
+            insert_return['result']['duplicates'] = len(rows) - insert_return['result']['inserted']
+
+        except Exception as e:
+            logger.exception(e)
+
+            insert_return['success'] = False
+
+        return insert_return
+
+    def query_trade(self, exchange, market, order):
+        codec = self.market_codec(exchange, market)
+
+        if codec == None:
+            return None
+
+        with self.lock:
+            row = self.cursor().execute('SELECT id, t, p, q, b, k FROM trades_compact WHERE m = ? ORDER BY id ' + order + ' LIMIT 1',
+                                        (codec.header['market_key'],)).fetchone()
+
+        return self.compact_row_doc(codec, row) if row != None else None
+
+    def trades_since(self, exchange, market, after_id=None, start_ms=None, limit=None):
+        codec = self.market_codec(exchange, market)
+
+        if codec == None:
+            return []
+
+        query = 'SELECT id, t, p, q, b, k FROM trades_compact WHERE m = ?'
+        parameters = [codec.header['market_key']]
+
+        if after_id != None:
+            query += ' AND id > ?'
+            parameters.append(after_id)
+        if start_ms != None:
+            query += ' AND t >= ?'
+            parameters.append(start_ms)
+
+        query += ' ORDER BY id'
+
+        if limit != None:
+            query += ' LIMIT ?'
+            parameters.append(limit)
+
+        with self.lock:
+            rows = self.cursor().execute(query, parameters).fetchall()
+
+        return [self.compact_row_doc(codec, row) for row in rows]
+
+    def trade_markets(self):
+        with self.lock:
+            rows = self.cursor().execute('SELECT exchange, market FROM trade_headers ORDER BY exchange, market').fetchall()
+
+        return [(row[0], row[1]) for row in rows]
+
+    def count_trades(self, exchange, market):
+        with self.lock:
+            row = self.cursor().execute('SELECT COUNT(*) FROM trades_compact WHERE m = '
+                                        '(SELECT market_key FROM trade_headers WHERE exchange = ? AND market = ?)', (exchange, market)).fetchone()
+
+        return row[0]
+
+    def window_aggregates(self, exchange, market, start_ms, end_ms=None):
+        codec = self.market_codec(exchange, market)
+
+        if codec == None:
+            return side_summary({})
+
+        # Integer sums are scaled once per side. TOTAL() is a float sum, since SUM() of p * q could overflow.
+        query = 'SELECT b, SUM(q), SUM(p), TOTAL(p * q), COUNT(*) FROM trades_compact WHERE m = ? AND t >= ?'
+        parameters = [codec.header['market_key'], start_ms]
+
+        if end_ms != None:
+            query += ' AND t < ?'
+            parameters.append(end_ms)
+
+        with self.lock:
+            rows = self.cursor().execute(query + ' GROUP BY b', parameters).fetchall()
+
+        side_sums = {}
+        for row in rows:
+            side_sums['buy' if row[0] else 'sell'] = {'volume': row[1] / codec.qty_scale, 'price_sum': row[2] / codec.price_scale,
+                                                      'amount': row[3] / (codec.price_scale * codec.qty_scale), 'count': row[4]}
+
+        return side_summary(side_sums)
+
+    def delete_before(self, before_ms):
+        delete_return = {'success': True, 'result': {'deleted_count': None}}
+
+        try:
+            deleted_count = 0
+
+            with self.lock:
+                connection = self.cursor()
+
+                # Per market, so each delete is a range of the clustered key
+                for (market_key,) in connection.execute('SELECT market_key FROM trade_headers').fetchall():
+                    deleted_count += connection.execute('DELETE FROM trades_compact WHERE m = ? AND t < ?', (market_key, before_ms)).rowcount
+
+                connection.commit()
+
+            delete_return['result']['deleted_count'] = deleted_count
+
+        except Exception as e:
+            logger.exception(e)
+
+            delete_return['success'] = False
+
+        return delete_return
+
+    def delete_market(self, exchange, market):
+        codec = self.market_codec(exchange, market)
+
+        if codec == None:
+            return 0
+
+        # Header is kept, so the market keeps its scales if trades are written again
+        with self.lock:
+            connection = self.cursor()
+
+            delete_result = connection.execute('DELETE FROM trades_compact WHERE m = ?', (codec.header['market_key'],))
+            connection.commit()
+
+        return delete_result.rowcount
+
+
+class ColumnarStorage(TradeStorage):
+    """
+    Trades in a ColumnarTradeStore, analysis and historical documents in another storage backend
+    """
+
+    def __init__(self, trade_store, document_storage):
+        self.trade_store = trade_store
+        self.document_storage = document_storage
+
+        self.shared_across_processes = document_storage.shared_across_processes
+
+    def insert_trades(self, trade_docs):
+        return self.trade_store.insert_trades(trade_docs)
+
+    def latest_trade(self, exchange, market):
+        return self.trade_store.latest_trade(exchange, market)
+
+    def first_trade(self, exchange, market):
+        return self.trade_store.first_trade(exchange, market)
+
+    def trades_since(self, exchange, market, after_id=None, start_ms=None, limit=None):
+        return self.trade_store.trades_since(exchange, market, after_id=after_id, start_ms=start_ms, limit=limit)
+
+    def trade_markets(self):
+        return self.trade_store.list_markets()
+
+    def window_aggregates(self, exchange, market, start_ms, end_ms=None):
+        from flow_engine import summarize_trades
+
+        range_columns = self.trade_store.read_range(exchange, market, start_ms, end_ms)
+
+        return summarize_trades(range_columns['price'], range_columns['quantity'], range_columns['side'] == 1)
+
+    def analyze(self, exchange, market, interval='1h', now_ms=None):
+        # Single range read covering both windows
+        return self.trade_store.analyze(exchange, market, interval=interval, now_ms=now_ms)
+
+    def delete_before(self, before_ms):
+        return self.trade_store.delete_before(int(before_ms))
+
+    def delete_market(self, exchange, market):
+        return self.trade_store.delete_market(exchange, market)
+
+    def upsert_analysis(self, analysis_document):
+        return self.document_storage.upsert_analysis(analysis_document)
+
+    def latest_analysis(self, exchange, market, interval):
+        return self.document_storage.latest_analysis(exchange, market, interval)
+
+    def analysis_catalog(self, exchange=None, market=None):
+        return self.document_storage.analysis_catalog(exchange, market)
+
+    def insert_historical(self, historical_document):
+        return self.document_storage.insert_historical(historical_document)
+
+    def historical_range(self, exchange, market=None, start=None, end=None):
+        return self.document_storage.historical_range(exchange, market, start, end)
+
+    def save_checkpoint(self, checkpoint):
+        return self.document_storage.save_checkpoint(checkpoint)
+
+    def load_checkpoints(self, exchange, market):
+        return self.document_storage.load_checkpoints(exchange, market)
+
+    def delete_checkpoints(self, exchange=None, market=None, before_ms=None):
+        return self.document_storage.delete_checkpoints(exchange, market, before_ms)
+
+    def push_recent_trades(self, exchange, market, trade_docs, keep):
+        return self.document_storage.push_recent_trades(exchange, market, trade_docs, keep)
+
+    def recent_trades(self, exchange, market, limit=None):
+        return self.document_storage.recent_trades(exchange, market, limit)
+
+    def delete_recent_trades(self, exchange=None, market=None):
+        return self.document_storage.delete_recent_trades(exchange, market)
+
+    def upsert_bars(self, bar_docs):
+        return self.document_storage.upsert_bars(bar_docs)
+
+    def load_bars(self, bar_ids):
+        return self.document_storage.load_bars(bar_ids)
+
+    def bar_range(self, exchange, market, resolution, start_ms, end_ms=None):
+        return self.document_storage.bar_range(exchange, market, resolution, start_ms, end_ms)
+
+    def delete_bars(self, exchange=None, market=None, before_ms=None):
+        return self.document_storage.delete_bars(exchange, market, before_ms)
+
+    def update_market_meta(self, exchange, market, first_id, first_time, last_id, last_time, trade_count):
+        return self.document_storage.update_market_meta(exchange, market, first_id, first_time, last_id, last_time, trade_count)
+
+    def set_market_meta(self, exchange, market, fields):
+        return self.document_storage.set_market_meta(exchange, market, fields)
+
+    def market_meta(self, exchange, market):
+        return self.document_storage.market_meta(exchange, market)
+
+    def market_catalog(self, exchange=None):
+        return self.document_storage.market_catalog(exchange)
+
+    def delete_market_meta(self, exchange=None, market=None):
+        return self.document_storage.delete_market_meta(exchange, market)
+
+    def close(self):
+        self.document_storage.close()
+
+
+def open_mongo_storage(config, collection_keys=('data', 'analysis', 'historical', 'candles', 'backfill', 'bars', 'recent', 'meta'), schema='full'):
+    from pymongo import MongoClient
+
+    mongo_uri = config['mongodb']['uri']
+
+    if mongo_uri == 'localhost':
+        mongo_uri = None
+
+    db = MongoClient(mongo_uri)[config['mongodb']['db']]
+
+    collections = {}
+    for collection_key in collection_keys:
+        if ('collection_' + collection_key) in config['mongodb']:
+            collections[collection_key] = config['mongodb']['collection_' + collection_key]
+
+    # Backfill checkpoint collection is optional in config.ini
+    if 'backfill' in collection_keys and 'backfill' not in collections:
+        collections['backfill'] = 'backfill'
+
+    # Flow bar collection is optional in config.ini
+    if 'bars' in collection_keys and 'bars' not in collections:
+        collections['bars'] = 'bars'
+
+    # Recent trade ring collection is optional in config.ini
+    if 'recent' in collection_keys and 'recent' not in collections:
+        collections['recent'] = 'recent_trades'
+
+    # Market metadata collection is optional in config.ini
+    if 'meta' in collection_keys and 'meta' not in collections:
+        collections['meta'] = 'market_meta'
+
+    if schema == 'compact':
+        return CompactMongoStorage(db, collections, scale_source=binance_symbol_scales)
+
+    elif schema == 'bucket':
+        return BucketMongoStorage(db, collections)
+
+    return MongoStorage(db, collections)
+
+
+def open_storage(config, backend=None, schema=None):
+    """
+    Create storage backend from config.ini
+
+    [storage]
+    backend = mongo | embedded | columnar
+    schema = full | compact | bucket  (trade documents: compact_schema.py for mongo/embedded, per-minute buckets for mongo)
+    path = data/trades              (columnar trade file directory)
+    embedded_path = data/flowmeter.db  (SQLite file, or :memory:)
+    documents = mongo | embedded    (where columnar backend keeps analysis/historical documents)
+    """
+
+    if backend == None:
+        backend = config.get('storage', 'backend', fallback='mongo')
+
+    if schema == None:
+        schema = config.get('storage', 'schema', fallback='full')
+
+    if schema not in ['full', 'compact', 'bucket']:
+        raise ValueError('Unrecognized trade schema: ' + schema)
+
+    if schema == 'bucket' and backend != 'mongo':
+        raise ValueError('Bucket trade schema requires the mongo storage backend.')
+
+    logger.debug('Opening ' + backend + ' storage backend (' + schema + ' trade schema).')
+
+    if backend == 'mongo':
+        return open_mongo_storage(config, schema=schema)
+
+    elif backend == 'embedded':
+        if schema == 'compact':
+            return CompactEmbeddedStorage(config.get('storage', 'embedded_path', fallback='data/flowmeter.db'), scale_source=binance_symbol_scales)
+
+        return EmbeddedStorage(config.get('storage', 'embedded_path', fallback='data/flowmeter.db'))
+
+    elif backend == 'columnar':
+        from trade_store import ColumnarTradeStore
+
+        return ColumnarStorage(ColumnarTradeStore(config.get('storage', 'path', fallback='data/trades')),
+                               open_storage(config, backend=config.get('storage', 'documents', fallback='mongo'), schema='full'))
+
+    else:
+        raise ValueError('Unrecognized storage backend: ' + backend)
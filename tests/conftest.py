@@ -0,0 +1,61 @@
+import os
+import random
+import sys
+import time
+
+import pytest
+
+# Modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def trade_doc(exchange, market, trade_id, trade_time, price, quantity, side):
+    return {'_id': trade_id, 'type': 'aggTrade', 'exchange': exchange, 'market': market,
+            'trade_currency': market[:-4], 'quote_currency': market[-4:],
+            'price': price, 'quantity': quantity, 'trade_time': trade_time, 'side': side}
+
+
+@pytest.fixture
+def now_ms():
+    # Whole seconds, same as analyze() / analyze_all() when now_ms isn't given
+    return int(time.time()) * 1000
+
+
+@pytest.fixture
+def make_trades():
+    """
+    Function of (market, count, end_ms, span_ms, first_id=1, seed=0) returning time-ordered trade documents
+    with prices/quantities on a 0.01 / 0.001 grid (exact in every trade schema)
+    """
+
+    def make(market, count, end_ms, span_ms, first_id=1, seed=0, exchange='binance'):
+        generator = random.Random(seed)
+
+        trade_times = sorted(generator.randint(end_ms - span_ms, end_ms - 1) for x in range(count))
+
+        return [trade_doc(exchange, market, first_id + x, trade_times[x],
+                          generator.randint(100000, 200000) / 100,
+                          generator.randint(1, 50000) / 1000,
+                          'buy' if generator.random() < 0.55 else 'sell')
+                for x in range(count)]
+
+    return make
+
+
+def assert_results_match(result, expected, rel=1e-9):
+    """
+    Compare analyze() style return values, floats within rel
+    """
+
+    if isinstance(expected, dict):
+        assert isinstance(result, dict)
+        assert set(result.keys()) == set(expected.keys())
+
+        for key in expected:
+            assert_results_match(result[key], expected[key], rel=rel)
+
+    elif isinstance(expected, float) and isinstance(result, float):
+        assert result == pytest.approx(expected, rel=rel, abs=1e-12)
+
+    else:
+        assert result == expected
@@ -0,0 +1,149 @@
+import mongomock
+import pytest
+
+from analysis_pool import ShardedAnalysisPool, trade_doc_columns
+from conftest import assert_results_match
+from flow_engine import RollingWindowEngine
+from storage import MongoStorage
+
+intervals = ['1m', '5m', '15m', '1h']
+markets = ['BTCUSDT', 'ETHUSDT', 'XLMUSDT']
+
+
+@pytest.fixture
+def mongo_storage():
+    return MongoStorage(mongomock.MongoClient()['flowmeter_test'], {'data': 'data', 'meta': 'market_meta'})
+
+
+def reference_results(trade_docs, now_ms):
+    engine = RollingWindowEngine()
+
+    for trade_doc in trade_docs:
+        engine.add_trade_doc(trade_doc)
+
+    return engine.analyze_all(intervals, now_ms=now_ms, markets=[('binance', market) for market in markets])
+
+
+def test_trade_doc_columns_accepts_storage_results(mongo_storage, make_trades, now_ms):
+    mongo_storage.insert_trades(make_trades('BTCUSDT', 20, now_ms, 60000))
+
+    columns = trade_doc_columns(mongo_storage.trades_since('binance', 'BTCUSDT'))
+
+    assert len(columns['trade_id']) == 20
+
+
+def test_resync_push_analyze_mongo(mongo_storage, make_trades, now_ms):
+    stored_docs = []
+    live_docs = []
+    for x in range(len(markets)):
+        market_docs = make_trades(markets[x], 300, now_ms - 60000, 3 * 3600000, first_id=(x * 100000) + 1, seed=x)
+        stored_docs += market_docs
+
+        # Written after the backfill finished, so only pushed
+        live_docs += make_trades(markets[x], 40, now_ms, 60000 - 1, first_id=(x * 100000) + 1001, seed=x + 10)
+
+    mongo_storage.insert_trades(stored_docs)
+
+    pool = ShardedAnalysisPool([('binance', market) for market in markets], intervals, workers=2)
+    pool.start()
+
+    try:
+        # Same order as MarketDaemon.analysis_tick()
+        for market in markets:
+            pool.resync('binance', market, storage=mongo_storage)
+
+        pool.push(live_docs)
+
+        pool_results = pool.analyze(now_ms=now_ms)
+
+        assert pool_results[('binance', 'BTCUSDT')]['1h']['result']['current']['count']['all'] > 0
+        assert_results_match(pool_results, reference_results(stored_docs + live_docs, now_ms))
+
+        # Nothing left over from the resync, the next tick still works
+        assert_results_match(pool.analyze(now_ms=now_ms), reference_results(stored_docs + live_docs, now_ms))
+
+    finally:
+        pool.stop()
+
+
+def test_forwarded_trades_across_ticks(make_trades, now_ms):
+    from storage import EmbeddedStorage
+
+    embedded_storage = EmbeddedStorage()
+
+    market_docs = {}
+    for x in range(len(markets)):
+        market_docs[markets[x]] = make_trades(markets[x], 600, now_ms, 3 * 3600000, first_id=(x * 100000) + 1, seed=x)
+
+    # First two thirds of each market are stored before the pool starts, the rest arrives over three ticks
+    stored_docs = [trade_doc for market in markets for trade_doc in market_docs[market][:400]]
+    embedded_storage.insert_trades(stored_docs)
+
+    reference = RollingWindowEngine()
+    for trade_doc in stored_docs:
+        reference.add_trade_doc(trade_doc)
+
+    pool = ShardedAnalysisPool([('binance', market) for market in markets], intervals, workers=2)
+    pool.start()
+
+    try:
+        for market in markets:
+            pool.resync('binance', market, storage=embedded_storage)
+
+        for tick in range(3):
+            tick_docs = [trade_doc for market in markets for trade_doc in market_docs[market][400 + (tick * 70):400 + ((tick + 1) * 70)]]
+
+            pool.push(tick_docs)
+            for trade_doc in tick_docs:
+                reference.add_trade_doc(trade_doc)
+
+            if tick == 1:
+                pool.prune(now_ms - 2 * 3600000)
+                reference.prune(now_ms - 2 * 3600000)
+
+            assert_results_match(pool.analyze(now_ms=now_ms),
+                                 reference.analyze_all(intervals, now_ms=now_ms, markets=[('binance', market) for market in markets]))
+
+        pool_stats = pool.get_stats()
+
+        assert sum(shard_stats['markets'] for shard_stats in pool_stats) == len(markets)
+        assert sum(shard_stats['held'] for shard_stats in pool_stats) == sum(len(reference.series('binance', market)) for market in markets)
+
+    finally:
+        pool.stop()
+
+
+def test_columnar_store_workers(tmp_path, make_trades, now_ms):
+    from storage import ColumnarStorage, EmbeddedStorage
+    from trade_store import ColumnarTradeStore
+
+    columnar_storage = ColumnarStorage(ColumnarTradeStore(str(tmp_path)), EmbeddedStorage())
+
+    market_docs = {}
+    for x in range(len(markets)):
+        market_docs[markets[x]] = make_trades(markets[x], 500, now_ms, 3 * 3600000, first_id=(x * 100000) + 1, seed=x)
+
+    first_docs = [trade_doc for market in markets for trade_doc in market_docs[market][:300]]
+    later_docs = [trade_doc for market in markets for trade_doc in market_docs[market][300:]]
+
+    columnar_storage.insert_trades(first_docs)
+
+    pool = ShardedAnalysisPool([('binance', market) for market in markets], intervals, workers=2, store_path=str(tmp_path))
+    pool.start()
+
+    try:
+        for market in markets:
+            pool.resync('binance', market, storage=columnar_storage)
+
+        # Ignored, workers read the store
+        pool.push(first_docs)
+
+        assert_results_match(pool.analyze(now_ms=now_ms), reference_results(first_docs, now_ms))
+
+        # Workers pick up newly written trades on the next tick
+        columnar_storage.insert_trades(later_docs)
+
+        assert_results_match(pool.analyze(now_ms=now_ms), reference_results(first_docs + later_docs, now_ms))
+
+    finally:
+        pool.stop()
@@ -0,0 +1,80 @@
+import pytest
+
+from compact_schema import TradeCodec, default_step, market_header, step_decimals
+from conftest import trade_doc
+
+
+def codec_for(price_tick, qty_step):
+    return TradeCodec(market_header(trade_doc('binance', 'BTCUSDT', 1, 0, 1.0, 1.0, 'buy'), scale_source=lambda exchange, market: (price_tick, qty_step)))
+
+
+def test_step_decimals():
+    assert step_decimals('0.00010000') == 4
+    assert step_decimals('0.01000000') == 2
+    assert step_decimals('1.00000000') == 0
+    assert step_decimals('10') == 0
+    assert step_decimals(default_step) == 8
+
+
+@pytest.mark.parametrize('price_tick, qty_step, prices, quantities', [
+    # Smallest and largest multiples of the tick/step, and values just around whole units
+    ('0.01000000', '0.00001000', [0.01, 0.99, 1.0, 1.01, 69999.99, 123456.78], [0.00001, 0.99999, 1.0, 1.00001, 9000.12345]),
+    ('0.00000001', '1.00000000', [0.00000001, 0.00000099, 0.12345678, 1.00000001], [1.0, 2.0, 123456789.0]),
+    ('1.00000000', '0.00000001', [1.0, 2.0, 1000000.0], [0.00000001, 0.5, 12.34567891])
+])
+def test_round_trip_at_tick_boundaries(price_tick, qty_step, prices, quantities):
+    codec = codec_for(price_tick, qty_step)
+
+    trade_id = 0
+    for price in prices:
+        for quantity in quantities:
+            for side in ['buy', 'sell']:
+                trade_id += 1
+
+                original_doc = trade_doc('binance', 'BTCUSDT', trade_id, 1700000000000 + trade_id, price, quantity, side)
+
+                compact_doc = codec.encode(original_doc)
+
+                assert isinstance(compact_doc['p'], int) and isinstance(compact_doc['q'], int)
+
+                decoded_doc = codec.decode(compact_doc)
+
+                for field in ['_id', 'type', 'exchange', 'market', 'trade_currency', 'quote_currency', 'price', 'quantity', 'trade_time', 'side']:
+                    assert decoded_doc[field] == original_doc[field]
+
+    assert codec.lossy_count == 0
+
+
+def test_trade_type_codes():
+    codec = codec_for('0.01', '0.001')
+
+    for trade_type in ['aggTrade', 'populate', 'refill']:
+        original_doc = dict(trade_doc('binance', 'BTCUSDT', 1, 0, 1.0, 1.0, 'buy'), type=trade_type)
+
+        compact_doc = codec.encode(original_doc)
+
+        # aggTrade is the default and left out of compact documents
+        assert ('k' in compact_doc) == (trade_type != 'aggTrade')
+        assert codec.decode(compact_doc)['type'] == trade_type
+
+
+def test_values_finer_than_tick_are_rounded():
+    codec = codec_for('0.01000000', '0.00100000')
+
+    compact_doc = codec.encode(trade_doc('binance', 'BTCUSDT', 1, 0, 100.005001, 0.0015001, 'buy'))
+
+    assert codec.lossy_count == 1
+    assert compact_doc['p'] == 10001
+    assert compact_doc['q'] == 2
+    assert codec.decode(compact_doc)['price'] == 100.01
+
+
+def test_header_falls_back_to_default_step():
+    def failing_source(exchange, market):
+        raise OSError('exchangeInfo unavailable')
+
+    header = market_header(trade_doc('binance', 'BTCUSDT', 1, 0, 1.0, 1.0, 'buy'), scale_source=failing_source)
+
+    assert header['price_tick'] == default_step and header['qty_step'] == default_step
+    assert header['price_decimals'] == 8 and header['qty_decimals'] == 8
+    assert header['trade_currency'] == 'BTC' and header['quote_currency'] == 'USDT'
@@ -0,0 +1,148 @@
+import pytest
+
+from conftest import assert_results_match
+from flow_engine import RollingWindowEngine, interval_to_ms
+
+hour_ms = 3600000
+
+
+def engine_with(trades):
+    """
+    trades - (trade_id, trade_time, price, quantity, side)
+    """
+
+    engine = RollingWindowEngine()
+
+    for trade_id, trade_time, price, quantity, side in trades:
+        engine.add_trade('binance', 'BTCUSDT', trade_id, trade_time, price, quantity, side)
+
+    return engine
+
+
+def test_interval_to_ms():
+    assert interval_to_ms('30s') == 30000
+    assert interval_to_ms('15m') == 900000
+    assert interval_to_ms('3h') == 3 * hour_ms
+    assert interval_to_ms('1d') == 24 * hour_ms
+
+    for interval in ['', 'h', '5y']:
+        with pytest.raises(ValueError):
+            interval_to_ms(interval)
+
+
+def test_window_edges(now_ms):
+    start = now_ms - hour_ms
+    start_last = start - hour_ms
+
+    engine = engine_with([(1, start_last - 1, 10.0, 1.0, 'buy'),  # before the last window
+                          (2, start_last, 10.0, 2.0, 'buy'),      # first ms of the last window
+                          (3, start - 1, 20.0, 4.0, 'sell'),      # last ms of the last window
+                          (4, start, 30.0, 8.0, 'buy'),           # first ms of the current window
+                          (5, now_ms, 40.0, 16.0, 'sell'),
+                          (6, now_ms + 5000, 50.0, 32.0, 'buy')])  # current window is open-ended
+
+    analysis_result = engine.analyze('binance', 'BTCUSDT', '1h', now_ms=now_ms)['result']
+
+    assert analysis_result['last']['count'] == {'all': 2, 'buy': 1, 'sell': 1}
+    assert analysis_result['last']['volume']['all'] == 6.0
+    assert analysis_result['last']['price']['all'] == 15.0
+
+    assert analysis_result['current']['count'] == {'all': 3, 'buy': 2, 'sell': 1}
+    assert analysis_result['current']['volume']['all'] == 56.0
+    assert analysis_result['current']['amount']['buy'] == (30.0 * 8.0) + (50.0 * 32.0)
+    assert analysis_result['current']['rate_count']['all'] == 3 / 3600
+
+    assert analysis_result['difference']['count']['all'] == {'absolute': 1, 'percent': 0.5}
+    assert analysis_result['current']['flow_differential'] == pytest.approx(40.0 / 56.0 * 100)
+
+
+def test_empty_market(now_ms):
+    analyze_return = RollingWindowEngine().analyze('binance', 'BTCUSDT', '1h', now_ms=now_ms)
+
+    # Same as analyze_data(): no flow differential without trades
+    assert analyze_return['success'] == False
+
+    for window in ['current', 'last']:
+        assert analyze_return['result'][window]['count'] == {'all': None, 'buy': None, 'sell': None}
+        assert analyze_return['result'][window]['flow_differential'] == None
+
+
+def test_empty_current_window(now_ms):
+    engine = engine_with([(1, now_ms - hour_ms - 10, 10.0, 1.0, 'buy'),
+                          (2, now_ms - hour_ms - 5, 10.0, 1.0, 'sell')])
+
+    analysis_result = engine.analyze('binance', 'BTCUSDT', '1h', now_ms=now_ms)['result']
+
+    # Like the analyze_data() pipelines, a side is only reported when both windows have trades
+    assert analysis_result['current']['count'] == {'all': None, 'buy': None, 'sell': None}
+    assert analysis_result['last']['count'] == {'all': None, 'buy': None, 'sell': None}
+    assert analysis_result['difference']['count']['all'] == {'absolute': None, 'percent': None}
+
+
+def test_one_sided_windows(now_ms):
+    engine = engine_with([(1, now_ms - hour_ms - 10, 10.0, 1.0, 'buy'),
+                          (2, now_ms - 10, 10.0, 3.0, 'buy')])
+
+    analyze_return = engine.analyze('binance', 'BTCUSDT', '1h', now_ms=now_ms)
+
+    # Sell side is empty in both windows, so only its values are missing
+    assert analyze_return['result']['current']['count'] == {'all': 1, 'buy': 1, 'sell': None}
+    assert analyze_return['result']['current']['flow_differential'] == 100.0
+    assert analyze_return['result']['difference']['volume']['buy'] == {'absolute': 2.0, 'percent': 2.0}
+
+
+def test_analyze_all_matches_analyze(make_trades, now_ms):
+    engine = RollingWindowEngine()
+
+    for market in ['BTCUSDT', 'ETHUSDT']:
+        for trade_doc in make_trades(market, 2000, now_ms, 6 * hour_ms, seed=len(market)):
+            engine.add_trade_doc(trade_doc)
+
+    intervals = ['1m', '5m', '30m', '1h', '3h']
+
+    analyze_all_results = engine.analyze_all(intervals, now_ms=now_ms)
+
+    assert set(analyze_all_results.keys()) == {('binance', 'BTCUSDT'), ('binance', 'ETHUSDT')}
+
+    for market_key in analyze_all_results:
+        for interval in intervals:
+            assert_results_match(analyze_all_results[market_key][interval], engine.analyze(market_key[0], market_key[1], interval, now_ms=now_ms))
+
+
+def test_out_of_order_and_repeated_trades(make_trades, now_ms):
+    trade_docs = make_trades('BTCUSDT', 500, now_ms, 3 * hour_ms)
+
+    in_order = RollingWindowEngine()
+    for trade_doc in trade_docs:
+        in_order.add_trade_doc(trade_doc)
+
+    # Live trades first, then backfill of older trades overlapping them
+    shuffled = RollingWindowEngine()
+    for trade_doc in trade_docs[300:] + trade_docs[:350]:
+        shuffled.add_trade_doc(trade_doc)
+
+    assert len(shuffled.series('binance', 'BTCUSDT')) == 550
+    assert_results_match(shuffled.analyze('binance', 'BTCUSDT', '1h', now_ms=now_ms), in_order.analyze('binance', 'BTCUSDT', '1h', now_ms=now_ms))
+
+    # Duplicates are dropped once arrays are consolidated
+    shuffled.series('binance', 'BTCUSDT').consolidate()
+
+    assert len(shuffled.series('binance', 'BTCUSDT')) == 500
+
+
+def test_prune_keeps_windows(make_trades, now_ms):
+    trade_docs = make_trades('BTCUSDT', 1000, now_ms, 4 * hour_ms)
+
+    pruned = RollingWindowEngine()
+    for trade_doc in trade_docs:
+        pruned.add_trade_doc(trade_doc)
+
+    pruned_count = pruned.prune(now_ms - 2 * hour_ms)
+
+    fresh = RollingWindowEngine()
+    for trade_doc in trade_docs:
+        if trade_doc['trade_time'] >= now_ms - 2 * hour_ms:
+            fresh.add_trade_doc(trade_doc)
+
+    assert pruned_count == 1000 - len(fresh.series('binance', 'BTCUSDT'))
+    assert_results_match(pruned.analyze('binance', 'BTCUSDT', '1h', now_ms=now_ms), fresh.analyze('binance', 'BTCUSDT', '1h', now_ms=now_ms))
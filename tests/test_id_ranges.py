@@ -0,0 +1,131 @@
+import threading
+
+from backfill import LiveMerge
+from id_ranges import IdRangeSet
+
+
+def test_add_in_order_extends_last_range():
+    id_ranges = IdRangeSet()
+
+    for trade_id in range(10, 20):
+        assert id_ranges.add(trade_id) == True
+
+    assert id_ranges.ranges() == [(10, 19)]
+    assert id_ranges.count() == 10
+
+    # Repeats report False and change nothing
+    assert id_ranges.add(10) == False
+    assert id_ranges.add(19) == False
+    assert id_ranges.ranges() == [(10, 19)]
+
+
+def test_add_merges_adjacent_ranges():
+    id_ranges = IdRangeSet([(1, 3), (5, 7)])
+
+    assert id_ranges.gaps() == [(4, 4)]
+
+    # Filling the one-id gap joins both neighbours
+    assert id_ranges.add(4) == True
+    assert id_ranges.ranges() == [(1, 7)]
+    assert id_ranges.gaps() == []
+
+    # Below the first range, adjacent and not adjacent
+    assert id_ranges.add(0) == True
+    assert id_ranges.add(-5) == True
+    assert id_ranges.ranges() == [(-5, -5), (0, 7)]
+
+
+def test_add_range_overlaps():
+    id_ranges = IdRangeSet([(10, 20), (30, 40), (50, 60)])
+
+    # Spans several ranges and the gaps between them
+    id_ranges.add_range(15, 55)
+    assert id_ranges.ranges() == [(10, 60)]
+
+    # Contained in an existing range
+    id_ranges.add_range(12, 18)
+    assert id_ranges.ranges() == [(10, 60)]
+
+    # Adjacent on both ends
+    id_ranges.add_range(61, 70)
+    id_ranges.add_range(0, 9)
+    assert id_ranges.ranges() == [(0, 70)]
+
+    # Empty range is ignored
+    id_ranges.add_range(100, 99)
+    assert id_ranges.ranges() == [(0, 70)]
+
+
+def test_contains_at_range_edges():
+    id_ranges = IdRangeSet([(10, 20), (30, 40)])
+
+    for trade_id in [10, 20, 30, 40]:
+        assert trade_id in id_ranges
+
+    for trade_id in [9, 21, 29, 41]:
+        assert trade_id not in id_ranges
+
+    assert 0 not in IdRangeSet()
+
+
+def test_remove_below():
+    id_ranges = IdRangeSet([(10, 20), (30, 40)])
+
+    id_ranges.remove_below(15)
+    assert id_ranges.ranges() == [(15, 20), (30, 40)]
+
+    id_ranges.remove_below(25)
+    assert id_ranges.ranges() == [(30, 40)]
+
+    id_ranges.remove_below(41)
+    assert id_ranges.ranges() == []
+    assert id_ranges.first() == None
+    assert id_ranges.last() == None
+
+
+def test_from_ids():
+    id_ranges = IdRangeSet.from_ids([7, 3, 4, 4, 5, 10, 11, 3])
+
+    assert id_ranges.ranges() == [(3, 5), (7, 7), (10, 11)]
+    assert id_ranges.count() == 6
+    assert id_ranges.gaps() == [(6, 6), (8, 9)]
+
+    assert IdRangeSet.from_ids([]).ranges() == []
+
+
+def test_live_merge_claims():
+    live_merge = LiveMerge()
+
+    assert live_merge.claim_live({'_id': 100, 'trade_time': 5000}) == True
+    assert live_merge.wait_first_live(timeout=0) == 100
+    assert live_merge.first_live_time == 5000
+
+    # Backfill reaching the live trade loses the claim, later live trades keep the first live id
+    assert live_merge.claim(99) == True
+    assert live_merge.claim(100) == False
+    assert live_merge.claim_live({'_id': 101, 'trade_time': 5001}) == True
+    assert live_merge.first_live_id == 100
+
+    assert live_merge.duplicates == 1
+    assert live_merge.claimed.ranges() == [(99, 101)]
+
+
+def test_live_merge_claims_each_id_once_across_threads():
+    live_merge = LiveMerge()
+
+    claimed_counts = [0, 0, 0, 0]
+
+    def claim_all(thread_index):
+        for trade_id in range(5000):
+            if live_merge.claim(trade_id) == True:
+                claimed_counts[thread_index] += 1
+
+    threads = [threading.Thread(target=claim_all, args=(thread_index,)) for thread_index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(claimed_counts) == 5000
+    assert live_merge.duplicates == 3 * 5000
+    assert live_merge.claimed.ranges() == [(0, 4999)]
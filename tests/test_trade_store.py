@@ -0,0 +1,89 @@
+import calendar
+
+import numpy as np
+
+from trade_store import ColumnarTradeStore
+
+# 2024-03-01 00:00:00 UTC, trades are spread across the day boundary
+midnight_ms = calendar.timegm((2024, 3, 1, 0, 0, 0)) * 1000
+
+
+def store_with_trades(tmp_path, make_trades):
+    trade_store = ColumnarTradeStore(str(tmp_path))
+
+    trade_docs = make_trades('BTCUSDT', 1000, midnight_ms + 3600000, 2 * 3600000)
+
+    # Written in three batches, the middle one out of order (ex. gap refill)
+    trade_store.insert_trades(trade_docs[:400])
+    trade_store.insert_trades(trade_docs[700:])
+    trade_store.insert_trades(trade_docs[400:700])
+
+    return trade_store, trade_docs
+
+
+def test_day_files_and_coverage(tmp_path, make_trades):
+    trade_store, trade_docs = store_with_trades(tmp_path, make_trades)
+
+    assert trade_store.market_days('binance', 'BTCUSDT') == ['20240229', '20240301']
+    assert trade_store.list_markets() == [('binance', 'BTCUSDT')]
+
+    assert trade_store.insert_trades(trade_docs[100:200])['result'] == {'inserted': 0, 'duplicates': 100}
+
+    # Coverage rebuilt from the files matches what was written
+    assert ColumnarTradeStore(str(tmp_path)).market_coverage('binance', 'BTCUSDT').ranges() == [(1, 1000)]
+
+
+def test_read_range_in_time_order(tmp_path, make_trades):
+    trade_store, trade_docs = store_with_trades(tmp_path, make_trades)
+
+    start_ms = midnight_ms - 1800000
+    end_ms = midnight_ms + 1800000
+
+    range_columns = trade_store.read_range('binance', 'BTCUSDT', start_ms, end_ms)
+
+    expected_docs = [trade_doc for trade_doc in trade_docs if start_ms <= trade_doc['trade_time'] < end_ms]
+
+    assert list(range_columns['trade_id']) == [trade_doc['_id'] for trade_doc in expected_docs]
+    assert np.all(np.diff(range_columns['trade_time']) >= 0)
+    assert list(range_columns['side'] == 1) == [trade_doc['side'] == 'buy' for trade_doc in expected_docs]
+
+
+def test_trades_since_pages_across_days(tmp_path, make_trades):
+    trade_store, trade_docs = store_with_trades(tmp_path, make_trades)
+
+    paged_ids = []
+    after_id = None
+
+    while True:
+        page = trade_store.trades_since('binance', 'BTCUSDT', after_id=after_id, limit=130)
+
+        if len(page) == 0:
+            break
+
+        paged_ids += [trade_doc['_id'] for trade_doc in page]
+        after_id = page[-1]['_id']
+
+    assert paged_ids == [trade_doc['_id'] for trade_doc in trade_docs]
+
+    start_docs = trade_store.trades_since('binance', 'BTCUSDT', start_ms=midnight_ms)
+
+    assert [trade_doc['_id'] for trade_doc in start_docs] == [trade_doc['_id'] for trade_doc in trade_docs if trade_doc['trade_time'] >= midnight_ms]
+    assert trade_store.latest_trade('binance', 'BTCUSDT')['_id'] == 1000
+    assert trade_store.first_trade('binance', 'BTCUSDT')['_id'] == 1
+
+
+def test_delete_before(tmp_path, make_trades):
+    trade_store, trade_docs = store_with_trades(tmp_path, make_trades)
+
+    before_ms = midnight_ms + 1800000
+
+    delete_result = trade_store.delete_before(before_ms)
+
+    remaining_docs = [trade_doc for trade_doc in trade_docs if trade_doc['trade_time'] >= before_ms]
+
+    assert delete_result['result']['deleted_count'] == len(trade_docs) - len(remaining_docs)
+    assert trade_store.market_days('binance', 'BTCUSDT') == ['20240301']
+    assert [trade_doc['_id'] for trade_doc in trade_store.trades_since('binance', 'BTCUSDT')] == [trade_doc['_id'] for trade_doc in remaining_docs]
+
+    # Deleted trades can be written again
+    assert trade_store.insert_trades(trade_docs[:10])['result']['inserted'] == 10
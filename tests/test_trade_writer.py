@@ -0,0 +1,101 @@
+import threading
+import time
+
+from storage import EmbeddedStorage
+from trade_writer import TradeWriter
+
+
+class GatedStorage(EmbeddedStorage):
+    """
+    EmbeddedStorage whose inserts wait for a gate and record the writing thread
+    """
+
+    def __init__(self):
+        EmbeddedStorage.__init__(self)
+
+        self.gate = threading.Event()
+        self.insert_started = threading.Event()
+        self.insert_threads = []
+
+    def insert_trades(self, trade_docs):
+        self.insert_threads.append(threading.current_thread().name)
+        self.insert_started.set()
+
+        # Bounded so a regression fails instead of hanging the suite
+        self.gate.wait(10)
+
+        return EmbeddedStorage.insert_trades(self, trade_docs)
+
+
+class PartialFailureStorage(EmbeddedStorage):
+    """
+    EmbeddedStorage that stores all but the last trade of a batch and reports the batch as failed (ex. unordered insert_many)
+    """
+
+    def insert_trades(self, trade_docs):
+        insert_result = EmbeddedStorage.insert_trades(self, trade_docs[:-1])
+
+        return {'success': False, 'result': insert_result['result']}
+
+
+def test_stop_flushes_queue(make_trades, now_ms):
+    storage = EmbeddedStorage()
+
+    trade_writer = TradeWriter(storage, batch_size=50, flush_interval=0.05, stats_interval=None, writer_label='test_stop')
+    trade_writer.start()
+
+    for trade_doc in make_trades('BTCUSDT', 120, now_ms, 60000):
+        trade_writer.submit(trade_doc)
+
+    trade_writer.stop()
+
+    assert trade_writer.get_stats()['inserted'] == 120
+    assert len(storage.trades_since('binance', 'BTCUSDT')) == 120
+
+
+def test_stop_leaves_queue_to_busy_writer(make_trades, now_ms):
+    storage = GatedStorage()
+
+    trade_writer = TradeWriter(storage, batch_size=10, flush_interval=0.01, stats_interval=None, writer_label='test_busy')
+    trade_writer.start()
+
+    trade_docs = make_trades('BTCUSDT', 30, now_ms, 60000)
+
+    for trade_doc in trade_docs:
+        trade_writer.submit(trade_doc)
+
+    assert storage.insert_started.wait(5) == True
+
+    trade_writer.stop(timeout=0.1)
+
+    # Writer is still blocked in its first batch, so nothing was flushed from this thread
+    assert storage.insert_threads == [trade_writer.name]
+    assert trade_writer.trade_queue.qsize() == 20
+
+    # Writer finishes the queue on its own once storage responds
+    storage.gate.set()
+    trade_writer.join(5)
+
+    assert trade_writer.is_alive() == False
+    assert set(storage.insert_threads) == {trade_writer.name}
+    assert len(storage.trades_since('binance', 'BTCUSDT')) == 30
+
+
+def test_partly_failed_batch_records_written(make_trades, now_ms):
+    storage = PartialFailureStorage()
+
+    written_batches = []
+    failed_batches = []
+
+    trade_writer = TradeWriter(storage, stats_interval=None, writer_label='test_partial',
+                               failure_callback=failed_batches.append, written_callback=written_batches.append)
+
+    flush_result = trade_writer.flush_batch(make_trades('BTCUSDT', 5, now_ms, 60000))
+
+    assert flush_result['success'] == False
+    assert flush_result['result'] == {'inserted': 4, 'duplicates': 0, 'errors': 1}
+
+    # Failed batch goes to the gap tracker and the stored trades still reach metadata and the tape
+    assert len(failed_batches) == 1
+    assert len(written_batches) == 1
+    assert storage.market_meta('binance', 'BTCUSDT')['trade_count'] == 4
@@ -0,0 +1,430 @@
+import datetime
+import logging
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from flow_engine import compile_analysis_result, interval_to_ms, summarize_trades
+from id_ranges import IdRangeSet
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+trade_columns = [('trade_id', 'i8'), ('trade_time', 'i8'), ('price', 'f8'), ('quantity', 'f8'), ('side', 'i1')]
+
+
+def day_key(trade_time):
+    return datetime.datetime.fromtimestamp(trade_time / 1000, datetime.timezone.utc).strftime('%Y%m%d')
+
+
+class ColumnarTradeStore:
+    """
+    Append-only columnar aggTrade storage
+
+    Each market/day gets one raw binary file per column under <root>/<exchange>/<market>/<YYYYMMDD>/,
+    read back through np.memmap. Exchange, market and currency names live only in the directory
+    path, and range reads of a single day are zero-copy slices of the mapped files.
+
+    side column: 1 = buy, 0 = sell
+    """
+
+    def __init__(self, root_path):
+        self.root_path = root_path
+
+        os.makedirs(self.root_path, exist_ok=True)
+
+        self.write_lock = threading.Lock()
+
+        # (exchange, market) -> IdRangeSet of stored aggregate trade ids
+        self.coverage = {}
+
+        # (day path, row count, column) -> whether the column is sorted
+        self.sorted_cache = {}
+
+    def market_path(self, exchange, market):
+        return os.path.join(self.root_path, exchange, market)
+
+    def market_days(self, exchange, market):
+        market_path = self.market_path(exchange, market)
+
+        if not os.path.isdir(market_path):
+            return []
+
+        return sorted(day for day in os.listdir(market_path) if day.isdigit())
+
+    def list_markets(self):
+        markets = []
+
+        for exchange in sorted(os.listdir(self.root_path)):
+            if os.path.isdir(os.path.join(self.root_path, exchange)):
+                for market in sorted(os.listdir(os.path.join(self.root_path, exchange))):
+                    markets.append((exchange, market))
+
+        return markets
+
+    def day_rows(self, day_path):
+        rows = None
+
+        for column, dtype in trade_columns:
+            column_path = os.path.join(day_path, column + '.bin')
+
+            if not os.path.exists(column_path):
+                return 0
+
+            column_rows = os.path.getsize(column_path) // np.dtype(dtype).itemsize
+
+            # Columns are appended one after another, so a partially written row is ignored until complete
+            if rows == None or column_rows < rows:
+                rows = column_rows
+
+        return rows
+
+    def map_day(self, exchange, market, day):
+        """
+        Memory-map every column of one market/day as read-only arrays
+        """
+
+        day_path = os.path.join(self.market_path(exchange, market), day)
+
+        rows = self.day_rows(day_path)
+
+        day_columns = {}
+
+        for column, dtype in trade_columns:
+            if rows == 0:
+                day_columns[column] = np.zeros(0, dtype=dtype)
+            else:
+                day_columns[column] = np.memmap(os.path.join(day_path, column + '.bin'), dtype=dtype, mode='r', shape=(rows,))
+
+        return day_columns
+
+    def column_sorted(self, exchange, market, day, day_columns, column):
+        values = day_columns[column]
+
+        sorted_key = (os.path.join(self.market_path(exchange, market), day), len(values), column)
+
+        if sorted_key not in self.sorted_cache:
+            self.sorted_cache[sorted_key] = bool(len(values) < 2 or np.all(np.diff(values) >= 0))
+
+        return self.sorted_cache[sorted_key]
+
+    def market_coverage(self, exchange, market):
+        market_key = (exchange, market)
+
+        if market_key not in self.coverage:
+            ranges = []
+
+            for day in self.market_days(exchange, market):
+                trade_id = np.unique(self.map_day(exchange, market, day)['trade_id'])
+
+                if len(trade_id) > 0:
+                    breaks = np.nonzero(np.diff(trade_id) != 1)[0]
+                    firsts = np.concatenate(([trade_id[0]], trade_id[breaks + 1]))
+                    lasts = np.concatenate((trade_id[breaks], [trade_id[-1]]))
+                    ranges.extend(zip(firsts.tolist(), lasts.tolist()))
+
+            self.coverage[market_key] = IdRangeSet(ranges)
+
+        return self.coverage[market_key]
+
+    def insert_trades(self, trade_docs):
+        """
+        Append trade documents (same fields as the Mongo data collection). Trades already stored are skipped.
+        """
+
+        insert_return = {'success': True, 'result': {'inserted': 0, 'duplicates': 0}}
+
+        try:
+            with self.write_lock:
+                day_batches = {}
+
+                for trade_doc in trade_docs:
+                    coverage = self.market_coverage(trade_doc['exchange'], trade_doc['market'])
+
+                    if coverage.add(int(trade_doc['_id'])) == False:
+                        insert_return['result']['duplicates'] += 1
+                        continue
+
+                    batch_key = (trade_doc['exchange'], trade_doc['market'], day_key(trade_doc['trade_time']))
+
+                    if batch_key not in day_batches:
+                        day_batches[batch_key] = []
+
+                    day_batches[batch_key].append(trade_doc)
+
+                for (exchange, market, day), batch in day_batches.items():
+                    day_path = os.path.join(self.market_path(exchange, market), day)
+
+                    os.makedirs(day_path, exist_ok=True)
+
+                    column_values = {
+                        'trade_id': [trade_doc['_id'] for trade_doc in batch],
+                        'trade_time': [trade_doc['trade_time'] for trade_doc in batch],
+                        'price': [trade_doc['price'] for trade_doc in batch],
+                        'quantity': [trade_doc['quantity'] for trade_doc in batch],
+                        'side': [1 if trade_doc['side'] == 'buy' else 0 for trade_doc in batch]
+                    }
+
+                    for column, dtype in trade_columns:
+                        with open(os.path.join(day_path, column + '.bin'), 'ab') as column_file:
+                            column_file.write(np.array(column_values[column], dtype=dtype).tobytes())
+
+                    insert_return['result']['inserted'] += len(batch)
+
+        except Exception as e:
+            logger.exception(e)
+
+            insert_return['success'] = False
+
+        finally:
+            return insert_return
+
+    def insert_trade(self, trade_doc):
+        """
+        Returns False if trade was already stored or could not be written
+        """
+
+        insert_result = self.insert_trades([trade_doc])
+
+        return insert_result['success'] == True and insert_result['result']['inserted'] == 1
+
+    def read_range(self, exchange, market, start_ms, end_ms=None):
+        """
+        Column arrays for trades with start_ms <= trade_time < end_ms, in time order
+
+        A range within one sorted day file is returned as memmap slices without copying.
+        """
+
+        day_first = day_key(start_ms)
+        day_last = day_key(end_ms - 1) if end_ms != None else None
+
+        day_slices = []
+
+        for day in self.market_days(exchange, market):
+            if day < day_first or (day_last != None and day > day_last):
+                continue
+
+            day_columns = self.map_day(exchange, market, day)
+
+            trade_time = day_columns['trade_time']
+
+            if self.column_sorted(exchange, market, day, day_columns, 'trade_time') == True:
+                i = int(np.searchsorted(trade_time, start_ms, side='left'))
+                j = len(trade_time) if end_ms == None else int(np.searchsorted(trade_time, end_ms, side='left'))
+
+                day_slices.append({column: day_columns[column][i:j] for column, dtype in trade_columns})
+
+            else:
+                # Out-of-order appends (ex. backfill after live data) need a sorting copy until compacted
+                mask = trade_time >= start_ms
+                if end_ms != None:
+                    mask &= trade_time < end_ms
+
+                order = np.argsort(trade_time[mask], kind='stable')
+
+                day_slices.append({column: np.asarray(day_columns[column])[mask][order] for column, dtype in trade_columns})
+
+        if len(day_slices) == 1:
+            return day_slices[0]
+
+        range_columns = {}
+        for column, dtype in trade_columns:
+            if len(day_slices) == 0:
+                range_columns[column] = np.zeros(0, dtype=dtype)
+            else:
+                range_columns[column] = np.concatenate([day_slice[column] for day_slice in day_slices])
+
+        return range_columns
+
+    def trades_since(self, exchange, market, after_id=None, start_ms=None, limit=None):
+        """
+        Trade documents in id order with trade_id > after_id and trade_time >= start_ms, at most limit
+
+        Aggregate ids grow with trade time, so days are read in order and each sorted day file is
+        entered with searchsorted. Documents are only built for the returned rows.
+        """
+
+        trade_docs = []
+
+        day_first = day_key(start_ms) if start_ms != None else None
+
+        for day in self.market_days(exchange, market):
+            if day_first != None and day < day_first:
+                continue
+
+            day_columns = self.map_day(exchange, market, day)
+
+            trade_id = day_columns['trade_id']
+            trade_time = day_columns['trade_time']
+
+            if self.column_sorted(exchange, market, day, day_columns, 'trade_id') == True and \
+                    self.column_sorted(exchange, market, day, day_columns, 'trade_time') == True:
+                i = 0
+                if after_id != None:
+                    i = max(i, int(np.searchsorted(trade_id, after_id, side='right')))
+                if start_ms != None:
+                    i = max(i, int(np.searchsorted(trade_time, start_ms, side='left')))
+
+                rows = np.arange(i, len(trade_id))
+
+            else:
+                # Out-of-order appends (ex. backfill after live data) are ordered by id until compacted
+                mask = np.ones(len(trade_id), dtype=bool)
+                if after_id != None:
+                    mask &= trade_id > after_id
+                if start_ms != None:
+                    mask &= trade_time >= start_ms
+
+                rows = np.nonzero(mask)[0]
+                rows = rows[np.argsort(trade_id[rows], kind='stable')]
+
+            if limit != None:
+                rows = rows[:(limit - len(trade_docs))]
+
+            trade_docs.extend(self.trade_doc(exchange, market, day_columns, int(row)) for row in rows)
+
+            if limit != None and len(trade_docs) >= limit:
+                break
+
+        return trade_docs
+
+    def trade_doc(self, exchange, market, day_columns, index):
+        return {
+            '_id': int(day_columns['trade_id'][index]),
+            'exchange': exchange,
+            'market': market,
+            'price': float(day_columns['price'][index]),
+            'quantity': float(day_columns['quantity'][index]),
+            'trade_time': int(day_columns['trade_time'][index]),
+            'side': 'buy' if day_columns['side'][index] == 1 else 'sell'
+        }
+
+    def latest_trade(self, exchange, market):
+        for day in reversed(self.market_days(exchange, market)):
+            day_columns = self.map_day(exchange, market, day)
+
+            if len(day_columns['trade_id']) > 0:
+                return self.trade_doc(exchange, market, day_columns, int(np.argmax(day_columns['trade_id'])))
+
+        return None
+
+    def first_trade(self, exchange, market):
+        for day in self.market_days(exchange, market):
+            day_columns = self.map_day(exchange, market, day)
+
+            if len(day_columns['trade_id']) > 0:
+                return self.trade_doc(exchange, market, day_columns, int(np.argmin(day_columns['trade_id'])))
+
+        return None
+
+    def compact_day(self, exchange, market, day, before_ms=None):
+        """
+        Rewrite one day sorted by time with duplicates removed, dropping trades older than before_ms
+        """
+
+        day_path = os.path.join(self.market_path(exchange, market), day)
+
+        day_columns = {column: np.array(values) for column, values in self.map_day(exchange, market, day).items()}
+
+        unique_id, unique_index = np.unique(day_columns['trade_id'], return_index=True)
+        keep = unique_index[np.argsort(day_columns['trade_time'][unique_index], kind='stable')]
+
+        if before_ms != None:
+            keep = keep[day_columns['trade_time'][keep] >= before_ms]
+
+        removed_count = len(day_columns['trade_id']) - len(keep)
+
+        for column, dtype in trade_columns:
+            temp_path = os.path.join(day_path, column + '.tmp')
+
+            with open(temp_path, 'wb') as column_file:
+                column_file.write(day_columns[column][keep].astype(dtype).tobytes())
+
+            os.replace(temp_path, os.path.join(day_path, column + '.bin'))
+
+        return removed_count
+
+    def delete_before(self, before_ms, exchange=None, market=None):
+        delete_return = {'success': True, 'result': {'deleted_count': 0}}
+
+        try:
+            with self.write_lock:
+                before_day = day_key(before_ms)
+
+                for store_exchange, store_market in self.list_markets():
+                    if (exchange != None and store_exchange != exchange) or (market != None and store_market != market):
+                        continue
+
+                    for day in self.market_days(store_exchange, store_market):
+                        if day < before_day:
+                            delete_return['result']['deleted_count'] += self.day_rows(os.path.join(self.market_path(store_exchange, store_market), day))
+
+                            shutil.rmtree(os.path.join(self.market_path(store_exchange, store_market), day))
+
+                        elif day == before_day:
+                            delete_return['result']['deleted_count'] += self.compact_day(store_exchange, store_market, day, before_ms=before_ms)
+
+                    # Coverage is rebuilt from remaining files on next access
+                    self.coverage.pop((store_exchange, store_market), None)
+
+        except Exception as e:
+            logger.exception(e)
+
+            delete_return['success'] = False
+
+        finally:
+            return delete_return
+
+    def delete_market(self, exchange, market):
+        with self.write_lock:
+            deleted_count = 0
+
+            for day in self.market_days(exchange, market):
+                deleted_count += self.day_rows(os.path.join(self.market_path(exchange, market), day))
+
+            shutil.rmtree(self.market_path(exchange, market), ignore_errors=True)
+
+            self.coverage.pop((exchange, market), None)
+
+        return deleted_count
+
+    def analyze(self, exchange, market, interval='1h', now_ms=None):
+        """
+        Same return value as FlowMeter.analyze_data(), computed from one range read of both windows
+        """
+
+        analyze_return = {'success': True, 'result': None}
+
+        try:
+            if now_ms == None:
+                now_ms = int(datetime.datetime.now().timestamp()) * 1000
+
+            analysis_delta = interval_to_ms(interval)
+
+            analysis_start = now_ms - analysis_delta
+            analysis_start_last = analysis_start - analysis_delta
+
+            range_columns = self.read_range(exchange, market, analysis_start_last)
+
+            split = int(np.searchsorted(range_columns['trade_time'], analysis_start, side='left'))
+
+            price = range_columns['price']
+            quantity = range_columns['quantity']
+            is_buy = range_columns['side'] == 1
+
+            window_metrics = {
+                'current': summarize_trades(price[split:], quantity[split:], is_buy[split:]),
+                'last': summarize_trades(price[:split], quantity[:split], is_buy[:split])
+            }
+
+            analyze_return = compile_analysis_result(window_metrics, analysis_delta)
+
+        except Exception as e:
+            logger.exception(e)
+
+            analyze_return['success'] = False
+
+        return analyze_return
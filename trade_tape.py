@@ -0,0 +1,88 @@
+import collections
+import logging
+import threading
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class TradeTape:
+    """
+    Latest trade and a ring of the last size trades per market, kept from written trade batches
+
+    Writers call add_trades() after each batch reaches storage. Trades newer than the market's
+    latest go into its in-memory ring and are pushed to the storage ring (push_recent_trades()),
+    so GUIs read the latest trade or a time-and-sales list by market instead of sorting the trade
+    collection. Older ids (refills, backfill overlap) are left out, which keeps each ring in id order.
+
+    size - Trades kept per market
+    """
+
+    def __init__(self, storage, size=100):
+        self.storage = storage
+        self.size = size
+
+        # (exchange, market) -> deque of trade documents, oldest first
+        self.rings = {}
+
+        self.lock = threading.Lock()
+
+    def add_trades(self, trade_docs):
+        """
+        Returns number of trades added to the rings
+        """
+
+        market_docs = {}
+
+        with self.lock:
+            for trade_doc in sorted(trade_docs, key=lambda trade_doc: trade_doc['_id']):
+                market_key = (trade_doc['exchange'], trade_doc['market'])
+
+                if market_key not in self.rings:
+                    self.rings[market_key] = collections.deque(maxlen=self.size)
+
+                ring = self.rings[market_key]
+
+                if len(ring) > 0 and trade_doc['_id'] <= ring[-1]['_id']:
+                    continue
+
+                ring.append(trade_doc)
+
+                market_docs.setdefault(market_key, []).append(trade_doc)
+
+        added = 0
+
+        for (exchange, market), new_docs in market_docs.items():
+            try:
+                self.storage.push_recent_trades(exchange, market, new_docs[-self.size:], self.size)
+
+            except Exception as e:
+                # Trades are already stored, only the ring falls behind until the next batch
+                logger.warning('Unable to update ' + exchange + '-' + market + ' recent trades (' + str(e) + ').')
+
+            added += len(new_docs)
+
+        return added
+
+    def latest(self, exchange, market):
+        with self.lock:
+            ring = self.rings.get((exchange, market))
+
+            if ring == None or len(ring) == 0:
+                return None
+
+            return ring[-1]
+
+    def recent(self, exchange, market, limit=None):
+        """
+        Last limit trades (Default: whole ring), oldest first
+        """
+
+        with self.lock:
+            ring = list(self.rings.get((exchange, market), []))
+
+        if limit != None:
+            ring = ring[-limit:]
+
+        return ring
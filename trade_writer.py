@@ -0,0 +1,253 @@
+import logging
+import queue
+import threading
+import time
+
+import metrics
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Shared by every batch writer (TradeWriter, asyncio runtime, daemon shards), labeled by writer
+write_batch_seconds = metrics.histogram('flowmeter_write_batch_seconds', 'Time to write one trade batch to storage.', ['writer'])
+write_batch_trades = metrics.histogram('flowmeter_write_batch_trades', 'Trades per written batch.', ['writer'],
+                                       buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+trades_written = metrics.counter('flowmeter_trades_written_total', 'Trades inserted by batch writers.', ['writer'])
+write_errors = metrics.counter('flowmeter_write_errors_total', 'Trades that failed to write.', ['writer'])
+trades_dropped = metrics.counter('flowmeter_trades_dropped_total', 'Trades dropped because the write queue was full.', ['writer'])
+write_queue_depth = metrics.gauge('flowmeter_write_queue_depth', 'Trades waiting in write queues.', ['writer'])
+
+
+def observe_batch(writer_label, batch_size, latency, inserted, errors):
+    write_batch_seconds.labels(writer_label).observe(latency)
+    write_batch_trades.labels(writer_label).observe(batch_size)
+    trades_written.labels(writer_label).inc(inserted)
+
+    if errors > 0:
+        write_errors.labels(writer_label).inc(errors)
+
+
+class TradeWriter(threading.Thread):
+    """
+    Buffered trade document writer
+
+    Trade documents are placed on a bounded queue by submit() and written to storage with
+    insert_trades() batches whenever batch_size documents are waiting or
+    flush_interval seconds have passed since the first document of the batch was queued.
+    Batches that stored any trades also update their markets' metadata (storage.record_written()).
+
+    batch_size - Maximum number of documents per insert_trades() call
+    flush_interval - Maximum time (seconds) a queued document waits before being written
+    max_queue - Maximum number of queued documents before new documents are dropped
+    stats_interval - Time (seconds) between writer statistics log messages (None to disable)
+    writer_label - Writer label on the write metrics
+    failure_callback - Called with the documents of every batch that failed to write (ex. GapTracker.report_docs)
+    written_callback - Called with the documents of every batch that stored trades or had no errors (ex. TradeTape.add_trades)
+    """
+
+    def __init__(self, storage, batch_size=500, flush_interval=1.0, max_queue=100000, stats_interval=60, writer_label='threaded',
+                 failure_callback=None, written_callback=None):
+        threading.Thread.__init__(self)
+
+        self.daemon = True
+
+        self.storage = storage
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats_interval = stats_interval
+
+        self.trade_queue = queue.Queue(maxsize=max_queue)
+
+        self.writer_label = writer_label
+        self.failure_callback = failure_callback
+        self.written_callback = written_callback
+        self.dropped_metric = trades_dropped.labels(writer_label)
+
+        write_queue_depth.labels(writer_label).set_function(self.trade_queue.qsize)
+
+        self.stats_lock = threading.Lock()
+
+        self.stats = {
+            'submitted': 0,
+            'inserted': 0,
+            'duplicates': 0,
+            'dropped': 0,
+            'errors': 0,
+            'flushes': 0,
+            'flush_latency_last': None,
+            'flush_latency_max': None,
+            'flush_latency_total': 0.0
+        }
+
+        self.writer_active = False
+
+    def submit(self, trade_doc):
+        """
+        Queue trade document for writing. Returns False if the queue is full and the document was dropped.
+        """
+
+        try:
+            self.trade_queue.put_nowait(trade_doc)
+
+        except queue.Full:
+            with self.stats_lock:
+                self.stats['dropped'] += 1
+
+            self.dropped_metric.inc()
+
+            return False
+
+        with self.stats_lock:
+            self.stats['submitted'] += 1
+
+        return True
+
+    def run(self):
+        self.writer_active = True
+
+        logger.debug('Trade writer started.')
+
+        stats_last = time.time()
+
+        while self.writer_active == True or self.trade_queue.qsize() > 0:
+            batch = self.collect_batch()
+
+            if len(batch) > 0:
+                self.flush_batch(batch)
+
+            if self.stats_interval != None and (time.time() - stats_last) > self.stats_interval:
+                logger.info('Trade writer stats: ' + str(self.get_stats()))
+
+                stats_last = time.time()
+
+        logger.debug('Trade writer stopped.')
+
+    def collect_batch(self):
+        batch = []
+
+        try:
+            # Block briefly for first document so an idle writer doesn't spin
+            batch.append(self.trade_queue.get(timeout=self.flush_interval))
+
+        except queue.Empty:
+            return batch
+
+        flush_deadline = time.time() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            remaining = flush_deadline - time.time()
+
+            if remaining <= 0:
+                break
+
+            try:
+                batch.append(self.trade_queue.get(timeout=remaining))
+
+            except queue.Empty:
+                break
+
+        return batch
+
+    def flush_batch(self, batch):
+        flush_batch_return = {'success': True, 'result': {'inserted': 0, 'duplicates': 0, 'errors': 0}}
+
+        flush_start = time.time()
+
+        try:
+            # Storage skips duplicates (ex. unordered insert_many) and reports counts
+            insert_result = self.storage.insert_trades(batch)
+
+            flush_batch_return['result']['inserted'] = insert_result['result']['inserted']
+            flush_batch_return['result']['duplicates'] = insert_result['result']['duplicates']
+
+            if insert_result['success'] == False:
+                flush_batch_return['result']['errors'] = len(batch) - insert_result['result']['inserted'] - insert_result['result']['duplicates']
+
+                logger.error('Errors while writing trade batch: ' + str(flush_batch_return['result']['errors']))
+
+                flush_batch_return['success'] = False
+
+        except Exception as e:
+            logger.exception(e)
+
+            flush_batch_return['result']['errors'] = len(batch)
+
+            flush_batch_return['success'] = False
+
+        flush_latency = time.time() - flush_start
+
+        observe_batch(self.writer_label, len(batch), flush_latency, flush_batch_return['result']['inserted'], flush_batch_return['result']['errors'])
+
+        if flush_batch_return['result']['errors'] > 0 and self.failure_callback != None:
+            # Storage doesn't say which documents failed, so the whole batch is reported (refills skip stored ids)
+            self.failure_callback(batch)
+
+        if flush_batch_return['success'] == True or flush_batch_return['result']['inserted'] > 0:
+            # Trades stored by a partly failed batch count too, refills would only see them as duplicates
+            self.storage.record_written(batch, flush_batch_return['result']['inserted'])
+
+            if self.written_callback != None:
+                self.written_callback(batch)
+
+        with self.stats_lock:
+            self.stats['inserted'] += flush_batch_return['result']['inserted']
+            self.stats['duplicates'] += flush_batch_return['result']['duplicates']
+            self.stats['errors'] += flush_batch_return['result']['errors']
+            self.stats['flushes'] += 1
+            self.stats['flush_latency_last'] = flush_latency
+            if self.stats['flush_latency_max'] == None or flush_latency > self.stats['flush_latency_max']:
+                self.stats['flush_latency_max'] = flush_latency
+            self.stats['flush_latency_total'] += flush_latency
+
+        logger.debug('Flushed ' + str(len(batch)) + ' trades in ' + "{:.4f}".format(flush_latency) + ' sec.')
+
+        return flush_batch_return
+
+    def get_stats(self):
+        with self.stats_lock:
+            writer_stats = self.stats.copy()
+
+        writer_stats['queue_depth'] = self.trade_queue.qsize()
+
+        if writer_stats['flushes'] > 0:
+            writer_stats['flush_latency_avg'] = writer_stats['flush_latency_total'] / writer_stats['flushes']
+        else:
+            writer_stats['flush_latency_avg'] = None
+
+        return writer_stats
+
+    def stop(self, timeout=30):
+        """
+        Stop accepting work and flush everything still queued.
+
+        If the writer thread is still writing after timeout seconds, queued trades are left to it (logged) instead.
+        """
+
+        logger.info('Flushing trade writer queue. [' + str(self.trade_queue.qsize()) + ' queued]')
+
+        self.writer_active = False
+
+        if self.is_alive():
+            self.join(timeout)
+
+        if self.is_alive():
+            # Still inside flush_batch(), flushing here too would write to storage from two threads at once
+            logger.warning('Trade writer still busy after ' + str(timeout) + ' sec. Not flushing from this thread. [' +
+                           str(self.trade_queue.qsize()) + ' queued]')
+
+            return
+
+        # Writer thread never started (or already stopped), so flush any leftovers from the caller's thread
+        leftover = []
+        while True:
+            try:
+                leftover.append(self.trade_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        for x in range(0, len(leftover), self.batch_size):
+            self.flush_batch(leftover[x:(x + self.batch_size)])
+
+        logger.info('Trade writer final stats: ' + str(self.get_stats()))